@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+Throughput benchmark: continuous batching vs serial execution.
+
+Runs the same set of chat prompts twice on one loaded model:
+  1. serially, one completion after another (how requests are served without batching)
+  2. concurrently through a BatchScheduler with N sequence slots
+
+and prints aggregate generated tokens/sec for both.
+
+Usage:
+    python benchmark_batching.py                       # uses MODEL_PATH from .env
+    python benchmark_batching.py --model path/to/model.gguf --requests 16 --slots 8
+"""
+import argparse
+import os
+import sys
+import time
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+PROMPTS = [
+    "Explain what a hash table is.",
+    "Write a haiku about the ocean.",
+    "List three uses of Python.",
+    "What is the capital of France and why is it famous?",
+    "Describe how a bicycle works.",
+    "Give two tips for writing clean code.",
+    "What is photosynthesis?",
+    "Summarize the plot of Romeo and Juliet.",
+]
+
+
+def build_prompts(n: int) -> list[str]:
+    return [f"User: {PROMPTS[i % len(PROMPTS)]}\nAssistant:" for i in range(n)]
+
+
+def run_serial(model, prompts, max_tokens, temperature):
+    tokens = 0
+    start = time.perf_counter()
+    for prompt in prompts:
+        output = model(
+            prompt,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            top_p=0.9,
+            echo=False,
+            stop=["User:", "System:"],
+        )
+        tokens += output["usage"]["completion_tokens"]
+    return tokens, time.perf_counter() - start
+
+
+def run_batched(scheduler, prompts, max_tokens, temperature):
+    start = time.perf_counter()
+    futures = [
+        scheduler.submit(prompt, max_tokens, temperature, 0.9, ["User:", "System:"])
+        for prompt in prompts
+    ]
+    tokens = sum(f.result()["completion_tokens"] for f in futures)
+    return tokens, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", default=os.getenv("MODEL_PATH", ""), help="GGUF model (default: MODEL_PATH)")
+    parser.add_argument("--requests", type=int, default=8, help="number of concurrent requests")
+    parser.add_argument("--slots", type=int, default=max(int(os.getenv("BATCH_SLOTS", "1")), 4),
+                        help="batch sequence slots (default: BATCH_SLOTS, at least 4)")
+    parser.add_argument("--max-tokens", type=int, default=64)
+    parser.add_argument("--temperature", type=float, default=0.7)
+    args = parser.parse_args()
+
+    if not args.model or not os.path.exists(args.model):
+        print(f"Model not found: {args.model!r}. Set MODEL_PATH in .env or pass --model.")
+        sys.exit(1)
+
+    from server import BatchScheduler, load_model
+
+    model = load_model(args.model)
+    prompts = build_prompts(args.requests)
+    print(f"Model: {args.model}")
+    print(f"Requests: {args.requests}  max_tokens: {args.max_tokens}  slots: {args.slots}\n")
+
+    # Warm up so the first measured call does not pay one-time costs
+    model(prompts[0], max_tokens=4, echo=False)
+
+    serial_tokens, serial_s = run_serial(model, prompts, args.max_tokens, args.temperature)
+    scheduler = BatchScheduler(model, args.slots)
+    try:
+        batched_tokens, batched_s = run_batched(scheduler, prompts, args.max_tokens, args.temperature)
+        stats = scheduler.stats()
+    finally:
+        scheduler.close()
+
+    serial_tps = serial_tokens / serial_s if serial_s else 0.0
+    batched_tps = batched_tokens / batched_s if batched_s else 0.0
+    print(f"Serial:  {serial_tokens:5d} tokens in {serial_s:6.2f}s  -> {serial_tps:7.1f} tok/s")
+    print(f"Batched: {batched_tokens:5d} tokens in {batched_s:6.2f}s  -> {batched_tps:7.1f} tok/s")
+    print(f"  (avg {stats['avg_batch_tokens']} tokens per llama_decode over {stats['decode_steps']} steps)")
+    if serial_tps:
+        print(f"\nSpeedup: {batched_tps / serial_tps:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+Benchmark: loading the recent messages of a growing JSONL session file.
+
+Writes session files of increasing size (default 1 MB to 256 MB) into a
+temporary directory and times, for each, how long it takes to load the last
+N messages:
+  1. full read: read_text().splitlines() and keep the last N lines
+     (how load_recent_session_messages used to work)
+  2. tail read: the reverse block reader used by the JSONL session store
+
+The tail read should stay flat as the file grows; the full read grows linearly.
+
+It then fills a JsonlSessionStore with a growing number of sessions
+(default 100 to 10,000) and times loading one session's recent messages:
+  1. index parse: parse a sessions_index.json listing every session to find
+     the session's log, then tail read (how the store used to work)
+  2. load_recent: JsonlSessionStore.load_recent, which only reads the
+     session's own meta.json
+
+load_recent should stay flat as sessions are added. No model is needed.
+
+Usage:
+    python benchmark_session_reader.py
+    python benchmark_session_reader.py --sizes 1,16,128,512 --messages 40 --sessions 1000,50000
+"""
+import argparse
+import json
+import tempfile
+import time
+from pathlib import Path
+
+
+def write_session_file(path: Path, size_mb: int) -> int:
+    """Write chat events until the file reaches size_mb; return the line count."""
+    target = size_mb * 1024 * 1024
+    written = lines = 0
+    with open(path, "w", encoding="utf-8") as f:
+        while written < target:
+            role = "user" if lines % 2 == 0 else "assistant"
+            event = {
+                "role": role,
+                "content": f"message {lines} " + "lorem ipsum dolor sit amet " * 20,
+                "timestamp": "2025-01-01T00:00:00Z",
+            }
+            line = json.dumps(event, ensure_ascii=False) + "\n"
+            f.write(line)
+            written += len(line.encode("utf-8"))
+            lines += 1
+    return lines
+
+
+def full_read(path: Path, max_messages: int) -> list:
+    lines = path.read_text(encoding="utf-8").splitlines()
+    return [json.loads(line) for line in lines[-max_messages:] if line.strip()]
+
+
+def tail_read(path: Path, max_messages: int) -> list:
+    from server import _read_tail_lines
+
+    return [json.loads(line) for line in _read_tail_lines(path, max_messages) if line.strip()]
+
+
+def index_read(index_path: Path, log_path: Path, session_id: str, max_messages: int) -> list:
+    from server import _read_tail_lines
+
+    meta = json.loads(index_path.read_text(encoding="utf-8"))["sessions"][session_id]
+    lines = _read_tail_lines(log_path, max_messages, start=meta["log"]["offset"])
+    return [json.loads(line) for line in lines if line.strip()]
+
+
+def bench_session_count(counts: list, max_messages: int, repeat: int) -> None:
+    """Time loading one session's history as the number of stored sessions grows."""
+    from server import JsonlSessionStore, _new_session_meta
+
+    print(f"\nLoading the last {max_messages} messages of one session among many (best of {repeat})\n")
+    print(f"{'sessions':>9} {'index parse':>12} {'load_recent':>12} {'speedup':>9}")
+    with tempfile.TemporaryDirectory() as tmp:
+        store = JsonlSessionStore(Path(tmp), max_messages=0, max_bytes=1 << 30, auto_trim=False)
+        store.create("target", _new_session_meta())
+        for i in range(max_messages * 2):
+            store.append("target", {"role": "user", "content": f"message {i}", "timestamp": "2025-01-01T00:00:00Z"})
+        log_path = store.log_dir("target") / "000000.jsonl"
+        index_path = Path(tmp) / "old_index.json"
+        created = 1
+        for count in counts:
+            while created < count:
+                store.create(f"session-{created:06d}", _new_session_meta())
+                created += 1
+            # The single index older versions rewrote on every append
+            index_path.write_text(json.dumps({"sessions": store.list_sessions()}, indent=2), encoding="utf-8")
+            if index_read(index_path, log_path, "target", max_messages) != store.load_recent("target", max_messages):
+                raise SystemExit("load_recent returned different messages than the index read")
+            index_s = best_of(lambda: index_read(index_path, log_path, "target", max_messages), repeat)
+            store_s = best_of(lambda: store.load_recent("target", max_messages), repeat)
+            print(f"{count:>9} {index_s * 1000:>10.2f}ms {store_s * 1000:>10.3f}ms {index_s / store_s:>8.0f}x")
+        store.close()
+
+
+def best_of(fn, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="1,16,64,256", help="comma-separated file sizes in MB")
+    parser.add_argument("--messages", type=int, default=40, help="recent messages to load (SESSION_MAX_MESSAGES)")
+    parser.add_argument("--sessions", default="100,1000,10000", help="comma-separated numbers of stored sessions")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per measurement (best is reported)")
+    args = parser.parse_args()
+
+    sizes = [int(s) for s in args.sizes.split(",") if s.strip()]
+    print(f"Loading the last {args.messages} messages (best of {args.repeat})\n")
+    print(f"{'size':>8} {'lines':>10} {'full read':>12} {'tail read':>12} {'speedup':>9}")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / "session.jsonl"
+        for size_mb in sizes:
+            lines = write_session_file(path, size_mb)
+            if full_read(path, args.messages) != tail_read(path, args.messages):
+                raise SystemExit("tail read returned different messages than the full read")
+            full_s = best_of(lambda: full_read(path, args.messages), args.repeat)
+            tail_s = best_of(lambda: tail_read(path, args.messages), args.repeat)
+            print(
+                f"{size_mb:>6}MB {lines:>10} {full_s * 1000:>10.2f}ms {tail_s * 1000:>10.3f}ms "
+                f"{full_s / tail_s:>8.0f}x"
+            )
+
+    bench_session_count([int(s) for s in args.sessions.split(",") if s.strip()], args.messages, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
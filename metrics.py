@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+"""
+Prometheus metrics for the MCP servers and the web chat.
+
+A small dependency-free implementation of the Prometheus text exposition format
+(version 0.0.4): counters, gauges and histograms with fixed buckets, kept in a
+process-wide registry and rendered on demand by the /metrics endpoints.
+
+Observations are cheap (a bisect and a few additions under a lock) and are made
+once per request or completion, never per generated token.
+"""
+import bisect
+import math
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Bucket upper bounds (the +Inf bucket is implicit)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+TOKEN_BUCKETS = (1, 4, 16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192)
+RATE_BUCKETS = (0.5, 1, 2, 5, 10, 20, 35, 50, 75, 100, 150, 250, 500)
+LOAD_BUCKETS = (0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 40.0, 80.0, 160.0)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if value == int(value) and abs(value) < 1e15:
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    """Base for labelled metrics: name, help text and label names."""
+
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, Any]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+    def samples(self) -> Iterable[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    """Monotonically increasing count per label set."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: Any) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels: Any) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0.0)
+
+    def samples(self) -> Iterable[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+
+
+class Gauge(_Metric):
+    """Current value per label set; callback (if given) supplies {labels: value} at render time."""
+
+    kind = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        callback: Optional[Callable[[], Dict[Tuple[str, ...], float]]] = None,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self.callback = callback
+
+    def set(self, value: float, **labels: Any) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def clear(self) -> None:
+        with self._lock:
+            self._values.clear()
+
+    def samples(self) -> Iterable[str]:
+        if self.callback is not None:
+            try:
+                values = dict(self.callback())
+            except Exception:
+                values = {}
+        else:
+            with self._lock:
+                values = dict(self._values)
+        for key, value in sorted(values.items()):
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+
+
+class Histogram(_Metric):
+    """Distribution of observed values over fixed buckets, per label set."""
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # label key -> [per-bucket counts (last one is +Inf), sum, count]
+        self._series: Dict[Tuple[str, ...], List[Any]] = {}
+
+    def observe(self, value: float, **labels: Any) -> None:
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def snapshot(self, **labels: Any) -> Dict[str, Any]:
+        """Return {"count", "sum", "buckets": [(upper bound, cumulative count), ...]}."""
+        with self._lock:
+            series = self._series.get(self._key(labels))
+            counts, total, count = (list(series[0]), series[1], series[2]) if series else ([0] * (len(self.buckets) + 1), 0.0, 0)
+        cumulative, running = [], 0
+        for bound, n in zip(self.buckets + (math.inf,), counts):
+            running += n
+            cumulative.append((bound, running))
+        return {"count": count, "sum": total, "buckets": cumulative}
+
+    def samples(self) -> Iterable[str]:
+        with self._lock:
+            items = sorted((k, (list(s[0]), s[1], s[2])) for k, s in self._series.items())
+        for key, (counts, total, count) in items:
+            running = 0
+            for bound, n in zip(self.buckets + (math.inf,), counts):
+                running += n
+                labels = _format_labels(self.labelnames, key, f'le="{_format_value(bound)}"')
+                yield f"{self.name}_bucket{labels} {running}"
+            labels = _format_labels(self.labelnames, key)
+            yield f"{self.name}_sum{labels} {_format_value(total)}"
+            yield f"{self.name}_count{labels} {count}"
+
+
+class Registry:
+    """Named collection of metrics rendered together."""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: _Metric) -> Any:
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = (), callback=None) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames, callback))
+
+    def histogram(
+        self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS
+    ) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def get(self, name: str) -> Optional[_Metric]:
+        with self._lock:
+            return self._metrics.get(name)
+
+    def render(self) -> str:
+        """Return every metric in Prometheus text format."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "\n".join(m.render() for m in metrics) + "\n"
+
+
+REGISTRY = Registry()
+
+# --- Shared metric definitions ---
+
+TOOL_CALLS = REGISTRY.counter("llm_tool_calls_total", "MCP tool calls by tool and outcome.", ("tool", "status"))
+TOOL_DURATION = REGISTRY.histogram("llm_tool_duration_seconds", "MCP tool call latency.", ("tool",))
+HTTP_REQUESTS = REGISTRY.counter(
+    "llm_http_requests_total", "HTTP requests by method, endpoint and status.", ("method", "endpoint", "status")
+)
+HTTP_DURATION = REGISTRY.histogram(
+    "llm_http_request_duration_seconds", "HTTP request latency (until the response body is sent).", ("endpoint",)
+)
+QUEUE_WAIT = REGISTRY.histogram(
+    "llm_queue_wait_seconds", "Time a request waited for the model (inference queue, model lock or batch slot).", ("queue",)
+)
+TIME_TO_FIRST_TOKEN = REGISTRY.histogram(
+    "llm_time_to_first_token_seconds", "Time from the start of generation to the first generated token."
+)
+REQUEST_DURATION = REGISTRY.histogram(
+    "llm_request_duration_seconds", "Total completion latency (prompt processing and generation).", ("cached",)
+)
+PROMPT_EVAL = REGISTRY.histogram(
+    "llm_prompt_eval_seconds", "Prompt evaluation time per completion (tokens not reused from the KV cache)."
+)
+COMPLETIONS = REGISTRY.counter("llm_completions_total", "Finished completions by stop reason.", ("finish_reason",))
+PROMPT_TOKENS = REGISTRY.histogram("llm_prompt_tokens", "Prompt tokens per completion.", buckets=TOKEN_BUCKETS)
+COMPLETION_TOKENS = REGISTRY.histogram(
+    "llm_completion_tokens", "Generated tokens per completion.", buckets=TOKEN_BUCKETS
+)
+TOKENS_PER_SECOND = REGISTRY.histogram(
+    "llm_tokens_per_second", "Generation throughput per completion (completion tokens / duration).", buckets=RATE_BUCKETS
+)
+MODEL_LOAD = REGISTRY.histogram("llm_model_load_seconds", "Model load time.", buckets=LOAD_BUCKETS)
+MODEL_LOADED = REGISTRY.gauge("llm_model_loaded", "Models currently resident in memory (1 per loaded model).", ("model",))
+
+
+def observe_completion(
+    duration_s: float,
+    prompt_tokens: int,
+    completion_tokens: int,
+    ttft_s: Optional[float] = None,
+    cached: bool = False,
+    prompt_eval_s: Optional[float] = None,
+    finish_reason: Optional[str] = None,
+) -> None:
+    """Record one finished completion."""
+    REQUEST_DURATION.observe(duration_s, cached="true" if cached else "false")
+    COMPLETIONS.inc(finish_reason="cached" if cached else finish_reason or "unknown")
+    PROMPT_TOKENS.observe(prompt_tokens)
+    COMPLETION_TOKENS.observe(completion_tokens)
+    if ttft_s is not None:
+        TIME_TO_FIRST_TOKEN.observe(ttft_s)
+    if prompt_eval_s is not None:
+        PROMPT_EVAL.observe(prompt_eval_s)
+    if not cached and duration_s > 0 and completion_tokens:
+        TOKENS_PER_SECOND.observe(completion_tokens / duration_s)
+
+
+def set_loaded_models_source(callback: Callable[[], Iterable[str]]) -> None:
+    """Report loaded models by calling callback() (model names) at scrape time."""
+    MODEL_LOADED.callback = lambda: {(name,): 1 for name in callback()}
+
+
+def render() -> str:
+    return REGISTRY.render()
+
+
+# --- ASGI middleware ---
+
+
+class PrometheusMiddleware:
+    """Pure ASGI middleware counting and timing HTTP requests.
+
+    The endpoint label is the matched route template (e.g. /api/sessions/{session_id}/messages)
+    so per-id paths do not create new series; unmatched paths collapse to their first segment.
+    """
+
+    def __init__(self, app, skip: Sequence[str] = ("/metrics",)):
+        self.app = app
+        self.skip = set(skip)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope.get("path") in self.skip:
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status = {"code": 500}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            endpoint = self._endpoint(scope)
+            HTTP_REQUESTS.inc(method=scope.get("method", ""), endpoint=endpoint, status=status["code"])
+            HTTP_DURATION.observe(time.perf_counter() - start, endpoint=endpoint)
+
+    @staticmethod
+    def _endpoint(scope) -> str:
+        path = getattr(scope.get("route"), "path", None)  # set by FastAPI routing
+        if path:
+            return path
+        segment = scope.get("path", "/").strip("/").split("/", 1)[0]
+        return "/" + segment
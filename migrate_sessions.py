@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+"""
+Migrate session history from the JSONL layout to the SQLite session store.
+
+Reads every JSONL session in history/ (segmented logs with their meta.json,
+single-file history/<session_id>.jsonl from older versions, including files
+missing from the old sessions_index.json) and copies them into
+history/sessions.db. Sessions already in the database with the same ID are
+replaced, so the script can be re-run safely; the JSONL files are not touched.
+
+The server never migrates on its own: run this before switching to
+SESSION_BACKEND=sqlite.
+
+Usage:
+    python migrate_sessions.py
+    python migrate_sessions.py --history-dir path/to/history --db path/to/sessions.db
+"""
+import argparse
+import sys
+from pathlib import Path
+
+
+def main():
+    from server import HISTORY_DIR, SESSIONS_DB_PATH, SqliteSessionStore, migrate_jsonl_sessions
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--history-dir", type=Path, default=HISTORY_DIR, help="directory with the JSONL history")
+    parser.add_argument("--db", type=Path, default=SESSIONS_DB_PATH, help="target SQLite database")
+    args = parser.parse_args()
+
+    if not args.history_dir.is_dir():
+        print(f"History directory not found: {args.history_dir}")
+        sys.exit(1)
+
+    store = SqliteSessionStore(args.db, max_messages=0, max_bytes=0, auto_trim=False)
+    try:
+        counts = migrate_jsonl_sessions(args.history_dir, store)
+    finally:
+        store.close()
+    print(f"Migrated {counts['sessions']} sessions ({counts['messages']} messages) into {args.db}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+"""
+On-demand CPU profiling of individual requests.
+
+A request is profiled when PROFILE_REQUESTS is on, when a web chat call sends
+an X-Profile: 1 header, or when an MCP tool call passes "profile": true.
+profile_request() then runs cProfile on every thread that works on the
+request: the thread that started it, functions marked @profiled and work
+handed to other threads through bind(). When the request ends, the profiles
+are merged and written to PROFILE_DIR as <request_id>.prof (pstats format,
+for snakeviz, pstats or gprof2dot) plus <request_id>.json with the functions
+that took the most time themselves, and listed by list_profiles().
+
+Requests that are not profiled pay one context-variable lookup in @profiled
+and bind(); the profiler itself only runs for profiled requests.
+"""
+import contextvars
+import cProfile
+import functools
+import json
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+from dotenv import load_dotenv
+
+import tracing
+
+load_dotenv()
+
+BASE_DIR = Path(__file__).resolve().parent
+
+# Profile every request (otherwise only those asking for it)
+PROFILE_REQUESTS = os.getenv("PROFILE_REQUESTS", "false").lower() in {"1", "true", "yes", "on"}
+PROFILE_DIR = BASE_DIR / os.getenv("PROFILE_DIR", str(Path(os.getenv("SESSION_HISTORY_DIR", "history")) / "profiles"))
+# Profiles kept on disk (oldest are deleted first)
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", "50"))
+# Functions listed in each profile's summary
+PROFILE_TOP_FUNCTIONS = 25
+
+# Threads currently running a profiler, so two requests never fight over one thread
+_profiled_threads: set = set()
+_profiled_threads_lock = threading.Lock()
+
+
+class RequestProfile:
+    """cProfile runs of the threads that worked on one request."""
+
+    def __init__(self, request_id: str, name: str, source: str):
+        self.request_id = request_id
+        self.name = name
+        self.source = source
+        self.started_at = time.time()
+        self.duration_ms = 0.0
+        self.path: Optional[Path] = None
+        # Threads that could not be profiled because another profiler was active
+        self.skipped_threads = 0
+        self._profiles: List[cProfile.Profile] = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def thread(self) -> Iterator[None]:
+        """Profile the current thread while the block runs (unless it is already profiled)."""
+        ident = threading.get_ident()
+        with _profiled_threads_lock:
+            busy = ident in _profiled_threads
+            if not busy:
+                _profiled_threads.add(ident)
+        if busy:
+            yield
+            return
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Python 3.12+ allows one active cProfile per process (sys.monitoring):
+            # leave this thread out rather than fail the request
+            with _profiled_threads_lock:
+                _profiled_threads.discard(ident)
+            with self._lock:
+                self.skipped_threads += 1
+            yield
+            return
+        try:
+            yield
+        finally:
+            profile.disable()
+            with _profiled_threads_lock:
+                _profiled_threads.discard(ident)
+            with self._lock:
+                self._profiles.append(profile)
+
+    def save(self, directory: Optional[Path] = None) -> Optional[Path]:
+        """Merge the thread profiles and write <request_id>.prof and .json to directory (default PROFILE_DIR)."""
+        directory = directory or PROFILE_DIR
+        with self._lock:
+            profiles = list(self._profiles)
+        if not profiles:
+            return None
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+        # Hottest by own time: cumulative time always puts the request's entry point first
+        top = sorted(stats.stats.items(), key=lambda item: item[1][2], reverse=True)[:PROFILE_TOP_FUNCTIONS]
+        summary = {
+            "request_id": self.request_id,
+            "name": self.name,
+            "source": self.source,
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(self.started_at)),
+            "duration_ms": round(self.duration_ms, 2),
+            "threads": len(profiles),
+            "skipped_threads": self.skipped_threads,
+            "total_calls": stats.total_calls,
+            "top_functions": [
+                {
+                    "function": f"{Path(file).name}:{line}({func})",
+                    "calls": calls,
+                    "own_ms": round(own * 1000, 3),
+                    "cumulative_ms": round(cumulative * 1000, 3),
+                }
+                for (file, line, func), (_, calls, own, cumulative, _) in top
+            ],
+        }
+        directory.mkdir(parents=True, exist_ok=True)
+        path = directory / f"{self.request_id}.prof"
+        stats.dump_stats(str(path))
+        (directory / f"{self.request_id}.json").write_text(json.dumps(summary, indent=2), encoding="utf-8")
+        self.path = path
+        _prune(directory)
+        return path
+
+
+_active_profile: contextvars.ContextVar[Optional[RequestProfile]] = contextvars.ContextVar(
+    "active_profile", default=None
+)
+
+
+def requested(flag: Any = False) -> bool:
+    """True when a request should be profiled (flag: the request's own opt-in)."""
+    return PROFILE_REQUESTS or flag is True or str(flag).lower() in {"1", "true", "yes", "on"}
+
+
+@contextmanager
+def profile_request(
+    name: str,
+    source: str,
+    request_id: Optional[str] = None,
+    enabled: bool = True,
+    profile_thread: bool = True,
+) -> Iterator[Optional[RequestProfile]]:
+    """Profile the block as one request (yields None and does nothing unless enabled).
+
+    With profile_thread=False the current thread is left alone and only @profiled
+    functions and bind() hand-offs are profiled (for event loop threads shared
+    with other requests).
+    """
+    if not enabled:
+        yield None
+        return
+    profile = RequestProfile(request_id or uuid.uuid4().hex, name, source)
+    token = _active_profile.set(profile)
+    start = time.perf_counter()
+    try:
+        if profile_thread:
+            with profile.thread():
+                yield profile
+        else:
+            yield profile
+    finally:
+        _active_profile.reset(token)
+        profile.duration_ms = (time.perf_counter() - start) * 1000
+        try:
+            path = profile.save()
+            if path is not None:
+                print(f"Profile saved: {path}", file=sys.stderr)
+        except Exception as e:
+            print(f"Warning: could not save profile: {e}", file=sys.stderr)
+
+
+def profiled(func: Callable) -> Callable:
+    """Decorator: profile the call on its thread when it runs under a profiled request."""
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        profile = _active_profile.get()
+        if profile is None:
+            return func(*args, **kwargs)
+        with profile.thread():
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+def bind(func: Callable) -> Callable:
+    """Return func profiled as part of the current request, for handing work to another thread."""
+    profile = _active_profile.get()
+    if profile is None:
+        return func
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        token = _active_profile.set(profile)
+        try:
+            with profile.thread():
+                return func(*args, **kwargs)
+        finally:
+            _active_profile.reset(token)
+
+    return wrapper
+
+
+def _prune(directory: Path) -> None:
+    summaries = sorted(directory.glob("*.json"), key=lambda p: p.stat().st_mtime, reverse=True)
+    for old in summaries[max(0, PROFILE_KEEP):]:
+        old.unlink(missing_ok=True)
+        old.with_suffix(".prof").unlink(missing_ok=True)
+
+
+def _valid_id(request_id: str) -> bool:
+    return re.fullmatch(r"[0-9a-f]{32}", request_id) is not None
+
+
+def list_profiles(limit: int = 50, directory: Optional[Path] = None) -> List[Dict[str, Any]]:
+    """Saved profiles, newest first, with their hottest function."""
+    directory = directory or PROFILE_DIR
+    if not directory.exists():
+        return []
+    summaries = sorted(directory.glob("*.json"), key=lambda p: p.stat().st_mtime, reverse=True)
+    result = []
+    for path in summaries[:limit]:
+        try:
+            summary = json.loads(path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            continue
+        top = summary.pop("top_functions", [])
+        summary["top_function"] = top[0]["function"] if top else None
+        result.append(summary)
+    return result
+
+
+def get_profile(request_id: str, directory: Optional[Path] = None) -> Optional[Dict[str, Any]]:
+    """Return a saved profile's summary (None if there is none)."""
+    directory = directory or PROFILE_DIR
+    if not _valid_id(request_id):
+        return None
+    try:
+        return json.loads((directory / f"{request_id}.json").read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return None
+
+
+def profile_path(request_id: str, directory: Optional[Path] = None) -> Optional[Path]:
+    """Return the path of a saved .prof file (None if there is none)."""
+    directory = directory or PROFILE_DIR
+    if not _valid_id(request_id):
+        return None
+    path = directory / f"{request_id}.prof"
+    return path if path.exists() else None
+
+
+# --- ASGI middleware ---
+
+
+class ProfilingMiddleware:
+    """Pure ASGI middleware profiling the HTTP requests that send X-Profile: 1 (all with PROFILE_REQUESTS).
+
+    The event loop thread is shared by every request, so only @profiled endpoints
+    and bind() hand-offs are profiled. Profiled responses get an X-Profile-Id header.
+    """
+
+    def __init__(self, app, prefixes=("/api/",), skip=()):
+        self.app = app
+        self.prefixes = tuple(prefixes)
+        self.skip = tuple(skip)
+
+    async def __call__(self, scope, receive, send):
+        path = scope.get("path", "")
+        if scope["type"] != "http" or not path.startswith(self.prefixes) or path.startswith(self.skip):
+            await self.app(scope, receive, send)
+            return
+        header = next((v for k, v in scope.get("headers", []) if k == b"x-profile"), b"").decode("latin-1")
+        if not requested(header):
+            await self.app(scope, receive, send)
+            return
+
+        method = scope.get("method", "")
+        request_id = tracing.current_span().trace_id  # the trace id, when traced, doubles as profile id
+        with profile_request(f"{method} {path}", "web_chat", request_id=request_id, profile_thread=False) as profile:
+
+            async def send_wrapper(message):
+                if message["type"] == "http.response.start":
+                    headers = list(message.get("headers", []))
+                    headers.append((b"x-profile-id", profile.request_id.encode()))
+                    message = {**message, "headers": headers}
+                await send(message)
+
+            try:
+                await self.app(scope, receive, send_wrapper)
+            finally:
+                route = getattr(scope.get("route"), "path", None)
+                if route:
+                    profile.name = f"{method} {route}"
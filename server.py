@@ -3,18 +3,43 @@
 MCP server with Llama integration for local execution
 """
 import asyncio
+import atexit
+import base64
+import bisect
+import codecs
+import contextvars
+import gc
+import gzip
+import hashlib
 import json
 import os
+import queue
+import re
+import shutil
+import sqlite3
+import struct
 import sys
+import threading
+import time
 import uuid
-from datetime import datetime
+from collections import OrderedDict
+from concurrent.futures import Future
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 from pathlib import Path
-from typing import Any, Dict, List, Optional
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
 from dotenv import load_dotenv
 
+import metrics as prom
+import profiling
+import tracing
+
 try:
+    import llama_cpp
+    import numpy as np
     from llama_cpp import Llama
+    from llama_cpp.llama_speculative import LlamaDraftModel
 except ImportError:
     print("Error: llama-cpp-python is not installed.")
     print("Install with: pip install llama-cpp-python")
@@ -38,10 +63,59 @@ DEFAULT_CONTEXT_SIZE = int(os.getenv("CONTEXT_SIZE", "2048"))
 DEFAULT_N_THREADS = int(os.getenv("N_THREADS", "4"))
 DEFAULT_N_GPU_LAYERS = int(os.getenv("N_GPU_LAYERS", "0"))
 
+# Model pool: RAM budget (MB) for models kept resident at once. 0 = keep only one model
+DEFAULT_MODEL_POOL_MAX_MB = int(os.getenv("MODEL_POOL_MAX_MB", "0"))
+
+# Continuous batching: concurrent web chats share one model across this many
+# llama.cpp sequence slots (1 = disabled; each slot gets CONTEXT_SIZE tokens)
+DEFAULT_BATCH_SLOTS = int(os.getenv("BATCH_SLOTS", "1"))
+DEFAULT_BATCH_SIZE = int(os.getenv("BATCH_SIZE", "512"))
+
+# Speculative decoding: draft model per target model ("target.gguf=draft.gguf,...", files in
+# MODELS_DIR; "*" = any target). Empty disables it
+DEFAULT_SPECULATIVE_DRAFT_MODELS = os.getenv("SPECULATIVE_DRAFT_MODELS", "")
+DEFAULT_SPECULATIVE_DRAFT_TOKENS = int(os.getenv("SPECULATIVE_DRAFT_TOKENS", "4"))
+DEFAULT_SPECULATIVE_MIN_ACCEPTANCE = float(os.getenv("SPECULATIVE_MIN_ACCEPTANCE", "0.3"))
+
 # Session / history configuration
 DEFAULT_SESSION_HISTORY_DIR = os.getenv("SESSION_HISTORY_DIR", "history")
 DEFAULT_SESSION_MAX_MESSAGES = int(os.getenv("SESSION_MAX_MESSAGES", "40"))
 DEFAULT_SESSION_MAX_FILE_BYTES = int(os.getenv("SESSION_MAX_FILE_BYTES", str(2 * 1024 * 1024)))  # ~2MB
+# Session storage backend: "sqlite" (history/sessions.db) or "jsonl" (one file per session)
+DEFAULT_SESSION_BACKEND = os.getenv("SESSION_BACKEND", "jsonl").lower()
+# JSONL backend: size of each session log segment, and how often dead segments are compacted
+DEFAULT_SESSION_SEGMENT_BYTES = int(os.getenv("SESSION_SEGMENT_BYTES", str(256 * 1024)))
+DEFAULT_SESSION_COMPACT_INTERVAL_S = float(os.getenv("SESSION_COMPACT_INTERVAL_S", "30"))
+# In-memory session cache with write-behind persistence: appends are batched to the backend
+# by a background flusher at most SESSION_FLUSH_DELAY_MS after they are made. Off by default:
+# the cache is per process, so only one process may use the history when it is on
+DEFAULT_SESSION_WRITE_BEHIND = os.getenv("SESSION_WRITE_BEHIND", "false").lower() in {"1", "true", "yes", "on"}
+DEFAULT_SESSION_FLUSH_DELAY_MS = int(os.getenv("SESSION_FLUSH_DELAY_MS", "100"))
+DEFAULT_SESSION_CACHE_SESSIONS = int(os.getenv("SESSION_CACHE_SESSIONS", "256"))
+# fsync session writes (each group commit) instead of leaving it to the OS
+DEFAULT_SESSION_FSYNC = os.getenv("SESSION_FSYNC", "false").lower() in {"1", "true", "yes", "on"}
+# Cold-session archival: sessions closed (or idle) for longer than these many hours are moved
+# to compressed archives (0 disables either); checked every SESSION_ARCHIVE_INTERVAL_S
+DEFAULT_SESSION_ARCHIVE_CLOSED_AFTER_H = float(os.getenv("SESSION_ARCHIVE_CLOSED_AFTER_H", "24"))
+DEFAULT_SESSION_ARCHIVE_IDLE_AFTER_H = float(os.getenv("SESSION_ARCHIVE_IDLE_AFTER_H", "720"))
+DEFAULT_SESSION_ARCHIVE_INTERVAL_S = float(os.getenv("SESSION_ARCHIVE_INTERVAL_S", "600"))
+# Rolling summaries (optional): once the turns of a session not yet summarized exceed
+# SESSION_SUMMARY_TRIGGER_TOKENS, a background job folds all but the newest
+# SESSION_SUMMARY_KEEP_TOKENS of them into a summary of at most SESSION_SUMMARY_MAX_TOKENS
+DEFAULT_SESSION_SUMMARY_ENABLED = os.getenv("SESSION_SUMMARY_ENABLED", "false").lower() in {"1", "true", "yes", "on"}
+DEFAULT_SESSION_SUMMARY_TRIGGER_TOKENS = int(os.getenv("SESSION_SUMMARY_TRIGGER_TOKENS", "1024"))
+DEFAULT_SESSION_SUMMARY_KEEP_TOKENS = int(os.getenv("SESSION_SUMMARY_KEEP_TOKENS", "384"))
+DEFAULT_SESSION_SUMMARY_MAX_TOKENS = int(os.getenv("SESSION_SUMMARY_MAX_TOKENS", "192"))
+# Session garbage collection, every SESSION_GC_INTERVAL_S (0 disables): sessions unused for
+# SESSION_TTL_H hours are deleted (0 keeps them), the least recently used go once stored
+# history exceeds SESSION_QUOTA_MB (0 = no quota), and orphaned files are removed
+DEFAULT_SESSION_TTL_H = float(os.getenv("SESSION_TTL_H", "0"))
+DEFAULT_SESSION_QUOTA_MB = float(os.getenv("SESSION_QUOTA_MB", "0"))
+DEFAULT_SESSION_GC_INTERVAL_S = float(os.getenv("SESSION_GC_INTERVAL_S", "900"))
+# Full-text search over session messages (SQLite FTS5 index in history/search.db)
+DEFAULT_SESSION_SEARCH_ENABLED = os.getenv("SESSION_SEARCH_ENABLED", "true").lower() in {"1", "true", "yes", "on"}
+# Tokens kept free in the context window on top of max_tokens when packing session history
+DEFAULT_CONTEXT_RESERVE_TOKENS = int(os.getenv("CONTEXT_RESERVE_TOKENS", "64"))
 DEFAULT_SESSION_AUTO_TRIM = os.getenv("SESSION_AUTO_TRIM", "true").lower() in {
     "1",
     "true",
@@ -49,6 +123,16 @@ DEFAULT_SESSION_AUTO_TRIM = os.getenv("SESSION_AUTO_TRIM", "true").lower() in {
     "on",
 }
 
+# Per-session KV-cache (llama state) configuration
+DEFAULT_SESSION_STATE_CACHE_ENABLED = os.getenv("SESSION_STATE_CACHE_ENABLED", "true").lower() in {
+    "1",
+    "true",
+    "yes",
+    "on",
+}
+DEFAULT_SESSION_STATE_CACHE_RAM_MB = int(os.getenv("SESSION_STATE_CACHE_RAM_MB", "512"))
+DEFAULT_SESSION_STATE_CACHE_DISK_MB = int(os.getenv("SESSION_STATE_CACHE_DISK_MB", "2048"))
+
 # Streaming configuration
 DEFAULT_STREAMING_ENABLED = os.getenv("STREAMING_ENABLED", "false").lower() in {
     "1",
@@ -58,20 +142,50 @@ DEFAULT_STREAMING_ENABLED = os.getenv("STREAMING_ENABLED", "false").lower() in {
 }
 DEFAULT_STREAMING_CHUNK_SIZE = int(os.getenv("STREAMING_CHUNK_SIZE", "50"))
 
+# Response cache configuration
+DEFAULT_RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "true").lower() in {
+    "1",
+    "true",
+    "yes",
+    "on",
+}
+DEFAULT_RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "256"))
+# Directory for the persistent tier (relative to server.py). Empty = in-memory only
+DEFAULT_RESPONSE_CACHE_DIR = os.getenv("RESPONSE_CACHE_DIR", "")
+DEFAULT_RESPONSE_CACHE_DISK_MB = int(os.getenv("RESPONSE_CACHE_DISK_MB", "256"))
+
+# Inference queue configuration
+DEFAULT_INFERENCE_QUEUE_SIZE = int(os.getenv("INFERENCE_QUEUE_SIZE", "8"))
+
 BASE_DIR = Path(__file__).resolve().parent
 HISTORY_DIR = BASE_DIR / DEFAULT_SESSION_HISTORY_DIR
+# Single session index of older versions (split into per-session meta.json files on first use)
 SESSIONS_INDEX_PATH = HISTORY_DIR / "sessions_index.json"
+SESSIONS_DB_PATH = HISTORY_DIR / "sessions.db"
+SESSION_STATE_DIR = HISTORY_DIR / "kv_cache"
+SESSION_ARCHIVE_DIR = HISTORY_DIR / "archive"
+SESSION_SEARCH_DB_PATH = HISTORY_DIR / "search.db"
 
-# Global model instance and current path
+# Most recently loaded model (kept for scripts that import it; see model_pool)
 llama_model: Optional[Llama] = None
-_current_model_path: Optional[str] = None
+
+# Model path used by the current request/thread (see get_current_model_path)
+_request_model_path: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar(
+    "request_model_path", default=None
+)
+
+# Time the current request waited for the model (inference queue, model lock) before
+# generating; generate_completion() reports it as queue_wait_ms and resets it
+_request_queue_wait_ms: contextvars.ContextVar[float] = contextvars.ContextVar(
+    "request_queue_wait_ms", default=0.0
+)
 
 MODELS_DIR = os.getenv("MODELS_DIR", "")
 if not MODELS_DIR:
     MODELS_DIR = str(BASE_DIR / "models")
 
 
-def get_available_models() -> List[Dict[str, str]]:
+def get_available_models() -> List[Dict[str, Any]]:
     """List available GGUF models in MODELS_DIR and MODEL_PATH."""
     models = []
     seen = set()
@@ -83,402 +197,4928 @@ def get_available_models() -> List[Dict[str, str]]:
             path_str = str(p.resolve())
             if path_str not in seen:
                 seen.add(path_str)
-                models.append({"path": path_str, "name": p.name})
+                models.append({"path": path_str, "name": p.name, "size_bytes": p.stat().st_size})
 
     # Include DEFAULT_MODEL_PATH if set and not already listed
     if DEFAULT_MODEL_PATH and os.path.exists(DEFAULT_MODEL_PATH):
         path_str = str(Path(DEFAULT_MODEL_PATH).resolve())
         if path_str not in seen:
             seen.add(path_str)
-            models.append({"path": path_str, "name": Path(DEFAULT_MODEL_PATH).name})
+            models.append({
+                "path": path_str,
+                "name": Path(DEFAULT_MODEL_PATH).name,
+                "size_bytes": os.path.getsize(DEFAULT_MODEL_PATH),
+            })
+
+    return sorted(models, key=lambda x: x["name"].lower())
+
+
+# === Speculative decoding =====================================================
+
+def _parse_draft_models(spec: str) -> Dict[str, str]:
+    """Parse SPECULATIVE_DRAFT_MODELS ("target.gguf=draft.gguf,..." ; "*" matches any target)."""
+    mapping: Dict[str, str] = {}
+    for item in spec.split(","):
+        target, sep, draft = item.partition("=")
+        if sep and target.strip() and draft.strip():
+            mapping[target.strip()] = draft.strip()
+    return mapping
+
+
+DRAFT_MODELS = _parse_draft_models(DEFAULT_SPECULATIVE_DRAFT_MODELS)
+
+
+def draft_model_path_for(target_path: str) -> Optional[str]:
+    """Return the configured draft model for a target model, resolved against MODELS_DIR."""
+    draft = DRAFT_MODELS.get(Path(target_path).name) or DRAFT_MODELS.get("*")
+    if not draft:
+        return None
+    draft_path = Path(draft) if Path(draft).is_absolute() else Path(MODELS_DIR) / draft
+    if draft_path.resolve() == Path(target_path).resolve():
+        return None
+    if not draft_path.exists():
+        print(f"Warning: draft model not found: {draft_path}", file=sys.stderr)
+        return None
+    return str(draft_path)
+
+
+class DraftModel(LlamaDraftModel):
+    """Drafts tokens with a small model for Llama's speculative decoding.
+
+    Llama evaluates the drafted tokens together with the token it just sampled
+    and keeps them while its own samples agree, so output is unchanged; only
+    the number of decode passes of the large model drops. Acceptance is tracked
+    over a sliding window; when it falls below min_acceptance, drafting pauses
+    (plain decoding) and is probed again after probe_interval calls.
+    """
+
+    def __init__(
+        self,
+        model: Llama,
+        num_pred_tokens: int = DEFAULT_SPECULATIVE_DRAFT_TOKENS,
+        min_acceptance: float = DEFAULT_SPECULATIVE_MIN_ACCEPTANCE,
+        window_tokens: int = 64,
+        probe_interval: int = 64,
+    ):
+        self.model = model
+        self.model_path = model.model_path
+        self.num_pred_tokens = num_pred_tokens
+        self.min_acceptance = min_acceptance
+        self.window_tokens = window_tokens
+        self.probe_interval = probe_interval
+        self._window: List[tuple[int, int]] = []  # (drafted, accepted) per resolved draft
+        self._pending: Optional[tuple[int, int, int]] = None  # (prefix_len, last_token, n_drafted)
+        self._paused_calls = 0
+        self.paused = False
+        self._stats = {"drafted": 0, "accepted": 0, "draft_calls": 0, "fallbacks": 0}
+
+    def _resolve_pending(self, input_ids: Any) -> None:
+        """Count how many of the previous draft's tokens the target model kept."""
+        if self._pending is None:
+            return
+        prefix_len, last_token, n_drafted = self._pending
+        self._pending = None
+        # Llama calls us again with prefix + accepted drafts + one newly sampled token
+        if len(input_ids) <= prefix_len or int(input_ids[prefix_len - 1]) != last_token:
+            return  # a different generation started; the draft was never verified
+        accepted = min(n_drafted, len(input_ids) - prefix_len - 1)
+        self._stats["drafted"] += n_drafted
+        self._stats["accepted"] += accepted
+        self._window.append((n_drafted, accepted))
+        while sum(d for d, _ in self._window) > self.window_tokens and len(self._window) > 1:
+            self._window.pop(0)
+
+    def window_acceptance(self) -> Optional[float]:
+        drafted = sum(d for d, _ in self._window)
+        if drafted < self.window_tokens // 2:
+            return None  # not enough evidence yet
+        return sum(a for _, a in self._window) / drafted
+
+    def __call__(self, input_ids: Any, /, **kwargs: Any) -> Any:
+        self._resolve_pending(input_ids)
+        empty = np.array([], dtype=np.intc)
+
+        if self.paused:
+            self._paused_calls += 1
+            if self._paused_calls < self.probe_interval:
+                return empty
+            # Probe again: the text may have become easier to predict
+            self.paused = False
+            self._window.clear()
+        else:
+            rate = self.window_acceptance()
+            if rate is not None and rate < self.min_acceptance:
+                self.paused = True
+                self._paused_calls = 0
+                self._stats["fallbacks"] += 1
+                return empty
+
+        n_pred = min(self.num_pred_tokens, self.model.n_ctx() - len(input_ids) - 1)
+        if n_pred <= 0:
+            return empty
+
+        drafted: List[int] = []
+        eos = self.model.token_eos()
+        for token in self.model.generate([int(t) for t in input_ids], top_k=1, temp=0.0):
+            if token == eos:
+                break
+            drafted.append(int(token))
+            if len(drafted) >= n_pred:
+                break
+        self._stats["draft_calls"] += 1
+        if drafted:
+            self._pending = (len(input_ids), int(input_ids[-1]), len(drafted))
+        return np.array(drafted, dtype=np.intc)
+
+    def stats(self) -> Dict[str, Any]:
+        stats = dict(self._stats)
+        stats["acceptance_rate"] = round(stats["accepted"] / stats["drafted"], 3) if stats["drafted"] else None
+        window_rate = self.window_acceptance()
+        stats["window_acceptance_rate"] = round(window_rate, 3) if window_rate is not None else None
+        stats["paused"] = self.paused
+        stats["draft_model"] = Path(self.model_path).name
+        return stats
+
+
+def _load_draft_model(target_path: str) -> Optional[DraftModel]:
+    """Load the draft model configured for target_path, or None."""
+    draft_path = draft_model_path_for(target_path)
+    if draft_path is None:
+        return None
+    print(f"Loading draft model from: {draft_path}", file=sys.stderr)
+    try:
+        draft = Llama(
+            model_path=draft_path,
+            n_ctx=DEFAULT_CONTEXT_SIZE,
+            n_threads=DEFAULT_N_THREADS,
+            n_gpu_layers=DEFAULT_N_GPU_LAYERS,
+            verbose=False,
+        )
+    except Exception as e:
+        print(f"Warning: could not load draft model ({e}); using normal decoding", file=sys.stderr)
+        return None
+    return DraftModel(draft)
+
+
+def get_speculative_stats() -> List[Dict[str, Any]]:
+    """Return draft acceptance statistics for each resident model using speculative decoding."""
+    return model_pool.speculative_stats()
+
+
+class ModelPool:
+    """Keeps several Llama models resident within a RAM budget.
+
+    When loading another model would exceed the budget, the least recently used
+    models are unloaded first. Each model has its own lock, held by use_model()
+    while generating, so two requests never share one llama context at the same
+    time and a model in use is never evicted. A budget of 0 keeps a single model
+    resident, i.e. switching models unloads the previous one.
+    """
+
+    def __init__(self, max_bytes: int = 0):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._load_locks: Dict[str, threading.Lock] = {}
+        # Bytes of models being loaded right now, counted against the budget until they are resident
+        self._reserved_bytes = 0
+
+    def _touch(self, path_resolved: str) -> Optional[Dict[str, Any]]:
+        entry = self._entries.get(path_resolved)
+        if entry is not None:
+            self._entries.move_to_end(path_resolved)
+            entry["last_used_at"] = time.time()
+        return entry
+
+    def acquire(self, path: str, path_resolved: str) -> tuple[Llama, threading.Lock]:
+        """Return (model, model_lock), loading the model into the pool if needed."""
+        with self._lock:
+            entry = self._touch(path_resolved)
+            if entry is not None:
+                return entry["model"], entry["lock"]
+            load_lock = self._load_locks.setdefault(path_resolved, threading.Lock())
+
+        # Only one thread loads a given model; others wait and then reuse it
+        with load_lock:
+            with self._lock:
+                entry = self._touch(path_resolved)
+                if entry is not None:
+                    return entry["model"], entry["lock"]
+
+            draft_path = draft_model_path_for(path)
+            size_bytes = os.path.getsize(path) + (os.path.getsize(draft_path) if draft_path else 0)
+            self._make_room(size_bytes)
+
+            print(f"Loading model from: {path}", file=sys.stderr)
+            start = time.perf_counter()
+            try:
+                draft_model = _load_draft_model(path) if draft_path else None
+                model = Llama(
+                    model_path=path,
+                    n_ctx=DEFAULT_CONTEXT_SIZE,
+                    n_threads=DEFAULT_N_THREADS,
+                    n_gpu_layers=DEFAULT_N_GPU_LAYERS,
+                    draft_model=draft_model,
+                    verbose=False,
+                )
+            except BaseException:
+                with self._lock:
+                    self._reserved_bytes -= size_bytes
+                raise
+            if draft_model is not None and draft_model.model.n_vocab() != model.n_vocab():
+                print("Warning: draft model vocabulary differs; using normal decoding", file=sys.stderr)
+                model.draft_model = None
+            load_time_ms = (time.perf_counter() - start) * 1000
+            prom.MODEL_LOAD.observe(load_time_ms / 1000)
+            tracing.set_attributes(loaded=True, load_time_ms=load_time_ms)
+            now = time.time()
+            entry = {
+                "model": model,
+                "lock": threading.Lock(),
+                "size_bytes": size_bytes,
+                "loaded_at": now,
+                "last_used_at": now,
+                "load_time_ms": load_time_ms,
+            }
+            with self._lock:
+                self._reserved_bytes -= size_bytes
+                self._entries[path_resolved] = entry
+            print(f"Model loaded successfully! ({load_time_ms / 1000:.1f}s)", file=sys.stderr)
+            return model, entry["lock"]
+
+    def resident(self, path_resolved: str) -> Optional[tuple[Llama, threading.Lock]]:
+        """Return (model, model_lock) if the model is loaded, without loading it or marking it used."""
+        with self._lock:
+            entry = self._entries.get(path_resolved)
+            return (entry["model"], entry["lock"]) if entry is not None else None
+
+    def acquire_scheduler(self, path: str, path_resolved: str, n_slots: int) -> "BatchScheduler":
+        """Return the model's BatchScheduler (created on first use), marked as held.
+
+        Callers must call release() on it when done so the model can be evicted again.
+        """
+        while True:
+            model, _ = self.acquire(path, path_resolved)
+            with self._lock:
+                entry = self._entries.get(path_resolved)
+                if entry is None or entry["model"] is not model:
+                    continue  # evicted between acquire() and here; load it again
+                if entry.get("scheduler") is None:
+                    entry["scheduler"] = BatchScheduler(model, n_slots)
+                scheduler = entry["scheduler"]
+                scheduler.hold()
+                return scheduler
+
+    def _in_use(self, entry: Dict[str, Any]) -> bool:
+        scheduler = entry.get("scheduler")
+        return entry["lock"].locked() or (scheduler is not None and scheduler.busy())
+
+    def _make_room(self, incoming_bytes: int) -> None:
+        """Evict idle models (LRU first) until incoming_bytes fits in the budget, and reserve it.
+
+        The reservation counts against the budget for other loads until acquire()
+        adds the model to the pool or gives up on loading it.
+        """
+        evicted = []
+        with self._lock:
+            used = sum(e["size_bytes"] for e in self._entries.values()) + self._reserved_bytes
+            for path_resolved in list(self._entries):
+                over_budget = (
+                    bool(self._entries) if self.max_bytes <= 0
+                    else used + incoming_bytes > self.max_bytes
+                )
+                if not over_budget:
+                    break
+                entry = self._entries[path_resolved]
+                # Never evict a model that is generating right now
+                scheduler = entry.get("scheduler")
+                if scheduler is not None and scheduler.busy():
+                    continue
+                if not entry["lock"].acquire(blocking=False):
+                    continue
+                try:
+                    del self._entries[path_resolved]
+                    used -= entry["size_bytes"]
+                    evicted.append((path_resolved, entry))
+                finally:
+                    entry["lock"].release()
+            if (self._entries or self._reserved_bytes) and self.max_bytes > 0 and used + incoming_bytes > self.max_bytes:
+                print(
+                    "Warning: model pool is over its RAM budget; models in use could not be unloaded.",
+                    file=sys.stderr,
+                )
+            self._reserved_bytes += incoming_bytes
+        for path_resolved, entry in evicted:
+            self._release(path_resolved, entry)
+
+    def _release(self, path_resolved: str, entry: Dict[str, Any]) -> None:
+        global llama_model
+        if llama_model is entry["model"]:
+            llama_model = None
+        # The scheduler's context must be freed before the model it was created from
+        if entry.get("scheduler") is not None:
+            entry["scheduler"].close()
+            entry["scheduler"] = None
+        entry["model"] = None
+        gc.collect()
+        print(f"Model unloaded: {Path(path_resolved).name}", file=sys.stderr)
+
+    def unload(self, path_resolved: Optional[str] = None) -> None:
+        """Unload one model, or every model when path_resolved is None."""
+        with self._lock:
+            targets = [path_resolved] if path_resolved else list(self._entries)
+            removed = [(p, self._entries.pop(p)) for p in targets if p in self._entries]
+        for p, entry in removed:
+            self._release(p, entry)
+
+    def most_recent_path(self) -> Optional[str]:
+        """Return the path of the most recently used resident model."""
+        with self._lock:
+            return next(reversed(self._entries), None)
+
+    def loaded_models(self) -> List[Dict[str, Any]]:
+        """Describe resident models, most recently used first."""
+        with self._lock:
+            items = list(self._entries.items())
+        return [
+            {
+                "path": path_resolved,
+                "name": Path(path_resolved).name,
+                "size_bytes": entry["size_bytes"],
+                "size_mb": round(entry["size_bytes"] / (1024 * 1024), 1),
+                "loaded_at": datetime.utcfromtimestamp(entry["loaded_at"]).isoformat() + "Z",
+                "last_used_at": datetime.utcfromtimestamp(entry["last_used_at"]).isoformat() + "Z",
+                "load_time_ms": round(entry["load_time_ms"], 2),
+                "in_use": self._in_use(entry),
+            }
+            for path_resolved, entry in reversed(items)
+        ]
+
+    def speculative_stats(self) -> List[Dict[str, Any]]:
+        """Describe draft acceptance for resident models that decode speculatively."""
+        with self._lock:
+            items = [(p, getattr(e["model"], "draft_model", None)) for p, e in self._entries.items()]
+        return [
+            {"path": p, "name": Path(p).name, **draft.stats()}
+            for p, draft in items
+            if isinstance(draft, DraftModel)
+        ]
+
+    def batch_stats(self) -> List[Dict[str, Any]]:
+        """Describe the batch schedulers of resident models."""
+        with self._lock:
+            items = [(p, e.get("scheduler")) for p, e in self._entries.items()]
+        return [
+            {"path": p, "name": Path(p).name, **scheduler.stats()}
+            for p, scheduler in items
+            if scheduler is not None
+        ]
+
+    def stats(self) -> Dict[str, Any]:
+        """Return pool usage against its budget."""
+        models = self.loaded_models()
+        with self._lock:
+            reserved = self._reserved_bytes
+        return {
+            "max_bytes": self.max_bytes,
+            "used_bytes": sum(m["size_bytes"] for m in models),
+            "loading_bytes": reserved,
+            "loaded_models": models,
+        }
+
+
+model_pool = ModelPool(max_bytes=DEFAULT_MODEL_POOL_MAX_MB * 1024 * 1024)
+prom.set_loaded_models_source(lambda: [m["name"] for m in model_pool.loaded_models()])
+
+
+def unload_model(model_path: Optional[str] = None) -> None:
+    """Unload a model to free memory (all resident models if model_path is None)."""
+    path_resolved = str(Path(model_path).resolve()) if model_path else None
+    model_pool.unload(path_resolved)
+
+
+@tracing.traced("load_model")
+def _acquire_model(model_path: Optional[str] = None) -> tuple[Llama, threading.Lock]:
+    global llama_model
+
+    path = model_path or DEFAULT_MODEL_PATH
+    if not path or not os.path.exists(path):
+        error_msg = (
+            f"Error: Model not found at {path}\nPlease configure MODEL_PATH in the .env file\n"
+            "Or download a GGUF model from: https://huggingface.co/models?library=gguf"
+        )
+        print(error_msg, file=sys.stderr)
+        raise FileNotFoundError(f"Model not found: {path}")
+
+    path_resolved = str(Path(path).resolve())
+    try:
+        model, lock = model_pool.acquire(path, path_resolved)
+    except Exception as e:
+        print(f"Error loading model: {e}", file=sys.stderr)
+        raise
+    llama_model = model
+    _request_model_path.set(path_resolved)
+    return model, lock
+
+
+def load_model(model_path: Optional[str] = None) -> Llama:
+    """Loads the Llama model. Pass model_path to use a different model.
+
+    Models stay resident in the model pool (within MODEL_POOL_MAX_MB), so
+    alternating between models does not reload them every time. The model is
+    returned without its lock; generate through use_model() instead.
+    """
+    model, _ = _acquire_model(model_path)
+    return model
+
+
+@contextmanager
+def use_model(model_path: Optional[str] = None, batched: bool = False):
+    """Load a model and hold its lock while the block runs (use this to generate).
+
+    With batched=True and BATCH_SLOTS > 1 this yields the model's BatchScheduler
+    instead, without taking the model lock: the scheduler has its own llama
+    context and is called like the model, so concurrent requests decode together.
+    """
+    global _batching_unsupported
+    if batched and DEFAULT_BATCH_SLOTS > 1 and not _batching_unsupported:
+        path = model_path or DEFAULT_MODEL_PATH
+        _acquire_model(path)  # validates the path and records it for this request
+        try:
+            scheduler = model_pool.acquire_scheduler(path, str(Path(path).resolve()), DEFAULT_BATCH_SLOTS)
+        except BatchingUnsupportedError as e:
+            print(f"Warning: {e}; generating without batching", file=sys.stderr)
+            _batching_unsupported = True
+        else:
+            try:
+                yield scheduler
+            finally:
+                scheduler.release()
+            return
+
+    model, lock = _acquire_model(model_path)
+    global _model_waiters
+    with _model_waiters_lock:
+        _model_waiters += 1
+    start = time.perf_counter()
+    with tracing.span("model_lock_wait"):
+        try:
+            lock.acquire()
+        finally:
+            with _model_waiters_lock:
+                _model_waiters -= 1
+    wait_s = time.perf_counter() - start
+    prom.QUEUE_WAIT.observe(wait_s, queue="model_lock")
+    _request_queue_wait_ms.set(_request_queue_wait_ms.get() + wait_s * 1000)
+    try:
+        yield model
+    finally:
+        lock.release()
+
+
+# Set once BatchScheduler turns out not to work with the installed llama-cpp-python
+_batching_unsupported = False
+
+# Requests blocked in use_model() waiting for a model lock (background jobs yield to them)
+_model_waiters = 0
+_model_waiters_lock = threading.Lock()
+
+
+def model_requests_waiting() -> bool:
+    """True while a request is waiting for a model that is in use."""
+    return _model_waiters > 0
+
+
+def get_current_model_path() -> Optional[str]:
+    """Return the model path used by the current request.
+
+    Falls back to the most recently used resident model outside of a request
+    that loaded one.
+    """
+    return _request_model_path.get() or model_pool.most_recent_path()
+
+
+def get_loaded_models() -> List[Dict[str, Any]]:
+    """Return the models currently resident in the pool."""
+    return model_pool.loaded_models()
+
+
+# === Continuous batching ======================================================
+
+# llama-cpp-python releases whose private Llama internals the batch scheduler was
+# written against: [first supported, first unsupported)
+_BATCH_LLAMA_CPP_VERSIONS = ((0, 3, 0), (0, 4, 0))
+
+
+class BatchingUnsupportedError(RuntimeError):
+    """Raised when the installed llama-cpp-python cannot back a BatchScheduler."""
+
+
+def _create_batch_context(model: Llama, n_ctx: int, n_batch: int, n_seq_max: int) -> tuple[Any, Any]:
+    """Create a llama context sharing model's weights, returning (context, vocab).
+
+    This is the only place that reaches into llama-cpp-python internals (the
+    Llama object's raw model and vocab handles). Other releases may lay them out
+    differently, so anything but a known release raises BatchingUnsupportedError
+    and callers fall back to unbatched generation.
+    """
+    version = tuple(int(part) for part in re.findall(r"\d+", getattr(llama_cpp, "__version__", ""))[:3])
+    first, last = _BATCH_LLAMA_CPP_VERSIONS
+    if not first <= version < last:
+        raise BatchingUnsupportedError(f"llama-cpp-python {llama_cpp.__version__} is not supported for batching")
+    internals = getattr(model, "_model", None)
+    model_handle = getattr(internals, "model", None)
+    vocab = getattr(internals, "vocab", None)
+    if model_handle is None or vocab is None or not hasattr(llama_cpp, "llama_init_from_model"):
+        raise BatchingUnsupportedError("this llama-cpp-python build does not expose the model handles")
+
+    params = llama_cpp.llama_context_default_params()
+    params.n_ctx = n_ctx
+    params.n_batch = n_batch
+    params.n_ubatch = n_batch
+    params.n_seq_max = n_seq_max
+    params.n_threads = DEFAULT_N_THREADS
+    params.n_threads_batch = DEFAULT_N_THREADS
+    if hasattr(params, "kv_unified"):
+        params.kv_unified = False  # one KV stream per slot
+    ctx = llama_cpp.llama_init_from_model(model_handle, params)
+    if ctx is None:
+        raise RuntimeError("Failed to create llama context for batching")
+    return ctx, vocab
+
+
+def _stop_holdback(text: str, stop: List[str]) -> int:
+    """Return how many trailing characters of text could still start a stop sequence."""
+    holdback = 0
+    for s in stop:
+        for k in range(min(len(s) - 1, len(text)), holdback, -1):
+            if text.endswith(s[:k]):
+                holdback = k
+                break
+    return holdback
+
+
+class _BatchRequest:
+    """One completion being decoded in a BatchScheduler slot."""
+
+    def __init__(
+        self,
+        prompt_tokens: List[int],
+        max_tokens: int,
+        stop: List[str],
+        sampler: Any,
+        on_text: Optional[Callable[[str], None]],
+    ):
+        self.prompt_tokens = prompt_tokens
+        self.pending = list(prompt_tokens)  # prompt tokens not decoded yet
+        self.max_tokens = max_tokens
+        self.stop = [s for s in stop if s]
+        self.max_stop_len = max((len(s) for s in self.stop), default=0)
+        self.sampler = sampler
+        self.on_text = on_text
+        self.future: Future = Future()
+        self.seq_id = -1
+        self.n_past = 0
+        self.last_token: Optional[int] = None
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+        self.text = ""
+        self.emitted = 0
+        self.completion_tokens = 0
+        self.enqueued_at = time.perf_counter()
+        self.admitted_at = 0.0
+        self.first_token_at = 0.0
+
+
+class BatchScheduler:
+    """Continuous batching over llama.cpp sequence slots on one loaded model.
+
+    The scheduler owns its own llama context (sharing the model weights) with
+    n_slots sequences. A single worker thread decodes one token for every
+    active request per llama_decode call; new requests join at the next token
+    boundary, so concurrent chats share each forward pass instead of waiting
+    for one another. Instances are callable like Llama for the subset of
+    arguments generate_completion() uses, so they plug into the same helpers.
+    """
+
+    def __init__(self, model: Llama, n_slots: int, n_batch: int = DEFAULT_BATCH_SIZE):
+        self.model = model
+        self.model_path = model.model_path
+        self.n_slots = max(1, n_slots)
+        self.n_batch = max(self.n_slots, n_batch)
+        self.slot_ctx = DEFAULT_CONTEXT_SIZE
+
+        self._ctx, self._vocab = _create_batch_context(
+            model, self.slot_ctx * self.n_slots, self.n_batch, self.n_slots
+        )
+        self._memory = llama_cpp.llama_get_memory(self._ctx)
+        self._batch = llama_cpp.llama_batch_init(self.n_batch, 0, 1)
+
+        self._slots: List[Optional[_BatchRequest]] = [None] * self.n_slots
+        self._queue: List[_BatchRequest] = []
+        self._cond = threading.Condition()
+        self._closed = False
+        self._users = 0
+        self._worker: Optional[threading.Thread] = None
+        self._stats = {
+            "submitted": 0,
+            "completed": 0,
+            "failed": 0,
+            "cancelled": 0,
+            "decode_steps": 0,
+            "generated_tokens": 0,
+            "batched_tokens": 0,
+        }
+
+    # -- public API -------------------------------------------------------------
+
+    def submit(
+        self,
+        prompt: str,
+        max_tokens: int = 256,
+        temperature: float = 0.7,
+        top_p: float = 0.9,
+        stop: Optional[List[str]] = None,
+        on_text: Optional[Callable[[str], None]] = None,
+    ) -> Future:
+        """Queue a completion. The future resolves to a dict with text and token counts.
+
+        on_text (if given) is called from the worker thread with each new piece
+        of text; pieces that could be the start of a stop sequence are held back.
+        Cancelling the future (or on_text raising GenerationCancelled) stops the
+        request at the next token boundary.
+        """
+        return self._enqueue(self._new_request(prompt, max_tokens, temperature, top_p, stop, on_text))
+
+    def _new_request(
+        self,
+        prompt: str,
+        max_tokens: int,
+        temperature: float,
+        top_p: float,
+        stop: Optional[List[str]],
+        on_text: Optional[Callable[[str], None]],
+    ) -> _BatchRequest:
+        tokens = self.model.tokenize(prompt.encode("utf-8"), special=True)
+        if len(tokens) >= self.slot_ctx:
+            raise ValueError(
+                f"Requested tokens ({len(tokens)}) exceed context window of {self.slot_ctx}"
+            )
+        max_tokens = self.slot_ctx - len(tokens) if max_tokens <= 0 else min(max_tokens, self.slot_ctx - len(tokens))
+        return _BatchRequest(tokens, max_tokens, stop or [], self._make_sampler(temperature, top_p), on_text)
+
+    def _enqueue(self, request: _BatchRequest) -> Future:
+        with self._cond:
+            if self._closed:
+                llama_cpp.llama_sampler_free(request.sampler)
+                raise RuntimeError("Batch scheduler is closed (model unloaded)")
+            self._queue.append(request)
+            self._stats["submitted"] += 1
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name="batch-scheduler", daemon=True)
+                self._worker.start()
+            self._cond.notify()
+        return request.future
+
+    def __call__(
+        self,
+        prompt: str,
+        max_tokens: int = 256,
+        temperature: float = 0.7,
+        top_p: float = 0.9,
+        echo: bool = False,
+        stop: Optional[List[str]] = None,
+        stream: bool = False,
+    ):
+        """Llama-compatible completion call (blocking, or an iterator when stream=True)."""
+        if not stream:
+            result = self.submit(prompt, max_tokens, temperature, top_p, stop).result()
+            return {
+                "choices": [{"text": result["text"], "finish_reason": result["finish_reason"]}],
+                "usage": {
+                    "prompt_tokens": result["prompt_tokens"],
+                    "completion_tokens": result["completion_tokens"],
+                    "total_tokens": result["prompt_tokens"] + result["completion_tokens"],
+                },
+                "timings": result["timings"],
+            }
+
+        pieces: "queue.Queue[Optional[tuple[str, int]]]" = queue.Queue()
+        # Each piece travels with the number of tokens sampled so far
+        request = self._new_request(
+            prompt, max_tokens, temperature, top_p, stop,
+            on_text=lambda piece: pieces.put((piece, request.completion_tokens)),
+        )
+        future = self._enqueue(request)
+        future.add_done_callback(lambda _: pieces.put(None))
+
+        def iterate():
+            try:
+                while True:
+                    item = pieces.get()
+                    if item is None:
+                        break
+                    piece, completion_tokens = item
+                    yield {"choices": [{"text": piece}], "usage": {"completion_tokens": completion_tokens}}
+            finally:
+                # The consumer stopped early (e.g. GenerationCancelled): free the slot
+                future.cancel()
+            result = future.result()  # re-raise decode errors in the consumer
+            yield {
+                "choices": [{"text": "", "finish_reason": result["finish_reason"]}],
+                "usage": {"prompt_tokens": result["prompt_tokens"], "completion_tokens": result["completion_tokens"]},
+                "timings": result["timings"],
+            }
+
+        return iterate()
+
+    def tokenize(self, text: bytes, add_bos: bool = True, special: bool = False) -> List[int]:
+        return self.model.tokenize(text, add_bos=add_bos, special=special)
+
+    def n_ctx(self) -> int:
+        """Context size available to one request (one slot)."""
+        return self.slot_ctx
+
+    def stats(self) -> Dict[str, Any]:
+        """Return slot usage and throughput counters."""
+        with self._cond:
+            stats = dict(self._stats)
+            stats["slots"] = self.n_slots
+            stats["active"] = sum(1 for r in self._slots if r is not None)
+            stats["queued"] = len(self._queue)
+        steps = stats["decode_steps"]
+        stats["avg_batch_tokens"] = round(stats["batched_tokens"] / steps, 2) if steps else 0.0
+        return stats
+
+    def busy(self) -> bool:
+        """True while requests are queued or decoding, or a caller is about to submit."""
+        with self._cond:
+            return self._users > 0 or bool(self._queue) or any(r is not None for r in self._slots)
+
+    def hold(self) -> None:
+        with self._cond:
+            self._users += 1
+
+    def release(self) -> None:
+        with self._cond:
+            self._users -= 1
+
+    def close(self) -> None:
+        """Stop the worker, fail outstanding requests and free the llama context."""
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify_all()
+            worker = self._worker
+        if worker is not None and worker is not threading.current_thread():
+            worker.join()
+        error = RuntimeError("Batch scheduler closed (model unloaded)")
+        for request in self._queue + [r for r in self._slots if r is not None]:
+            self._finish(request, error=error)
+        self._queue.clear()
+        llama_cpp.llama_batch_free(self._batch)
+        llama_cpp.llama_free(self._ctx)
+        self._ctx = None
+
+    # -- worker -----------------------------------------------------------------
+
+    def _make_sampler(self, temperature: float, top_p: float) -> Any:
+        chain = llama_cpp.llama_sampler_chain_init(llama_cpp.llama_sampler_chain_default_params())
+        if temperature <= 0:
+            llama_cpp.llama_sampler_chain_add(chain, llama_cpp.llama_sampler_init_greedy())
+        else:
+            # Same defaults as Llama.__call__ (top_k=40, min_p=0.05)
+            llama_cpp.llama_sampler_chain_add(chain, llama_cpp.llama_sampler_init_top_k(40))
+            llama_cpp.llama_sampler_chain_add(chain, llama_cpp.llama_sampler_init_top_p(top_p, 1))
+            llama_cpp.llama_sampler_chain_add(chain, llama_cpp.llama_sampler_init_min_p(0.05, 1))
+            llama_cpp.llama_sampler_chain_add(chain, llama_cpp.llama_sampler_init_temp(temperature))
+            llama_cpp.llama_sampler_chain_add(
+                chain, llama_cpp.llama_sampler_init_dist(llama_cpp.LLAMA_DEFAULT_SEED)
+            )
+        return chain
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while not self._closed and not self._queue and all(r is None for r in self._slots):
+                    self._cond.wait()
+                if self._closed:
+                    return
+                cancelled = [r for r in self._queue if r.future.cancelled()]
+                self._queue = [r for r in self._queue if not r.future.cancelled()]
+                cancelled += [r for r in self._slots if r is not None and r.future.cancelled()]
+            # Abandoned requests stop decoding and give their slot back
+            for request in cancelled:
+                self._finish(request, error=GenerationCancelled())
+            with self._cond:
+                # Join waiting requests into free slots at this token boundary
+                for seq_id, slot in enumerate(self._slots):
+                    if slot is None and self._queue:
+                        request = self._queue.pop(0)
+                        request.seq_id = seq_id
+                        self._slots[seq_id] = request
+                        request.admitted_at = time.perf_counter()
+                        prom.QUEUE_WAIT.observe(request.admitted_at - request.enqueued_at, queue="batch_slot")
+                active = [r for r in self._slots if r is not None]
+            try:
+                self._step(active)
+            except Exception as e:
+                print(f"Batch decode failed: {e}", file=sys.stderr)
+                for request in active:
+                    self._finish(request, error=e)
+
+    def _add_token(self, token: int, pos: int, seq_id: int, logits: bool) -> int:
+        batch = self._batch
+        i = batch.n_tokens
+        batch.token[i] = token
+        batch.pos[i] = pos
+        batch.n_seq_id[i] = 1
+        batch.seq_id[i][0] = seq_id
+        batch.logits[i] = logits
+        batch.n_tokens = i + 1
+        return i
+
+    def _step(self, active: List[_BatchRequest]) -> None:
+        """Run one llama_decode over all active slots and sample their next tokens."""
+        self._batch.n_tokens = 0
+        outputs: List[tuple[_BatchRequest, int]] = []
+
+        # One token per generating request, then fill the rest with prompt tokens
+        for request in active:
+            if not request.pending and request.last_token is not None:
+                idx = self._add_token(request.last_token, request.n_past, request.seq_id, True)
+                request.n_past += 1
+                outputs.append((request, idx))
+        budget = self.n_batch - self._batch.n_tokens
+        for request in active:
+            if not request.pending or budget <= 0:
+                continue
+            take = request.pending[:budget]
+            del request.pending[: len(take)]
+            budget -= len(take)
+            for j, token in enumerate(take):
+                last = not request.pending and j == len(take) - 1
+                idx = self._add_token(token, request.n_past, request.seq_id, last)
+                request.n_past += 1
+                if last:
+                    outputs.append((request, idx))
+
+        if self._batch.n_tokens == 0:
+            return
+        rc = llama_cpp.llama_decode(self._ctx, self._batch)
+        if rc != 0:
+            raise RuntimeError(f"llama_decode returned {rc}")
+        with self._cond:
+            self._stats["decode_steps"] += 1
+            self._stats["batched_tokens"] += self._batch.n_tokens
+
+        for request, idx in outputs:
+            token = llama_cpp.llama_sampler_sample(request.sampler, self._ctx, idx)
+            self._accept(request, token)
+
+    def _accept(self, request: _BatchRequest, token: int) -> None:
+        if not request.first_token_at:
+            request.first_token_at = time.perf_counter()  # the prompt is evaluated
+        if llama_cpp.llama_vocab_is_eog(self._vocab, token):
+            self._finish(request, finish_reason="stop")
+            return
+        request.completion_tokens += 1
+        request.last_token = token
+        with self._cond:
+            self._stats["generated_tokens"] += 1
+        # Incomplete UTF-8 sequences are held by the decoder until the next token completes them
+        previous_len = len(request.text)
+        request.text += request.decoder.decode(self.model.detokenize([token]))
+
+        if request.stop:
+            # Earlier text was already checked, so a match must end in the new piece
+            window = max(0, previous_len - request.max_stop_len + 1)
+            tail = request.text[window:]
+            stop_at = min((p for p in (tail.find(s) for s in request.stop) if p >= 0), default=-1)
+            if stop_at >= 0:
+                request.text = request.text[: window + stop_at]
+                self._finish(request, finish_reason="stop")
+                return
+        if request.completion_tokens >= request.max_tokens or request.n_past + 1 >= self.slot_ctx:
+            self._finish(request, finish_reason="length")
+            return
+        safe = len(request.text) - _stop_holdback(request.text, request.stop)
+        self._emit(request, safe)
+
+    def _emit(self, request: _BatchRequest, upto: int) -> None:
+        if upto > request.emitted:
+            piece = request.text[request.emitted : upto]
+            request.emitted = upto
+            if request.on_text is not None:
+                try:
+                    request.on_text(piece)
+                except GenerationCancelled:
+                    request.future.cancel()
+                except Exception as e:
+                    print(f"Batch on_text callback failed: {e}", file=sys.stderr)
+
+    def _finish(
+        self,
+        request: _BatchRequest,
+        finish_reason: str = "stop",
+        error: Optional[BaseException] = None,
+    ) -> None:
+        if error is None:
+            self._emit(request, len(request.text))
+        if request.seq_id >= 0 and self._ctx is not None:
+            llama_cpp.llama_memory_seq_rm(self._memory, request.seq_id, -1, -1)
+        if request.sampler is not None:
+            llama_cpp.llama_sampler_free(request.sampler)
+            request.sampler = None
+        with self._cond:
+            if request.seq_id >= 0 and self._slots[request.seq_id] is request:
+                self._slots[request.seq_id] = None
+            if request.future.cancelled():
+                self._stats["cancelled"] += 1
+            else:
+                self._stats["failed" if error is not None else "completed"] += 1
+        if request.future.done():
+            return
+        if error is not None:
+            request.future.set_exception(error)
+        else:
+            now = time.perf_counter()
+            first_token_at = request.first_token_at or now
+            request.future.set_result({
+                "text": request.text,
+                "prompt_tokens": len(request.prompt_tokens),
+                "completion_tokens": request.completion_tokens,
+                "finish_reason": finish_reason,
+                "timings": {
+                    "slot_wait_ms": (request.admitted_at - request.enqueued_at) * 1000,
+                    "prompt_eval_ms": (first_token_at - request.admitted_at) * 1000,
+                    "prompt_eval_tokens": len(request.prompt_tokens),
+                    "decode_ms": (now - first_token_at) * 1000,
+                    "decode_tokens": max(0, request.completion_tokens - 1),
+                },
+            })
+
+
+def get_batch_stats() -> List[Dict[str, Any]]:
+    """Return batching stats for each resident model that has a scheduler."""
+    return model_pool.batch_stats()
+
+
+# === Inference executor =======================================================
+
+class InferenceQueueFullError(RuntimeError):
+    """Raised when the inference queue is full and a new request is rejected."""
+
+
+class InferenceExecutor:
+    """Dedicated worker thread(s) that own the Llama model and run inference jobs.
+
+    Jobs are handed over through a bounded queue and processed one at a time per
+    worker, so the asyncio event loop never blocks on generation. When the queue
+    is full, new jobs are rejected with InferenceQueueFullError instead of piling
+    up. Queue waits are recorded under name in the Prometheus queue-wait histogram.
+    """
+
+    def __init__(self, max_queue_size: int = DEFAULT_INFERENCE_QUEUE_SIZE, workers: int = 1, name: str = "inference"):
+        self.max_queue_size = max(1, max_queue_size)
+        self.workers = max(1, workers)
+        self.name = name
+        self._queue: "queue.Queue[Optional[tuple]]" = queue.Queue(maxsize=self.max_queue_size)
+        self._threads: List[threading.Thread] = []
+        self._lock = threading.Lock()
+        self._submitted = 0
+        self._completed = 0
+        self._failed = 0
+        self._rejected = 0
+        self._cancelled = 0
+        self._total_queue_wait_ms = 0.0
+        self._max_queue_wait_ms = 0.0
+        self._last_queue_wait_ms = 0.0
+
+    def _ensure_worker(self) -> None:
+        with self._lock:
+            self._threads = [t for t in self._threads if t.is_alive()]
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(
+                    target=self._worker, name=f"{self.name}-worker-{len(self._threads)}", daemon=True
+                )
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        """Queue fn(*args, **kwargs) for the inference thread and return its Future.
+
+        Raises InferenceQueueFullError if the queue is at capacity.
+        """
+        self._ensure_worker()
+        future: Future = Future()
+        # Each job runs in a copy of the caller's context, so per-request context
+        # variables never carry over from one job to the next on a worker thread
+        context = contextvars.copy_context()
+        try:
+            self._queue.put_nowait((future, context, fn, args, kwargs, time.perf_counter()))
+        except queue.Full:
+            with self._lock:
+                self._rejected += 1
+            raise InferenceQueueFullError(
+                f"Inference queue is full ({self.max_queue_size} pending requests). "
+                "Try again in a moment."
+            )
+        with self._lock:
+            self._submitted += 1
+        return future
+
+    def _worker(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            future, context, fn, args, kwargs, enqueued_at = item
+            # Skip jobs whose caller gave up while they were waiting
+            if not future.set_running_or_notify_cancel():
+                with self._lock:
+                    self._cancelled += 1
+                continue
+
+            wait_ms = (time.perf_counter() - enqueued_at) * 1000
+            context.run(_request_queue_wait_ms.set, wait_ms)
+            with self._lock:
+                self._last_queue_wait_ms = wait_ms
+                self._total_queue_wait_ms += wait_ms
+                self._max_queue_wait_ms = max(self._max_queue_wait_ms, wait_ms)
+            prom.QUEUE_WAIT.observe(wait_ms / 1000, queue=self.name)
+
+            try:
+                result = context.run(fn, *args, **kwargs)
+            except BaseException as exc:
+                with self._lock:
+                    self._failed += 1
+                future.set_exception(exc)
+            else:
+                with self._lock:
+                    self._completed += 1
+                future.set_result(result)
+
+    def stats(self) -> Dict[str, Any]:
+        """Return queue depth, counters and queue-wait timings (ms)."""
+        with self._lock:
+            started = self._completed + self._failed
+            avg_wait = self._total_queue_wait_ms / started if started else 0.0
+            return {
+                "queue_depth": self._queue.qsize(),
+                "max_queue_size": self.max_queue_size,
+                "submitted": self._submitted,
+                "completed": self._completed,
+                "failed": self._failed,
+                "rejected": self._rejected,
+                "cancelled": self._cancelled,
+                "last_queue_wait_ms": round(self._last_queue_wait_ms, 2),
+                "avg_queue_wait_ms": round(avg_wait, 2),
+                "max_queue_wait_ms": round(self._max_queue_wait_ms, 2),
+            }
+
+    def shutdown(self, wait: bool = True) -> None:
+        """Stop the workers after the jobs already queued have run."""
+        with self._lock:
+            threads = [t for t in self._threads if t.is_alive()]
+        for _ in threads:
+            self._queue.put(None)
+        if wait:
+            for thread in threads:
+                thread.join()
+
+
+inference_executor = InferenceExecutor()
+
+
+async def run_inference(fn, *args, **kwargs) -> Any:
+    """Run fn on the inference thread and await its result without blocking the loop.
+
+    Cancelling the awaiting task drops the job if it has not started yet.
+    """
+    future = inference_executor.submit(profiling.bind(tracing.bind(fn)), *args, **kwargs)
+    return await asyncio.wrap_future(future)
+
+
+async def run_blocking(fn, *args, **kwargs) -> Any:
+    """Run a blocking call (session files, SQLite) on a worker thread so the loop keeps serving."""
+    return await asyncio.to_thread(profiling.bind(tracing.bind(fn)), *args, **kwargs)
+
+
+def get_inference_stats() -> Dict[str, Any]:
+    """Return inference queue metrics."""
+    return inference_executor.stats()
+
+
+# === Response cache ===========================================================
+
+def _prune_oldest_files(directory: Path, pattern: str, max_bytes: int) -> None:
+    """Delete the least recently modified files matching pattern until under max_bytes."""
+    try:
+        files = []
+        for p in directory.glob(pattern):
+            st = p.stat()
+            files.append((st.st_mtime, st.st_size, p))
+    except OSError:
+        return
+    total = sum(size for _, size, _ in files)
+    for _, size, path in sorted(files):
+        if total <= max_bytes:
+            break
+        try:
+            path.unlink()
+            total -= size
+        except OSError:
+            pass
+
+
+class ResponseCache:
+    """Cache of generated responses keyed on model file, rendered prompt and sampling params.
+
+    Only used for deterministic generation (temperature 0) unless the caller
+    explicitly asks for caching. Entries live in a bounded in-memory LRU, with an
+    optional on-disk tier (one JSON file per entry) that survives restarts.
+    """
+
+    def __init__(
+        self,
+        max_entries: int,
+        cache_dir: Optional[Path] = None,
+        max_disk_bytes: int = 0,
+        enabled: bool = True,
+    ):
+        self.max_entries = max(1, max_entries)
+        self.cache_dir = cache_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.enabled = enabled
+        self._memory: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.bypassed = 0
+
+    def should_use(self, temperature: float, cache: Optional[bool]) -> bool:
+        """Decide whether a call is cacheable: cache=None means 'only if deterministic'."""
+        if cache is False:
+            with self._lock:
+                self.bypassed += 1
+            return False
+        if not self.enabled:
+            return False
+        return bool(cache) or float(temperature) <= 0
+
+    @staticmethod
+    def key_for(
+        model: Llama,
+        prompt: str,
+        max_tokens: int,
+        temperature: float,
+        top_p: float,
+        stop: Optional[List[str]],
+    ) -> str:
+        """Build a cache key from the model file identity, prompt and sampling params."""
+        model_path = getattr(model, "model_path", "") or ""
+        try:
+            st = os.stat(model_path)
+            model_id = f"{Path(model_path).resolve()}|{st.st_size}|{st.st_mtime_ns}"
+        except (OSError, TypeError):
+            model_id = str(model_path)
+        payload = json.dumps(
+            {
+                "model": model_id,
+                "prompt": prompt,
+                "max_tokens": int(max_tokens),
+                "temperature": float(temperature),
+                "top_p": float(top_p),
+                "stop": list(stop or []),
+            },
+            ensure_ascii=False,
+            sort_keys=True,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _disk_path(self, key: str) -> Optional[Path]:
+        if self.cache_dir is None:
+            return None
+        return self.cache_dir / f"{key}.json"
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """Return the cached entry ({text, prompt_tokens, completion_tokens}) or None."""
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return entry
+
+        path = self._disk_path(key)
+        if path is not None and path.exists():
+            try:
+                entry = json.loads(path.read_text(encoding="utf-8"))
+            except Exception:
+                entry = None
+            if isinstance(entry, dict) and "text" in entry:
+                with self._lock:
+                    self._remember(key, entry)
+                    self.hits += 1
+                    self.disk_hits += 1
+                return entry
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key: str, entry: Dict[str, Any]) -> None:
+        """Store an entry in memory and, if configured, on disk."""
+        with self._lock:
+            self._remember(key, entry)
+
+        path = self._disk_path(key)
+        if path is None:
+            return
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_suffix(".tmp")
+            tmp_path.write_text(json.dumps(entry, ensure_ascii=False), encoding="utf-8")
+            tmp_path.replace(path)
+        except Exception as e:
+            print(f"Warning: could not persist cached response: {e}", file=sys.stderr)
+            return
+        _prune_oldest_files(path.parent, "*.json", self.max_disk_bytes)
+
+    def _remember(self, key: str, entry: Dict[str, Any]) -> None:
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def clear(self) -> None:
+        """Drop all in-memory entries (the disk tier is left untouched)."""
+        with self._lock:
+            self._memory.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        """Return hit/miss counters and sizes."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "entries": len(self._memory),
+                "max_entries": self.max_entries,
+                "persistent": self.cache_dir is not None,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "bypassed": self.bypassed,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+response_cache = ResponseCache(
+    max_entries=DEFAULT_RESPONSE_CACHE_MAX_ENTRIES,
+    cache_dir=(BASE_DIR / DEFAULT_RESPONSE_CACHE_DIR) if DEFAULT_RESPONSE_CACHE_DIR else None,
+    max_disk_bytes=DEFAULT_RESPONSE_CACHE_DISK_MB * 1024 * 1024,
+    enabled=DEFAULT_RESPONSE_CACHE_ENABLED,
+)
+
+
+def get_response_cache_stats() -> Dict[str, Any]:
+    """Return response cache metrics."""
+    return response_cache.stats()
+
+
+# === Streaming generation helpers =============================================
+
+class GenerationCancelled(Exception):
+    """Raised by an on_chunk callback to stop a generation whose caller went away."""
+
+
+def generate_with_streaming(
+    model: Llama,
+    prompt: str,
+    max_tokens: int = 256,
+    temperature: float = 0.7,
+    top_p: float = 0.9,
+    stop: Optional[List[str]] = None,
+    chunk_size: int = DEFAULT_STREAMING_CHUNK_SIZE,
+    on_chunk: Optional[Callable[[str], None]] = None,
+    metrics: Optional[Dict[str, Any]] = None,
+    on_progress: Optional[Callable[[int], None]] = None,
+) -> List[TextContent]:
+    """Generate text with streaming enabled, returning multiple TextContent chunks.
+    
+    Returns a list of TextContent objects, one per chunk, for incremental display.
+    If on_chunk is given, it is called with each chunk as soon as it is produced;
+    the first token is flushed immediately to keep time-to-first-token low.
+    If on_progress is given, it is called just before each chunk with the number
+    of tokens sampled so far.
+    If metrics is given, it is filled with token counts, time_to_first_token_ms
+    and finish_reason (plus the phase timings a BatchScheduler reports).
+    """
+    stop_sequences = stop or []
+    start = time.perf_counter()
+
+    # A delta is not a token: llama-cpp-python holds back partial UTF-8 and possible
+    # stop sequences, then releases several tokens' text at once. Its stopping check
+    # runs once per sampled token with the tokens so far (the first call sees the
+    # whole prompt), so the model's own positions give the counts.
+    positions: List[int] = []  # [prompt length, latest length]
+    extra: Dict[str, Any] = {}
+    if isinstance(model, Llama):
+        def count_tokens(input_ids, logits) -> bool:
+            if not positions:
+                positions.extend((len(input_ids), len(input_ids)))
+            else:
+                positions[1] = max(positions[1], len(input_ids))
+            return False
+
+        extra["stopping_criteria"] = llama_cpp.StoppingCriteriaList([count_tokens])
+    
+    # Use stream=True to get incremental tokens
+    stream = model(
+        prompt,
+        max_tokens=max_tokens,
+        temperature=temperature,
+        top_p=top_p,
+        echo=False,
+        stop=stop_sequences,
+        stream=True,
+        **extra,
+    )
+    
+    chunks: List[TextContent] = []
+    current_chunk = ""
+    reported_tokens = 0  # from the chunks' usage (BatchScheduler) or, failing that, one per delta
+    usage: Dict[str, Any] = {}
+    finish_reason = None
+
+    def sampled_tokens() -> int:
+        return positions[1] - positions[0] + 1 if positions else reported_tokens
+
+    def emit(text: str) -> None:
+        if not chunks and metrics is not None:
+            metrics["time_to_first_token_ms"] = (time.perf_counter() - start) * 1000
+        chunks.append(TextContent(type="text", text=text))
+        if on_progress is not None:
+            on_progress(sampled_tokens())
+        if on_chunk is not None:
+            on_chunk(text)
+    
+    for chunk in stream:
+        if "choices" in chunk and len(chunk["choices"]) > 0:
+            choice = chunk["choices"][0]
+            if "usage" in chunk:
+                usage = chunk["usage"]
+            if choice.get("finish_reason"):
+                finish_reason = choice["finish_reason"]
+                if metrics is not None and "timings" in chunk:
+                    metrics.update(chunk["timings"])
+            delta_text = choice.get("text", "")
+            if delta_text:
+                reported_tokens = usage.get("completion_tokens", reported_tokens + 1)
+                current_chunk += delta_text
+                
+                # Emit chunk when it reaches the target size (or right away for the first one)
+                if not chunks or len(current_chunk) >= chunk_size:
+                    emit(current_chunk)
+                    current_chunk = ""
+    
+    # Emit any remaining text as final chunk
+    if current_chunk:
+        emit(current_chunk)
+    
+    # If no chunks were emitted (empty response), return at least one empty chunk
+    if not chunks:
+        chunks.append(TextContent(type="text", text=""))
+
+    if metrics is not None:
+        if positions:
+            metrics["prompt_tokens"] = positions[0]
+            # Like llama-cpp-python's usage, leave out the end-of-generation token of a
+            # "stop" finish; a stop sequence ends the same way from here, one token short
+            metrics["completion_tokens"] = sampled_tokens() - (1 if finish_reason == "stop" else 0)
+        elif isinstance(model, Llama):
+            # Nothing was sampled: the context holds just the evaluated prompt
+            metrics["prompt_tokens"] = model.n_tokens
+            metrics["completion_tokens"] = 0
+        else:
+            metrics["prompt_tokens"] = usage.get("prompt_tokens", metrics.get("prompt_tokens", 0))
+            metrics["completion_tokens"] = usage.get("completion_tokens", reported_tokens)
+        metrics["finish_reason"] = finish_reason
+    
+    return chunks
+
+
+def generate_without_streaming(
+    model: Llama,
+    prompt: str,
+    max_tokens: int = 256,
+    temperature: float = 0.7,
+    top_p: float = 0.9,
+    stop: Optional[List[str]] = None,
+    metrics: Optional[Dict[str, Any]] = None,
+) -> List[TextContent]:
+    """Generate text without streaming, returning a single TextContent with full response.
+
+    If metrics is given, it is filled with the token usage and finish_reason
+    reported by the model (plus the phase timings a BatchScheduler reports).
+    """
+    stop_sequences = stop or []
+    
+    output = model(
+        prompt,
+        max_tokens=max_tokens,
+        temperature=temperature,
+        top_p=top_p,
+        echo=False,
+        stop=stop_sequences,
+    )
+    
+    generated_text = output["choices"][0]["text"]
+    if metrics is not None:
+        usage = output.get("usage", {})
+        metrics["prompt_tokens"] = usage.get("prompt_tokens", 0)
+        metrics["completion_tokens"] = usage.get("completion_tokens", 0)
+        metrics["finish_reason"] = output["choices"][0].get("finish_reason")
+        metrics.update(output.get("timings", {}))
+    return [TextContent(type="text", text=generated_text)]
+
+
+@tracing.traced("generate_completion")
+def generate_completion(
+    model: Llama,
+    prompt: str,
+    max_tokens: int = 256,
+    temperature: float = 0.7,
+    top_p: float = 0.9,
+    stop: Optional[List[str]] = None,
+    streaming: bool = False,
+    chunk_size: int = DEFAULT_STREAMING_CHUNK_SIZE,
+    on_chunk: Optional[Callable[[str], None]] = None,
+    cache: Optional[bool] = None,
+    metrics: Optional[Dict[str, Any]] = None,
+    on_progress: Optional[Callable[[int], None]] = None,
+) -> tuple[List[TextContent], str]:
+    """Generate completion with optional streaming.
+    
+    When streaming, on_chunk (if given) receives each chunk while generation is
+    still running; it can raise GenerationCancelled to stop decoding, which then
+    propagates to the caller (nothing is cached). on_progress (if given) receives
+    the number of tokens generated so far before each chunk.
+
+    Deterministic calls (temperature 0) are served from the response cache when
+    possible; cache=True caches regardless of temperature and cache=False bypasses
+    the cache. If metrics is given, it is filled with token counts, whether
+    the response came from the cache, finish_reason and the latency phases
+    (all in ms): queue_wait_ms, prompt_eval_ms (with
+    prompt_eval_tokens, the prompt tokens not reused from the KV cache),
+    time_to_first_token_ms, decode_ms and decode_tokens_per_s, and the total
+    generation_ms. Phases come from llama.cpp's perf counters when available,
+    otherwise from the stream timestamps. Every completion is also recorded in
+    the Prometheus histograms (see metrics.py).
+
+    Returns:
+        - List of TextContent objects (multiple chunks if streaming, single chunk otherwise)
+        - Full accumulated text (for session persistence)
+    """
+    if metrics is None:
+        metrics = {}
+    start = time.perf_counter()
+    metrics["queue_wait_ms"] = _request_queue_wait_ms.get()
+    _request_queue_wait_ms.set(0.0)
+
+    cache_key = None
+    if response_cache.should_use(temperature, cache):
+        cache_key = response_cache.key_for(model, prompt, max_tokens, temperature, top_p, stop)
+        cached = response_cache.get(cache_key)
+        if cached is not None:
+            full_text = cached["text"]
+            metrics["prompt_tokens"] = cached.get("prompt_tokens", 0)
+            metrics["completion_tokens"] = cached.get("completion_tokens", 0)
+            metrics["cached"] = True
+            _observe_completion(metrics, start)
+            if not streaming:
+                return [TextContent(type="text", text=full_text)], full_text
+            # Replay the cached text in chunks so streaming clients still see output
+            chunks = [
+                TextContent(type="text", text=full_text[i : i + chunk_size])
+                for i in range(0, len(full_text), max(1, chunk_size))
+            ] or [TextContent(type="text", text="")]
+            if on_progress is not None:
+                on_progress(metrics["completion_tokens"])
+            if on_chunk is not None:
+                for chunk in chunks:
+                    if chunk.text:
+                        on_chunk(chunk.text)
+            return chunks, full_text
+
+    metrics["cached"] = False
+    perf_ctx = _reset_llama_perf(model)
+    if streaming:
+        chunks = generate_with_streaming(
+            model, prompt, max_tokens, temperature, top_p, stop, chunk_size, on_chunk, metrics,
+            on_progress,
+        )
+        # Accumulate full text from chunks
+        full_text = "".join(chunk.text for chunk in chunks)
+    else:
+        chunks = generate_without_streaming(
+            model, prompt, max_tokens, temperature, top_p, stop, metrics
+        )
+        full_text = chunks[0].text if chunks else ""
+    _fill_phase_timings(metrics, perf_ctx, start)
+
+    if cache_key is not None:
+        response_cache.put(
+            cache_key,
+            {
+                "text": full_text,
+                "prompt_tokens": metrics.get("prompt_tokens", 0),
+                "completion_tokens": metrics.get("completion_tokens", 0),
+            },
+        )
+    _observe_completion(metrics, start)
+    return chunks, full_text
+
+
+def _reset_llama_perf(model: Any) -> Any:
+    """Reset llama.cpp's perf counters on model's context and return the context.
+
+    Returns None when the counters would not describe this completion: stubs and
+    batch schedulers have no such context, and speculative decoding verifies draft
+    tokens in batches that llama.cpp counts as prompt evaluation.
+    """
+    if not isinstance(model, Llama) or getattr(model, "draft_model", None) is not None:
+        return None
+    # The raw context handle is private to llama-cpp-python; go without counters if it moves
+    ctx = getattr(getattr(model, "_ctx", None), "ctx", None)
+    if ctx is None or not hasattr(llama_cpp, "llama_perf_context_reset"):
+        return None
+    llama_cpp.llama_perf_context_reset(ctx)
+    return ctx
+
+
+def _fill_phase_timings(metrics: Dict[str, Any], perf_ctx: Any, start: float) -> None:
+    """Split a finished completion into prompt-eval and decode phases."""
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    streamed_ttft_ms = metrics.get("time_to_first_token_ms")  # from the start of the stream
+    if perf_ctx is not None:
+        perf = llama_cpp.llama_perf_context(perf_ctx)
+        metrics["prompt_eval_ms"] = perf.t_p_eval_ms
+        metrics["prompt_eval_tokens"] = perf.n_p_eval
+        metrics["decode_ms"] = perf.t_eval_ms
+        metrics["decode_tokens"] = perf.n_eval
+    elif "prompt_eval_ms" not in metrics and streamed_ttft_ms is not None:
+        # Only the stream to go by: everything before the first token is prompt work
+        metrics["prompt_eval_ms"] = streamed_ttft_ms
+        metrics["decode_ms"] = elapsed_ms - streamed_ttft_ms
+        metrics["decode_tokens"] = max(0, metrics.get("completion_tokens", 0) - 1)
+
+    slot_wait_ms = metrics.pop("slot_wait_ms", 0.0)
+    metrics["queue_wait_ms"] += slot_wait_ms
+    if streamed_ttft_ms is None and "decode_ms" in metrics:
+        # Not streamed: everything before decoding (tokenizing, any slot wait, prompt evaluation)
+        metrics["time_to_first_token_ms"] = max(0.0, elapsed_ms - metrics["decode_ms"])
+    decode_ms, decode_tokens = metrics.get("decode_ms"), metrics.get("decode_tokens")
+    if decode_ms and decode_tokens:
+        metrics["decode_tokens_per_s"] = decode_tokens / decode_ms * 1000
+
+
+def _observe_completion(metrics: Dict[str, Any], start: float) -> None:
+    """Fill generation_ms and record the completion in the Prometheus histograms."""
+    elapsed = time.perf_counter() - start
+    metrics["generation_ms"] = elapsed * 1000
+    ttft_ms = metrics.get("time_to_first_token_ms")
+    prompt_eval_ms = metrics.get("prompt_eval_ms")
+    prom.observe_completion(
+        elapsed,
+        metrics.get("prompt_tokens", 0),
+        metrics.get("completion_tokens", 0),
+        ttft_s=ttft_ms / 1000 if ttft_ms is not None else None,
+        cached=metrics.get("cached", False),
+        prompt_eval_s=prompt_eval_ms / 1000 if prompt_eval_ms is not None else None,
+        finish_reason=metrics.get("finish_reason"),
+    )
+    tracing.set_attributes(**{k: metrics.get(k) for k in _TRACED_COMPLETION_METRICS})
+
+
+# Completion metrics copied onto the generate_completion span
+_TRACED_COMPLETION_METRICS = (
+    "cached",
+    "prompt_tokens",
+    "completion_tokens",
+    "finish_reason",
+    "queue_wait_ms",
+    "prompt_eval_ms",
+    "time_to_first_token_ms",
+    "decode_ms",
+    "generation_ms",
+)
+
+
+def _load_and_generate(
+    prompt: str,
+    max_tokens: int = 256,
+    temperature: float = 0.7,
+    top_p: float = 0.9,
+    stop: Optional[List[str]] = None,
+    on_chunk: Optional[Callable[[str], None]] = None,
+    cache: Optional[bool] = None,
+    on_progress: Optional[Callable[[int], None]] = None,
+) -> tuple[List[TextContent], str]:
+    """Load the default model and generate a completion (runs on the inference thread)."""
+    with use_model() as model:
+        return generate_completion(
+            model,
+            prompt,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            top_p=top_p,
+            stop=stop,
+            streaming=DEFAULT_STREAMING_ENABLED,
+            chunk_size=DEFAULT_STREAMING_CHUNK_SIZE,
+            on_chunk=on_chunk,
+            cache=cache,
+            on_progress=on_progress,
+        )
+
+
+def _load_and_generate_for_session(
+    session_id: str,
+    message: str,
+    max_tokens: int = 256,
+    temperature: float = 0.7,
+    top_p: float = 0.9,
+    stop: Optional[List[str]] = None,
+    on_chunk: Optional[Callable[[str], None]] = None,
+    cache: Optional[bool] = None,
+    on_progress: Optional[Callable[[int], None]] = None,
+) -> tuple[List[TextContent], str]:
+    """Answer message in a session: pack its history into the context window,
+    generate (reusing the session's KV state) and persist the new turn.
+    """
+    usage: Dict[str, Any] = {}
+    with use_model() as model:
+        prompt, prefix_key = build_session_prompt(model, session_id, message, max_tokens)
+        restore_session_state(model, session_id, prefix_key)
+        chunks, full_text = generate_completion(
+            model,
+            prompt,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            top_p=top_p,
+            stop=stop,
+            streaming=DEFAULT_STREAMING_ENABLED,
+            chunk_size=DEFAULT_STREAMING_CHUNK_SIZE,
+            on_chunk=on_chunk,
+            cache=cache,
+            metrics=usage,
+            on_progress=on_progress,
+        )
+        # A cached answer decoded nothing: the model's state is not this session's
+        if not usage.get("cached"):
+            save_session_state(model, session_id, prefix_key)
+
+        # Persist the turn (with token counts, while the tokenizer is at hand)
+        full_text = full_text.strip()
+        append_session_message(session_id, "user", message, model=model)
+        append_session_message(session_id, "assistant", full_text, model=model)
+    return chunks, full_text
+
+
+# === Session storage helpers ==================================================
+
+def _new_session_meta(metadata: Optional[Dict[str, Any]] = None, now: Optional[str] = None) -> Dict[str, Any]:
+    now = now or datetime.utcnow().isoformat() + "Z"
+    return {
+        "created_at": now,
+        "last_used_at": now,
+        "message_count": 0,
+        "bytes": 0,
+        "status": "active",
+        "metadata": metadata or {},
+    }
+
+
+class SessionStore:
+    """Interface of a session storage backend.
+
+    A backend keeps per-session metadata (created_at, last_used_at,
+    message_count, bytes, status, metadata) and an ordered list of message
+    events ({"role", "content", "timestamp", ...}). Appending enforces the
+    SESSION_MAX_MESSAGES / SESSION_MAX_FILE_BYTES limits (when auto-trim is on),
+    always keeping a leading system message.
+    """
+
+    def __init__(self, max_messages: int, max_bytes: int, auto_trim: bool, fsync: bool = False):
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.auto_trim = auto_trim
+        self.fsync = fsync
+
+    def create(self, session_id: str, meta: Dict[str, Any]) -> None:
+        raise NotImplementedError
+
+    def append(self, session_id: str, event: Dict[str, Any]) -> int:
+        """Append an event. Returns how many old messages trimming dropped."""
+        raise NotImplementedError
+
+    def load_recent(self, session_id: str, max_messages: int) -> List[Dict[str, Any]]:
+        """Return the newest max_messages events (all if <= 0), oldest first."""
+        raise NotImplementedError
+
+    def load_head(self, session_id: str) -> Optional[Dict[str, Any]]:
+        """Return the session's leading system message (kept by trimming), if it has one."""
+        return _system_head(self.load_recent(session_id, 0))
+
+    def end(self, session_id: str, delete: bool = False) -> bool:
+        """Mark a session closed (optionally deleting its messages). False if unknown."""
+        raise NotImplementedError
+
+    def list_sessions(self) -> Dict[str, Dict[str, Any]]:
+        """Return {session_id: metadata} for every session."""
+        raise NotImplementedError
+
+    def replace_messages(self, session_id: str, events: List[Dict[str, Any]], status: str) -> bool:
+        """Replace all of a session's messages as-is (no trimming) and set its status.
+
+        last_used_at is left unchanged. False if the session is unknown.
+        """
+        raise NotImplementedError
+
+    def purge(self, sessions: Dict[str, str]) -> List[str]:
+        """Remove sessions entirely (metadata and messages).
+
+        sessions maps each session ID to the last_used_at it was selected with;
+        a session used since then is kept. Returns the IDs actually removed.
+        """
+        raise NotImplementedError
+
+    def reconcile(self, grace_s: float) -> Dict[str, int]:
+        """Delete stored data no session owns (older than grace_s) and repair stale counters.
+
+        Returns {"orphans": items deleted, "bytes": their size, "repaired": sessions fixed}.
+        """
+        return {"orphans": 0, "bytes": 0, "repaired": 0}
+
+    def get_meta(self, session_id: str) -> Optional[Dict[str, Any]]:
+        """Return one session's metadata, or None if unknown."""
+        return self.list_sessions().get(session_id)
+
+    def list_page(
+        self,
+        limit: int,
+        cursor: Optional[str] = None,
+        status: Optional[str] = None,
+        metadata: Optional[Dict[str, str]] = None,
+    ) -> Tuple[List[Tuple[str, Dict[str, Any]]], Optional[str]]:
+        """Return up to limit (session_id, metadata) pairs, most recently used first.
+
+        cursor is the next_cursor of the previous page; status and metadata
+        (exact string values) filter the sessions. Returns (page, next_cursor),
+        next_cursor being None on the last page. This default sorts every
+        session; stores override it with a maintained index.
+        """
+        sessions = self.list_sessions()
+        order = sorted((meta.get("last_used_at", ""), sid) for sid, meta in sessions.items())
+        return _page_sessions(order, sessions, limit, cursor, status, metadata)
+
+    def write_batch(
+        self, creates: Dict[str, Dict[str, Any]], appends: Dict[str, List[Dict[str, Any]]]
+    ) -> Dict[str, int]:
+        """Apply several creates and appends in one go (group commit).
+
+        Creates are applied first. Returns {session_id: messages dropped by trimming}.
+        """
+        for session_id, meta in creates.items():
+            self.create(session_id, meta)
+        return {sid: sum(self.append(sid, e) for e in events) for sid, events in appends.items()}
+
+    def close(self) -> None:
+        """Persist anything still pending and release resources."""
+
+
+def _event_bytes(event: Dict[str, Any]) -> int:
+    """Size of an event as a JSONL line, newline included (the session "bytes" unit)."""
+    return len(json.dumps(event, ensure_ascii=False).encode("utf-8")) + 1
+
+
+def _encode_session_cursor(last_used_at: str, session_id: str) -> str:
+    """Opaque pagination cursor: the sort key of the last session of a page."""
+    return base64.urlsafe_b64encode(json.dumps([last_used_at, session_id]).encode("utf-8")).decode("ascii")
+
+
+def _decode_session_cursor(cursor: str) -> Tuple[str, str]:
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        if isinstance(key, list) and len(key) == 2 and all(isinstance(k, str) for k in key):
+            return key[0], key[1]
+    except (ValueError, TypeError):
+        pass
+    raise ValueError(f"Invalid session cursor: {cursor!r}")
+
+
+def _session_matches(meta: Dict[str, Any], status: Optional[str], metadata: Optional[Dict[str, str]]) -> bool:
+    if status is not None and meta.get("status", "active") != status:
+        return False
+    values = meta.get("metadata") or {}
+    return all(values.get(key) == value for key, value in (metadata or {}).items())
+
+
+def _page_sessions(
+    order: List[Tuple[str, str]],
+    sessions: Dict[str, Dict[str, Any]],
+    limit: int,
+    cursor: Optional[str],
+    status: Optional[str],
+    metadata: Optional[Dict[str, str]],
+) -> Tuple[List[Tuple[str, Dict[str, Any]]], Optional[str]]:
+    """One page of sessions from order, a list of (last_used_at, session_id) kept ascending."""
+    end = len(order) if cursor is None else bisect.bisect_left(order, _decode_session_cursor(cursor))
+    page: List[Tuple[str, Dict[str, Any]]] = []
+    for i in range(end - 1, -1, -1):
+        last_used_at, session_id = order[i]
+        meta = sessions[session_id]
+        if not _session_matches(meta, status, metadata):
+            continue
+        if len(page) == limit:
+            last_id = page[-1][0]
+            return page, _encode_session_cursor(sessions[last_id].get("last_used_at", ""), last_id)
+        page.append((session_id, dict(meta)))
+    return page, None
+
+
+def _is_system_line(line: bytes) -> bool:
+    """True if a JSONL line holds a system message."""
+    try:
+        event = json.loads(line)
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        return False
+    return isinstance(event, dict) and event.get("role") == "system"
+
+
+def _fsync_file(path: Path) -> None:
+    """Flush a file's data to disk."""
+    with open(path, "rb+") as f:
+        os.fsync(f.fileno())
+
+
+def _system_head(events: List[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """Return the first event if it is a system message."""
+    return events[0] if events and events[0].get("role") == "system" else None
+
+
+def _read_tail_lines(path: Path, max_lines: int, block_size: int = 64 * 1024, start: int = 0) -> List[bytes]:
+    """Return the last max_lines lines of a file, reading backwards from the end.
+
+    Blocks are read from the end of the file until enough newlines have been
+    seen, so the cost depends on the size of the lines returned, not of the file.
+    max_lines <= 0 returns every line. A trailing newline does not start an
+    extra (empty) line; a partial last line without one is returned as-is.
+    Nothing before byte offset start (a line boundary) is read.
+    """
+    with open(path, "rb") as f:
+        if max_lines <= 0:
+            f.seek(start)
+            data = f.read()
+        else:
+            f.seek(0, os.SEEK_END)
+            pos = f.tell()
+            blocks: List[bytes] = []
+            newlines = 0
+            # One newline more than max_lines: the file normally ends with one
+            while pos > start and newlines <= max_lines:
+                step = min(block_size, pos - start)
+                pos -= step
+                f.seek(pos)
+                block = f.read(step)
+                blocks.append(block)
+                newlines += block.count(b"\n")
+            data = b"".join(reversed(blocks))
+
+    lines = data.split(b"\n")
+    if lines and not lines[-1]:
+        lines.pop()
+    if 0 < max_lines < len(lines):
+        # Drops the (possibly partial) first line of the first block read as well
+        lines = lines[-max_lines:]
+    return lines
+
+
+class JsonlSessionStore(SessionStore):
+    """JSONL layout: a segmented, append-only log per session.
+
+    history/<session_id>.log/ holds meta.json (the session's metadata and log
+    position), head.jsonl (the leading system message, if any) and numbered
+    segments (000000.jsonl, 000001.jsonl, ...). Lines are only ever appended to
+    the last segment; a new one is started once it reaches segment_bytes.
+    Trimming never rewrites a file: it moves the session's first live position
+    (meta["log"]: segment "first", byte "offset") past the dropped lines, and
+    message_count / bytes are updated incrementally. A background compactor
+    later deletes segments that are entirely dead and rewrites the first
+    segment once most of it is.
+
+    Reading or writing a session only touches its own meta.json, so the cost
+    does not grow with the number of sessions. history/sessions.stamp is
+    replaced on every metadata change so paginated listings can tell when
+    another process changed a session.
+
+    Sessions stored by older versions as a single history/<session_id>.jsonl
+    are read as-is and converted to a log on their next write; the
+    history/sessions_index.json they were listed in is split into meta.json
+    files on first use.
+    """
+
+    def __init__(
+        self,
+        history_dir: Path,
+        max_messages: int,
+        max_bytes: int,
+        auto_trim: bool,
+        fsync: bool = False,
+        segment_bytes: int = 256 * 1024,
+        compact_interval_s: float = 30.0,
+    ):
+        super().__init__(max_messages, max_bytes, auto_trim, fsync)
+        self.history_dir = history_dir
+        self.legacy_index_path = history_dir / "sessions_index.json"
+        self.stamp_path = history_dir / "sessions.stamp"
+        self.segment_bytes = max(1, segment_bytes)
+        self.compact_interval = compact_interval_s
+        self._lock = threading.RLock()
+        # Sessions whose first live position moved since the last compaction
+        self._dirty: set = set()
+        self._compact_wakeup = threading.Event()
+        self._compactor: Optional[threading.Thread] = None
+        self._closed = False
+        self._compact_stats = {"compactions": 0, "segments_deleted": 0, "segments_rewritten": 0, "bytes_reclaimed": 0}
+        # (listing stamp, sessions, [(last_used_at, session_id)] ascending) for paginated listing
+        self._listing: Optional[Tuple[Any, Dict[str, Dict[str, Any]], List[Tuple[str, str]]]] = None
+        self._ready = False
+
+    def _ensure_history_dir(self) -> None:
+        """Ensure the history directory exists, splitting a legacy sessions_index.json once."""
+        if self._ready:
+            return
+        with self._lock:
+            if self._ready:
+                return
+            self.history_dir.mkdir(parents=True, exist_ok=True)
+            if self.legacy_index_path.exists():
+                self._migrate_legacy_index()
+            self._ready = True
+
+    def _migrate_legacy_index(self) -> None:
+        """Write a meta.json for every session listed in the old single index, then retire it."""
+        try:
+            data = json.loads(self.legacy_index_path.read_text(encoding="utf-8") or "{}")
+            sessions = data.get("sessions") if isinstance(data, dict) else None
+        except (OSError, ValueError):
+            sessions = None
+        for session_id, meta in (sessions if isinstance(sessions, dict) else {}).items():
+            # A session already split (an interrupted migration) keeps its newer metadata
+            if isinstance(meta, dict) and not self._meta_path(session_id).exists():
+                self._write_meta(session_id, meta)
+        self.legacy_index_path.replace(self.history_dir / "sessions_index.migrated.json")
+        self._touch_stamp()
+
+    def _meta_path(self, session_id: str) -> Path:
+        return self.log_dir(session_id) / "meta.json"
+
+    def _read_meta(self, session_id: str) -> Optional[Dict[str, Any]]:
+        """Load one session's metadata (None if the session is unknown or its file unreadable)."""
+        self._ensure_history_dir()
+        try:
+            meta = json.loads(self._meta_path(session_id).read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return None
+        return meta if isinstance(meta, dict) else None
+
+    def _write_meta(self, session_id: str, meta: Dict[str, Any]) -> None:
+        """Persist one session's metadata atomically."""
+        log_dir = self.log_dir(session_id)
+        log_dir.mkdir(parents=True, exist_ok=True)
+        tmp_path = log_dir / f"meta.{os.getpid()}.tmp"
+        tmp_path.write_text(json.dumps(meta, ensure_ascii=False), encoding="utf-8")
+        if self.fsync:
+            _fsync_file(tmp_path)
+        tmp_path.replace(self._meta_path(session_id))
+
+    def _save_metas(self, changed: Dict[str, Optional[Dict[str, Any]]]) -> None:
+        """Persist the metadata of changed sessions (None: already removed) and update the listing."""
+        if not changed:
+            return
+        for session_id, meta in changed.items():
+            if meta is not None:
+                self._write_meta(session_id, meta)
+        stamp = self._listing_stamp()
+        self._touch_stamp()
+        self._update_listing(stamp, changed)
+
+    def _touch_stamp(self) -> None:
+        """Replace the listing stamp with a new random token to signal a metadata change."""
+        tmp_path = self.history_dir / f"sessions.{os.getpid()}.tmp"
+        tmp_path.write_text(uuid.uuid4().hex, encoding="utf-8")
+        tmp_path.replace(self.stamp_path)
+
+    def _listing_stamp(self) -> Optional[str]:
+        """Return the current listing stamp token (None before any session was written)."""
+        try:
+            return self.stamp_path.read_text(encoding="utf-8")
+        except OSError:
+            return None
+
+    def _update_listing(self, stamp_before: Any, changed: Dict[str, Optional[Dict[str, Any]]]) -> None:
+        """Carry the listing order over to just-saved metadata, re-sorting only the changed sessions."""
+        listing = self._listing
+        if listing is None or listing[0] != stamp_before:
+            # Not built yet, or another process changed a session meanwhile
+            self._listing = None
+            return
+        _, sessions, order = listing
+        for session_id, meta in changed.items():
+            before = sessions.pop(session_id, None)
+            if before is not None:
+                del order[bisect.bisect_left(order, (before.get("last_used_at", ""), session_id))]
+            if meta is not None:
+                sessions[session_id] = meta
+                bisect.insort(order, (meta.get("last_used_at", ""), session_id))
+        self._listing = (self._listing_stamp(), sessions, order)
+
+    def _has_message_files(self, session_id: str, meta: Dict[str, Any]) -> bool:
+        """True if the files holding a session's messages exist (the log, or a legacy single file)."""
+        if meta.get("log") is None:
+            return self.session_file_path(session_id).exists()
+        try:
+            return any(path.name != "meta.json" for path in self.log_dir(session_id).iterdir())
+        except OSError:
+            return False
+
+    def _delete_messages(self, session_id: str) -> None:
+        """Delete a session's message files, keeping its meta.json."""
+        try:
+            for path in self.log_dir(session_id).iterdir():
+                if path.name != "meta.json":
+                    path.unlink(missing_ok=True)
+        except OSError:
+            pass
+        self.session_file_path(session_id).unlink(missing_ok=True)
+
+    def session_file_path(self, session_id: str) -> Path:
+        """Return the path of a session's legacy single-file history."""
+        self._ensure_history_dir()
+        return self.history_dir / f"{session_id}.jsonl"
+
+    def log_dir(self, session_id: str) -> Path:
+        """Return the directory holding a session's log segments."""
+        return self.history_dir / f"{session_id}.log"
+
+    def _segment_path(self, session_id: str, n: int) -> Path:
+        return self.log_dir(session_id) / f"{n:06d}.jsonl"
+
+    @staticmethod
+    def _new_log() -> Dict[str, Any]:
+        # id tells a recreated log (after a delete) apart from the one it replaced
+        return {"id": uuid.uuid4().hex[:8], "first": 0, "offset": 0, "last": 0, "head": False}
+
+    def _close_segment(self, f) -> None:
+        if self.fsync:
+            f.flush()
+            os.fsync(f.fileno())
+        f.close()
+
+    def _log_state(self, session_id: str, meta: Dict[str, Any], converted: List[Path]) -> Dict[str, Any]:
+        """Return a session's log position, converting a legacy single-file history first.
+
+        Converted legacy files are appended to converted; the caller deletes them
+        once the metadata pointing at the new log has been saved.
+        """
+        log = meta.get("log")
+        if log is not None:
+            return log
+
+        log = self._new_log()
+        log_dir = self.log_dir(session_id)
+        log_dir.mkdir(parents=True, exist_ok=True)
+        legacy = self.session_file_path(session_id)
+        lines: List[bytes] = []
+        if legacy.exists():
+            lines = [line for line in legacy.read_bytes().split(b"\n") if line.strip()]
+            converted.append(legacy)
+        if lines and _is_system_line(lines[0]):
+            (log_dir / "head.jsonl").write_bytes(lines.pop(0) + b"\n")
+            log["head"] = True
+        with open(self._segment_path(session_id, 0), "wb") as f:
+            f.write(b"".join(line + b"\n" for line in lines))
+            self._close_segment(f)
+
+        meta["log"] = log
+        meta["message_count"] = len(lines) + (1 if log["head"] else 0)
+        meta["bytes"] = sum(len(line) + 1 for line in lines) + (
+            (log_dir / "head.jsonl").stat().st_size if log["head"] else 0
+        )
+        return log
+
+    def _append_lines(self, session_id: str, meta: Dict[str, Any], lines: List[bytes], converted: List[Path]) -> None:
+        """Append encoded lines (newline included) to the session's last segment."""
+        log = self._log_state(session_id, meta, converted)
+        self.log_dir(session_id).mkdir(parents=True, exist_ok=True)
+        if not log["head"] and meta.get("message_count", 0) == 0 and _is_system_line(lines[0]):
+            # A system message starting an empty session becomes the kept head
+            with open(self.log_dir(session_id) / "head.jsonl", "wb") as f:
+                f.write(lines[0])
+                self._close_segment(f)
+            log["head"] = True
+            meta["message_count"] = 1
+            meta["bytes"] = len(lines[0])
+            lines = lines[1:]
+
+        f = None
+        try:
+            for line in lines:
+                if f is None:
+                    f = open(self._segment_path(session_id, log["last"]), "ab")
+                    size = f.tell()
+                if size >= self.segment_bytes:
+                    # Roll over to a new segment
+                    self._close_segment(f)
+                    log["last"] += 1
+                    f = open(self._segment_path(session_id, log["last"]), "ab")
+                    size = 0
+                f.write(line)
+                size += len(line)
+        finally:
+            if f is not None:
+                self._close_segment(f)
+        meta["message_count"] = meta.get("message_count", 0) + len(lines)
+        meta["bytes"] = meta.get("bytes", 0) + sum(len(line) for line in lines)
+
+    def _promote_head(self, session_id: str, log: Dict[str, Any]) -> None:
+        """Keep the oldest live line as the head if it is a system message.
+
+        As in a single history file, where the first line is kept when it is a
+        system message, whichever message is oldest at trim time.
+        """
+        n, offset = log["first"], log["offset"]
+        line = b""
+        while n <= log["last"] and not line:
+            try:
+                with open(self._segment_path(session_id, n), "rb") as f:
+                    f.seek(offset)
+                    line = f.readline()
+            except FileNotFoundError:
+                pass
+            if not line:
+                n, offset = n + 1, 0
+        if not line or not _is_system_line(line):
+            return
+        with open(self.log_dir(session_id) / "head.jsonl", "wb") as f:
+            f.write(line if line.endswith(b"\n") else line + b"\n")
+            self._close_segment(f)
+        log["head"] = True
+        log["first"], log["offset"] = n, offset + len(line)
+        self._dirty.add(session_id)
+
+    def _trim_log(self, session_id: str, meta: Dict[str, Any]) -> int:
+        """Drop the oldest messages (after the head) beyond the limits by moving the live start.
+
+        Only the dropped lines are read, so the cost is proportional to what is
+        trimmed (one line per append once a session is at its limit).
+        """
+        if not self.auto_trim:
+            return 0
+        log = meta["log"]
+        count, size = meta.get("message_count", 0), meta.get("bytes", 0)
+        if not log["head"] and count and (count > self.max_messages or size > self.max_bytes):
+            self._promote_head(session_id, log)
+        head = 1 if log["head"] else 0
+        dropped = 0
+        f = None
+        try:
+            while count > head and (count > max(self.max_messages, head) or size > self.max_bytes):
+                if f is None:
+                    f = open(self._segment_path(session_id, log["first"]), "rb")
+                    f.seek(log["offset"])
+                line = f.readline()
+                if not line:
+                    # End of this segment: it is now entirely dead
+                    f.close()
+                    f = None
+                    if log["first"] >= log["last"]:
+                        break
+                    log["first"] += 1
+                    log["offset"] = 0
+                    self._compact_wakeup.set()
+                    continue
+                log["offset"] += len(line)
+                count -= 1
+                size -= len(line)
+                dropped += 1
+        finally:
+            if f is not None:
+                f.close()
+
+        if dropped:
+            meta["message_count"] = count
+            meta["bytes"] = size
+            self._dirty.add(session_id)
+            self._ensure_compactor()
+        return dropped
+
+    def _read_log(self, session_id: str, meta: Dict[str, Any], max_messages: int) -> List[bytes]:
+        """Return the newest max_messages live lines (all if <= 0), reading segments from the end."""
+        log = meta["log"]
+        count = meta.get("message_count", 0)
+        if max_messages <= 0 or max_messages >= count:
+            include_head, want = log["head"], count - (1 if log["head"] else 0)
+        else:
+            # The head is the oldest message, so it is only returned with everything else
+            include_head, want = False, max_messages
+
+        lines: List[bytes] = []
+        n = log["last"]
+        while n >= log["first"] and len(lines) < want:
+            path = self._segment_path(session_id, n)
+            if path.exists():
+                start = log["offset"] if n == log["first"] else 0
+                lines = _read_tail_lines(path, want - len(lines), start=start) + lines
+            n -= 1
+        if include_head:
+            lines.insert(0, (self.log_dir(session_id) / "head.jsonl").read_bytes().rstrip(b"\n"))
+        return lines
+
+    def create(self, session_id: str, meta: Dict[str, Any]) -> None:
+        self.write_batch({session_id: meta}, {})
+
+    def append(self, session_id: str, event: Dict[str, Any]) -> int:
+        return self.write_batch({}, {session_id: [event]}).get(session_id, 0)
+
+    def write_batch(
+        self, creates: Dict[str, Dict[str, Any]], appends: Dict[str, List[Dict[str, Any]]]
+    ) -> Dict[str, int]:
+        # Only the sessions in the batch are touched: one log write and one meta.json each
+        converted: List[Path] = []
+        with self._lock:
+            changed: Dict[str, Optional[Dict[str, Any]]] = {}
+            for session_id, meta in creates.items():
+                changed[session_id] = {**meta, "log": self._new_log()}
+
+            dropped: Dict[str, int] = {}
+            for session_id, events in appends.items():
+                if not events:
+                    continue
+                meta = changed.get(session_id) or self._read_meta(session_id)
+                if meta is None:
+                    # Unknown session; create basic entry so we don't lose data
+                    meta = _new_session_meta(now=events[0]["timestamp"])
+                changed[session_id] = meta
+
+                lines = [json.dumps(e, ensure_ascii=False).encode("utf-8") + b"\n" for e in events]
+                self._append_lines(session_id, meta, lines, converted)
+                meta["last_used_at"] = events[-1]["timestamp"]
+                dropped[session_id] = self._trim_log(session_id, meta)
+
+            self._save_metas(changed)
+            for legacy in converted:
+                legacy.unlink(missing_ok=True)
+            return dropped
+
+    def load_recent(self, session_id: str, max_messages: int) -> List[Dict[str, Any]]:
+        # Only the session's meta.json and the most recent N lines are read, seeking from the end of the log
+        try:
+            with self._lock:
+                meta = self._read_meta(session_id)
+                if meta is not None and meta.get("log") is not None:
+                    lines = self._read_log(session_id, meta, max_messages)
+                else:
+                    path = self.session_file_path(session_id)
+                    if not path.exists():
+                        return []
+                    lines = _read_tail_lines(path, max_messages)
+        except OSError:
+            return []
+
+        messages: List[Dict[str, Any]] = []
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                event = json.loads(line)
+                if isinstance(event, dict):
+                    messages.append(event)
+            except (json.JSONDecodeError, UnicodeDecodeError):
+                continue
+
+        return messages
+
+    def load_head(self, session_id: str) -> Optional[Dict[str, Any]]:
+        # The leading system message is head.jsonl; a legacy single file has it on its first line
+        try:
+            with self._lock:
+                meta = self._read_meta(session_id)
+                if meta is not None and meta.get("log") is not None:
+                    if not meta["log"]["head"]:
+                        return None
+                    line = (self.log_dir(session_id) / "head.jsonl").read_bytes()
+                else:
+                    path = self.session_file_path(session_id)
+                    if not path.exists():
+                        return None
+                    with open(path, "rb") as f:
+                        line = f.readline()
+            event = json.loads(line)
+        except (OSError, json.JSONDecodeError, UnicodeDecodeError):
+            return None
+        return _system_head([event]) if isinstance(event, dict) else None
+
+    def end(self, session_id: str, delete: bool = False) -> bool:
+        with self._lock:
+            meta = self._read_meta(session_id)
+            if meta is None:
+                return False
+
+            meta["status"] = "closed"
+            meta["last_used_at"] = datetime.utcnow().isoformat() + "Z"
+
+            if delete:
+                try:
+                    self._delete_messages(session_id)
+                    meta["bytes"] = 0
+                    meta["message_count"] = 0
+                    meta["log"] = self._new_log()
+                    self._dirty.discard(session_id)
+                except Exception:
+                    # Best effort; keep metadata if delete fails
+                    pass
+
+            self._save_metas({session_id: meta})
+            return True
+
+    def replace_messages(self, session_id: str, events: List[Dict[str, Any]], status: str) -> bool:
+        with self._lock:
+            meta = self._read_meta(session_id)
+            if meta is None:
+                return False
+            self._delete_messages(session_id)
+            self._dirty.discard(session_id)
+            meta.update(log=self._new_log(), message_count=0, bytes=0, status=status)
+            if events:
+                lines = [json.dumps(e, ensure_ascii=False).encode("utf-8") + b"\n" for e in events]
+                self._append_lines(session_id, meta, lines, [])
+            self._save_metas({session_id: meta})
+            return True
+
+    def purge(self, sessions: Dict[str, str]) -> List[str]:
+        with self._lock:
+            removed = []
+            for session_id, last_used_at in sessions.items():
+                meta = self._read_meta(session_id)
+                if meta is None or meta.get("last_used_at", "") != last_used_at:
+                    continue
+                # Metadata first: a crash before the files are gone leaves orphans for reconcile()
+                try:
+                    self._meta_path(session_id).unlink()
+                except OSError:
+                    continue
+                self._dirty.discard(session_id)
+                shutil.rmtree(self.log_dir(session_id), ignore_errors=True)
+                self.session_file_path(session_id).unlink(missing_ok=True)
+                removed.append(session_id)
+            self._save_metas({session_id: None for session_id in removed})
+            return removed
+
+    def reconcile(self, grace_s: float) -> Dict[str, int]:
+        result = {"orphans": 0, "bytes": 0, "repaired": 0}
+        cutoff = time.time() - grace_s
+        sessions = self.list_sessions()
+        # Scanned without the lock; every candidate is checked again under it
+        orphans: List[Tuple[str, Path]] = []
+        try:
+            with os.scandir(self.history_dir) as it:
+                for entry in it:
+                    if entry.name.endswith(".log") and entry.is_dir():
+                        session_id = entry.name[:-len(".log")]
+                    elif entry.name.endswith(".jsonl") and entry.is_file():
+                        session_id = entry.name[:-len(".jsonl")]
+                    else:
+                        continue
+                    if session_id not in sessions and entry.stat().st_mtime < cutoff:
+                        orphans.append((session_id, Path(entry.path)))
+        except OSError:
+            return result
+        # Sessions with messages whose files are gone (deleted by hand, or a crash mid-delete)
+        missing = [
+            sid for sid, meta in sessions.items()
+            if meta.get("message_count", 0) and not self._has_message_files(sid, meta)
+        ]
+        if not orphans and not missing:
+            return result
+
+        with self._lock:
+            repaired: Dict[str, Optional[Dict[str, Any]]] = {}
+            for session_id, path in orphans:
+                if self._meta_path(session_id).exists():
+                    continue
+                try:
+                    if path.is_dir():
+                        size = sum(f.stat().st_size for f in path.iterdir())
+                        shutil.rmtree(path)
+                    else:
+                        size = path.stat().st_size
+                        path.unlink()
+                except OSError:
+                    continue
+                result["orphans"] += 1
+                result["bytes"] += size
+            for session_id in missing:
+                meta = self._read_meta(session_id)
+                if meta is None or self._has_message_files(session_id, meta):
+                    continue
+                meta.update(log=self._new_log(), message_count=0, bytes=0)
+                self._dirty.discard(session_id)
+                repaired[session_id] = meta
+            result["repaired"] = len(repaired)
+            self._save_metas(repaired)
+        return result
+
+    def list_sessions(self) -> Dict[str, Dict[str, Any]]:
+        self._ensure_history_dir()
+        sessions: Dict[str, Dict[str, Any]] = {}
+        try:
+            with os.scandir(self.history_dir) as it:
+                names = [entry.name for entry in it if entry.name.endswith(".log") and entry.is_dir()]
+        except OSError:
+            return sessions
+        for name in names:
+            session_id = name[:-len(".log")]
+            meta = self._read_meta(session_id)
+            if meta is not None:
+                sessions[session_id] = meta
+        return sessions
+
+    def get_meta(self, session_id: str) -> Optional[Dict[str, Any]]:
+        return self._read_meta(session_id)
+
+    def list_page(
+        self,
+        limit: int,
+        cursor: Optional[str] = None,
+        status: Optional[str] = None,
+        metadata: Optional[Dict[str, str]] = None,
+    ) -> Tuple[List[Tuple[str, Dict[str, Any]]], Optional[str]]:
+        # Sessions are only read and sorted again when another process has changed one
+        with self._lock:
+            self._ensure_history_dir()
+            stamp = self._listing_stamp()
+            if self._listing is None or self._listing[0] != stamp:
+                sessions = self.list_sessions()
+                order = sorted((meta.get("last_used_at", ""), sid) for sid, meta in sessions.items())
+                self._listing = (stamp, sessions, order)
+            _, sessions, order = self._listing
+            return _page_sessions(order, sessions, limit, cursor, status, metadata)
+
+    # --- background compaction ---
+
+    def compact(self) -> Dict[str, int]:
+        """Reclaim space behind the live start of recently trimmed sessions.
+
+        Segments entirely before it are deleted; the first live segment is
+        rewritten without its dead prefix once that prefix is at least half of
+        it (never the last segment, which is still being appended to).
+        """
+        reclaimed = {"segments_deleted": 0, "segments_rewritten": 0, "bytes_reclaimed": 0}
+        rewrites: Dict[str, Dict[str, Any]] = {}
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+            for session_id in dirty:
+                log = (self._read_meta(session_id) or {}).get("log")
+                if not log:
+                    continue
+                try:
+                    # Segments before the first live one are never read again
+                    for path in self.log_dir(session_id).glob("*.jsonl"):
+                        if path.stem.isdigit() and int(path.stem) < log["first"]:
+                            reclaimed["bytes_reclaimed"] += path.stat().st_size
+                            path.unlink()
+                            reclaimed["segments_deleted"] += 1
+                    path = self._segment_path(session_id, log["first"])
+                    if log["first"] < log["last"] and log["offset"] and log["offset"] * 2 >= path.stat().st_size:
+                        rewrites[session_id] = dict(log)
+                except OSError as e:
+                    print(f"Warning: compaction of session {session_id} failed: {e}", file=sys.stderr)
+
+        for session_id, log in rewrites.items():
+            path = self._segment_path(session_id, log["first"])
+            try:
+                # The segment is immutable (not the last), so copy its live part without the lock
+                with open(path, "rb") as f:
+                    f.seek(log["offset"])
+                    live = f.read()
+                tmp_path = path.with_suffix(".tmp")
+                with open(tmp_path, "wb") as f:
+                    f.write(live)
+                    self._close_segment(f)
+                with self._lock:
+                    meta = self._read_meta(session_id) or {}
+                    current = meta.get("log")
+                    if (
+                        current
+                        and current.get("id") == log.get("id")
+                        and current["first"] == log["first"]
+                        and current["offset"] >= log["offset"]
+                    ):
+                        tmp_path.replace(path)
+                        current["offset"] -= log["offset"]
+                        self._save_metas({session_id: meta})
+                        reclaimed["segments_rewritten"] += 1
+                        reclaimed["bytes_reclaimed"] += log["offset"]
+                    else:
+                        tmp_path.unlink()
+            except OSError as e:
+                print(f"Warning: compaction of session {session_id} failed: {e}", file=sys.stderr)
+
+        with self._lock:
+            self._compact_stats["compactions"] += 1
+            for key, value in reclaimed.items():
+                self._compact_stats[key] += value
+        return reclaimed
+
+    def _ensure_compactor(self) -> None:
+        if self._compactor is None and not self._closed:
+            self._compactor = threading.Thread(target=self._compact_loop, name="session-compactor", daemon=True)
+            self._compactor.start()
+
+    def _compact_loop(self) -> None:
+        # Runs every compact_interval, or sooner once a whole segment has become dead
+        while not self._closed:
+            self._compact_wakeup.wait(self.compact_interval)
+            self._compact_wakeup.clear()
+            if self._closed:
+                return
+            try:
+                self.compact()
+            except Exception as e:
+                print(f"Warning: session log compaction failed: {e}", file=sys.stderr)
+
+    def compaction_stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._compact_stats)
+
+    def close(self) -> None:
+        self._closed = True
+        self._compact_wakeup.set()
+        if self._compactor is not None:
+            self._compactor.join(timeout=5)
+
+
+def _connect_sqlite(db_path: Path, fsync: bool) -> sqlite3.Connection:
+    """Open a WAL-mode connection in autocommit mode (transactions are explicit)."""
+    conn = sqlite3.connect(str(db_path), timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    # NORMAL only syncs the WAL at checkpoints; FULL syncs on every commit
+    conn.execute(f"PRAGMA synchronous={'FULL' if fsync else 'NORMAL'}")
+    return conn
+
+
+class SqliteSessionStore(SessionStore):
+    """Sessions in one SQLite database (WAL mode) under the history directory.
+
+    Messages live in a single table keyed by (session_id, seq), so an append is
+    one indexed insert plus an in-place counter update, and trimming is a range
+    delete. message_count and bytes (the size the message would take as a JSONL
+    line) are maintained incrementally.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS sessions (
+            id TEXT PRIMARY KEY,
+            created_at TEXT NOT NULL,
+            last_used_at TEXT NOT NULL,
+            message_count INTEGER NOT NULL DEFAULT 0,
+            bytes INTEGER NOT NULL DEFAULT 0,
+            status TEXT NOT NULL DEFAULT 'active',
+            metadata TEXT NOT NULL DEFAULT '{}'
+        );
+        CREATE TABLE IF NOT EXISTS messages (
+            session_id TEXT NOT NULL,
+            seq INTEGER NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            timestamp TEXT NOT NULL,
+            extra TEXT,
+            bytes INTEGER NOT NULL,
+            PRIMARY KEY (session_id, seq)
+        ) WITHOUT ROWID;
+        -- Listing order (most recently used first), unfiltered and by status
+        CREATE INDEX IF NOT EXISTS sessions_by_last_used ON sessions (last_used_at, id);
+        CREATE INDEX IF NOT EXISTS sessions_by_status ON sessions (status, last_used_at, id);
+    """
+
+    def __init__(self, db_path: Path, max_messages: int, max_bytes: int, auto_trim: bool, fsync: bool = False):
+        super().__init__(max_messages, max_bytes, auto_trim, fsync)
+        self.db_path = db_path
+        self._local = threading.local()
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn().executescript(self.SCHEMA)
+
+    def _conn(self) -> sqlite3.Connection:
+        """Return this thread's connection (sqlite3 connections are not shared across threads)."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = _connect_sqlite(self.db_path, self.fsync)
+            self._local.conn = conn
+        return conn
+
+    def close(self) -> None:
+        """Close this thread's connection."""
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    @staticmethod
+    def _meta_from_row(row: sqlite3.Row) -> Dict[str, Any]:
+        try:
+            metadata = json.loads(row["metadata"] or "{}")
+        except json.JSONDecodeError:
+            metadata = {}
+        return {
+            "created_at": row["created_at"],
+            "last_used_at": row["last_used_at"],
+            "message_count": row["message_count"],
+            "bytes": row["bytes"],
+            "status": row["status"],
+            "metadata": metadata,
+        }
+
+    @staticmethod
+    def _event_row(event: Dict[str, Any]) -> tuple:
+        extra = {k: v for k, v in event.items() if k not in ("role", "content", "timestamp")}
+        return (
+            event.get("role", "user"),
+            event.get("content", ""),
+            event.get("timestamp", ""),
+            json.dumps(extra, ensure_ascii=False) if extra else None,
+            _event_bytes(event),
+        )
+
+    @staticmethod
+    def _event_from_row(row: sqlite3.Row) -> Dict[str, Any]:
+        event = {"role": row["role"], "content": row["content"], "timestamp": row["timestamp"]}
+        if row["extra"]:
+            try:
+                event.update(json.loads(row["extra"]))
+            except json.JSONDecodeError:
+                pass
+        return event
+
+    def _insert_session(self, conn: sqlite3.Connection, session_id: str, meta: Dict[str, Any]) -> None:
+        conn.execute(
+            "INSERT OR REPLACE INTO sessions (id, created_at, last_used_at, message_count, bytes, status, metadata)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                session_id,
+                meta.get("created_at", ""),
+                meta.get("last_used_at", ""),
+                meta.get("message_count", 0),
+                meta.get("bytes", 0),
+                meta.get("status", "active"),
+                json.dumps(meta.get("metadata") or {}, ensure_ascii=False),
+            ),
+        )
+
+    def create(self, session_id: str, meta: Dict[str, Any]) -> None:
+        with self._transaction() as conn:
+            self._insert_session(conn, session_id, meta)
+
+    def _trim(self, conn: sqlite3.Connection, session_id: str) -> int:
+        """Drop the oldest messages (after a leading system message) beyond the limits."""
+        row = conn.execute(
+            "SELECT message_count, bytes FROM sessions WHERE id = ?", (session_id,)
+        ).fetchone()
+        count, size = row["message_count"], row["bytes"]
+        if count <= self.max_messages and size <= self.max_bytes:
+            return 0
+
+        first = conn.execute(
+            "SELECT seq, role FROM messages WHERE session_id = ? ORDER BY seq LIMIT 1", (session_id,)
+        ).fetchone()
+        head_seq = first["seq"] if first is not None and first["role"] == "system" else -1
+        keep_head = 1 if head_seq >= 0 else 0
+
+        # Everything with seq in (head_seq, cutoff] is dropped
+        cutoff = -1
+        over_count = count - max(self.max_messages, keep_head)
+        if over_count > 0:
+            row = conn.execute(
+                "SELECT seq FROM messages WHERE session_id = ? AND seq > ? ORDER BY seq LIMIT 1 OFFSET ?",
+                (session_id, head_seq, over_count - 1),
+            ).fetchone()
+            cutoff = row["seq"] if row is not None else cutoff
+
+        removed_bytes = conn.execute(
+            "SELECT COALESCE(SUM(bytes), 0) FROM messages WHERE session_id = ? AND seq > ? AND seq <= ?",
+            (session_id, head_seq, cutoff),
+        ).fetchone()[0]
+        if size - removed_bytes > self.max_bytes:
+            # Still too large: walk the oldest remaining messages until it fits
+            excess = size - removed_bytes - self.max_bytes
+            for msg in conn.execute(
+                "SELECT seq, bytes FROM messages WHERE session_id = ? AND seq > ? ORDER BY seq",
+                (session_id, max(head_seq, cutoff)),
+            ):
+                cutoff = msg["seq"]
+                excess -= msg["bytes"]
+                if excess <= 0:
+                    break
+
+        if cutoff <= head_seq:
+            return 0
+        deleted = conn.execute(
+            "DELETE FROM messages WHERE session_id = ? AND seq > ? AND seq <= ? RETURNING bytes",
+            (session_id, head_seq, cutoff),
+        ).fetchall()
+        conn.execute(
+            "UPDATE sessions SET message_count = message_count - ?, bytes = bytes - ? WHERE id = ?",
+            (len(deleted), sum(r[0] for r in deleted), session_id),
+        )
+        return len(deleted)
+
+    def _append_events(self, conn: sqlite3.Connection, session_id: str, events: List[Dict[str, Any]]) -> int:
+        if conn.execute("SELECT 1 FROM sessions WHERE id = ?", (session_id,)).fetchone() is None:
+            # Unknown session; create basic entry so we don't lose data
+            self._insert_session(conn, session_id, _new_session_meta(now=events[0]["timestamp"]))
+        seq = conn.execute(
+            "SELECT COALESCE(MAX(seq), -1) + 1 FROM messages WHERE session_id = ?", (session_id,)
+        ).fetchone()[0]
+        rows = [self._event_row(e) for e in events]
+        conn.executemany(
+            "INSERT INTO messages (session_id, seq, role, content, timestamp, extra, bytes)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(session_id, seq + i, *row) for i, row in enumerate(rows)],
+        )
+        conn.execute(
+            "UPDATE sessions SET last_used_at = ?, message_count = message_count + ?, bytes = bytes + ?"
+            " WHERE id = ?",
+            (events[-1]["timestamp"], len(rows), sum(r[-1] for r in rows), session_id),
+        )
+        return self._trim(conn, session_id) if self.auto_trim else 0
+
+    def append(self, session_id: str, event: Dict[str, Any]) -> int:
+        with self._transaction() as conn:
+            return self._append_events(conn, session_id, [event])
+
+    def write_batch(
+        self, creates: Dict[str, Dict[str, Any]], appends: Dict[str, List[Dict[str, Any]]]
+    ) -> Dict[str, int]:
+        # A single transaction, so the whole batch costs one commit (and at most one fsync)
+        with self._transaction() as conn:
+            for session_id, meta in creates.items():
+                self._insert_session(conn, session_id, meta)
+            return {sid: self._append_events(conn, sid, events) for sid, events in appends.items() if events}
+
+    def load_recent(self, session_id: str, max_messages: int) -> List[Dict[str, Any]]:
+        if max_messages > 0:
+            rows = self._conn().execute(
+                "SELECT * FROM messages WHERE session_id = ? ORDER BY seq DESC LIMIT ?",
+                (session_id, max_messages),
+            ).fetchall()
+            rows.reverse()
+        else:
+            rows = self._conn().execute(
+                "SELECT * FROM messages WHERE session_id = ? ORDER BY seq", (session_id,)
+            ).fetchall()
+        return [self._event_from_row(r) for r in rows]
+
+    def load_head(self, session_id: str) -> Optional[Dict[str, Any]]:
+        row = self._conn().execute(
+            "SELECT * FROM messages WHERE session_id = ? ORDER BY seq LIMIT 1", (session_id,)
+        ).fetchone()
+        return _system_head([self._event_from_row(row)]) if row is not None else None
+
+    def end(self, session_id: str, delete: bool = False) -> bool:
+        with self._transaction() as conn:
+            cur = conn.execute(
+                "UPDATE sessions SET status = 'closed', last_used_at = ? WHERE id = ?",
+                (datetime.utcnow().isoformat() + "Z", session_id),
+            )
+            if cur.rowcount == 0:
+                return False
+            if delete:
+                conn.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+                conn.execute("UPDATE sessions SET message_count = 0, bytes = 0 WHERE id = ?", (session_id,))
+            return True
+
+    def replace_messages(self, session_id: str, events: List[Dict[str, Any]], status: str) -> bool:
+        rows = [self._event_row(e) for e in events]
+        with self._transaction() as conn:
+            cur = conn.execute(
+                "UPDATE sessions SET message_count = ?, bytes = ?, status = ? WHERE id = ?",
+                (len(rows), sum(r[-1] for r in rows), status, session_id),
+            )
+            if cur.rowcount == 0:
+                return False
+            conn.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+            conn.executemany(
+                "INSERT INTO messages (session_id, seq, role, content, timestamp, extra, bytes)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(session_id, seq, *row) for seq, row in enumerate(rows)],
+            )
+            return True
+
+    def purge(self, sessions: Dict[str, str]) -> List[str]:
+        removed = []
+        with self._transaction() as conn:
+            for session_id, last_used_at in sessions.items():
+                cur = conn.execute(
+                    "DELETE FROM sessions WHERE id = ? AND last_used_at = ?", (session_id, last_used_at)
+                )
+                if cur.rowcount:
+                    conn.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+                    removed.append(session_id)
+        return removed
+
+    def reconcile(self, grace_s: float) -> Dict[str, int]:
+        # Messages of sessions that no longer exist. One primary-key seek per
+        # distinct session_id instead of a scan of the whole messages table.
+        conn = self._conn()
+        orphans = []
+        row = conn.execute("SELECT session_id FROM messages ORDER BY session_id LIMIT 1").fetchone()
+        while row is not None:
+            session_id = row[0]
+            if conn.execute("SELECT 1 FROM sessions WHERE id = ?", (session_id,)).fetchone() is None:
+                orphans.append(session_id)
+            row = conn.execute(
+                "SELECT session_id FROM messages WHERE session_id > ? ORDER BY session_id LIMIT 1", (session_id,)
+            ).fetchone()
+        result = {"orphans": 0, "bytes": 0, "repaired": 0}
+        if not orphans:
+            return result
+        with self._transaction() as conn:
+            for session_id in orphans:
+                if conn.execute("SELECT 1 FROM sessions WHERE id = ?", (session_id,)).fetchone() is not None:
+                    continue
+                size = conn.execute(
+                    "SELECT COALESCE(SUM(bytes), 0) FROM messages WHERE session_id = ?", (session_id,)
+                ).fetchone()[0]
+                conn.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+                result["orphans"] += 1
+                result["bytes"] += size
+        return result
+
+    def list_sessions(self) -> Dict[str, Dict[str, Any]]:
+        rows = self._conn().execute("SELECT * FROM sessions").fetchall()
+        return {r["id"]: self._meta_from_row(r) for r in rows}
+
+    def get_meta(self, session_id: str) -> Optional[Dict[str, Any]]:
+        row = self._conn().execute("SELECT * FROM sessions WHERE id = ?", (session_id,)).fetchone()
+        return self._meta_from_row(row) if row is not None else None
+
+    def list_page(
+        self,
+        limit: int,
+        cursor: Optional[str] = None,
+        status: Optional[str] = None,
+        metadata: Optional[Dict[str, str]] = None,
+    ) -> Tuple[List[Tuple[str, Dict[str, Any]]], Optional[str]]:
+        # Keyset pagination: walks an index backwards from the cursor, whatever the page number
+        clauses: List[str] = []
+        params: List[Any] = []
+        if cursor is not None:
+            clauses.append("(last_used_at, id) < (?, ?)")
+            params.extend(_decode_session_cursor(cursor))
+        if status is not None:
+            clauses.append("status = ?")
+            params.append(status)
+        for key, value in (metadata or {}).items():
+            clauses.append("json_extract(metadata, ?) = ?")
+            params.extend(["$." + json.dumps(key), value])
+        where = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+        rows = self._conn().execute(
+            f"SELECT * FROM sessions{where} ORDER BY last_used_at DESC, id DESC LIMIT ?", (*params, limit + 1)
+        ).fetchall()
+        page = [(r["id"], self._meta_from_row(r)) for r in rows[:limit]]
+        if len(rows) <= limit:
+            return page, None
+        return page, _encode_session_cursor(rows[limit - 1]["last_used_at"], rows[limit - 1]["id"])
+
+    def import_session(self, session_id: str, meta: Dict[str, Any], events: List[Dict[str, Any]]) -> None:
+        """Replace a session with the given metadata and events, as-is (used by the migrator)."""
+        rows = [self._event_row(e) for e in events]
+        meta = {**meta, "message_count": len(rows), "bytes": sum(r[-1] for r in rows)}
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+            self._insert_session(conn, session_id, meta)
+            conn.executemany(
+                "INSERT INTO messages (session_id, seq, role, content, timestamp, extra, bytes)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(session_id, seq, *row) for seq, row in enumerate(rows)],
+            )
+
+
+def migrate_jsonl_sessions(history_dir: Path, target: SqliteSessionStore) -> Dict[str, int]:
+    """Copy sessions from the JSONL layout in history_dir into target.
+
+    Every stored session (an old sessions_index.json is split first) and
+    orphaned <id>.jsonl files are imported; existing sessions in target with
+    the same ID are replaced, so the migration can be re-run. The JSONL files
+    are left untouched.
+    """
+    source = JsonlSessionStore(history_dir, max_messages=0, max_bytes=0, auto_trim=False)
+    sessions = dict(source.list_sessions())
+    for path in history_dir.glob("*.jsonl"):
+        sessions.setdefault(path.stem, _new_session_meta(metadata={"migrated_orphan": True}))
+
+    counts = {"sessions": 0, "messages": 0}
+    for session_id, meta in sessions.items():
+        events = source.load_recent(session_id, max_messages=0)
+        target.import_session(session_id, meta, events)
+        counts["sessions"] += 1
+        counts["messages"] += len(events)
+    return counts
+
+
+class WriteBehindSessionStore(SessionStore):
+    """In-memory cache of active sessions in front of a backend, persisted in the background.
+
+    Recent messages and metadata of recently used sessions are kept in memory,
+    so reads and appends on the chat path do not touch the disk. Writes update
+    the cache (trimming included) and are queued; a flusher thread writes
+    everything queued to the backend as one batch (group commit) at most
+    max_delay_ms after the first write. close() drains the queue.
+
+    Each process has its own cache: writes made by one process are not seen by
+    another until they are flushed, and a second process's cached copy can
+    overwrite them. Only enable it when a single process (the MCP server or the
+    web chat) uses the session history.
+    """
+
+    def __init__(
+        self,
+        backend: SessionStore,
+        max_delay_ms: int = 100,
+        max_sessions: int = 256,
+        on_drop: Optional[Callable[[str], None]] = None,
+    ):
+        super().__init__(backend.max_messages, backend.max_bytes, backend.auto_trim, backend.fsync)
+        self.backend = backend
+        self.max_delay = max(0, max_delay_ms) / 1000
+        self.max_sessions = max(1, max_sessions)
+        # Called when the backend trimmed a session differently than the cache predicted
+        self.on_drop = on_drop
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._creates: Dict[str, Dict[str, Any]] = {}
+        self._appends: Dict[str, List[Dict[str, Any]]] = {}
+        self._expected_drops: Dict[str, int] = {}
+        self._in_flight: set = set()
+        self._closed = False
+        self._stats = {"hits": 0, "misses": 0, "flushes": 0, "flushed_writes": 0, "max_batch": 0, "flush_errors": 0}
+        self._thread = threading.Thread(target=self._run, name="session-flusher", daemon=True)
+        self._thread.start()
+
+    # --- cache (all called with self._cond held) ---
+
+    def _has_writes(self, session_id: str) -> bool:
+        return session_id in self._creates or session_id in self._appends or session_id in self._in_flight
+
+    def _new_entry(self, meta: Dict[str, Any], messages: List[Dict[str, Any]], complete: bool) -> Dict[str, Any]:
+        return {
+            "meta": meta,
+            "messages": messages,
+            "sizes": [_event_bytes(e) for e in messages],
+            # True when messages is the whole session, not just its newest part
+            "complete": complete,
+            "stale": False,
+        }
+
+    def _cached(self, session_id: str) -> Optional[Dict[str, Any]]:
+        entry = self._entries.get(session_id)
+        if entry is not None and entry["stale"] and not self._has_writes(session_id):
+            return None
+        return entry
+
+    def _entry(self, session_id: str) -> Optional[Dict[str, Any]]:
+        """Return a session's cache entry, loading it from the backend on a miss.
+
+        The backend is read with self._cond released, so a cold session does not
+        hold up every other session; the cache is checked again afterwards in
+        case another thread filled it meanwhile.
+        """
+        entry = self._cached(session_id)
+        if entry is not None:
+            self._entries.move_to_end(session_id)
+            self._stats["hits"] += 1
+            return entry
+
+        self._stats["misses"] += 1
+        window = max(self.max_messages, 1)
+        self._cond.release()
+        try:
+            meta = self.backend.get_meta(session_id)
+            messages = self.backend.load_recent(session_id, window) if meta is not None else []
+        finally:
+            self._cond.acquire()
+
+        entry = self._cached(session_id)
+        if entry is not None:
+            self._entries.move_to_end(session_id)
+            return entry
+        self._entries.pop(session_id, None)
+        if meta is None:
+            return None
+        complete = len(messages) < window or meta.get("message_count", 0) <= len(messages)
+        entry = self._new_entry(meta, messages, complete)
+        self._entries[session_id] = entry
+        self._evict()
+        return entry
+
+    def _trim_entry(self, entry: Dict[str, Any]) -> int:
+        """Apply the backend's trimming rules to a cached session; returns messages dropped."""
+        messages, sizes, meta = entry["messages"], entry["sizes"], entry["meta"]
+        window = max(self.max_messages, 1)
+        if not self.auto_trim or not entry["complete"]:
+            # Nothing is dropped from storage; only bound what is kept in memory
+            if len(messages) > window:
+                del messages[:-window], sizes[:-window]
+                entry["complete"] = False
+            return 0
+
+        head = 1 if messages and messages[0].get("role") == "system" else 0
+        drop = max(0, len(messages) - max(self.max_messages, head))
+        size = meta.get("bytes", 0) - sum(sizes[head:head + drop])
+        while head + drop < len(messages) and size > self.max_bytes:
+            size -= sizes[head + drop]
+            drop += 1
+        if drop:
+            del messages[head:head + drop], sizes[head:head + drop]
+            meta["message_count"] = len(messages)
+            meta["bytes"] = size
+        return drop
+
+    def _queue_write(
+        self,
+        session_id: str,
+        create: Optional[Dict[str, Any]] = None,
+        event: Optional[Dict[str, Any]] = None,
+        dropped: int = 0,
+    ) -> None:
+        if not (self._creates or self._appends):
+            self._cond.notify_all()  # wake the flusher; it waits for the queue to fill otherwise
+        if create is not None:
+            self._creates[session_id] = create
+        if event is not None:
+            self._appends.setdefault(session_id, []).append(event)
+            self._expected_drops[session_id] = self._expected_drops.get(session_id, 0) + dropped
+
+    def _evict(self) -> None:
+        """Drop least recently used sessions beyond max_sessions.
+
+        Sessions with unwritten changes are kept, and so is the most recently
+        used one (the caller may be about to modify it).
+        """
+        excess = len(self._entries) - self.max_sessions
+        for session_id in list(self._entries)[:-1]:
+            if excess <= 0:
+                break
+            if not self._has_writes(session_id):
+                del self._entries[session_id]
+                excess -= 1
+
+    # --- SessionStore interface ---
+
+    def create(self, session_id: str, meta: Dict[str, Any]) -> None:
+        with self._cond:
+            if not self._closed:
+                self._entries[session_id] = self._new_entry(dict(meta), [], complete=True)
+                self._queue_write(session_id, create=dict(meta))
+                self._evict()
+                return
+        with self._flush_lock:
+            self.backend.create(session_id, meta)
+
+    def append(self, session_id: str, event: Dict[str, Any]) -> int:
+        with self._cond:
+            if not self._closed:
+                entry = self._entry(session_id)
+                if entry is None:
+                    # Unknown session; the backend creates a basic entry on append
+                    entry = self._new_entry(_new_session_meta(now=event["timestamp"]), [], complete=True)
+                    self._entries[session_id] = entry
+                meta = entry["meta"]
+                entry["messages"].append(event)
+                entry["sizes"].append(_event_bytes(event))
+                meta["last_used_at"] = event["timestamp"]
+                meta["message_count"] = meta.get("message_count", 0) + 1
+                meta["bytes"] = meta.get("bytes", 0) + entry["sizes"][-1]
+                dropped = self._trim_entry(entry)
+
+                self._queue_write(session_id, event=event, dropped=dropped)
+                return dropped
+        with self._flush_lock:
+            return self.backend.append(session_id, event)
+
+    def load_recent(self, session_id: str, max_messages: int) -> List[Dict[str, Any]]:
+        with self._cond:
+            if not self._closed:
+                entry = self._entry(session_id)
+                if entry is None:
+                    return []
+                messages = entry["messages"]
+                if entry["complete"] or 0 < max_messages <= len(messages):
+                    selected = messages[-max_messages:] if max_messages > 0 else messages
+                    return [dict(e) for e in selected]
+        # Older messages than the cache holds: read through to the backend
+        self.flush()
+        return self.backend.load_recent(session_id, max_messages)
+
+    def load_head(self, session_id: str) -> Optional[Dict[str, Any]]:
+        with self._cond:
+            if not self._closed:
+                entry = self._entry(session_id)
+                if entry is None:
+                    return None
+                if entry["complete"]:
+                    head = _system_head(entry["messages"])
+                    return dict(head) if head is not None else None
+        self.flush()
+        return self.backend.load_head(session_id)
+
+    def _invalidate(self, session_id: str) -> None:
+        with self._cond:
+            if not self._has_writes(session_id):
+                self._entries.pop(session_id, None)
+            elif session_id in self._entries:
+                self._entries[session_id]["stale"] = True
+
+    def end(self, session_id: str, delete: bool = False) -> bool:
+        self.flush()
+        existed = self.backend.end(session_id, delete=delete)
+        self._invalidate(session_id)
+        return existed
+
+    def replace_messages(self, session_id: str, events: List[Dict[str, Any]], status: str) -> bool:
+        self.flush()
+        existed = self.backend.replace_messages(session_id, events, status)
+        self._invalidate(session_id)
+        return existed
+
+    def purge(self, sessions: Dict[str, str]) -> List[str]:
+        self.flush()
+        with self._cond:
+            # The cache knows about uses the backend has not seen yet
+            sessions = {
+                sid: last_used_at for sid, last_used_at in sessions.items()
+                if not self._has_writes(sid)
+                and (sid not in self._entries or self._entries[sid]["meta"].get("last_used_at", "") == last_used_at)
+            }
+            for session_id in sessions:
+                self._entries.pop(session_id, None)
+        return self.backend.purge(sessions)
+
+    def reconcile(self, grace_s: float) -> Dict[str, int]:
+        self.flush()
+        return self.backend.reconcile(grace_s)
+
+    def list_sessions(self) -> Dict[str, Dict[str, Any]]:
+        sessions = self.backend.list_sessions()
+        with self._cond:
+            # Cached metadata is at least as new as what has been written
+            for session_id, entry in self._entries.items():
+                sessions[session_id] = dict(entry["meta"])
+        return sessions
+
+    def get_meta(self, session_id: str) -> Optional[Dict[str, Any]]:
+        with self._cond:
+            entry = self._entries.get(session_id)
+            if entry is not None:
+                return dict(entry["meta"])
+        return self.backend.get_meta(session_id)
+
+    def list_page(
+        self,
+        limit: int,
+        cursor: Optional[str] = None,
+        status: Optional[str] = None,
+        metadata: Optional[Dict[str, str]] = None,
+    ) -> Tuple[List[Tuple[str, Dict[str, Any]]], Optional[str]]:
+        # Queued appends move last_used_at (the sort key), so write them before paging the backend's index
+        self.flush()
+        return self.backend.list_page(limit, cursor, status, metadata)
+
+    # --- write-behind ---
+
+    def _flush_locked(self) -> bool:
+        with self._cond:
+            creates, appends, expected = self._creates, self._appends, self._expected_drops
+            if not creates and not appends:
+                return True
+            self._creates, self._appends, self._expected_drops = {}, {}, {}
+            self._in_flight = set(creates) | set(appends)
+        n_writes = len(creates) + sum(len(events) for events in appends.values())
+
+        try:
+            dropped = self.backend.write_batch(creates, appends)
+        except Exception as e:
+            with self._cond:
+                # Put the batch back in front of anything queued meanwhile; it is retried
+                self._creates = {**creates, **self._creates}
+                for session_id, events in appends.items():
+                    self._appends[session_id] = events + self._appends.get(session_id, [])
+                for session_id, count in expected.items():
+                    self._expected_drops[session_id] = count + self._expected_drops.get(session_id, 0)
+                self._in_flight = set()
+                self._stats["flush_errors"] += 1
+            print(f"Warning: could not persist {n_writes} session writes: {e}", file=sys.stderr)
+            return False
+
+        resynced = []
+        with self._cond:
+            self._in_flight = set()
+            self._stats["flushes"] += 1
+            self._stats["flushed_writes"] += n_writes
+            self._stats["max_batch"] = max(self._stats["max_batch"], n_writes)
+            for session_id, count in dropped.items():
+                if count != expected.get(session_id, 0):
+                    # The backend trimmed differently (e.g. byte accounting); reload on next use
+                    if session_id in self._entries:
+                        self._entries[session_id]["stale"] = True
+                    resynced.append(session_id)
+            self._evict()
+        if self.on_drop:
+            for session_id in resynced:
+                self.on_drop(session_id)
+        return True
+
+    def flush(self) -> bool:
+        """Write all queued creates and appends to the backend now. False if that failed."""
+        with self._flush_lock:
+            return self._flush_locked()
+
+    def _wait_closed(self, timeout: float) -> bool:
+        """Wait up to timeout seconds (lock held); True if close() was called meanwhile."""
+        deadline = time.monotonic() + timeout
+        while not self._closed:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            self._cond.wait(remaining)
+        return self._closed
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while not (self._creates or self._appends) and not self._closed:
+                    self._cond.wait()
+                # Group commit: writes arriving within max_delay join this batch
+                if self._wait_closed(self.max_delay):
+                    return
+            if not self.flush():
+                with self._cond:
+                    if self._wait_closed(max(self.max_delay, 1.0)):
+                        return
+
+    def close(self) -> None:
+        """Stop the flusher and persist everything still queued.
+
+        Later calls go straight to the backend.
+        """
+        with self._flush_lock:
+            with self._cond:
+                if self._closed:
+                    return
+                self._closed = True
+                self._cond.notify_all()
+            if not self._flush_locked():
+                with self._cond:
+                    lost = len(self._creates) + sum(len(v) for v in self._appends.values())
+                print(f"Error: {lost} session writes could not be persisted", file=sys.stderr)
+        self._thread.join(timeout=5)
+        self.backend.close()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            return {
+                "enabled": True,
+                "cached_sessions": len(self._entries),
+                "pending_writes": len(self._creates) + sum(len(v) for v in self._appends.values()),
+                **self._stats,
+                "max_delay_ms": int(self.max_delay * 1000),
+                "fsync": self.fsync,
+            }
+
+
+class SessionArchiver:
+    """Moves cold sessions out of the session store into compressed archives.
+
+    A background thread looks every interval_s for sessions closed for longer
+    than closed_after_h, or still active but idle for longer than idle_after_h
+    (0 disables either). All their messages are written to
+    archive_dir/<session_id>.jsonl.gz and removed from the store; the session
+    itself stays, with status "archived", so listings still show it.
+    archive_dir/manifest.json records each archive (sizes, previous status).
+
+    Reading an archived session decompresses it on demand; writing to it again
+    rehydrates it first (its messages go back to the store, the archive is
+    removed). A session counts as archived only while the store says so, so a
+    crash between the steps of either operation never hides messages.
+    """
+
+    def __init__(
+        self,
+        store: SessionStore,
+        archive_dir: Path,
+        closed_after_h: float = 24.0,
+        idle_after_h: float = 720.0,
+        interval_s: float = 600.0,
+    ):
+        self.store = store
+        self.archive_dir = archive_dir
+        self.manifest_path = archive_dir / "manifest.json"
+        self.closed_after_h = closed_after_h
+        self.idle_after_h = idle_after_h
+        self.interval = interval_s
+        self._lock = threading.RLock()
+        self._manifest: Dict[str, Dict[str, Any]] = {}
+        self._manifest_stamp: Any = None
+        self._closed = False
+        self._wakeup = threading.Event()
+        self._stats = {
+            "archived": 0,
+            "restored": 0,
+            "reads": 0,
+            "errors": 0,
+            "archive_ms_total": 0.0,
+            "archive_ms_max": 0.0,
+            "restore_ms_total": 0.0,
+            "restore_ms_max": 0.0,
+        }
+        self._thread: Optional[threading.Thread] = None
+        if interval_s > 0 and (closed_after_h > 0 or idle_after_h > 0):
+            self._thread = threading.Thread(target=self._run, name="session-archiver", daemon=True)
+            self._thread.start()
+
+    # --- manifest (called with self._lock held) ---
+
+    def _entries(self) -> Dict[str, Dict[str, Any]]:
+        """Return the manifest, re-reading it if another process has replaced it."""
+        try:
+            st = self.manifest_path.stat()
+            stamp: Any = (st.st_ino, st.st_mtime_ns, st.st_size)
+        except OSError:
+            stamp = None
+        if stamp != self._manifest_stamp:
+            manifest: Dict[str, Dict[str, Any]] = {}
+            if stamp is not None:
+                try:
+                    manifest = json.loads(self.manifest_path.read_text(encoding="utf-8")).get("sessions", {})
+                except (OSError, ValueError, AttributeError):
+                    manifest = {}
+            self._manifest, self._manifest_stamp = manifest, stamp
+        return self._manifest
+
+    def _save_manifest(self) -> None:
+        self.archive_dir.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.manifest_path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps({"sessions": self._manifest}, ensure_ascii=False, indent=2), encoding="utf-8")
+        if self.store.fsync:
+            _fsync_file(tmp_path)
+        tmp_path.replace(self.manifest_path)
+        st = self.manifest_path.stat()
+        self._manifest_stamp = (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def _archive_path(self, session_id: str) -> Path:
+        return self.archive_dir / f"{session_id}.jsonl.gz"
+
+    def _read_archive(self, session_id: str) -> List[Dict[str, Any]]:
+        raw = gzip.decompress(self._archive_path(session_id).read_bytes())
+        events = []
+        for line in raw.split(b"\n"):
+            if line.strip():
+                try:
+                    events.append(json.loads(line))
+                except (json.JSONDecodeError, UnicodeDecodeError):
+                    continue
+        return events
+
+    def _drop(self, session_id: str) -> None:
+        self._entries().pop(session_id, None)
+        self._save_manifest()
+        self._archive_path(session_id).unlink(missing_ok=True)
+
+    def _archived_meta(self, session_id: str) -> Optional[Dict[str, Any]]:
+        """The store's metadata of a session in the manifest, or None if it is not (or no longer) archived."""
+        if session_id not in self._entries():
+            return None
+        meta = self.store.get_meta(session_id)
+        if meta is None or meta.get("status") != "archived":
+            # Left over from an interrupted archive/restore; the store has the messages
+            self._drop(session_id)
+            return None
+        return meta
+
+    def _record(self, kind: str, start: float) -> None:
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        self._stats["archived" if kind == "archive" else "restored"] += 1
+        self._stats[f"{kind}_ms_total"] += elapsed_ms
+        self._stats[f"{kind}_ms_max"] = max(self._stats[f"{kind}_ms_max"], elapsed_ms)
+
+    # --- operations ---
+
+    def archive(self, session_id: str, cutoff: Optional[str] = None) -> bool:
+        """Archive one session (only if last used before cutoff, when given). True if archived."""
+        with self._lock:
+            if session_id in self._entries():
+                return False
+            meta = self.store.get_meta(session_id)
+            if meta is None or meta.get("status") == "archived":
+                return False
+            if cutoff is not None and meta.get("last_used_at", "") >= cutoff:
+                return False
+            start = time.perf_counter()
+            events = self.store.load_recent(session_id, 0)
+            raw = b"".join(json.dumps(e, ensure_ascii=False).encode("utf-8") + b"\n" for e in events)
+            compressed = gzip.compress(raw)
+
+            self.archive_dir.mkdir(parents=True, exist_ok=True)
+            path = self._archive_path(session_id)
+            tmp_path = path.with_suffix(".tmp")
+            with open(tmp_path, "wb") as f:
+                f.write(compressed)
+                if self.store.fsync:
+                    f.flush()
+                    os.fsync(f.fileno())
+            tmp_path.replace(path)
+            # Manifest first, store last: until the store says "archived", reads still use it
+            self._entries()[session_id] = {
+                "messages": len(events),
+                "bytes": len(raw),
+                "compressed_bytes": len(compressed),
+                "status": meta.get("status", "active"),
+                "archived_at": datetime.utcnow().isoformat() + "Z",
+            }
+            self._save_manifest()
+            self.store.replace_messages(session_id, [], "archived")
+            self._record("archive", start)
+            return True
+
+    def restore(self, session_id: str) -> bool:
+        """Rehydrate an archived session into the store. False if it was not archived."""
+        with self._lock:
+            if session_id not in self._entries():
+                return False
+            if self._archived_meta(session_id) is None:
+                return False
+            start = time.perf_counter()
+            # Messages written to the store after archiving (e.g. by another process) come last
+            events = self._read_archive(session_id) + self.store.load_recent(session_id, 0)
+            status = self._entries()[session_id].get("status", "active")
+            self.store.replace_messages(session_id, events, status)
+            self._drop(session_id)
+            self._record("restore", start)
+            return True
+
+    def load_recent(self, session_id: str, max_messages: int) -> Optional[List[Dict[str, Any]]]:
+        """Recent messages of an archived session, decompressed; None if it is not archived."""
+        with self._lock:
+            if session_id not in self._entries() or self._archived_meta(session_id) is None:
+                return None
+            events = self._read_archive(session_id) + self.store.load_recent(session_id, 0)
+            self._stats["reads"] += 1
+        return events[-max_messages:] if max_messages > 0 else events
+
+    def discard(self, session_id: str) -> None:
+        """Delete a session's archive, if any (its history is being deleted)."""
+        with self._lock:
+            if session_id in self._entries():
+                self._drop(session_id)
+
+    def sizes(self) -> Dict[str, int]:
+        """Return {session_id: compressed archive bytes} for every archive in the manifest."""
+        with self._lock:
+            return {sid: e.get("compressed_bytes", 0) for sid, e in self._entries().items()}
+
+    def prune_files(self, grace_s: float) -> Dict[str, int]:
+        """Delete archive files older than grace_s that the manifest does not list (e.g. left by a crash)."""
+        result = {"orphans": 0, "bytes": 0}
+        cutoff = time.time() - grace_s
+        with self._lock:
+            entries = self._entries()
+            # Unfinished writes (*.tmp) only go once they are older than grace_s too
+            paths = [p for p in self.archive_dir.glob("*.jsonl.gz") if p.name[: -len(".jsonl.gz")] not in entries]
+            paths += self.archive_dir.glob("*.tmp")
+            for path in paths:
+                try:
+                    st = path.stat()
+                    if st.st_mtime >= cutoff:
+                        continue
+                    path.unlink()
+                except OSError:
+                    continue
+                result["orphans"] += 1
+                result["bytes"] += st.st_size
+        return result
+
+    def run_once(self) -> int:
+        """Archive every session past its TTL now; returns how many were archived."""
+        now = datetime.utcnow()
+        archived = 0
+        for status, hours in (("closed", self.closed_after_h), ("active", self.idle_after_h)):
+            if hours <= 0:
+                continue
+            cutoff = (now - timedelta(hours=hours)).isoformat() + "Z"
+            # Keyset cursor at the cutoff: the listing index yields only sessions last used before it
+            cursor: Optional[str] = _encode_session_cursor(cutoff, "")
+            while cursor is not None and not self._closed:
+                page, cursor = self.store.list_page(100, cursor, status)
+                for session_id, _ in page:
+                    try:
+                        archived += self.archive(session_id, cutoff)
+                    except Exception as e:
+                        self._stats["errors"] += 1
+                        print(f"Warning: archiving session {session_id} failed: {e}", file=sys.stderr)
+        return archived
+
+    def _run(self) -> None:
+        # The first pass waits one interval, so short-lived processes never archive
+        while not self._wakeup.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception as e:
+                print(f"Warning: session archival failed: {e}", file=sys.stderr)
+
+    def close(self) -> None:
+        self._closed = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            entries = list(self._entries().values())
+            stats = dict(self._stats)
+        raw = sum(e.get("bytes", 0) for e in entries)
+        compressed = sum(e.get("compressed_bytes", 0) for e in entries)
+        return {
+            "enabled": self._thread is not None,
+            "sessions": len(entries),
+            "bytes": raw,
+            "compressed_bytes": compressed,
+            "bytes_saved": raw - compressed,
+            "archived": stats["archived"],
+            "restored": stats["restored"],
+            "reads": stats["reads"],
+            "errors": stats["errors"],
+            "avg_archive_ms": round(stats["archive_ms_total"] / stats["archived"], 2) if stats["archived"] else 0.0,
+            "max_archive_ms": round(stats["archive_ms_max"], 2),
+            "avg_restore_ms": round(stats["restore_ms_total"] / stats["restored"], 2) if stats["restored"] else 0.0,
+            "max_restore_ms": round(stats["restore_ms_max"], 2),
+        }
+
+
+def _fts_query(text: str) -> str:
+    """Turn free text into an FTS5 query: every word required, the last one as a prefix.
+
+    Words shorter than three characters are only matched whole: a shorter prefix
+    expands to a large part of the vocabulary and makes ranking slow.
+    """
+    words = re.findall(r"\w+", text)
+    if not words:
+        return ""
+    terms = [f'"{w}"' for w in words]
+    if len(words[-1]) >= 3:
+        terms[-1] += "*"
+    return " ".join(terms)
+
+
+class SessionSearchIndex:
+    """Full-text index (SQLite FTS5) over session messages, in its own database.
+
+    It is kept apart from the session store, so it works with either backend
+    and stays off the chat path. append_session_message() only queues the new
+    message (with the number of old ones trimming dropped); an indexer thread
+    applies the queue in one transaction at most flush_delay_ms later.
+    search() applies whatever is still queued first.
+
+    Messages live in a plain table (docs) indexed by session, with an
+    external-content FTS5 table over it, so trimmed or deleted messages are
+    removed without scanning the full-text index. A new database is filled
+    from the existing history in the background (rebuild()).
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS docs (
+            id INTEGER PRIMARY KEY,
+            session_id TEXT NOT NULL,
+            role TEXT NOT NULL,
+            timestamp TEXT NOT NULL,
+            content TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS docs_by_session ON docs (session_id, id);
+        CREATE VIRTUAL TABLE IF NOT EXISTS docs_fts USING fts5(
+            content, content='docs', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2', prefix='3'
+        );
+        CREATE TRIGGER IF NOT EXISTS docs_ai AFTER INSERT ON docs BEGIN
+            INSERT INTO docs_fts (rowid, content) VALUES (new.id, new.content);
+        END;
+        CREATE TRIGGER IF NOT EXISTS docs_ad AFTER DELETE ON docs BEGIN
+            INSERT INTO docs_fts (docs_fts, rowid, content) VALUES ('delete', old.id, old.content);
+        END;
+    """
+
+    def __init__(
+        self,
+        db_path: Path,
+        loader: Callable[[str], List[Dict[str, Any]]],
+        list_session_ids: Callable[[], List[str]],
+        flush_delay_ms: int = 100,
+        fsync: bool = False,
+    ):
+        self.db_path = db_path
+        # Read a session's stored messages / list every session (resync and rebuild)
+        self.loader = loader
+        self.list_session_ids = list_session_ids
+        self.flush_delay = max(0, flush_delay_ms) / 1000
+        self.fsync = fsync
+        self._local = threading.local()
+        is_new = not db_path.exists()
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn().executescript(self.SCHEMA)
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._ops: List[tuple] = []
+        self._closed = False
+        self._stats = {"indexed": 0, "removed": 0, "flushes": 0, "searches": 0, "search_ms_total": 0.0, "search_ms_max": 0.0}
+        self._rebuild_pending = is_new
+        self._thread = threading.Thread(target=self._run, name="session-indexer", daemon=True)
+        self._thread.start()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = _connect_sqlite(self.db_path, self.fsync)
+            self._local.conn = conn
+        return conn
+
+    # --- updates (queued) ---
+
+    def _queue(self, op: tuple) -> None:
+        with self._cond:
+            if not self._ops:
+                self._cond.notify_all()
+            self._ops.append(op)
+
+    def add(self, session_id: str, event: Dict[str, Any], dropped: int = 0) -> None:
+        """Index a message just appended to a session; dropped = older messages trimming removed."""
+        self._queue(("add", session_id, event, dropped))
+
+    def remove(self, session_id: str) -> None:
+        """Forget every message of a session."""
+        self._queue(("replace", session_id, []))
+
+    def resync(self, session_id: str) -> None:
+        """Re-index a session from the store (its stored messages differ from what was indexed)."""
+        self._queue(("resync", session_id))
+
+    def _drop_oldest(self, conn: sqlite3.Connection, session_id: str, count: int) -> None:
+        # Mirrors the store's trimming: the oldest messages go, except a leading system message
+        first = conn.execute(
+            "SELECT id, role FROM docs WHERE session_id = ? ORDER BY id LIMIT 1", (session_id,)
+        ).fetchone()
+        head = first["id"] if first is not None and first["role"] == "system" else -1
+        cur = conn.execute(
+            "DELETE FROM docs WHERE id IN (SELECT id FROM docs WHERE session_id = ? AND id > ? ORDER BY id LIMIT ?)",
+            (session_id, head, count),
+        )
+        self._stats["removed"] += cur.rowcount
+
+    def _insert(self, conn: sqlite3.Connection, session_id: str, events: List[Dict[str, Any]]) -> None:
+        rows = [
+            (session_id, e.get("role", "user"), e.get("timestamp", ""), e.get("content", ""))
+            for e in events
+            if e.get("content")
+        ]
+        conn.executemany("INSERT INTO docs (session_id, role, timestamp, content) VALUES (?, ?, ?, ?)", rows)
+        self._stats["indexed"] += len(rows)
+
+    def flush(self) -> None:
+        """Apply every queued update now."""
+        with self._flush_lock:
+            with self._cond:
+                ops, self._ops = self._ops, []
+            if not ops:
+                return
+            # Resyncs read the store outside the transaction; what they load already
+            # includes every message queued for that session in this batch
+            resynced = {op[1] for op in ops if op[0] == "resync"}
+            ops = [
+                ("replace", op[1], self.loader(op[1])) if op[0] == "resync" else op
+                for op in ops
+                if not (op[0] == "add" and op[1] in resynced)
+            ]
+            conn = self._conn()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                for op in ops:
+                    if op[0] == "add":
+                        _, session_id, event, dropped = op
+                        self._insert(conn, session_id, [event])
+                        if dropped:
+                            self._drop_oldest(conn, session_id, dropped)
+                    else:
+                        _, session_id, events = op
+                        cur = conn.execute("DELETE FROM docs WHERE session_id = ?", (session_id,))
+                        self._stats["removed"] += cur.rowcount
+                        self._insert(conn, session_id, events)
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+            self._stats["flushes"] += 1
+
+    def rebuild(self) -> int:
+        """Re-index every stored session from the store; returns how many were indexed."""
+        count = 0
+        for session_id in self.list_session_ids():
+            if self._closed:
+                break
+            self._queue(("resync", session_id))
+            count += 1
+            if count % 100 == 0:
+                self.flush()
+        self.flush()
+        return count
+
+    def _run(self) -> None:
+        if self._rebuild_pending:
+            try:
+                count = self.rebuild()
+                print(f"Indexed {count} sessions for search in {self.db_path.name}", file=sys.stderr)
+            except Exception as e:
+                print(f"Warning: building the session search index failed: {e}", file=sys.stderr)
+        while True:
+            with self._cond:
+                while not self._ops and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+                # Updates arriving within flush_delay join this transaction
+                self._cond.wait(self.flush_delay)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Warning: session search indexing failed: {e}", file=sys.stderr)
+                time.sleep(1.0)
+
+    # --- queries ---
+
+    def session_ids(self) -> List[str]:
+        """Return the ID of every session with indexed messages."""
+        self.flush()
+        conn = self._conn()
+        ids: List[str] = []
+        # One index seek per session rather than a scan of every indexed message
+        row = conn.execute("SELECT session_id FROM docs ORDER BY session_id LIMIT 1").fetchone()
+        while row is not None:
+            ids.append(row[0])
+            row = conn.execute(
+                "SELECT session_id FROM docs WHERE session_id > ? ORDER BY session_id LIMIT 1", (row[0],)
+            ).fetchone()
+        return ids
+
+    def search(
+        self,
+        query: str,
+        limit: int = 20,
+        session_id: Optional[str] = None,
+        mark: Tuple[str, str] = ("[", "]"),
+    ) -> List[Dict[str, Any]]:
+        """Messages matching every word of query (the last one as a prefix), best match first.
+
+        Each hit has session_id, role, timestamp, score (higher is better) and a
+        snippet of the message with the matched words between the two mark strings.
+        """
+        match = _fts_query(query)
+        if not match:
+            return []
+        self.flush()
+        start = time.perf_counter()
+        sql = (
+            "SELECT d.session_id, d.role, d.timestamp, f.snippet, f.rank"
+            " FROM (SELECT rowid, snippet(docs_fts, 0, ?, ?, '…', 16) AS snippet, rank FROM docs_fts"
+            "       WHERE docs_fts MATCH ?{scope} ORDER BY rank LIMIT ?) AS f"
+            " JOIN docs d ON d.id = f.rowid ORDER BY f.rank"
+        )
+        params: List[Any] = [mark[0], mark[1], match]
+        scope = ""
+        if session_id is not None:
+            scope = " AND rowid IN (SELECT id FROM docs WHERE session_id = ?)"
+            params.append(session_id)
+        params.append(limit)
+        rows = self._conn().execute(sql.format(scope=scope), params).fetchall()
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        self._stats["searches"] += 1
+        self._stats["search_ms_total"] += elapsed_ms
+        self._stats["search_ms_max"] = max(self._stats["search_ms_max"], elapsed_ms)
+        return [
+            {
+                "session_id": r["session_id"],
+                "role": r["role"],
+                "timestamp": r["timestamp"],
+                "snippet": r["snippet"],
+                "score": round(-r["rank"], 4),
+            }
+            for r in rows
+        ]
+
+    def close(self) -> None:
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join(timeout=5)
+        try:
+            self.flush()
+        except Exception as e:
+            print(f"Error: session search updates could not be saved: {e}", file=sys.stderr)
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            pending = len(self._ops)
+        stats = dict(self._stats)
+        searches = stats["searches"]
+        return {
+            "enabled": True,
+            "pending": pending,
+            "indexed": stats["indexed"],
+            "removed": stats["removed"],
+            "flushes": stats["flushes"],
+            "searches": searches,
+            "avg_search_ms": round(stats["search_ms_total"] / searches, 2) if searches else 0.0,
+            "max_search_ms": round(stats["search_ms_max"], 2),
+        }
+
+
+class SessionGarbageCollector:
+    """Removes stale sessions and orphaned session data in the background.
+
+    Every interval_s a pass walks the session listing, most recently used
+    first, and removes entirely (store, archive, search index, KV cache):
+
+    - sessions last used more than ttl_h ago (0 keeps them forever)
+    - sessions without messages (e.g. ended with delete) idle for grace_s
+    - once the sessions kept so far fill quota_bytes (0 = unlimited), every
+      older one; stored plus archived bytes count towards it
+
+    It then reconciles what is on disk with the store: files no session owns
+    (store files without an index entry, archives, KV-cache states and search
+    entries of unknown sessions) are deleted. A session used since the walk
+    saw it is never removed, and files younger than grace_s are left alone.
+    Work goes in batches of batch sessions with a short pause between them, so
+    requests are not held up. What a pass reclaimed is logged to stderr.
+    """
+
+    def __init__(
+        self,
+        store: SessionStore,
+        archiver: SessionArchiver,
+        search: Optional[SessionSearchIndex],
+        state_cache: "SessionStateCache",
+        quota_bytes: int = 0,
+        ttl_h: float = 0.0,
+        interval_s: float = 900.0,
+        grace_s: float = 3600.0,
+        batch: int = 100,
+    ):
+        self.store = store
+        self.archiver = archiver
+        self.search = search
+        self.state_cache = state_cache
+        self.quota_bytes = max(0, quota_bytes)
+        self.ttl_h = ttl_h
+        self.interval = interval_s
+        self.grace_s = grace_s
+        self.batch = max(1, batch)
+        self._lock = threading.Lock()
+        self._closed = False
+        self._wakeup = threading.Event()
+        self._stats = {
+            "runs": 0,
+            "expired": 0,
+            "empty": 0,
+            "over_quota": 0,
+            "orphans": 0,
+            "repaired": 0,
+            "bytes_reclaimed": 0,
+            "errors": 0,
+            "last_run_ms": 0.0,
+            "stored_bytes": 0,
+        }
+        self._thread: Optional[threading.Thread] = None
+        if interval_s > 0:
+            self._thread = threading.Thread(target=self._run, name="session-gc", daemon=True)
+            self._thread.start()
+
+    def _forget(self, session_id: str) -> None:
+        """Drop everything kept about a session outside the store."""
+        self.archiver.discard(session_id)
+        if self.search is not None:
+            self.search.remove(session_id)
+        self.state_cache.invalidate(session_id)
+
+    def _remove(self, doomed: Dict[str, Tuple[str, str, int]], result: Dict[str, int]) -> None:
+        if not doomed:
+            return
+        removed = self.store.purge({sid: last_used_at for sid, (last_used_at, _, _) in doomed.items()})
+        for session_id in removed:
+            _, reason, size = doomed[session_id]
+            self._forget(session_id)
+            result[reason] += 1
+            result["bytes_reclaimed"] += size
+
+    def _reconcile(self, known: set, result: Dict[str, int]) -> None:
+        for found in (self.store.reconcile(self.grace_s), self.archiver.prune_files(self.grace_s)):
+            result["orphans"] += found["orphans"]
+            result["bytes_reclaimed"] += found["bytes"]
+            result["repaired"] += found.get("repaired", 0)
+        archived = self.archiver.sizes()
+        derived = set(archived) | set(self.state_cache.session_ids())
+        if self.search is not None:
+            derived.update(self.search.session_ids())
+        unknown = derived - known
+        if unknown:
+            # Sessions created after the walk are not orphans
+            unknown -= set(self.store.list_sessions())
+        for session_id in unknown:
+            self._forget(session_id)
+            result["orphans"] += 1
+            result["bytes_reclaimed"] += archived.get(session_id, 0)
+
+    def run_once(self) -> Dict[str, int]:
+        """Run one full pass now; returns what it reclaimed."""
+        with self._lock:
+            start = time.perf_counter()
+            now = datetime.utcnow()
+            ttl_cutoff = (now - timedelta(hours=self.ttl_h)).isoformat() + "Z" if self.ttl_h > 0 else ""
+            empty_cutoff = (now - timedelta(seconds=self.grace_s)).isoformat() + "Z"
+            result = {"expired": 0, "empty": 0, "over_quota": 0, "orphans": 0, "repaired": 0, "bytes_reclaimed": 0}
+            archived = self.archiver.sizes()
+            known: set = set()
+            kept_bytes = 0
+            over_quota = False
+            # session_id -> (last_used_at seen, reason, bytes)
+            doomed: Dict[str, Tuple[str, str, int]] = {}
+            cursor: Optional[str] = None
+            while not self._closed:
+                page, cursor = self.store.list_page(self.batch, cursor)
+                for session_id, meta in page:
+                    known.add(session_id)
+                    last_used_at = meta.get("last_used_at", "")
+                    size = meta.get("bytes", 0) + archived.get(session_id, 0)
+                    if last_used_at < ttl_cutoff:
+                        doomed[session_id] = (last_used_at, "expired", size)
+                    elif (
+                        not meta.get("message_count")
+                        and meta.get("status") != "archived"
+                        and last_used_at < empty_cutoff
+                    ):
+                        doomed[session_id] = (last_used_at, "empty", size)
+                    elif over_quota or (self.quota_bytes and kept_bytes + size > self.quota_bytes):
+                        # Newest first: once the quota is full, every older session goes
+                        over_quota = True
+                        doomed[session_id] = (last_used_at, "over_quota", size)
+                    else:
+                        kept_bytes += size
+                # Keyset pagination is unaffected by removing sessions already paged past
+                self._remove(doomed, result)
+                doomed = {}
+                if cursor is None or self._wakeup.wait(0.01):
+                    break
+            if not self._closed:
+                self._reconcile(known, result)
+
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            self._stats["runs"] += 1
+            for key, value in result.items():
+                self._stats[key] += value
+            self._stats["last_run_ms"] = round(elapsed_ms, 2)
+            self._stats["stored_bytes"] = kept_bytes
+        removed = result["expired"] + result["empty"] + result["over_quota"]
+        if removed or result["orphans"] or result["repaired"]:
+            print(
+                f"Session GC: removed {removed} sessions ({result['expired']} expired, {result['empty']} empty, "
+                f"{result['over_quota']} over quota), {result['orphans']} orphaned, {result['repaired']} repaired; "
+                f"reclaimed {result['bytes_reclaimed'] / 1024:.1f} KB in {elapsed_ms:.0f} ms",
+                file=sys.stderr,
+            )
+        return result
+
+    def _run(self) -> None:
+        # The first pass waits one interval, like archival
+        while not self._wakeup.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception as e:
+                self._stats["errors"] += 1
+                print(f"Warning: session garbage collection failed: {e}", file=sys.stderr)
+
+    def close(self) -> None:
+        self._closed = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self._thread is not None,
+            "quota_bytes": self.quota_bytes,
+            "ttl_h": self.ttl_h,
+            **self._stats,
+        }
+
+
+def _on_session_dropped(session_id: str) -> None:
+    # The write-behind cache gave up on queued writes: what is stored is now authoritative
+    session_state_cache.invalidate(session_id)
+    if session_search is not None:
+        session_search.resync(session_id)
+
+
+def _create_session_store() -> SessionStore:
+    limits = dict(
+        max_messages=DEFAULT_SESSION_MAX_MESSAGES,
+        max_bytes=DEFAULT_SESSION_MAX_FILE_BYTES,
+        auto_trim=DEFAULT_SESSION_AUTO_TRIM,
+        fsync=DEFAULT_SESSION_FSYNC,
+    )
+    if DEFAULT_SESSION_BACKEND == "sqlite":
+        jsonl_history = any(HISTORY_DIR.glob("*.log")) or any(HISTORY_DIR.glob("*.jsonl")) or SESSIONS_INDEX_PATH.exists()
+        if not SESSIONS_DB_PATH.exists() and jsonl_history:
+            # Never migrated implicitly: the JSONL history stays the source of truth until imported
+            print(
+                f"Warning: {HISTORY_DIR} holds JSONL history that is not in {SESSIONS_DB_PATH.name}; "
+                "run `python migrate_sessions.py` to import it",
+                file=sys.stderr,
+            )
+        store: SessionStore = SqliteSessionStore(SESSIONS_DB_PATH, **limits)
+    else:
+        if DEFAULT_SESSION_BACKEND != "jsonl":
+            print(f"Warning: unknown SESSION_BACKEND {DEFAULT_SESSION_BACKEND!r}; using jsonl", file=sys.stderr)
+        store = JsonlSessionStore(
+            HISTORY_DIR,
+            **limits,
+            segment_bytes=DEFAULT_SESSION_SEGMENT_BYTES,
+            compact_interval_s=DEFAULT_SESSION_COMPACT_INTERVAL_S,
+        )
+
+    if DEFAULT_SESSION_WRITE_BEHIND:
+        store = WriteBehindSessionStore(
+            store,
+            max_delay_ms=DEFAULT_SESSION_FLUSH_DELAY_MS,
+            max_sessions=DEFAULT_SESSION_CACHE_SESSIONS,
+            on_drop=_on_session_dropped,
+        )
+    # Drain queued writes (and close connections) on interpreter exit
+    atexit.register(store.close)
+    return store
+
+
+# Session services, created by init_session_services() (see there)
+session_store: Optional[SessionStore] = None
+session_archiver: Optional["SessionArchiver"] = None
+session_search: Optional["SessionSearchIndex"] = None
+session_gc: Optional["SessionGarbageCollector"] = None
+_session_services_lock = threading.RLock()
+_session_services_ready = False
+
+
+def create_session(metadata: Optional[Dict[str, Any]] = None) -> str:
+    """Create a new session and return its ID."""
+    init_session_services()
+    session_id = uuid.uuid4().hex
+    session_store.create(session_id, _new_session_meta(metadata))
+    return session_id
+
+
+@tracing.traced("append_session_message")
+def append_session_message(
+    session_id: str,
+    role: str,
+    content: str,
+    model: Optional[Any] = None,
+    extra: Optional[Dict[str, Any]] = None,
+) -> None:
+    """Append a message to a session and update index/trim as needed.
+
+    If model is given, the message's token count for that model's tokenizer is
+    stored with the event so context packing does not tokenize it again. extra
+    holds additional event fields (e.g. those of a rolling summary).
+    """
+    event = {
+        "role": role,
+        "content": content,
+        "timestamp": datetime.utcnow().isoformat() + "Z",
+        **(extra or {}),
+    }
+    if model is not None:
+        event["n_tokens"] = count_message_tokens(model, role, content)
+        event["tokenizer"] = _tokenizer_id(model)
+
+    init_session_services()
+    # A reopened archived session gets its messages back before the new one is added
+    session_archiver.restore(session_id)
+    # Dropping old messages changes the prompt prefix, so the cached KV state is stale
+    dropped = session_store.append(session_id, event)
+    if dropped:
+        session_state_cache.invalidate(session_id)
+    if session_search is not None:
+        session_search.add(session_id, event, dropped)
+    if DEFAULT_SESSION_SUMMARY_ENABLED and role == "assistant":
+        session_summarizer.notify(session_id, get_current_model_path())
+
+
+@tracing.traced("load_recent_session_messages")
+def load_recent_session_messages(session_id: str, max_messages: Optional[int] = None) -> List[Dict[str, Any]]:
+    """Load the most recent messages for a session.
+
+    Returned list is ordered from oldest to newest. max_messages <= 0 loads every
+    stored message.
+    """
+    if max_messages is None:
+        max_messages = DEFAULT_SESSION_MAX_MESSAGES
+    init_session_services()
+    archived = session_archiver.load_recent(session_id, max_messages)
+    if archived is not None:
+        return archived
+    return session_store.load_recent(session_id, max_messages)
+
+
+def load_session_head(session_id: str) -> Optional[Dict[str, Any]]:
+    """Return a session's leading system message, if it has one, without reading its history."""
+    init_session_services()
+    archived = session_archiver.load_recent(session_id, 0)
+    if archived is not None:
+        return _system_head(archived)
+    return session_store.load_head(session_id)
+
+
+def list_sessions() -> Dict[str, Dict[str, Any]]:
+    """Return {session_id: metadata} for every stored session."""
+    init_session_services()
+    return session_store.list_sessions()
+
+
+def list_sessions_page(
+    limit: int = 50,
+    cursor: Optional[str] = None,
+    status: Optional[str] = None,
+    metadata: Optional[Dict[str, str]] = None,
+) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """Return one page of sessions, most recently used first, and the cursor of the next page.
+
+    Each item is the session's metadata plus its "id". Raises ValueError for a bad cursor.
+    """
+    init_session_services()
+    page, next_cursor = session_store.list_page(max(1, limit), cursor, status, metadata)
+    return [{"id": sid, **meta} for sid, meta in page], next_cursor
+
+
+def search_sessions(
+    query: str,
+    limit: int = 20,
+    session_id: Optional[str] = None,
+    mark: Tuple[str, str] = ("[", "]"),
+) -> List[Dict[str, Any]]:
+    """Full-text search over stored session messages, best match first (see SessionSearchIndex.search).
+
+    Raises RuntimeError if search is disabled.
+    """
+    init_session_services()
+    if session_search is None:
+        raise RuntimeError("Session search is disabled (SESSION_SEARCH_ENABLED=false)")
+    return session_search.search(query, max(1, limit), session_id, mark)
+
+
+def collect_session_garbage() -> Dict[str, int]:
+    """Run a session garbage collection pass now (see SessionGarbageCollector); returns what it reclaimed."""
+    init_session_services()
+    return session_gc.run_once()
+
+
+def get_session_store_stats() -> Dict[str, Any]:
+    """Return session cache / write-behind, compaction, archival, summary, search and GC counters."""
+    init_session_services()
+    stats = session_store.stats() if isinstance(session_store, WriteBehindSessionStore) else {"enabled": False}
+    backend = getattr(session_store, "backend", session_store)
+    if isinstance(backend, JsonlSessionStore):
+        stats["compaction"] = backend.compaction_stats()
+    stats["archive"] = session_archiver.stats()
+    stats["summaries"] = session_summarizer.stats()
+    stats["search"] = session_search.stats() if session_search is not None else {"enabled": False}
+    stats["gc"] = session_gc.stats()
+    return {"backend": DEFAULT_SESSION_BACKEND, **stats}
+
+
+def mark_session_ended(session_id: str, delete: bool = False) -> bool:
+    """Mark a session as closed and optionally delete its history file.
+
+    Returns True if the session existed, False otherwise.
+    """
+    init_session_services()
+    if delete:
+        session_archiver.discard(session_id)
+    else:
+        # Closing keeps the messages in the store; the archiver picks the session up again later
+        session_archiver.restore(session_id)
+    existed = session_store.end(session_id, delete=delete)
+    if delete and session_search is not None:
+        session_search.remove(session_id)
+    if existed:
+        session_state_cache.invalidate(session_id)
+    return existed
+
+
+
+
+# === Session KV-cache =========================================================
+
+# Spill file layout: magic, little-endian uint32 header length, JSON header,
+# then the raw bytes of input_ids, scores and llama_state in that order
+_STATE_FILE_MAGIC = b"LLMSTATE1\n"
+_STATE_ARRAYS = ("input_ids", "scores")
+
+
+def _write_state_file(path: Path, entry: Dict[str, Any]) -> None:
+    """Write a cache entry holding a LlamaState as a JSON header plus raw buffers."""
+    state = entry["state"]
+    arrays = {name: np.ascontiguousarray(getattr(state, name)) for name in _STATE_ARRAYS}
+    llama_state = bytes(state.llama_state)
+    header = json.dumps({
+        "model_path": entry["model_path"],
+        "prefix_key": entry["prefix_key"],
+        "n_tokens": int(state.n_tokens),
+        "seed": int(state.seed),
+        "llama_state_size": len(llama_state),
+        "arrays": {
+            name: {"dtype": array.dtype.str, "shape": list(array.shape), "nbytes": array.nbytes}
+            for name, array in arrays.items()
+        },
+    }).encode("utf-8")
+    with path.open("wb") as f:
+        f.write(_STATE_FILE_MAGIC)
+        f.write(struct.pack("<I", len(header)))
+        f.write(header)
+        for array in arrays.values():
+            f.write(array.tobytes())
+        f.write(llama_state)
+
+
+def _read_state_file(path: Path) -> Dict[str, Any]:
+    """Read a file written by _write_state_file back into a cache entry.
+
+    Raises ValueError (or KeyError/TypeError/struct.error) when the file is not
+    a complete state file.
+    """
+    data = path.read_bytes()
+    if not data.startswith(_STATE_FILE_MAGIC):
+        raise ValueError("not a session state file")
+    pos = len(_STATE_FILE_MAGIC)
+    (header_len,) = struct.unpack_from("<I", data, pos)
+    pos += 4
+    header = json.loads(data[pos:pos + header_len].decode("utf-8"))
+    pos += header_len
+    arrays = {}
+    for name in _STATE_ARRAYS:
+        spec = header["arrays"][name]
+        dtype = np.dtype(spec["dtype"])
+        nbytes = int(spec["nbytes"])
+        if dtype.hasobject or pos + nbytes > len(data):
+            raise ValueError(f"bad {name} buffer")
+        arrays[name] = np.frombuffer(data, dtype=dtype, count=nbytes // dtype.itemsize, offset=pos).reshape(spec["shape"])
+        pos += nbytes
+    size = int(header["llama_state_size"])
+    if pos + size != len(data):
+        raise ValueError("truncated session state file")
+    state = llama_cpp.LlamaState(
+        input_ids=arrays["input_ids"],
+        scores=arrays["scores"],
+        n_tokens=int(header["n_tokens"]),
+        llama_state=data[pos:],
+        llama_state_size=size,
+        seed=int(header["seed"]),
+    )
+    return {"model_path": header["model_path"], "prefix_key": header["prefix_key"], "state": state, "size": size}
+
+
+class SessionStateCache:
+    """Keeps the llama state (KV cache) of each session between continue_session calls.
+
+    Restoring a session's state before generation lets llama.cpp reuse the
+    already-evaluated prompt prefix, so only the newly appended turn needs prompt
+    evaluation. Recently used states stay in RAM (LRU, bounded by bytes); evicted
+    ones are spilled to disk under the history directory. Each entry records the
+    model path and a key for the session's history prefix, and is discarded when
+    either stops matching.
+    """
+
+    def __init__(
+        self,
+        state_dir: Path,
+        max_memory_bytes: int,
+        max_disk_bytes: int,
+        enabled: bool = True,
+    ):
+        self.state_dir = state_dir
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.enabled = enabled
+        self._memory: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def _disk_path(self, session_id: str) -> Path:
+        return self.state_dir / f"{session_id}.state"
+
+    def _pop_memory(self, session_id: str) -> Optional[Dict[str, Any]]:
+        entry = self._memory.pop(session_id, None)
+        if entry is not None:
+            self._memory_bytes -= entry["size"]
+        return entry
+
+    def _load_from_disk(self, session_id: str) -> Optional[Dict[str, Any]]:
+        path = self._disk_path(session_id)
+        if not path.exists():
+            return None
+        try:
+            entry = _read_state_file(path)
+            path.unlink()
+            return entry
+        except (OSError, ValueError, KeyError, TypeError, struct.error):
+            # Unreadable spill file; drop it and fall back to a full prompt eval
+            try:
+                path.unlink()
+            except OSError:
+                pass
+            return None
+
+    def _spill(self, session_id: str, entry: Dict[str, Any]) -> None:
+        if self.max_disk_bytes <= 0:
+            return
+        try:
+            self.state_dir.mkdir(parents=True, exist_ok=True)
+            path = self._disk_path(session_id)
+            tmp_path = path.with_suffix(".tmp")
+            _write_state_file(tmp_path, entry)
+            tmp_path.replace(path)
+        except Exception as e:
+            print(f"Warning: could not spill session state {session_id}: {e}", file=sys.stderr)
+            return
+        self._enforce_disk_budget()
+
+    def _enforce_disk_budget(self) -> None:
+        _prune_oldest_files(self.state_dir, "*.state", self.max_disk_bytes)
+
+    def get(self, session_id: str, model_path: Optional[str], prefix_key: str) -> Optional[Any]:
+        """Return the cached LlamaState for a session, or None if missing or stale."""
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._pop_memory(session_id)
+            from_disk = False
+            if entry is None:
+                entry = self._load_from_disk(session_id)
+                from_disk = entry is not None
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry["model_path"] != model_path or entry["prefix_key"] != prefix_key:
+                self.misses += 1
+                self.invalidations += 1
+                return None
+            self.hits += 1
+            if from_disk:
+                self.disk_hits += 1
+            return entry["state"]
+
+    def put(self, session_id: str, model_path: Optional[str], prefix_key: str, state: Any) -> None:
+        """Store a session's LlamaState as the most recently used entry."""
+        if not self.enabled:
+            return
+        size = int(getattr(state, "llama_state_size", 0) or 0)
+        entry = {"model_path": model_path, "prefix_key": prefix_key, "state": state, "size": size}
+        with self._lock:
+            self._pop_memory(session_id)
+            disk_path = self._disk_path(session_id)
+            if disk_path.exists():
+                try:
+                    disk_path.unlink()
+                except OSError:
+                    pass
+            self._memory[session_id] = entry
+            self._memory_bytes += size
+            while self._memory_bytes > self.max_memory_bytes and self._memory:
+                evicted_id, evicted = self._memory.popitem(last=False)
+                self._memory_bytes -= evicted["size"]
+                self._spill(evicted_id, evicted)
+
+    def invalidate(self, session_id: str) -> None:
+        """Forget any cached state for a session (RAM and disk)."""
+        with self._lock:
+            dropped = self._pop_memory(session_id) is not None
+            path = self._disk_path(session_id)
+            if path.exists():
+                try:
+                    path.unlink()
+                    dropped = True
+                except OSError:
+                    pass
+            if dropped:
+                self.invalidations += 1
+
+    def session_ids(self) -> List[str]:
+        """Return the ID of every session with a cached state (RAM or disk)."""
+        with self._lock:
+            ids = set(self._memory)
+            ids.update(p.stem for p in self.state_dir.glob("*.state"))
+        return sorted(ids)
+
+    def stats(self) -> Dict[str, Any]:
+        """Return hit/miss counters and memory usage."""
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "sessions_in_memory": len(self._memory),
+                "memory_bytes": self._memory_bytes,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+            }
+
+
+session_state_cache = SessionStateCache(
+    SESSION_STATE_DIR,
+    max_memory_bytes=DEFAULT_SESSION_STATE_CACHE_RAM_MB * 1024 * 1024,
+    max_disk_bytes=DEFAULT_SESSION_STATE_CACHE_DISK_MB * 1024 * 1024,
+    enabled=DEFAULT_SESSION_STATE_CACHE_ENABLED,
+)
+
+
+def init_session_services() -> None:
+    """Open the session store and start the archiver, search index and GC (once).
+
+    Not done at import: importing server (the web chat, tests, tools) must not
+    open databases under SESSION_HISTORY_DIR or start background threads. main()
+    and the web chat call this on startup; the session functions call it lazily.
+    """
+    global session_store, session_archiver, session_search, session_gc, _session_services_ready
+    if _session_services_ready:
+        return
+    with _session_services_lock:
+        if session_store is not None:
+            return  # ready, or re-entered while the search index reads sessions back
+        store = _create_session_store()
+        archiver = SessionArchiver(
+            store,
+            SESSION_ARCHIVE_DIR,
+            closed_after_h=DEFAULT_SESSION_ARCHIVE_CLOSED_AFTER_H,
+            idle_after_h=DEFAULT_SESSION_ARCHIVE_IDLE_AFTER_H,
+            interval_s=DEFAULT_SESSION_ARCHIVE_INTERVAL_S,
+        )
+        atexit.register(archiver.close)
+        session_archiver = archiver
+        session_store = store  # the search index below reads sessions back through it
+        if DEFAULT_SESSION_SEARCH_ENABLED:
+            session_search = SessionSearchIndex(
+                SESSION_SEARCH_DB_PATH,
+                loader=lambda session_id: load_recent_session_messages(session_id, max_messages=0),
+                list_session_ids=lambda: list(list_sessions()),
+                flush_delay_ms=DEFAULT_SESSION_FLUSH_DELAY_MS,
+                fsync=DEFAULT_SESSION_FSYNC,
+            )
+            atexit.register(session_search.close)
+        session_gc = SessionGarbageCollector(
+            store,
+            archiver,
+            session_search,
+            session_state_cache,
+            quota_bytes=int(DEFAULT_SESSION_QUOTA_MB * 1024 * 1024),
+            ttl_h=DEFAULT_SESSION_TTL_H,
+            interval_s=DEFAULT_SESSION_GC_INTERVAL_S,
+        )
+        atexit.register(session_gc.close)
+        if DEFAULT_BATCH_SLOTS > 1 and session_state_cache.enabled:
+            print(
+                "Warning: BATCH_SLOTS > 1 and SESSION_STATE_CACHE_ENABLED exclude each other for web chat "
+                "sessions: batched turns decode in the scheduler's context, so their KV cache is neither "
+                "restored nor saved (set SESSION_STATE_CACHE_ENABLED=false or BATCH_SLOTS=1)",
+                file=sys.stderr,
+            )
+        _session_services_ready = True
 
-    return sorted(models, key=lambda x: x["name"].lower())
 
+def session_prefix_key(history_events: List[Dict[str, Any]], next_message: str = "") -> str:
+    """Identify the start of a session's prompt history.
 
-def unload_model() -> None:
-    """Unload the current model to free memory."""
-    global llama_model, _current_model_path
-    if llama_model is not None:
-        try:
-            del llama_model
-        except Exception:
-            pass
-        llama_model = None
-        _current_model_path = None
-        import gc
-        gc.collect()
-        print("Model unloaded.", file=sys.stderr)
+    History is append-only apart from trimming and context packing, which only
+    drop the oldest turns after the system message. So the events up to the
+    first non-system one determine whether a cached state still matches the
+    prompt prefix. When the history has no such event yet, the new user message
+    becomes it, so pass it as next_message to keep the key stable into the
+    following turn. (A false match only costs a useless state load: llama.cpp
+    still compares the tokens.)
+    """
+    head: List[Dict[str, Any]] = []
+    for event in history_events:
+        head.append(event)
+        if event.get("role") != "system":
+            break
+    else:
+        if next_message:
+            head.append({"role": "user", "content": next_message})
+    if not head:
+        return ""
+    raw = "\n".join(f"{e.get('role', '')}|{e.get('content', '')}" for e in head)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
 
 
-def load_model(model_path: Optional[str] = None) -> Llama:
-    """Loads the Llama model. Pass model_path to switch to a different model."""
-    global llama_model, _current_model_path
+@tracing.traced("restore_session_state")
+def restore_session_state(model: Llama, session_id: str, prefix_key: str) -> bool:
+    """Load a session's cached state into the model. Returns True on a cache hit."""
+    state = session_state_cache.get(session_id, get_current_model_path(), prefix_key)
+    if state is None:
+        return False
+    try:
+        model.load_state(state)
+        return True
+    except Exception as e:
+        print(f"Warning: could not restore session state {session_id}: {e}", file=sys.stderr)
+        session_state_cache.invalidate(session_id)
+        return False
 
-    path = model_path or DEFAULT_MODEL_PATH
-    if not path:
-        path = DEFAULT_MODEL_PATH
 
-    path_resolved = str(Path(path).resolve()) if path else ""
+@tracing.traced("save_session_state")
+def save_session_state(model: Llama, session_id: str, prefix_key: str) -> None:
+    """Capture the model's state after a session turn for reuse on the next one."""
+    if not session_state_cache.enabled:
+        return
+    try:
+        state = model.save_state()
+    except Exception as e:
+        print(f"Warning: could not save session state {session_id}: {e}", file=sys.stderr)
+        return
+    session_state_cache.put(session_id, get_current_model_path(), prefix_key, state)
 
-    # If requesting a different model, unload first
-    if llama_model is not None and _current_model_path != path_resolved:
-        unload_model()
 
-    if llama_model is not None:
-        return llama_model
+def get_session_state_cache_stats() -> Dict[str, Any]:
+    """Return per-session KV-cache metrics."""
+    return session_state_cache.stats()
 
-    if not path or not os.path.exists(path):
-        error_msg = (
-            f"Error: Model not found at {path}\nPlease configure MODEL_PATH in the .env file\n"
-            "Or download a GGUF model from: https://huggingface.co/models?library=gguf"
-        )
-        print(error_msg, file=sys.stderr)
-        raise FileNotFoundError(f"Model not found: {path}")
 
-    print(f"Loading model from: {path}", file=sys.stderr)
+# === Context packing ==========================================================
 
-    try:
-        llama_model = Llama(
-            model_path=path,
-            n_ctx=DEFAULT_CONTEXT_SIZE,
-            n_threads=DEFAULT_N_THREADS,
-            n_gpu_layers=DEFAULT_N_GPU_LAYERS,
-            verbose=False,
-        )
-        _current_model_path = path_resolved
-        print("Model loaded successfully!", file=sys.stderr)
-        return llama_model
-    except Exception as e:
-        print(f"Error loading model: {e}", file=sys.stderr)
-        raise
+def _session_line(role: str, content: str) -> str:
+    """Render one history event the way session prompts show it."""
+    prefix = "System" if role == "system" else ("Assistant" if role == "assistant" else "User")
+    return f"{prefix}: {content}"
 
 
-def get_current_model_path() -> Optional[str]:
-    """Return the path of the currently loaded model."""
-    return _current_model_path
+def _tokenizer_id(model: Any) -> str:
+    return Path(getattr(model, "model_path", "") or "").name
 
 
-# === Streaming generation helpers =============================================
+def count_message_tokens(model: Any, role: str, content: str) -> int:
+    """Count the tokens one history event takes in a session prompt."""
+    line = _session_line(role, content) + "\n"
+    return len(model.tokenize(line.encode("utf-8"), add_bos=False, special=True))
 
-def generate_with_streaming(
-    model: Llama,
-    prompt: str,
-    max_tokens: int = 256,
-    temperature: float = 0.7,
-    top_p: float = 0.9,
-    stop: Optional[List[str]] = None,
-    chunk_size: int = DEFAULT_STREAMING_CHUNK_SIZE,
-) -> List[TextContent]:
-    """Generate text with streaming enabled, returning multiple TextContent chunks.
-    
-    Returns a list of TextContent objects, one per chunk, for incremental display.
-    """
-    stop_sequences = stop or []
-    
-    # Use stream=True to get incremental tokens
-    stream = model(
-        prompt,
-        max_tokens=max_tokens,
-        temperature=temperature,
-        top_p=top_p,
-        echo=False,
-        stop=stop_sequences,
-        stream=True,
-    )
-    
-    chunks: List[TextContent] = []
-    current_chunk = ""
-    
-    for chunk in stream:
-        if "choices" in chunk and len(chunk["choices"]) > 0:
-            delta_text = chunk["choices"][0].get("text", "")
-            if delta_text:
-                current_chunk += delta_text
-                
-                # Emit chunk when it reaches the target size
-                if len(current_chunk) >= chunk_size:
-                    chunks.append(TextContent(type="text", text=current_chunk))
-                    current_chunk = ""
-    
-    # Emit any remaining text as final chunk
-    if current_chunk:
-        chunks.append(TextContent(type="text", text=current_chunk))
-    
-    # If no chunks were emitted (empty response), return at least one empty chunk
-    if not chunks:
-        chunks.append(TextContent(type="text", text=""))
-    
-    return chunks
 
+def _event_tokens(model: Any, event: Dict[str, Any]) -> int:
+    """Token count of a stored event, using the persisted count when it matches the tokenizer."""
+    n_tokens = event.get("n_tokens")
+    if isinstance(n_tokens, int) and event.get("tokenizer") == _tokenizer_id(model):
+        return n_tokens
+    return count_message_tokens(model, event.get("role", "user"), event.get("content", ""))
 
-def generate_without_streaming(
-    model: Llama,
-    prompt: str,
-    max_tokens: int = 256,
-    temperature: float = 0.7,
-    top_p: float = 0.9,
-    stop: Optional[List[str]] = None,
-) -> List[TextContent]:
-    """Generate text without streaming, returning a single TextContent with full response."""
-    stop_sequences = stop or []
-    
-    output = model(
-        prompt,
-        max_tokens=max_tokens,
-        temperature=temperature,
-        top_p=top_p,
-        echo=False,
-        stop=stop_sequences,
-    )
-    
-    generated_text = output["choices"][0]["text"]
-    return [TextContent(type="text", text=generated_text)]
 
+def pack_session_context(
+    model: Any,
+    history_events: List[Dict[str, Any]],
+    message: str,
+    max_tokens: int,
+    reserve: int = DEFAULT_CONTEXT_RESERVE_TOKENS,
+) -> List[Dict[str, Any]]:
+    """Select the history that fits the context window next to the new message.
 
-def generate_completion(
-    model: Llama,
-    prompt: str,
-    max_tokens: int = 256,
-    temperature: float = 0.7,
-    top_p: float = 0.9,
-    stop: Optional[List[str]] = None,
-    streaming: bool = False,
-    chunk_size: int = DEFAULT_STREAMING_CHUNK_SIZE,
-) -> tuple[List[TextContent], str]:
-    """Generate completion with optional streaming.
-    
-    Returns:
-        - List of TextContent objects (multiple chunks if streaming, single chunk otherwise)
-        - Full accumulated text (for session persistence)
+    The budget is n_ctx - max_tokens - reserve, minus the new user turn. System
+    messages are always kept; the remaining budget is filled with the newest
+    turns, stopping at the first one that does not fit. Returned oldest first.
     """
-    if streaming:
-        chunks = generate_with_streaming(
-            model, prompt, max_tokens, temperature, top_p, stop, chunk_size
-        )
-        # Accumulate full text from chunks
-        full_text = "".join(chunk.text for chunk in chunks)
-        return chunks, full_text
-    else:
-        chunks = generate_without_streaming(
-            model, prompt, max_tokens, temperature, top_p, stop
-        )
-        full_text = chunks[0].text if chunks else ""
-        return chunks, full_text
+    budget = model.n_ctx() - max(0, max_tokens) - reserve
+    budget -= count_message_tokens(model, "user", message) + 1  # + BOS
+    budget -= len(model.tokenize(b"Assistant:", add_bos=False, special=True))
 
+    events = [e for e in history_events if e.get("content")]
+    system = [e for e in events if e.get("role") == "system"]
+    budget -= sum(_event_tokens(model, e) for e in system)
 
-# === Session storage helpers ==================================================
+    recent: List[Dict[str, Any]] = []
+    for event in reversed([e for e in events if e.get("role") != "system"]):
+        n_tokens = _event_tokens(model, event)
+        if n_tokens > budget:
+            break
+        budget -= n_tokens
+        recent.append(event)
+    return system + recent[::-1]
 
-def _ensure_history_dir() -> None:
-    """Ensure the history directory and index file exist."""
-    HISTORY_DIR.mkdir(parents=True, exist_ok=True)
-    if not SESSIONS_INDEX_PATH.exists():
-        initial_index = {"sessions": {}}
-        SESSIONS_INDEX_PATH.write_text(
-            json.dumps(initial_index, ensure_ascii=False, indent=2),
-            encoding="utf-8",
-        )
 
+# Fewest prompt tokens a message takes ("User: x" and its newline): n_ctx divided by
+# this bounds how many recent messages can fit in the context window
+MIN_TOKENS_PER_MESSAGE = 4
 
-def _load_sessions_index() -> Dict[str, Any]:
-    """Load the sessions index from disk."""
-    _ensure_history_dir()
-    try:
-        raw = SESSIONS_INDEX_PATH.read_text(encoding="utf-8")
-        if not raw.strip():
-            return {"sessions": {}}
-        data = json.loads(raw)
-        if "sessions" not in data or not isinstance(data["sessions"], dict):
-            return {"sessions": {}}
-        return data
-    except Exception:
-        # Corrupt or unreadable index; start fresh but don't delete any history files
-        return {"sessions": {}}
-
-
-def _save_sessions_index(index: Dict[str, Any]) -> None:
-    """Persist the sessions index to disk atomically."""
-    _ensure_history_dir()
-    tmp_path = SESSIONS_INDEX_PATH.with_suffix(".tmp")
-    tmp_path.write_text(
-        json.dumps(index, ensure_ascii=False, indent=2),
-        encoding="utf-8",
-    )
-    tmp_path.replace(SESSIONS_INDEX_PATH)
 
+@tracing.traced("build_session_prompt")
+def build_session_prompt(model: Any, session_id: str, message: str, max_tokens: int) -> tuple[str, str]:
+    """Build the prompt for the next turn of a session. Returns (prompt, prefix_key).
 
-def _session_file_path(session_id: str) -> Path:
-    """Return the path for a given session's history file."""
-    _ensure_history_dir()
-    return HISTORY_DIR / f"{session_id}.jsonl"
+    Only the newest n_ctx // MIN_TOKENS_PER_MESSAGE messages are read (older ones
+    cannot fit the context), plus the leading system message when the tail does
+    not reach it. The latest rolling summary is among them: one is appended
+    whenever the turns after the previous one exceed SESSION_SUMMARY_TRIGGER_TOKENS.
+    History is then chosen by token budget (see pack_session_context).
+    """
+    limit = max(1, model.n_ctx() // MIN_TOKENS_PER_MESSAGE)
+    events = load_recent_session_messages(session_id, max_messages=limit)
+    if len(events) >= limit:
+        head = load_session_head(session_id)
+        if head is not None and head != events[0]:
+            events = [head] + events
+    history_events = pack_session_context(model, apply_session_summary(events), message, max_tokens)
+    prompt_parts = [_session_line(e.get("role", "user"), e.get("content", "")) for e in history_events]
+    prompt_parts.append(_session_line("user", message))
+    prompt_parts.append("Assistant:")
+    return "\n".join(prompt_parts), session_prefix_key(history_events, message)
 
 
-def create_session(metadata: Optional[Dict[str, Any]] = None) -> str:
-    """Create a new session and return its ID."""
-    _ensure_history_dir()
-    index = _load_sessions_index()
+# === Session summaries ========================================================
 
-    session_id = uuid.uuid4().hex
-    now = datetime.utcnow().isoformat() + "Z"
+SUMMARY_PREFIX = "Summary of the earlier conversation: "
 
-    index["sessions"][session_id] = {
-        "created_at": now,
-        "last_used_at": now,
-        "message_count": 0,
-        "bytes": 0,
-        "status": "active",
-        "metadata": metadata or {},
-    }
 
-    # Create an empty history file
-    history_path = _session_file_path(session_id)
-    if not history_path.exists():
-        history_path.touch()
+def apply_session_summary(events: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Replace the turns covered by the session's latest rolling summary with the summary.
 
-    _save_sessions_index(index)
-    return session_id
+    A summary is a system event with "summary": true and "until", the timestamp
+    of the last turn it covers. Other system messages are kept; older summaries
+    are superseded by the latest one.
+    """
+    latest = None
+    for event in events:
+        if event.get("summary"):
+            latest = event
+    if latest is None:
+        return events
+    until = latest.get("until", "")
+    system = [e for e in events if e.get("role") == "system" and not e.get("summary")]
+    turns = [e for e in events if e.get("role") != "system" and e.get("timestamp", "") > until]
+    return system + [latest] + turns
 
 
-def _trim_session_file(session_id: str, index: Dict[str, Any]) -> None:
-    """Trim a session file to respect max messages and file size limits."""
-    if not DEFAULT_SESSION_AUTO_TRIM:
-        return
+class SessionSummarizer:
+    """Background job that folds the older turns of long sessions into a rolling summary.
 
-    path = _session_file_path(session_id)
-    if not path.exists():
-        return
+    After each answer, notify() queues the session. The worker thread checks
+    whether the turns not yet summarized exceed trigger_tokens (or half of
+    SESSION_MAX_MESSAGES, so trimming never drops turns that no summary
+    covers). If so, it asks the model to merge the previous summary with those
+    turns, except the newest keep_tokens worth. The result is appended as a
+    summary event (see apply_session_summary), so each prompt carries one summary
+    plus recent turns instead of the whole transcript.
 
-    try:
-        lines = path.read_text(encoding="utf-8").splitlines()
-    except Exception:
-        return
+    The worker never delays a request: it only takes a model that is resident
+    and idle (it never loads one), and gives it up (discarding the partial summary and retrying later) as soon as
+    a request is waiting for it.
+    """
 
-    # Keep only the most recent messages according to configured limit
-    if len(lines) > DEFAULT_SESSION_MAX_MESSAGES:
-        lines = lines[-DEFAULT_SESSION_MAX_MESSAGES :]
-
-    content = "\n".join(lines) + ("\n" if lines else "")
-
-    # Enforce approximate file size limit as well
-    encoded = content.encode("utf-8")
-    if len(encoded) > DEFAULT_SESSION_MAX_FILE_BYTES:
-        # If still too large, drop oldest lines until under limit
-        while lines and len("\n".join(lines).encode("utf-8")) > DEFAULT_SESSION_MAX_FILE_BYTES:
-            lines.pop(0)
-        content = "\n".join(lines) + ("\n" if lines else "")
-        encoded = content.encode("utf-8")
-
-    path.write_text(content, encoding="utf-8")
-
-    # Update index metadata
-    meta = index.get("sessions", {}).get(session_id)
-    if meta is not None:
-        meta["message_count"] = len(lines)
-        meta["bytes"] = len(encoded)
-
-
-def append_session_message(session_id: str, role: str, content: str) -> None:
-    """Append a message to a session and update index/trim as needed."""
-    _ensure_history_dir()
-    index = _load_sessions_index()
-
-    if "sessions" not in index or session_id not in index["sessions"]:
-        # Unknown session; create basic entry so we don't lose data
-        now = datetime.utcnow().isoformat() + "Z"
-        index.setdefault("sessions", {})[session_id] = {
-            "created_at": now,
-            "last_used_at": now,
-            "message_count": 0,
-            "bytes": 0,
-            "status": "active",
-            "metadata": {},
+    def __init__(
+        self,
+        trigger_tokens: int = 1024,
+        keep_tokens: int = 384,
+        max_tokens: int = 192,
+        retry_s: float = 5.0,
+    ):
+        self.trigger_tokens = trigger_tokens
+        self.keep_tokens = keep_tokens
+        self.max_tokens = max_tokens
+        self.retry_s = retry_s
+        self._cond = threading.Condition()
+        self._pending: "OrderedDict[str, Optional[str]]" = OrderedDict()
+        self._closed = False
+        self._thread: Optional[threading.Thread] = None
+        self._stats = {
+            "summaries": 0, "summarized_messages": 0, "interrupted": 0, "skipped": 0, "failed": 0, "total_ms": 0.0,
         }
 
-    history_path = _session_file_path(session_id)
-
-    event = {
-        "role": role,
-        "content": content,
-        "timestamp": datetime.utcnow().isoformat() + "Z",
-    }
-
-    line = json.dumps(event, ensure_ascii=False)
-    # Append event
-    with history_path.open("a", encoding="utf-8") as f:
-        f.write(line + "\n")
+    def notify(self, session_id: str, model_path: Optional[str]) -> None:
+        """Queue a session for a summary check with the model that served it."""
+        with self._cond:
+            if self._closed:
+                return
+            self._pending[session_id] = model_path
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="session-summarizer", daemon=True)
+                self._thread.start()
+            self._cond.notify_all()
 
-    # Update index metadata
-    meta = index["sessions"][session_id]
-    meta["last_used_at"] = event["timestamp"]
-    meta["message_count"] = meta.get("message_count", 0) + 1
-    meta["bytes"] = history_path.stat().st_size
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+                session_id, model_path = self._pending.popitem(last=False)
+            try:
+                done = self._run_for_session(session_id, model_path)
+            except Exception as e:
+                done = True
+                self._stats["failed"] += 1
+                print(f"Warning: summarizing session {session_id} failed: {e}", file=sys.stderr)
+            if not done:
+                # Interrupted by a request: try again once things are quiet
+                with self._cond:
+                    self._pending.setdefault(session_id, model_path)
+                    self._cond.wait(self.retry_s)
 
-    _trim_session_file(session_id, index)
-    _save_sessions_index(index)
+    def _run_for_session(self, session_id: str, model_path: Optional[str]) -> bool:
+        """Summarize a session if it needs it. False if interrupted (the session should be retried)."""
+        if model_requests_waiting():
+            return False
+        path = model_path or DEFAULT_MODEL_PATH
+        resident = model_pool.resident(str(Path(path).resolve())) if path else None
+        if resident is None:
+            # Loading it here could evict a model requests are using; the next answer
+            # in this session loads it and queues the session again
+            self._stats["skipped"] += 1
+            return True
+        model, lock = resident
+        if not lock.acquire(blocking=False):
+            return False
+        try:
+            while not self._closed:
+                start = time.perf_counter()
+                result = self.summarize(model, session_id)
+                if result is None:
+                    self._stats["interrupted"] += 1
+                    return False
+                if not result:
+                    return True
+                self._stats["summaries"] += 1
+                self._stats["summarized_messages"] += result
+                self._stats["total_ms"] += (time.perf_counter() - start) * 1000
+            return True
+        finally:
+            lock.release()
 
+    def _pending_turns(self, events: List[Dict[str, Any]]) -> tuple[Optional[Dict[str, Any]], List[Dict[str, Any]]]:
+        previous = None
+        for event in events:
+            if event.get("summary"):
+                previous = event
+        until = previous.get("until", "") if previous else ""
+        turns = [e for e in events if e.get("role") != "system" and e.get("timestamp", "") > until]
+        return previous, turns
 
-def load_recent_session_messages(session_id: str, max_messages: Optional[int] = None) -> List[Dict[str, Any]]:
-    """Load the most recent messages for a session.
+    def summarize(self, model: Any, session_id: str) -> Optional[int]:
+        """Write one summary for a session if it is due (model lock held).
 
-    Returned list is ordered from oldest to newest.
-    """
-    _ensure_history_dir()
-    path = _session_file_path(session_id)
-    if not path.exists():
-        return []
+        Returns the number of turns summarized (0 if not needed), or None if a
+        request interrupted the generation.
+        """
+        previous, turns = self._pending_turns(load_recent_session_messages(session_id, max_messages=0))
+        sizes = [_event_tokens(model, e) for e in turns]
+        if sum(sizes) <= self.trigger_tokens and len(turns) < max(2, DEFAULT_SESSION_MAX_MESSAGES // 2):
+            return 0
 
-    try:
-        lines = path.read_text(encoding="utf-8").splitlines()
-    except Exception:
-        return []
+        # The newest keep_tokens stay verbatim; the rest, oldest first, goes into the summary
+        # as long as the summary prompt fits the context window
+        keep, budget = len(turns), self.keep_tokens
+        while keep > 0 and sizes[keep - 1] <= budget:
+            keep -= 1
+            budget -= sizes[keep]
+        if keep > 0 and turns[keep - 1].get("role") == "user":
+            keep -= 1  # do not separate a question from its answer
+        room = model.n_ctx() - self.max_tokens - 128
+        if previous is not None:
+            room -= _event_tokens(model, previous)
+        count = 0
+        while count < keep and sizes[count] <= room:
+            room -= sizes[count]
+            count += 1
+        if count == 0:
+            return 0
 
-    if max_messages is None:
-        max_messages = DEFAULT_SESSION_MAX_MESSAGES
+        covered = turns[:count]
+        text = self._generate(model, previous, covered)
+        if text is None:
+            return None
+        if text:
+            append_session_message(
+                session_id, "system", SUMMARY_PREFIX + text, model=model,
+                extra={"summary": True, "until": covered[-1].get("timestamp", "")},
+            )
+        return count if text else 0
 
-    # Take only the most recent N lines
-    if len(lines) > max_messages:
-        lines = lines[-max_messages:]
+    def _generate(self, model: Any, previous: Optional[Dict[str, Any]], turns: List[Dict[str, Any]]) -> Optional[str]:
+        parts = [
+            "System: Summarize the conversation below for the assistant's memory. Keep facts, names, "
+            "decisions, open questions and the user's preferences. Be concise."
+        ]
+        if previous is not None:
+            parts.append(_session_line("system", previous.get("content", "")))
+        parts += [_session_line(e.get("role", "user"), e.get("content", "")) for e in turns]
+        parts.append("Summary:")
+        prompt = "\n".join(parts)
 
-    messages: List[Dict[str, Any]] = []
-    for line in lines:
-        line = line.strip()
-        if not line:
-            continue
-        try:
-            event = json.loads(line)
-            if isinstance(event, dict):
-                messages.append(event)
-        except json.JSONDecodeError:
-            continue
+        # Evaluate the prompt in small batches so a request arriving meanwhile only waits for
+        # one of them; the completion call below then reuses the evaluated prefix
+        tokens = model.tokenize(prompt.encode("utf-8"), special=True)
+        model.reset()
+        step = max(1, min(getattr(model, "n_batch", 128), 128))
+        for i in range(0, len(tokens) - 1, step):
+            if model_requests_waiting() or self._closed:
+                return None
+            model.eval(tokens[i:min(i + step, len(tokens) - 1)])
 
-    return messages
+        interrupted = []
 
+        def yield_to_requests(input_ids, logits) -> bool:
+            if model_requests_waiting() or self._closed:
+                interrupted.append(True)
+            return bool(interrupted)
 
-def mark_session_ended(session_id: str, delete: bool = False) -> bool:
-    """Mark a session as closed and optionally delete its history file.
+        output = model(
+            prompt,
+            max_tokens=self.max_tokens,
+            temperature=0.2,
+            echo=False,
+            stop=["User:", "Assistant:", "System:"],
+            stopping_criteria=llama_cpp.StoppingCriteriaList([yield_to_requests]),
+        )
+        if interrupted:
+            return None
+        return output["choices"][0]["text"].strip()
 
-    Returns True if the session existed, False otherwise.
-    """
-    _ensure_history_dir()
-    index = _load_sessions_index()
-    sessions = index.get("sessions", {})
-    if session_id not in sessions:
-        return False
+    def close(self) -> None:
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+            thread = self._thread
+        if thread is not None:
+            thread.join(timeout=5)
 
-    sessions[session_id]["status"] = "closed"
-    sessions[session_id]["last_used_at"] = datetime.utcnow().isoformat() + "Z"
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            pending = len(self._pending)
+        stats = dict(self._stats)
+        total_ms = stats.pop("total_ms")
+        return {
+            "enabled": DEFAULT_SESSION_SUMMARY_ENABLED,
+            "pending": pending,
+            **stats,
+            "avg_summary_ms": round(total_ms / stats["summaries"], 2) if stats["summaries"] else 0.0,
+        }
 
-    history_path = _session_file_path(session_id)
-    if delete and history_path.exists():
-        try:
-            history_path.unlink()
-            sessions[session_id]["bytes"] = 0
-            sessions[session_id]["message_count"] = 0
-        except Exception:
-            # Best effort; keep metadata if delete fails
-            pass
 
-    _save_sessions_index(index)
-    return True
+session_summarizer = SessionSummarizer(
+    trigger_tokens=DEFAULT_SESSION_SUMMARY_TRIGGER_TOKENS,
+    keep_tokens=DEFAULT_SESSION_SUMMARY_KEEP_TOKENS,
+    max_tokens=DEFAULT_SESSION_SUMMARY_MAX_TOKENS,
+)
+atexit.register(session_summarizer.close)
 
 
 def _read_file_safe(
@@ -537,11 +5177,97 @@ def _read_file_safe(
 # Create MCP server
 server = Server("local-llm-mcp-tool")
 
+STREAM_LOGGER_NAME = "local-llm-stream"
+
+
+async def run_generation(
+    prompt: str,
+    max_tokens: int = 256,
+    temperature: float = 0.7,
+    top_p: float = 0.9,
+    stop: Optional[List[str]] = None,
+    session_id: Optional[str] = None,
+    cache: Optional[bool] = None,
+) -> tuple[List[TextContent], str]:
+    """Generate on the inference thread, forwarding partial output to the client.
+
+    With streaming enabled, each chunk is sent while generation is still running:
+    as a progress notification when the client supplied a progressToken (progress
+    is the number of tokens generated so far), otherwise as a log notification. The full chunk list and text are returned at the end.
+    With session_id, prompt is the new user message: the session history is packed
+    around it, its KV cache reused and the turn persisted. cache forces (True) or
+    bypasses (False) the response cache.
+    """
+    if session_id:
+        fn, args = _load_and_generate_for_session, (session_id, prompt)
+    else:
+        fn, args = _load_and_generate, (prompt,)
+    kwargs = dict(max_tokens=max_tokens, temperature=temperature, top_p=top_p, stop=stop, cache=cache)
+    if not DEFAULT_STREAMING_ENABLED:
+        return await run_inference(fn, *args, **kwargs)
+
+    try:
+        ctx = server.request_context
+    except LookupError:
+        # Called outside of an MCP request; nobody to stream to
+        return await run_inference(fn, *args, **kwargs)
+
+    loop = asyncio.get_running_loop()
+    pending: asyncio.Queue = asyncio.Queue()
+    progress_token = ctx.meta.progressToken if ctx.meta else None
+
+    async def forward() -> None:
+        while True:
+            item = await pending.get()
+            if item is None:
+                return
+            text, tokens = item
+            try:
+                if progress_token is not None:
+                    await ctx.session.send_progress_notification(
+                        progress_token,
+                        progress=tokens,
+                        message=text,
+                        related_request_id=ctx.request_id,
+                    )
+                else:
+                    await ctx.session.send_log_message(
+                        level="info",
+                        data=text,
+                        logger=STREAM_LOGGER_NAME,
+                        related_request_id=ctx.request_id,
+                    )
+            except Exception as e:
+                print(f"Warning: could not send stream chunk: {e}", file=sys.stderr)
+
+    generated = [0]
+
+    def on_progress(tokens: int) -> None:
+        generated[0] = tokens  # reported right before the chunk it counts
+
+    def on_chunk(text: str) -> None:
+        # Called from the inference thread; hand the chunk over to the event loop
+        loop.call_soon_threadsafe(pending.put_nowait, (text, generated[0]))
+
+    forwarder = asyncio.create_task(forward())
+    try:
+        return await run_inference(fn, *args, on_chunk=on_chunk, on_progress=on_progress, **kwargs)
+    finally:
+        pending.put_nowait(None)
+        await forwarder
+
+
+# Accepted by every tool: profile this call (see profiling.py)
+_PROFILE_ARGUMENT = {
+    "type": "boolean",
+    "description": "Capture a CPU profile of this call; its id is returned as an extra profile_id line",
+}
+
 
 @server.list_tools()
 async def list_tools() -> list[Tool]:
     """Lists available tools"""
-    return [
+    tools = [
         Tool(
             name="generate_text",
             description="Generates text using the Llama model locally",
@@ -566,6 +5292,13 @@ async def list_tools() -> list[Tool]:
                         "type": "number",
                         "description": "Top-p sampling (0.0-1.0)",
                         "default": 0.9
+                    },
+                    "cache": {
+                        "type": "boolean",
+                        "description": (
+                            "Response cache control: true caches even non-deterministic calls, "
+                            "false bypasses the cache. By default only temperature 0 calls are cached."
+                        ),
                     }
                 },
                 "required": ["prompt"]
@@ -597,6 +5330,13 @@ async def list_tools() -> list[Tool]:
                         "type": "number",
                         "description": "Temperature for sampling",
                         "default": 0.7
+                    },
+                    "cache": {
+                        "type": "boolean",
+                        "description": (
+                            "Response cache control: true caches even non-deterministic calls, "
+                            "false bypasses the cache. By default only temperature 0 calls are cached."
+                        ),
                     }
                 },
                 "required": ["messages"]
@@ -621,6 +5361,13 @@ async def list_tools() -> list[Tool]:
                         "type": "number",
                         "description": "Temperature for sampling",
                         "default": 0.7
+                    },
+                    "cache": {
+                        "type": "boolean",
+                        "description": (
+                            "Response cache control: true caches even non-deterministic calls, "
+                            "false bypasses the cache. By default only temperature 0 calls are cached."
+                        ),
                     }
                 },
                 "required": ["text"]
@@ -704,6 +5451,13 @@ async def list_tools() -> list[Tool]:
                         "description": "Temperature for sampling.",
                         "default": 0.3,
                     },
+                    "cache": {
+                        "type": "boolean",
+                        "description": (
+                            "Response cache control: true caches even non-deterministic calls, "
+                            "false bypasses the cache. By default only temperature 0 calls are cached."
+                        ),
+                    },
                 },
                 "required": ["path"],
             },
@@ -773,20 +5527,78 @@ async def list_tools() -> list[Tool]:
                 "required": ["session_id"],
             },
         ),
+        Tool(
+            name="search_sessions",
+            description="Full-text search over the messages of stored sessions, best match first",
+            inputSchema={
+                "type": "object",
+                "properties": {
+                    "query": {
+                        "type": "string",
+                        "description": "Words to search for (all must match; the last one also matches as a prefix)",
+                    },
+                    "limit": {
+                        "type": "integer",
+                        "description": "Maximum number of matching messages to return",
+                        "default": 10,
+                    },
+                    "session_id": {
+                        "type": "string",
+                        "description": "Only search this session",
+                    },
+                },
+                "required": ["query"],
+            },
+        ),
     ]
+    for tool in tools:
+        tool.inputSchema["properties"]["profile"] = _PROFILE_ARGUMENT
+    return tools
 
 
 @server.call_tool()
 async def call_tool(name: str, arguments: Any) -> list[TextContent]:
-    """Executes a tool"""
+    """Executes a tool, counting and timing the call for /metrics, tracing it and
+    profiling it when asked to (the "profile" argument or PROFILE_REQUESTS)"""
+    start = time.perf_counter()
+    profile_arg = arguments.pop("profile", False) if isinstance(arguments, dict) else False
+    with tracing.start_trace(f"tool {name}", **{"mcp.tool": name}) as root:
+        # The event loop runs every client's calls: only work bound to this call is profiled
+        with profiling.profile_request(
+            f"tool {name}",
+            "mcp",
+            request_id=root.trace_id,
+            enabled=profiling.requested(profile_arg),
+            profile_thread=False,
+        ) as profile:
+            result, failed = await _call_tool(name, arguments)
+        if failed:
+            root.set(error=result[0].text.splitlines()[0][:200])
+    if profile is not None and profile.path is not None and profile_arg:
+        result = [*result, TextContent(type="text", text=f"profile_id: {profile.request_id}")]
+    if failed and result[0].text.startswith("Unknown tool:"):
+        name = "unknown"  # keep arbitrary names out of the label set
+    status = "error" if failed else "ok"
+    prom.TOOL_CALLS.inc(tool=name, status=status)
+    prom.TOOL_DURATION.observe(time.perf_counter() - start, tool=name)
+    return result
+
+
+def _tool_error(text: str) -> tuple[list[TextContent], bool]:
+    """Return a tool error the way _call_tool reports it."""
+    return [TextContent(type="text", text=text)], True
+
+
+async def _call_tool(name: str, arguments: Any) -> tuple[list[TextContent], bool]:
+    """Run a tool, returning its content and whether the call failed."""
     try:
         # Session management tools that don't require the model
         if name == "start_session":
             metadata = arguments.get("metadata")
             if metadata is not None and not isinstance(metadata, dict):
-                return [TextContent(type="text", text="Error: metadata must be an object if provided")]
+                return _tool_error("Error: metadata must be an object if provided")
 
-            session_id = create_session(metadata=metadata)
+            session_id = await run_blocking(create_session, metadata=metadata)
 
             # Persist an initial system event so the history file is never empty
             if metadata:
@@ -794,7 +5606,7 @@ async def call_tool(name: str, arguments: Any) -> list[TextContent]:
                 content = f"Session started with metadata: {meta_str}"
             else:
                 content = "Session started."
-            append_session_message(session_id, "system", content)
+            await run_blocking(append_session_message, session_id, "system", content)
 
             return [
                 TextContent(
@@ -805,18 +5617,18 @@ async def call_tool(name: str, arguments: Any) -> list[TextContent]:
                         "Use the continue_session tool with this session_id to continue the conversation."
                     ),
                 )
-            ]
+            ], False
 
         if name == "end_session":
             session_id = arguments.get("session_id", "")
             delete = bool(arguments.get("delete", False))
 
             if not session_id:
-                return [TextContent(type="text", text="Error: session_id is required")]
+                return _tool_error("Error: session_id is required")
 
-            existed = mark_session_ended(session_id, delete=delete)
+            existed = await run_blocking(mark_session_ended, session_id, delete=delete)
             if not existed:
-                return [TextContent(type="text", text=f"Error: session not found: {session_id}")]
+                return _tool_error(f"Error: session not found: {session_id}")
 
             action = "and deleted" if delete else "and marked as closed"
             return [
@@ -824,19 +5636,37 @@ async def call_tool(name: str, arguments: Any) -> list[TextContent]:
                     type="text",
                     text=f"Session {session_id} has been ended {action}.",
                 )
-            ]
+            ], False
+
+        if name == "search_sessions":
+            query = (arguments.get("query") or "").strip()
+            limit = int(arguments.get("limit", 10))
+            session_id = arguments.get("session_id") or None
+
+            if not query:
+                return _tool_error("Error: query is required")
+
+            hits = await run_blocking(search_sessions, query, limit=limit, session_id=session_id)
+            if not hits:
+                return [TextContent(type="text", text=f"No messages match: {query}")], False
+
+            lines = [f"{len(hits)} matching message(s) for: {query}", ""]
+            for hit in hits:
+                lines.append(f"session_id: {hit['session_id']}  [{hit['role']}, {hit['timestamp']}]")
+                lines.append(f"  {hit['snippet']}")
+            return [TextContent(type="text", text="\n".join(lines))], False
 
         if name == "read_file":
             path_arg = arguments.get("path", "")
             max_bytes = int(arguments.get("max_bytes", 200000))
             encoding = arguments.get("encoding", "utf-8")
-            content, full_path, err = _read_file_safe(path_arg, max_bytes, encoding)
+            content, full_path, err = await run_blocking(_read_file_safe, path_arg, max_bytes, encoding)
             if err is not None:
-                return [TextContent(type="text", text=err)]
+                return _tool_error(err)
             assert content is not None and full_path is not None
             header = f"Path: {full_path}\nCharacters: {len(content)}"
             body = f"{header}\n\n{content}"
-            return [TextContent(type="text", text=body)]
+            return [TextContent(type="text", text=body)], False
 
         if name == "analyze_file":
             path_arg = arguments.get("path", "")
@@ -845,9 +5675,10 @@ async def call_tool(name: str, arguments: Any) -> list[TextContent]:
             encoding = arguments.get("encoding", "utf-8")
             max_tokens = int(arguments.get("max_tokens", 512))
             temperature = float(arguments.get("temperature", 0.3))
-            content, full_path, err = _read_file_safe(path_arg, max_bytes, encoding)
+            cache = arguments.get("cache")
+            content, full_path, err = await run_blocking(_read_file_safe, path_arg, max_bytes, encoding)
             if err is not None:
-                return [TextContent(type="text", text=err)]
+                return _tool_error(err)
             assert content is not None and full_path is not None
             if not instruction:
                 instruction = (
@@ -859,50 +5690,45 @@ async def call_tool(name: str, arguments: Any) -> list[TextContent]:
                 f"--- File: {full_path} ---\n\n"
                 f"{content}"
             )
-            model = load_model()
-            chunks, _ = generate_completion(
-                model,
+            chunks, _ = await run_generation(
                 prompt,
                 max_tokens=max_tokens,
                 temperature=temperature,
                 top_p=0.9,
                 stop=None,
-                streaming=DEFAULT_STREAMING_ENABLED,
-                chunk_size=DEFAULT_STREAMING_CHUNK_SIZE,
+                cache=cache,
             )
-            return chunks
-
-        # Load model if not already loaded
-        model = load_model()
+            return chunks, False
 
+        # Generation tools below run on the inference thread, which loads the model on demand
         if name == "generate_text":
             prompt = arguments.get("prompt", "")
             max_tokens = arguments.get("max_tokens", 256)
             temperature = arguments.get("temperature", 0.7)
             top_p = arguments.get("top_p", 0.9)
+            cache = arguments.get("cache")
             
             if not prompt:
-                return [TextContent(type="text", text="Error: prompt is required")]
+                return _tool_error("Error: prompt is required")
             
-            chunks, _ = generate_completion(
-                model,
+            chunks, _ = await run_generation(
                 prompt,
                 max_tokens=max_tokens,
                 temperature=temperature,
                 top_p=top_p,
                 stop=None,
-                streaming=DEFAULT_STREAMING_ENABLED,
-                chunk_size=DEFAULT_STREAMING_CHUNK_SIZE,
+                cache=cache,
             )
-            return chunks
+            return chunks, False
         
         elif name == "chat":
             messages = arguments.get("messages", [])
             max_tokens = arguments.get("max_tokens", 256)
             temperature = arguments.get("temperature", 0.7)
+            cache = arguments.get("cache")
             
             if not messages:
-                return [TextContent(type="text", text="Error: messages is required")]
+                return _tool_error("Error: messages is required")
             
             # Convert messages to prompt format
             prompt_parts = []
@@ -918,40 +5744,37 @@ async def call_tool(name: str, arguments: Any) -> list[TextContent]:
             
             prompt = "\n".join(prompt_parts) + "\nAssistant:"
             
-            chunks, _ = generate_completion(
-                model,
+            chunks, _ = await run_generation(
                 prompt,
                 max_tokens=max_tokens,
                 temperature=temperature,
                 top_p=0.9,
                 stop=["User:", "System:"],
-                streaming=DEFAULT_STREAMING_ENABLED,
-                chunk_size=DEFAULT_STREAMING_CHUNK_SIZE,
+                cache=cache,
             )
             # Strip whitespace from first chunk if present
             if chunks and chunks[0].text:
                 chunks[0].text = chunks[0].text.strip()
-            return chunks
+            return chunks, False
         
         elif name == "complete":
             text = arguments.get("text", "")
             max_tokens = arguments.get("max_tokens", 128)
             temperature = arguments.get("temperature", 0.7)
+            cache = arguments.get("cache")
             
             if not text:
-                return [TextContent(type="text", text="Error: text is required")]
+                return _tool_error("Error: text is required")
             
-            chunks, _ = generate_completion(
-                model,
+            chunks, _ = await run_generation(
                 text,
                 max_tokens=max_tokens,
                 temperature=temperature,
                 top_p=0.9,
                 stop=None,
-                streaming=DEFAULT_STREAMING_ENABLED,
-                chunk_size=DEFAULT_STREAMING_CHUNK_SIZE,
+                cache=cache,
             )
-            return chunks
+            return chunks, False
         
         elif name == "continue_session":
             session_id = arguments.get("session_id", "")
@@ -961,75 +5784,44 @@ async def call_tool(name: str, arguments: Any) -> list[TextContent]:
             top_p = arguments.get("top_p", 0.9)
 
             if not session_id:
-                return [TextContent(type="text", text="Error: session_id is required")]
+                return _tool_error("Error: session_id is required")
             if not message:
-                return [TextContent(type="text", text="Error: message is required")]
-
-            # Load recent history for this session
-            history_events = load_recent_session_messages(
-                session_id,
-                max_messages=DEFAULT_SESSION_MAX_MESSAGES,
-            )
-
-            prompt_parts: list[str] = []
-            for event in history_events:
-                role = event.get("role", "user")
-                content = event.get("content", "")
-                if not content:
-                    continue
-                if role == "system":
-                    prefix = "System"
-                elif role == "assistant":
-                    prefix = "Assistant"
-                else:
-                    prefix = "User"
-                prompt_parts.append(f"{prefix}: {content}")
-
-            # Add new user message
-            prompt_parts.append(f"User: {message}")
-            prompt_parts.append("Assistant:")
-            prompt = "\n".join(prompt_parts)
+                return _tool_error("Error: message is required")
 
-            # Generate with streaming support
-            chunks, full_response = generate_completion(
-                model,
-                prompt,
+            # Pack history into the context window, generate and persist the turn
+            chunks, _ = await run_generation(
+                message,
                 max_tokens=max_tokens,
                 temperature=temperature,
                 top_p=top_p,
                 stop=["User:", "System:"],
-                streaming=DEFAULT_STREAMING_ENABLED,
-                chunk_size=DEFAULT_STREAMING_CHUNK_SIZE,
+                session_id=session_id,
             )
 
-            # Strip whitespace from full response before persisting
-            full_response = full_response.strip()
-
-            # Persist new turn in session history (always use full accumulated text)
-            append_session_message(session_id, "user", message)
-            append_session_message(session_id, "assistant", full_response)
-
             # Strip whitespace from first chunk if present
             if chunks and chunks[0].text:
                 chunks[0].text = chunks[0].text.strip()
 
-            return chunks
+            return chunks, False
         
         else:
-            return [TextContent(type="text", text=f"Unknown tool: {name}")]
+            return _tool_error(f"Unknown tool: {name}")
     
+    except InferenceQueueFullError as e:
+        return _tool_error(f"Error: server busy. {str(e)}")
     except FileNotFoundError as e:
-        return [TextContent(type="text", text=f"Error: {str(e)}")]
+        return _tool_error(f"Error: {str(e)}")
     except Exception as e:
-        return [TextContent(type="text", text=f"Error executing tool: {str(e)}")]
+        return _tool_error(f"Error executing tool: {str(e)}")
 
 
 async def main():
     """Main function"""
+    init_session_services()
     # Load model on initialization (optional, can be lazy)
     try:
         if DEFAULT_MODEL_PATH and os.path.exists(DEFAULT_MODEL_PATH):
-            load_model()
+            await run_inference(load_model)
     except Exception as e:
         print(f"Warning: Could not load model on initialization: {e}", file=sys.stderr)
         print("The model will be loaded when the first tool is called.", file=sys.stderr)
@@ -1041,6 +5833,15 @@ async def main():
             write_stream,
             server.create_initialization_options()
         )
+    inference_executor.shutdown(wait=False)
+    session_summarizer.close()
+    if session_store is None:
+        return
+    session_gc.close()
+    session_archiver.close()
+    if session_search is not None:
+        session_search.close()
+    session_store.close()
 
 
 if __name__ == "__main__":
@@ -2,11 +2,17 @@
 """
 MCP server with Llama integration using FastMCP (simpler alternative version)
 """
+import functools
 import os
 import sys
+import threading
+import time
 from typing import Optional
 from dotenv import load_dotenv
 
+import metrics as prom
+from server import generate_completion
+
 try:
     from llama_cpp import Llama
 except ImportError:
@@ -51,6 +57,7 @@ def get_model() -> Llama:
     print(f"Loading model from: {path}", file=sys.stderr)
     
     try:
+        start = time.perf_counter()
         llama_model = Llama(
             model_path=path,
             n_ctx=DEFAULT_CONTEXT_SIZE,
@@ -58,6 +65,7 @@ def get_model() -> Llama:
             n_gpu_layers=DEFAULT_N_GPU_LAYERS,
             verbose=False
         )
+        prom.MODEL_LOAD.observe(time.perf_counter() - start)
         print("Model loaded successfully!", file=sys.stderr)
         return llama_model
     except Exception as e:
@@ -65,11 +73,50 @@ def get_model() -> Llama:
         raise
 
 
+# Tool calls share one llama context, so they generate one at a time
+_model_lock = threading.Lock()
+
+
+def generate(model: Llama, prompt: str, **kwargs) -> str:
+    """Run a completion and record it in the Prometheus metrics
+
+    generate_completion() records the latency, time-to-first-token, prompt
+    evaluation and token histograms, as on the stdio and web chat paths; the
+    wait for the model is recorded as queue wait.
+    """
+    start = time.perf_counter()
+    with _model_lock:
+        prom.QUEUE_WAIT.observe(time.perf_counter() - start, queue="model_lock")
+        _, text = generate_completion(model, prompt, **kwargs)
+    return text
+
+
+def instrumented(func):
+    """Count and time calls of a tool for /metrics"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        status = "error"
+        try:
+            result = func(*args, **kwargs)
+            status = "ok"
+            return result
+        finally:
+            prom.TOOL_CALLS.inc(tool=func.__name__, status=status)
+            prom.TOOL_DURATION.observe(time.perf_counter() - start, tool=func.__name__)
+    return wrapper
+
+
+prom.set_loaded_models_source(
+    lambda: [os.path.basename(llama_model.model_path)] if llama_model is not None else []
+)
+
 # Create FastMCP server
 mcp = FastMCP("Local LLM MCP Tool")
 
 
 @mcp.tool()
+@instrumented
 def generate_text(
     prompt: str,
     max_tokens: int = 256,
@@ -79,19 +126,18 @@ def generate_text(
     """Generates text using the Llama model locally"""
     model = get_model()
     
-    output = model(
+    return generate(
+        model,
         prompt,
         max_tokens=max_tokens,
         temperature=temperature,
         top_p=top_p,
-        echo=False,
         stop=["\n\n"]
     )
-    
-    return output["choices"][0]["text"]
 
 
 @mcp.tool()
+@instrumented
 def chat(
     messages: list[dict],
     max_tokens: int = 256,
@@ -114,18 +160,19 @@ def chat(
     
     prompt = "\n".join(prompt_parts) + "\nAssistant:"
     
-    output = model(
+    text = generate(
+        model,
         prompt,
         max_tokens=max_tokens,
         temperature=temperature,
-        echo=False,
         stop=["User:", "System:"]
     )
     
-    return output["choices"][0]["text"].strip()
+    return text.strip()
 
 
 @mcp.tool()
+@instrumented
 def complete(
     text: str,
     max_tokens: int = 128,
@@ -134,14 +181,12 @@ def complete(
     """Completes text using the Llama model"""
     model = get_model()
     
-    output = model(
+    return generate(
+        model,
         text,
         max_tokens=max_tokens,
-        temperature=temperature,
-        echo=False
+        temperature=temperature
     )
-    
-    return output["choices"][0]["text"]
 
 
 if __name__ == "__main__":
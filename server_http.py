@@ -1,13 +1,17 @@
 #!/usr/bin/env python3
 """
 MCP server with HTTP/Streamable HTTP transport for Fly.io and remote deployment.
-Mounts the FastMCP server at /mcp and adds a health endpoint at / for Fly.io checks.
+Mounts the FastMCP server at /mcp and adds a health endpoint at / for Fly.io checks
+and a Prometheus /metrics endpoint.
 """
 import os
 from starlette.applications import Starlette
-from starlette.responses import JSONResponse
+from starlette.middleware import Middleware
+from starlette.responses import JSONResponse, Response
 from starlette.routing import Route, Mount
 
+import metrics as prom
+
 # Import the FastMCP instance and tools from server_fastmcp
 from server_fastmcp import mcp
 
@@ -17,12 +21,19 @@ async def health(_request):
     return JSONResponse({"status": "ok", "service": "local-llm-mcp"})
 
 
-# Create Starlette app with health route and MCP mount
+async def metrics(_request):
+    """Prometheus scrape endpoint"""
+    return Response(prom.render(), media_type=prom.CONTENT_TYPE)
+
+
+# Create Starlette app with health and metrics routes and MCP mount
 app = Starlette(
     routes=[
         Route("/", health),
+        Route("/metrics", metrics),
         Mount("/mcp", app=mcp.streamable_http_app()),
     ],
+    middleware=[Middleware(prom.PrometheusMiddleware)],
 )
 
 
@@ -1,14 +1,29 @@
 """
 Quick test script to verify if the MCP server is working
 """
+import atexit
+import json
 import os
+import shutil
 import sys
+import tempfile
 from dotenv import load_dotenv
 
+
 # Load environment variables
 load_dotenv()
 
 
+# Session history, traces, profiles and dashboard metrics written by the tests go to a
+# temporary directory, never to the repo (set before server and the web chat are imported)
+_TEST_DATA_DIR = tempfile.mkdtemp(prefix="llm-mcp-test-")
+atexit.register(shutil.rmtree, _TEST_DATA_DIR, ignore_errors=True)
+os.environ["SESSION_HISTORY_DIR"] = os.path.join(_TEST_DATA_DIR, "history")
+os.environ["TRACE_DIR"] = os.path.join(_TEST_DATA_DIR, "traces")
+os.environ["PROFILE_DIR"] = os.path.join(_TEST_DATA_DIR, "profiles")
+os.environ["WEB_CHAT_DATA_DIR"] = os.path.join(_TEST_DATA_DIR, "web_chat")
+
+
 def test_model_loading():
     """Tests if the model can be loaded"""
     print("=== Test: Model Loading ===\n")
@@ -16,104 +31,1551 @@ def test_model_loading():
     model_path = os.getenv("MODEL_PATH", "")
     
     if not model_path:
-        print("❌ MODEL_PATH is not configured in .env file")
+        print("  (skipping: MODEL_PATH is not configured in .env file)")
         print("\nPlease:")
         print("1. Copy .env.example to .env")
         print("2. Configure MODEL_PATH with the path to a .gguf file")
         print("3. Or run: python download_model.py")
-        return False
+        return
     
-    if not os.path.exists(model_path):
-        print(f"❌ Model file not found: {model_path}")
-        return False
+    assert os.path.exists(model_path), f"Model file not found: {model_path}"
     
     print(f"✓ File found: {model_path}")
     print(f"  Size: {os.path.getsize(model_path) / (1024*1024):.2f} MB")
     
-    try:
-        from llama_cpp import Llama
-        print("\nLoading model...")
-        
-        model = Llama(
-            model_path=model_path,
-            n_ctx=512,  # Smaller context for quick test
-            n_threads=2,
-            verbose=False
-        )
-        
-        print("✓ Model loaded successfully!")
-        
-        # Quick generation test
-        print("\nTesting text generation...")
-        output = model("Hello", max_tokens=10, temperature=0.7, echo=False)
-        print(f"✓ Model response: {output['choices'][0]['text']}")
-        
-        return True
-        
-    except ImportError:
-        print("❌ llama-cpp-python is not installed")
-        print("Install with: pip install llama-cpp-python")
-        return False
-    except Exception as e:
-        print(f"❌ Error loading model: {e}")
-        return False
+    from llama_cpp import Llama
+    print("\nLoading model...")
+    
+    model = Llama(
+        model_path=model_path,
+        n_ctx=512,  # Smaller context for quick test
+        n_threads=2,
+        verbose=False
+    )
+    
+    print("✓ Model loaded successfully!")
+    
+    # Quick generation test
+    print("\nTesting text generation...")
+    output = model("Hello", max_tokens=10, temperature=0.7, echo=False)
+    print(f"✓ Model response: {output['choices'][0]['text']}")
 
 
 def test_mcp_imports():
     """Tests if MCP dependencies are installed"""
     print("\n=== Test: MCP Dependencies ===\n")
     
-    try:
-        from mcp.server import Server
-        from mcp.server.stdio import stdio_server
-        from mcp.types import Tool, TextContent
-        print("✓ MCP libraries imported successfully")
-        return True
-    except ImportError as e:
-        print(f"❌ Error importing MCP libraries: {e}")
-        print("Install with: pip install mcp")
-        return False
+    from mcp.server import Server
+    from mcp.server.stdio import stdio_server
+    from mcp.types import Tool, TextContent
+    print("✓ MCP libraries imported successfully")
 
 
 def test_session_helpers():
     """Tests basic session helper behavior (no model required)."""
     print("\n=== Test: Session Helpers ===\n")
 
+    # Import after environment is loaded
+    import server
+
+    # Start a new session
+    session_id = server.create_session(metadata={"label": "Test session"})
+    print(f"✓ Created session: {session_id}")
+
+    # Append a short conversation
+    server.append_session_message(session_id, "user", "Hello")
+    server.append_session_message(session_id, "assistant", "Hi there")
+
+    messages = server.load_recent_session_messages(session_id, max_messages=10)
+    assert len(messages) >= 2, "Expected at least 2 messages in session history"
+    print(f"✓ Loaded recent messages (count={len(messages)})")
+
+    # End and delete the session
+    assert server.mark_session_ended(session_id, delete=True), "Failed to end session"
+    print("✓ Session ended and history cleaned up (if possible)")
+
+
+def test_inference_executor():
+    """Tests the bounded inference queue (no model required)."""
+    print("\n=== Test: Inference Executor ===\n")
+
+    import threading
+    import time
+
+    import server
+
+    executor = server.InferenceExecutor(max_queue_size=1)
+    release = threading.Event()
+
+    # Occupy the worker, then fill the single queue slot
+    busy = executor.submit(release.wait, 5)
+    time.sleep(0.05)
+    queued = executor.submit(threading.get_ident)
+
+    try:
+        executor.submit(time.sleep, 0)
+        raise AssertionError("Expected InferenceQueueFullError when the queue is full")
+    except server.InferenceQueueFullError:
+        print("✓ Full queue rejects new requests")
+
+    release.set()
+    busy.result(timeout=5)
+    worker_ident = queued.result(timeout=5)
+    assert worker_ident != threading.get_ident(), "Job ran on the caller thread instead of the inference thread"
+    print("✓ Jobs run on the inference thread")
+
+    stats = executor.stats()
+    assert stats["completed"] == 2 and stats["rejected"] == 1 and stats["max_queue_wait_ms"] > 0, f"Unexpected executor stats: {stats}"
+    print(f"✓ Queue-wait metrics recorded (max={stats['max_queue_wait_ms']}ms)")
+
+    # A job's context variables must not leak into the next job on the same worker
+    executor.submit(server._request_model_path.set, "/models/previous.gguf").result(timeout=5)
+    leaked = executor.submit(server._request_model_path.get).result(timeout=5)
+    assert leaked is None, f"Previous job's model leaked into the next job: {leaked}"
+    print("✓ Each job runs in its caller's context")
+
+    executor.shutdown()
+
+    # Session tools do their disk / SQLite work off the event loop thread
+    import asyncio
+
+    writers = []
+    original_create, original_append = server.create_session, server.append_session_message
+    server.create_session = lambda metadata=None: "executor-test"
+    server.append_session_message = lambda *args, **kwargs: writers.append(threading.get_ident())
+    try:
+        async def start_session():
+            await server._call_tool("start_session", {})
+            return threading.get_ident()
+
+        loop_ident = asyncio.run(start_session())
+    finally:
+        server.create_session, server.append_session_message = original_create, original_append
+    assert writers and writers[0] != loop_ident, "start_session wrote the session on the event loop thread"
+    print("✓ Session tools write off the event loop")
+
+
+def test_session_state_cache():
+    """Tests the per-session KV-cache LRU and disk spill (no model required)."""
+    print("\n=== Test: Session KV-Cache ===\n")
+
+    import tempfile
+    from pathlib import Path
+    import numpy as np
+    from llama_cpp import LlamaState
+
+    import server
+
+    def make_state(tag: bytes) -> LlamaState:
+        return LlamaState(
+            input_ids=np.arange(4, dtype=np.intc),
+            scores=np.ones((4, 3), dtype=np.single),
+            n_tokens=4,
+            llama_state=tag * 60,
+            llama_state_size=60,
+            seed=7,
+        )
+
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = server.SessionStateCache(Path(tmp), max_memory_bytes=100, max_disk_bytes=10_000)
+        cache.put("a", "model.gguf", "k1", make_state(b"a"))
+        cache.put("b", "model.gguf", "k1", make_state(b"b"))
+
+        # "a" no longer fits in RAM and must have been spilled to disk
+        assert (Path(tmp) / "a.state").exists(), "Expected the least recently used state to spill to disk"
+        print("✓ Cold state spilled to disk")
+
+        state = cache.get("a", "model.gguf", "k1")
+        assert (
+            state is not None
+            and state.llama_state == b"a" * 60
+            and state.n_tokens == 4
+            and state.seed == 7
+            and np.array_equal(state.input_ids, np.arange(4))
+            and state.scores.shape == (4, 3)
+            and cache.disk_hits == 1
+        ), "Expected the spilled state to be restored from disk"
+        print("✓ Spilled state restored from disk")
+
+        # Truncated or foreign spill files are a cache miss, never an error
+        cache.put("c", "model.gguf", "k1", make_state(b"c"))
+        spilled = Path(tmp) / "b.state"
+        spilled.write_bytes(spilled.read_bytes()[:-10])
+        (Path(tmp) / "d.state").write_bytes(b"\x80\x04not a state file")
+        assert cache.get("b", "model.gguf", "k1") is None and cache.get("d", "model.gguf", "k1") is None, "Damaged spill files should be treated as a miss"
+        assert not spilled.exists(), "Damaged spill files should be removed"
+        print("✓ Damaged spill files are a cache miss")
+
+        assert cache.get("c", "model.gguf", "k2") is None, "State should be invalidated when the history prefix changes"
+        assert cache.get("c", "model.gguf", "k1") is None, "Stale state should have been dropped"
+        print("✓ Prefix change invalidates the cached state")
+
+
+def test_model_pool():
+    """Tests LRU eviction within the model pool's RAM budget (no model required)."""
+    print("\n=== Test: Model Pool ===\n")
+
+    import tempfile
+    import threading
+    from pathlib import Path
+
+    import server
+
+    loading = threading.Event()
+    finish_loading = threading.Event()
+
+    class FakeLlama:
+        def __init__(self, model_path, **kwargs):
+            self.model_path = model_path
+            if model_path.endswith("bad.gguf"):
+                raise RuntimeError("corrupt model")
+            if model_path.endswith("slow.gguf"):
+                loading.set()
+                finish_loading.wait(10)
+
+    original_llama = server.Llama
+    server.Llama = FakeLlama
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            paths = []
+            for name in ("a", "b", "c"):
+                path = Path(tmp) / f"{name}.gguf"
+                path.write_bytes(b"\0" * 100)
+                paths.append(str(path))
+
+            pool = server.ModelPool(max_bytes=250)
+            first, _ = pool.acquire(paths[0], paths[0])
+            pool.acquire(paths[1], paths[1])
+            again, _ = pool.acquire(paths[0], paths[0])
+            assert again is first, "Resident model was reloaded instead of reused"
+            print("✓ Switching back to a resident model reuses it")
+
+            # "b" is now least recently used and must make room for "c"
+            pool.acquire(paths[2], paths[2])
+            resident = {m["path"] for m in pool.loaded_models()}
+            assert resident == {paths[0], paths[2]}, f"Unexpected resident models: {sorted(resident)}"
+            print("✓ Least recently used model evicted to stay within budget")
+
+            # A model that is generating (lock held) is never evicted
+            _, lock_c = pool.acquire(paths[2], paths[2])
+            with lock_c:
+                pool.acquire(paths[1], paths[1])
+                assert paths[2] in {m["path"] for m in pool.loaded_models()}, "A model in use was evicted"
+            print("✓ Models in use are not evicted")
+
+            # A model still loading counts against the budget of concurrent loads
+            slow = Path(tmp) / "slow.gguf"
+            slow.write_bytes(b"\0" * 100)
+            pool = server.ModelPool(max_bytes=250)
+            pool.acquire(paths[0], paths[0])
+            loader = threading.Thread(target=pool.acquire, args=(str(slow), str(slow)))
+            loader.start()
+            loading.wait(10)
+            pool.acquire(paths[1], paths[1])
+            finish_loading.set()
+            loader.join(10)
+            resident = {m["path"] for m in pool.loaded_models()}
+            assert resident == {str(slow), paths[1]}, f"Concurrent loads went over budget: {sorted(resident)}"
+            print("✓ Concurrent loads stay within budget")
+
+            bad = Path(tmp) / "bad.gguf"
+            bad.write_bytes(b"\0" * 100)
+            try:
+                pool.acquire(str(bad), str(bad))
+            except RuntimeError:
+                pass
+            assert pool.stats()["loading_bytes"] == 0, "A failed load kept its budget reservation"
+            print("✓ Failed loads release their reservation")
+    finally:
+        server.Llama = original_llama
+
+
+class _SlowStubModel:
+    """Stands in for Llama: streams fixed tokens with a fake per-token latency."""
+
+    def __init__(self, tokens, token_latency_s):
+        self.tokens = tokens
+        self.token_latency_s = token_latency_s
+        self.calls = 0
+
+    def __call__(self, prompt, stream=False, **kwargs):
+        import time
+
+        self.calls += 1
+
+        def generate():
+            for token in self.tokens:
+                time.sleep(self.token_latency_s)
+                yield {"choices": [{"text": token}]}
+
+        if stream:
+            return generate()
+        return {"choices": [{"text": "".join(c["choices"][0]["text"] for c in generate())}]}
+
+
+def test_streaming_time_to_first_token():
+    """Tests that streamed output reaches the caller before generation ends (no model required)."""
+    print("\n=== Test: Streaming Time-to-First-Token ===\n")
+
+    import time
+
+    import server
+
+    token_latency_s = 0.02
+    tokens = [f"tok{i} " for i in range(40)]
+    model = _SlowStubModel(tokens, token_latency_s)
+
+    arrivals = []
+    start = time.perf_counter()
+    _, full_text = server.generate_completion(
+        model,
+        "Hello",
+        streaming=True,
+        chunk_size=50,
+        on_chunk=lambda text: arrivals.append(time.perf_counter() - start),
+    )
+    total_s = time.perf_counter() - start
+
+    assert full_text == "".join(tokens), "Full text does not match the streamed tokens"
+
+    ttft_s = arrivals[0]
+    print(f"  time-to-first-token: {ttft_s * 1000:.1f}ms, total: {total_s * 1000:.1f}ms")
+    assert ttft_s <= 3 * token_latency_s and ttft_s <= total_s / 4, "First chunk arrived too late; output is being buffered"
+    print("✓ First token delivered while generation was still running")
+
+    assert len(arrivals) >= 2, "Expected several incremental chunks"
+    print(f"✓ {len(arrivals)} chunks delivered incrementally")
+
+
+def test_response_cache():
+    """Tests that deterministic generations are served from the response cache (no model required)."""
+    print("\n=== Test: Response Cache ===\n")
+
+    import tempfile
+    from pathlib import Path
+
+    import server
+
+    original_cache = server.response_cache
+    model = _SlowStubModel(["cached ", "answer"], 0)
+    with tempfile.TemporaryDirectory() as tmp:
+        try:
+            server.response_cache = server.ResponseCache(8, cache_dir=Path(tmp), max_disk_bytes=1_000_000)
+
+            server.generate_completion(model, "Q", temperature=0)
+            metrics = {}
+            _, text = server.generate_completion(model, "Q", temperature=0, metrics=metrics)
+            assert model.calls == 1 and metrics.get("cached") and text == "cached answer", "Expected the second temperature-0 call to hit the cache"
+            print("✓ Deterministic call served from cache")
+
+            server.generate_completion(model, "Q", temperature=0.7)
+            server.generate_completion(model, "Q", temperature=0, cache=False)
+            assert model.calls == 3, "Sampled calls and cache=False must reach the model"
+            print("✓ Sampled calls and per-call bypass skip the cache")
+
+            # A fresh cache over the same directory simulates a restart
+            server.response_cache = server.ResponseCache(8, cache_dir=Path(tmp), max_disk_bytes=1_000_000)
+            server.generate_completion(model, "Q", temperature=0)
+            stats = server.get_response_cache_stats()
+            assert model.calls == 3 and stats["disk_hits"] == 1, f"Expected a disk hit after restart: {stats}"
+            print("✓ On-disk tier survives restarts")
+        finally:
+            server.response_cache = original_cache
+
+
+def test_batch_scheduler():
+    """Tests stop handling and, if MODEL_PATH is set, concurrent decoding across batch slots."""
+    print("\n=== Test: Batch Scheduler ===\n")
+
+    import server
+
+    assert server._stop_holdback("Hello Us", ["User:"]) == 2 and server._stop_holdback("Hello", ["User:"]) == 0, "Text that may start a stop sequence must be held back"
+    print("✓ Partial stop sequences are held back from streamed output")
+
+    supported = server._BATCH_LLAMA_CPP_VERSIONS
+    server._BATCH_LLAMA_CPP_VERSIONS = ((0, 0, 0), (0, 0, 1))
+    try:
+        server._create_batch_context(None, 64, 8, 2)
+        raise AssertionError("Unknown llama-cpp-python releases should not be used for batching")
+    except server.BatchingUnsupportedError:
+        print("✓ Unknown llama-cpp-python releases are not used for batching")
+    finally:
+        server._BATCH_LLAMA_CPP_VERSIONS = supported
+
+    model_path = os.getenv("MODEL_PATH", "")
+    if not model_path or not os.path.exists(model_path):
+        print("  (skipping decode check: MODEL_PATH not configured)")
+        return
+
+    model = server.load_model(model_path)
+    scheduler = server.BatchScheduler(model, n_slots=2)
+    try:
+        prompts = [f"User: Count to {i}.\nAssistant:" for i in range(3)]
+        futures = [scheduler.submit(p, max_tokens=8, temperature=0, stop=["User:"]) for p in prompts]
+        results = [f.result(timeout=300) for f in futures]
+        stats = scheduler.stats()
+
+        # A stop sequence found in the middle of the output cuts it right there
+        full = scheduler.submit(prompts[0], max_tokens=16, temperature=0).result(timeout=300)["text"]
+        stop = full[3:6]
+        cut = scheduler.submit(prompts[0], max_tokens=16, temperature=0, stop=[stop]).result(timeout=300)["text"]
+    finally:
+        scheduler.close()
+
+    assert not (len(stop) == 3 and cut != full[: full.find(stop)]), f"Output not cut at the stop sequence: {cut!r} (stop {stop!r} in {full!r})"
+
+    assert not any("User:" in r["text"] or r["completion_tokens"] > 8 for r in results), f"Stop lists or max_tokens not honoured: {results}"
+    assert stats["completed"] == 3 and stats["avg_batch_tokens"] > 1, f"Requests were not decoded together: {stats}"
+    print(f"✓ 3 requests decoded over 2 slots ({stats['avg_batch_tokens']} tokens per decode)")
+
+
+class _WordTokenizerModel:
+    """Stands in for Llama's tokenizer: one token per whitespace-separated word."""
+
+    def __init__(self, n_ctx, model_path="words.gguf"):
+        self._n_ctx = n_ctx
+        self.model_path = model_path
+        self.tokenized = 0
+
+    def n_ctx(self):
+        return self._n_ctx
+
+    def tokenize(self, text, add_bos=True, special=False):
+        self.tokenized += 1
+        return [0] * (len(text.split()) + (1 if add_bos else 0))
+
+
+def test_context_packing():
+    """Tests that session history is packed by token budget (no model required)."""
+    print("\n=== Test: Context Packing ===\n")
+
+    import server
+
+    # "User: w w w" is 4 tokens with the word tokenizer
+    history = [{"role": "system", "content": "be brief"}]
+    history += [{"role": "user", "content": " ".join(["w"] * 40)}]  # one long, old message
+    history += [{"role": "user", "content": f"short {i}"} for i in range(6)]
+
+    model = _WordTokenizerModel(n_ctx=40)
+    packed = server.pack_session_context(model, history, "next question", max_tokens=10, reserve=0)
+    # budget 40 - 10 - (3 + 1) - 1 - 3 (system) = 22 -> six 3-token turns fit, the long one does not
+    assert packed[0]["role"] == "system" and [e["content"] for e in packed[1:]] == [f"short {i}" for i in range(6)], f"Unexpected packing: {[e['content'] for e in packed]}"
+    print("✓ System message kept, newest turns filled up to the token budget")
+
+    tight = server.pack_session_context(model, history, "next question", max_tokens=25, reserve=0)
+    assert [e["content"] for e in tight] == ["be brief", "short 4", "short 5"], f"Expected fewer turns with a larger max_tokens: {[e['content'] for e in tight]}"
+    print("✓ Larger max_tokens leaves room for fewer turns")
+
+    # Persisted counts for the same tokenizer are used instead of re-tokenizing
+    stored = [{"role": "user", "content": "x", "n_tokens": 100, "tokenizer": "words.gguf"}]
+    assert not server.pack_session_context(model, stored, "q", max_tokens=0, reserve=0), "The persisted token count was ignored"
+    other = _WordTokenizerModel(n_ctx=40, model_path="other.gguf")
+    assert server.pack_session_context(other, stored, "q", max_tokens=0, reserve=0), "A count from another tokenizer must be recomputed"
+    print("✓ Persisted token counts reused only for the matching tokenizer")
+
+    session_id = server.create_session()
+    try:
+        server.append_session_message(session_id, "user", "three word message", model=model)
+        event = server.load_recent_session_messages(session_id)[-1]
+        assert event.get("n_tokens") == 4 and event.get("tokenizer") == "words.gguf", f"Token count not persisted with the event: {event}"
+        print("✓ Token counts persisted alongside new events")
+    finally:
+        server.mark_session_ended(session_id, delete=True)
+
+    # Only a bounded tail (n_ctx // MIN_TOKENS_PER_MESSAGE) plus the system head is read
+    session_id = server.create_session()
+    reads = []
+    load_recent = server.load_recent_session_messages
+    server.load_recent_session_messages = lambda sid, max_messages=None: reads.append(max_messages) or load_recent(
+        sid, max_messages
+    )
     try:
-        # Import after environment is loaded
-        import server
+        server.append_session_message(session_id, "system", "be brief")
+        for i in range(25):
+            server.append_session_message(session_id, "user", f"turn {i}")
+        prompt, _ = server.build_session_prompt(model, session_id, "next", max_tokens=5)
+        assert reads == [40 // server.MIN_TOKENS_PER_MESSAGE] and prompt.startswith("System: be brief"), f"Expected a bounded tail read plus the system head: reads {reads}, prompt {prompt!r}"
+        print(f"✓ Prompt built from the newest {reads[0]} messages plus the system head")
+    finally:
+        server.load_recent_session_messages = load_recent
+        server.mark_session_ended(session_id, delete=True)
 
-        # Start a new session
-        session_id = server.create_session(metadata={"label": "Test session"})
-        print(f"✓ Created session: {session_id}")
 
-        # Append a short conversation
-        server.append_session_message(session_id, "user", "Hello")
-        server.append_session_message(session_id, "assistant", "Hi there")
+def test_speculative_draft():
+    """Tests draft acceptance tracking and the fallback to normal decoding (no model required)."""
+    print("\n=== Test: Speculative Decoding ===\n")
 
-        messages = server.load_recent_session_messages(session_id, max_messages=10)
-        if len(messages) >= 2:
-            print(f"✓ Loaded recent messages (count={len(messages)})")
-        else:
-            print("❌ Expected at least 2 messages in session history")
-            return False
+    import server
 
-        # End and delete the session
-        ended = server.mark_session_ended(session_id, delete=True)
-        if ended:
-            print("✓ Session ended and history cleaned up (if possible)")
-        else:
-            print("❌ Failed to end session")
-            return False
+    mapping = server._parse_draft_models("big.gguf=small.gguf, *=tiny.gguf")
+    assert mapping == {"big.gguf": "small.gguf", "*": "tiny.gguf"}, f"Unexpected draft mapping: {mapping}"
+    print("✓ Per-target draft models parsed")
 
-        return True
+    class FakeDraftLlama:
+        model_path = "draft.gguf"
 
+        def n_ctx(self):
+            return 512
+
+        def token_eos(self):
+            return -1
+
+        def generate(self, tokens, **kwargs):
+            while True:
+                yield 7
+
+    draft = server.DraftModel(FakeDraftLlama(), num_pred_tokens=4, min_acceptance=0.5,
+                              window_tokens=8, probe_interval=3)
+    assert list(draft([1, 2, 3])) == [7, 7, 7, 7], "Expected four drafted tokens"
+    # The target kept two drafts, then sampled 9 instead of the third
+    draft([1, 2, 3, 7, 7, 9])
+    stats = draft.stats()
+    assert stats["drafted"] == 4 and stats["accepted"] == 2, f"Acceptance not tracked: {stats}"
+    print("✓ Accepted draft tokens counted from the verified sequence")
+
+    # Keep rejecting every draft: drafting must pause, then be probed again
+    seq = [1, 2, 3, 7, 7, 9]
+    outputs = []
+    for _ in range(8):
+        seq = seq + [9]
+        outputs.append(len(draft(seq)))
+    assert draft.stats()["fallbacks"] and 0 in outputs, f"Expected a fallback to normal decoding: {outputs}"
+    assert any(outputs[outputs.index(0):]), f"Drafting was never probed again: {outputs}"
+    print(f"✓ Low acceptance falls back to normal decoding and re-probes ({outputs})")
+
+
+def test_chat_stream_endpoint():
+    """Tests that /api/chat/stream sends tokens before a final event with metrics (no model required)."""
+    print("\n=== Test: Web Chat SSE Streaming ===\n")
+
+    try:
+        import json
+
+        from fastapi.testclient import TestClient
+    except ImportError:
+        print("  (skipping: web chat dependencies not installed, see web_chat/requirements.txt)")
+        return
+
+    from web_chat import app as web_app
+
+    calls = []
+
+    def fake_chat(messages, on_text=None, **kwargs):
+        calls.append(kwargs)
+        for piece in ("Hel", "lo", "!"):
+            on_text(piece)
+        return "Hello!", {"prompt_tokens": 3, "completion_tokens": 3, "total_tokens": 6}
+
+    original_get_llm = web_app.get_llm
+    web_app.get_llm = lambda: (fake_chat, None, None, None, None, None, None)
+    try:
+        client = TestClient(web_app.app)
+        body = {"messages": [{"role": "user", "content": "hi"}], "save_history": False}
+        with client.stream("POST", "/api/chat/stream", json=body) as r:
+            raw = "".join(r.iter_text())
+    finally:
+        web_app.get_llm = original_get_llm
+
+    events = []
+    for block in raw.split("\n\n"):
+        if block.strip():
+            name, data = block.split("\n", 1)
+            events.append((name[len("event: "):], json.loads(data[len("data: "):])))
+
+    tokens = [d["text"] for e, d in events if e == "token"]
+    assert tokens == ["Hel", "lo", "!"], f"Unexpected token events: {events}"
+    print(f"✓ {len(tokens)} token events streamed")
+
+    last_event, last_data = events[-1]
+    assert last_event == "done" and last_data.get("metrics", {}).get("completion_tokens") == 3 and len(calls) == 1, f"Expected one final 'done' event with metrics: {events[-1]}"
+    print("✓ Final event carries the response and metrics")
+
+    # A client that goes away stops the generation at its next chunk
+    import asyncio
+    import threading
+    import time
+
+    import server
+
+    stopped = threading.Event()
+
+    def endless_chat(messages, on_text=None, **kwargs):
+        try:
+            for _ in range(500):
+                on_text("x")
+                time.sleep(0.01)
+        except server.GenerationCancelled:
+            stopped.set()
+            raise
+        return "x" * 500, {}
+
+    async def disconnect_after_first_token():
+        # Raw ASGI call: TestClient only reports a disconnect once the response is complete
+        pending = [{"type": "http.request", "body": json.dumps(body).encode(), "more_body": False}]
+        got_token = asyncio.Event()
+
+        async def receive():
+            if pending:
+                return pending.pop(0)
+            await got_token.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            if message["type"] == "http.response.body" and message.get("body"):
+                got_token.set()
+
+        scope = {
+            "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "POST",
+            "scheme": "http", "path": "/api/chat/stream", "raw_path": b"/api/chat/stream",
+            "query_string": b"", "root_path": "", "headers": [(b"content-type", b"application/json")],
+            "client": ("test", 1), "server": ("test", 80),
+        }
+        await asyncio.wait_for(web_app.app(scope, receive, send), 10)
+
+    web_app.get_llm = lambda: (endless_chat, None, None, None, None, None, None)
+    try:
+        asyncio.run(disconnect_after_first_token())
+        assert stopped.wait(5), "Generation kept running after the client disconnected"
+    finally:
+        web_app.get_llm = original_get_llm
+    assert web_app.get_chat_stream_executor().stats()["submitted"] >= 2, "Streams should run on the chat stream executor"
+    print("✓ Disconnected clients cancel their generation")
+
+
+def test_sqlite_session_store():
+    """Tests the SQLite session store: trimming, counters and JSONL migration (no model required)."""
+    print("\n=== Test: SQLite Session Store ===\n")
+
+    import tempfile
+    from pathlib import Path
+    import server
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        store = server.SqliteSessionStore(tmp / "sessions.db", max_messages=4, max_bytes=1 << 20, auto_trim=True)
+        store.create("s1", server._new_session_meta({"label": "t"}))
+        store.append("s1", {"role": "system", "content": "be brief", "timestamp": "t0"})
+        dropped = sum(
+            store.append("s1", {"role": "user", "content": f"m{i}", "timestamp": f"t{i + 1}"})
+            for i in range(6)
+        )
+        events = store.load_recent("s1", max_messages=0)
+        assert [e["content"] for e in events] == ["be brief", "m3", "m4", "m5"] and dropped == 3, f"Unexpected trim result: {[e['content'] for e in events]} (dropped {dropped})"
+        print("✓ Range-delete trim keeps the system message and the newest turns")
+
+        meta = store.list_sessions()["s1"]
+        expected_bytes = sum(
+            len(json.dumps(e, ensure_ascii=False).encode("utf-8")) + 1 for e in events
+        )
+        assert meta["message_count"] == 4 and meta["bytes"] == expected_bytes, f"Counters out of sync: {meta}"
+        print("✓ message_count and bytes maintained incrementally")
+
+        jsonl = server.JsonlSessionStore(tmp / "jsonl", max_messages=0, max_bytes=0, auto_trim=False)
+        jsonl.create("old", server._new_session_meta())
+        for i in range(3):
+            jsonl.append("old", {"role": "user", "content": f"old {i}", "timestamp": f"t{i}"})
+        (tmp / "jsonl" / "orphan.jsonl").write_text(
+            json.dumps({"role": "user", "content": "lost", "timestamp": "t"}) + "\n", encoding="utf-8"
+        )
+        for _ in range(2):  # re-running must not duplicate messages
+            counts = server.migrate_jsonl_sessions(tmp / "jsonl", store)
+        migrated = store.load_recent("old", max_messages=0)
+        assert (
+            counts == {"sessions": 2, "messages": 4}
+            and [e["content"] for e in migrated] == ["old 0", "old 1", "old 2"]
+            and "orphan" in store.list_sessions()
+        ), f"Migration mismatch: {counts}"
+        print("✓ JSONL sessions (including orphans) migrated, re-runnable")
+        store.close()
+
+
+def test_session_tail_reader():
+    """Tests that recent JSONL history is read from the end of the file (no model required)."""
+    print("\n=== Test: Session Tail Reader ===\n")
+
+    import tempfile
+    from pathlib import Path
+    import server
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / "session.jsonl"
+        events = [{"role": "user", "content": f"message {i}", "timestamp": "t"} for i in range(200)]
+        body = "".join(json.dumps(e) + "\n" for e in events)
+        # A malformed line in the middle and a partial last line (an append in progress)
+        path.write_text(body + "not json\n" + '{"role": "user", "content": "trunc', encoding="utf-8")
+
+        lines = server._read_tail_lines(path, 5, block_size=64)
+        assert [line.decode() for line in lines[:3]] == [json.dumps(e) for e in events[-3:]], f"Unexpected tail: {lines}"
+        print("✓ Last lines returned across block boundaries")
+
+        store = server.JsonlSessionStore(Path(tmp), max_messages=0, max_bytes=0, auto_trim=False)
+        recent = store.load_recent("session", max_messages=5)
+        assert [e["content"] for e in recent] == [f"message {i}" for i in range(197, 200)], f"Malformed/partial lines not skipped: {recent}"
+        assert len(store.load_recent("session", max_messages=0)) == 200, "max_messages=0 must load the whole history"
+        print("✓ Malformed and partial lines skipped; max_messages=0 loads everything")
+
+        # Loading one session reads only that session's metadata, however many are stored
+        for i in range(50):
+            store.create(f"other-{i}", server._new_session_meta())
+        store.create("s", server._new_session_meta())
+        store.append("s", {"role": "user", "content": "hi", "timestamp": "t"})
+        read_metas = []
+        original_read_meta = store._read_meta
+        store._read_meta = lambda session_id: read_metas.append(session_id) or original_read_meta(session_id)
+        assert [e["content"] for e in store.load_recent("s", max_messages=5)] == ["hi"] and read_metas == ["s"], f"Other sessions read: {read_metas}"
+        print("✓ Only the session's own metadata is read")
+
+
+def test_session_segmented_log():
+    """Tests the segmented JSONL session log: trimming without rewrites, compaction, legacy files (no model required)."""
+    print("\n=== Test: Segmented Session Log ===\n")
+
+    import tempfile
+    from pathlib import Path
+    import server
+
+    with tempfile.TemporaryDirectory() as tmp:
+        store = server.JsonlSessionStore(
+            Path(tmp), max_messages=4, max_bytes=1 << 20, auto_trim=True,
+            segment_bytes=256, compact_interval_s=3600,
+        )
+        store.create("idle", server._new_session_meta())
+        idle_meta = store.log_dir("idle") / "meta.json"
+        idle_stat = idle_meta.stat()
+        store.create("s1", server._new_session_meta())
+        store.append("s1", {"role": "system", "content": "be brief", "timestamp": "t0"})
+        for i in range(40):
+            store.append("s1", {"role": "user", "content": f"m{i}", "timestamp": f"t{i + 1}"})
+
+        log = store.list_sessions()["s1"]["log"]
+        contents = [e["content"] for e in store.load_recent("s1", max_messages=0)]
+        assert log["last"] >= 2 and log["first"] != 0 and contents == ["be brief", "m37", "m38", "m39"], f"Unexpected log state: log={log} contents={contents}"
+        print(f"✓ Log rolled over {log['last'] + 1} segments; trimming moved its start past the dropped lines")
+        after = idle_meta.stat()
+        assert (after.st_ino, after.st_mtime_ns) == (idle_stat.st_ino, idle_stat.st_mtime_ns), "Appending to one session rewrote another session's metadata"
+        assert not (Path(tmp) / "sessions_index.json").exists(), "Appends should not write a shared session index"
+        print("✓ Log position kept in the session's own meta.json; other sessions untouched")
+
+        # The compactor may already have run in the background (a segment became dead)
+        store.compact()
+        segments = [int(p.stem) for p in store.log_dir("s1").glob("0*.jsonl")]
+        stats = store.compaction_stats()
+        assert min(segments) >= log["first"] and stats["segments_deleted"] != 0, f"Dead segments not reclaimed: segments={segments} stats={stats}"
+        assert [e["content"] for e in store.load_recent("s1", max_messages=2)] == ["m38", "m39"], "Compaction changed the live history"
+        print(f"✓ Compaction deleted {stats['segments_deleted']} dead segment(s) without touching live messages")
+
+        store.close()
+
+        # Layout of older versions: one <id>.jsonl per session, listed in sessions_index.json
+        legacy_dir = Path(tmp) / "legacy"
+        legacy_dir.mkdir()
+        legacy = legacy_dir / "old.jsonl"
+        legacy.write_text(
+            "".join(json.dumps({"role": "user", "content": f"o{i}", "timestamp": "t"}) + "\n" for i in range(3)),
+            encoding="utf-8",
+        )
+        legacy_meta = {**server._new_session_meta(metadata={"label": "legacy"}), "message_count": 3}
+        (legacy_dir / "sessions_index.json").write_text(json.dumps({"sessions": {"old": legacy_meta}}), encoding="utf-8")
+        store = server.JsonlSessionStore(legacy_dir, max_messages=4, max_bytes=1 << 20, auto_trim=True)
+        assert [e["content"] for e in store.load_recent("old", max_messages=2)] == ["o1", "o2"], "Legacy single-file history not readable"
+        assert store.get_meta("old")["metadata"] == {"label": "legacy"} and not (legacy_dir / "sessions_index.json").exists(), "Legacy index not split into per-session metadata"
+        store.append("old", {"role": "user", "content": "o3", "timestamp": "t"})
+        contents = [e["content"] for e in store.load_recent("old", max_messages=0)]
+        assert not legacy.exists() and contents == ["o0", "o1", "o2", "o3"], f"Legacy history not converted on write: {contents}"
+        print("✓ Legacy index split into per-session metadata; single-file history converted to a log on its next write")
+        store.close()
+
+
+def test_write_behind_session_store():
+    """Tests the in-memory session cache and its group-commit flusher (no model required)."""
+    print("\n=== Test: Write-Behind Session Store ===\n")
+
+    import tempfile
+    import threading
+    import time
+    from pathlib import Path
+    import server
+
+    with tempfile.TemporaryDirectory() as tmp:
+        backend = server.SqliteSessionStore(Path(tmp) / "sessions.db", max_messages=5, max_bytes=1 << 20, auto_trim=True)
+        # A flush delay long enough that only explicit flushes write
+        store = server.WriteBehindSessionStore(backend, max_delay_ms=600_000)
+        store.create("s1", server._new_session_meta())
+        store.append("s1", {"role": "system", "content": "be brief", "timestamp": "t0"})
+        dropped = sum(
+            store.append("s1", {"role": "user", "content": f"m{i}", "timestamp": f"t{i + 1}"})
+            for i in range(8)
+        )
+        cached = [e["content"] for e in store.load_recent("s1", max_messages=0)]
+        assert backend.get_meta("s1") is None and cached == ["be brief", "m4", "m5", "m6", "m7"] and dropped == 4, f"Writes should stay in memory until flushed: {cached} (dropped {dropped})"
+        print("✓ Reads and trimming served from memory before anything is written")
+
+        store.flush()
+        stats = store.stats()
+        on_disk = [e["content"] for e in backend.load_recent("s1", max_messages=0)]
+        assert on_disk == cached and stats["flushes"] == 1 and stats["max_batch"] == 10, f"Group commit mismatch: {on_disk} {stats}"
+        print("✓ One flush wrote the create and all appends as a single batch")
+
+        # A cold session read from a slow disk must not hold up cached sessions
+        backend.create("cold", server._new_session_meta())
+        reading, release = threading.Event(), threading.Event()
+        original_load = backend.load_recent
+
+        def slow_load(session_id, max_messages):
+            if session_id == "cold":
+                reading.set()
+                release.wait(5)
+            return original_load(session_id, max_messages)
+
+        backend.load_recent = slow_load
+        cold = threading.Thread(target=store.load_recent, args=("cold", 5))
+        cold.start()
+        try:
+            assert reading.wait(5), "Cold session was not read from the backend"
+            start = time.perf_counter()
+            store.append("s1", {"role": "user", "content": "m8", "timestamp": "t8"})
+            blocked_s = time.perf_counter() - start
+        finally:
+            release.set()
+            cold.join()
+            backend.load_recent = original_load
+        assert blocked_s < 1, f"Append waited {blocked_s:.1f}s for another session's disk read"
+        print("✓ Cold-session loads do not block other sessions")
+
+        store.append("s1", {"role": "user", "content": "last", "timestamp": "t9"})
+        store.close()
+        assert backend.load_recent("s1", max_messages=1)[0]["content"] == "last", "close() did not drain queued writes"
+        print("✓ close() drains queued writes")
+
+
+def test_session_listing():
+    """Tests paginated, filtered session listing on both storage backends (no model required)."""
+    print("\n=== Test: Session Listing ===\n")
+
+    import tempfile
+    from pathlib import Path
+    import server
+
+    with tempfile.TemporaryDirectory() as tmp:
+        stores = {
+            "sqlite": server.SqliteSessionStore(Path(tmp) / "sessions.db", max_messages=40, max_bytes=1 << 20, auto_trim=True),
+            "jsonl": server.JsonlSessionStore(Path(tmp) / "jsonl", max_messages=40, max_bytes=1 << 20, auto_trim=True),
+        }
+        for name, store in stores.items():
+            for i in range(25):
+                meta = server._new_session_meta(metadata={"source": "web_chat" if i % 2 else "mcp"})
+                meta["last_used_at"] = f"2026-01-01T00:00:{i:02d}Z"
+                store.create(f"s{i:02d}", meta)
+            store.end("s03")
+
+            seen, cursor = [], None
+            while True:
+                page, cursor = store.list_page(10, cursor)
+                seen += [sid for sid, _ in page]
+                if cursor is None:
+                    break
+            # end() bumps last_used_at, so s03 is now the most recent
+            expected = ["s03"] + [f"s{i:02d}" for i in range(24, -1, -1) if i != 3]
+            assert seen == expected, f"{name}: pages out of order: {seen}"
+
+            closed, _ = store.list_page(10, status="closed")
+            web, _ = store.list_page(50, metadata={"source": "web_chat"})
+            assert [sid for sid, _ in closed] == ["s03"] and len(web) == 12, f"{name}: filters returned {closed} / {len(web)} sessions"
+
+            # An append moves a session back to the top of the listing
+            store.append("s10", {"role": "user", "content": "hi", "timestamp": "2999-01-01T00:00:00Z"})
+            first, _ = store.list_page(1)
+            assert first[0][0] == "s10", f"{name}: listing not updated after a write: {first}"
+            print(f"✓ {name}: cursor pages, status/metadata filters and ordering after writes")
+
+        try:
+            stores["sqlite"].list_page(10, cursor="not-a-cursor")
+            raise AssertionError("Invalid cursor accepted")
+        except ValueError:
+            print("✓ Invalid cursor rejected")
+        for store in stores.values():
+            store.close()
+
+
+def test_session_archival():
+    """Tests archiving cold sessions to compressed files, on-demand reads and rehydration (no model required)."""
+    print("\n=== Test: Session Archival ===\n")
+
+    import tempfile
+    from pathlib import Path
+    import server
+
+    with tempfile.TemporaryDirectory() as tmp:
+        store = server.SqliteSessionStore(Path(tmp) / "sessions.db", max_messages=40, max_bytes=1 << 20, auto_trim=True)
+        archiver = server.SessionArchiver(store, Path(tmp) / "archive", closed_after_h=1, idle_after_h=0, interval_s=0)
+        events = [{"role": "user", "content": f"question {i} " * 10, "timestamp": "t"} for i in range(20)]
+        cold = {**server._new_session_meta(), "status": "closed", "last_used_at": "2020-01-01T00:00:00Z"}
+        store.import_session("cold", cold, events)
+        store.import_session("warm", {**server._new_session_meta(), "status": "closed"}, events)
+
+        archived = archiver.run_once()
+        meta = store.get_meta("cold")
+        stats = archiver.stats()
+        assert archived == 1 and meta["status"] == "archived" and not store.load_recent("cold", 0) and stats["bytes_saved"] > 0, f"Cold session not archived: archived={archived} meta={meta} stats={stats}"
+        print(f"✓ Closed session past its TTL archived ({stats['bytes']} -> {stats['compressed_bytes']} bytes); recent one kept")
+
+        assert archiver.load_recent("cold", 5) == events[-5:] and archiver.load_recent("warm", 5) is None, "Archived messages not readable on demand"
+        print("✓ Archived messages decompressed on demand")
+
+        assert archiver.restore("cold") and store.load_recent("cold", 0) == events and store.get_meta("cold")["status"] == "closed", "Session not rehydrated"
+        assert not (Path(tmp) / "archive" / "cold.jsonl.gz").exists() and archiver.stats()["sessions"] == 0, "Archive not removed after rehydration"
+        print("✓ Rehydration restored messages and status and removed the archive")
+        store.close()
+
+
+class _SummaryModel(_WordTokenizerModel):
+    """Word-tokenizer model that "summarizes" by returning a fixed text."""
+
+    n_batch = 8
+
+    def __init__(self, n_ctx):
+        super().__init__(n_ctx)
+        self.prompts = []
+
+    def reset(self):
+        pass
+
+    def eval(self, tokens):
+        pass
+
+    def __call__(self, prompt, stopping_criteria=None, **kwargs):
+        self.prompts.append(prompt)
+        if stopping_criteria is not None and stopping_criteria([], None):
+            return {"choices": [{"text": "partial"}]}
+        return {"choices": [{"text": " likes tea "}]}
+
+
+def test_session_summary():
+    """Tests rolling summaries: older turns replaced in the prompt, yielding to requests (no model required)."""
+    print("\n=== Test: Rolling Session Summary ===\n")
+
+    import server
+
+    model = _SummaryModel(n_ctx=400)
+    summarizer = server.SessionSummarizer(trigger_tokens=40, keep_tokens=12, max_tokens=20)
+    session_id = server.create_session()
+    try:
+        for i in range(8):
+            server.append_session_message(session_id, "user", f"question {i} about tea", model=model)
+            server.append_session_message(session_id, "assistant", f"answer {i}", model=model)
+
+        server._model_waiters += 1  # a request is waiting for the model
+        try:
+            assert summarizer.summarize(model, session_id) is None, "Summary not abandoned while a request was waiting"
+        finally:
+            server._model_waiters -= 1
+        print("✓ Summary abandoned while a request waits for the model")
+
+        def no_loading(*args, **kwargs):
+            raise AssertionError("the summarizer loaded a model")
+
+        original_acquire = server._acquire_model
+        server._acquire_model = no_loading
+        try:
+            assert summarizer._run_for_session(session_id, "/models/not-loaded.gguf"), "Session should be dropped, not retried"
+        finally:
+            server._acquire_model = original_acquire
+        assert summarizer.stats()["skipped"] == 1, f"Skip not counted: {summarizer.stats()}"
+        print("✓ A model that is not resident is never loaded for a summary")
+
+        summarized = summarizer.summarize(model, session_id)
+        events = server.load_recent_session_messages(session_id, max_messages=0)
+        assert summarized and events[-1].get("summary") and "question 0 about tea" in model.prompts[-1], f"No summary written: {summarized} {events[-1]}"
+        packed = server.apply_session_summary(events)
+        contents = [e["content"] for e in packed]
+        assert contents[0] == server.SUMMARY_PREFIX + "likes tea" and len(packed) == 1 + 16 - summarized, f"Covered turns not replaced by the summary: {contents}"
+        print(f"✓ {summarized} older turns folded into a summary; newest turns kept verbatim")
+
+        prompt, _ = server.build_session_prompt(model, session_id, "next", max_tokens=10)
+        assert "question 0 about tea" not in prompt and "likes tea" in prompt, f"Prompt still carries the summarized turns: {prompt}"
+        assert summarizer.summarize(model, session_id) == 0, "A fresh summary should not be summarized again"
+        print("✓ Prompt uses the summary; nothing more to do until new turns accumulate")
+    finally:
+        server.mark_session_ended(session_id, delete=True)
+
+
+def test_session_search():
+    """Tests the full-text session search index: ranking, trimming, resync and backfill (no model required)."""
+    print("\n=== Test: Session Search ===\n")
+
+    import tempfile
+    import time
+    from pathlib import Path
+    import server
+
+    with tempfile.TemporaryDirectory() as tmp:
+        stored = {
+            "old": [
+                {"role": "system", "content": "Você é um assistente.", "timestamp": "t0"},
+                {"role": "user", "content": "Como criar um índice no PostgreSQL?", "timestamp": "t1"},
+            ],
+        }
+        index = server.SessionSearchIndex(
+            Path(tmp) / "search.db",
+            loader=lambda sid: list(stored.get(sid, [])),
+            list_session_ids=lambda: list(stored),
+            flush_delay_ms=10,
+        )
+        # A new database is backfilled from the store in the background
+        hits = index.search("indice postgres")
+        deadline = time.time() + 5
+        while not hits and time.time() < deadline:
+            time.sleep(0.05)
+            hits = index.search("indice postgres")
+        assert [h["session_id"] for h in hits] == ["old"] and "[índice]" in hits[0]["snippet"], f"Backfill / diacritic-insensitive prefix search failed: {hits}"
+        print("✓ Existing sessions backfilled; accents ignored, last word matched as a prefix")
+
+        index.add("s1", {"role": "system", "content": "Sistema de buscas.", "timestamp": "t0"})
+        for i in range(4):
+            index.add("s1", {"role": "user", "content": f"mensagem número {i} sobre bancos", "timestamp": f"t{i}"})
+        index.add("s2", {"role": "user", "content": "bancos bancos bancos de dados", "timestamp": "t0"})
+        hits = index.search("bancos")
+        assert hits[0]["session_id"] == "s2" and len(index.search("bancos", session_id="s1")) == 4, f"Ranking or session filter wrong: {hits}"
+        print("✓ Results ranked by relevance and filtered by session")
+
+        # Trimming drops the oldest messages but keeps a leading system message
+        index.add("s1", {"role": "user", "content": "mensagem nova", "timestamp": "t9"}, dropped=2)
+        left = sorted(h["snippet"] for h in index.search("mensagem", session_id="s1"))
+        assert len(left) == 3 and index.search("sistema"), f"Trimming not mirrored: {left}"
+        print("✓ Trimmed messages removed from the index")
+
+        stored["s1"] = [{"role": "user", "content": "conteúdo reescrito", "timestamp": "t0"}]
+        index.resync("s1")
+        index.remove("s2")
+        assert not index.search("mensagem") and not index.search("bancos") and index.search("reescrito"), "Resync / remove not applied"
+        assert index.search('"*) OR (') == [] and index.search("") == [], "Query syntax not neutralized"
+        print("✓ Resync, removal and arbitrary query text handled")
+        index.close()
+
+
+def test_session_gc():
+    """Tests session garbage collection: TTL, empty sessions, quota and orphan reconciliation (no model required)."""
+    print("\n=== Test: Session Garbage Collection ===\n")
+
+    import tempfile
+    from pathlib import Path
+    import server
+
+    for name in ("sqlite", "jsonl"):
+        with tempfile.TemporaryDirectory() as tmp:
+            tmp = Path(tmp)
+            if name == "sqlite":
+                store = server.SqliteSessionStore(tmp / "sessions.db", max_messages=40, max_bytes=1 << 20, auto_trim=True)
+            else:
+                store = server.JsonlSessionStore(tmp, max_messages=40, max_bytes=1 << 20, auto_trim=True)
+            archiver = server.SessionArchiver(store, tmp / "archive", interval_s=0)
+            state_cache = server.SessionStateCache(tmp / "kv_cache", 1 << 20, 1 << 20)
+            search = server.SessionSearchIndex(
+                tmp / "search.db",
+                loader=lambda sid: store.load_recent(sid, 0) or [],
+                list_session_ids=lambda: list(store.list_sessions()),
+                flush_delay_ms=0,
+            )
+
+            def make(session_id, when, messages):
+                store.create(session_id, server._new_session_meta(now=when))
+                for _ in range(messages):
+                    store.append(session_id, {"role": "user", "content": "x" * 200, "timestamp": when})
+
+            make("ancient", "2000-01-01T00:00:00Z", 2)
+            make("old", "2026-01-01T00:00:00Z", 3)
+            make("recent", "2026-01-02T00:00:00Z", 3)
+            make("newest", "2026-01-03T00:00:00Z", 3)
+            make("deleted", "2026-01-04T00:00:00Z", 0)
+            # Orphans: a KV state and an archive file of sessions that do not exist
+            (tmp / "kv_cache").mkdir()
+            (tmp / "kv_cache" / "ghost.state").write_bytes(b"state")
+            (tmp / "archive").mkdir()
+            (tmp / "archive" / "ghost2.jsonl.gz").write_bytes(b"gz")
+            search.add("ghost3", {"role": "user", "content": "orphaned search entry", "timestamp": "t0"})
+
+            sizes = {sid: meta["bytes"] for sid, meta in store.list_sessions().items()}
+            gc = server.SessionGarbageCollector(
+                store, archiver, search, state_cache,
+                quota_bytes=sizes["newest"] + sizes["recent"], ttl_h=24 * 365 * 10, interval_s=0, grace_s=0,
+            )
+            result = gc.run_once()
+            left = sorted(store.list_sessions())
+            assert left == ["newest", "recent"], f"{name}: wrong sessions kept: {left} ({result})"
+            assert (result["expired"], result["empty"], result["over_quota"], result["orphans"]) == (1, 1, 1, 3), f"{name}: unexpected reclaim counts: {result}"
+            assert not state_cache.session_ids() and not (tmp / "archive" / "ghost2.jsonl.gz").exists(), f"{name}: orphaned files left behind"
+            assert not search.search("orphaned") and "ghost3" not in search.session_ids(), f"{name}: orphaned search entries left behind"
+            assert not store.load_recent("old", 0) and gc.run_once()["bytes_reclaimed"] == 0, f"{name}: removed session still has messages, or a second pass reclaimed more"
+            print(f"✓ {name}: expired, empty and over-quota sessions removed; orphans reconciled")
+            search.close()
+            store.close()
+
+
+def test_metrics_store():
+    """Tests the web chat metrics ring buffer, append-only log, snapshots and replay (no model required)."""
+    print("\n=== Test: Web Chat Metrics Store ===\n")
+
+    import json
+    import tempfile
+    import threading
+    from pathlib import Path
+    from web_chat.llm_client import MetricsStore
+
+    def entry(i):
+        return {
+            "session_id": f"s{i}", "timestamp": "2026-01-01T00:00:00Z", "prompt_tokens": 2,
+            "completion_tokens": 3, "total_tokens": 5, "response_time_ms": 10.0, "model": "m",
+        }
+
+    with tempfile.TemporaryDirectory() as tmp:
+        snapshot, log = Path(tmp) / "metrics.json", Path(tmp) / "metrics.log"
+        # A metrics.json written by older versions is read as the first snapshot
+        snapshot.write_text(json.dumps({"sessions": [entry(-1)], "summary": {"total_requests": 1, "total_tokens": 5}}))
+        store = MetricsStore(snapshot, log, max_recent=20, snapshot_every=16)
+
+        threads = [threading.Thread(target=lambda t=t: [store.record(entry(t * 100 + i)) for i in range(25)]) for t in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        summary = store.summary()
+        assert summary["total_requests"] == 201 and summary["total_tokens"] == 1005 and len(store.recent(50)) == 20, f"Concurrent updates lost: {summary}"
+        logged = log.read_text().splitlines()
+        assert len(logged) < 16, f"Log not truncated by snapshots: {len(logged)} lines"
+        print(f"✓ 200 concurrent records counted; {len(logged)} lines left to replay after the last snapshot")
+
+        # Simulate a crash right after a snapshot: a line it already includes is still in the log
+        seq = json.loads(snapshot.read_text())["seq"]
+        with open(log, "a") as f:
+            f.write(json.dumps({"seq": seq, **entry(999)}) + "\n")
+        reopened = MetricsStore(snapshot, log, max_recent=20, snapshot_every=16)
+        assert reopened.summary() == summary and reopened.recent(20) == store.recent(20), f"Replay differs: {reopened.summary()} vs {summary}"
+        reopened.close()
+        assert not log.read_text() and MetricsStore(snapshot, log).summary() == summary, "close() did not leave a complete snapshot"
+        print("✓ Snapshot + bounded log replay restores the same totals and recent requests")
+
+
+def test_prometheus_metrics():
+    """Tests the /metrics exposition fed by completions, tool calls and HTTP requests (no model required)."""
+    print("\n=== Test: Prometheus Metrics ===\n")
+
+    import asyncio
+
+    import metrics as prom
+    import server
+
+    before = prom.TIME_TO_FIRST_TOKEN.snapshot()["count"]
+    usage = {}
+    server.generate_completion(
+        _SlowStubModel([f"tok{i} " for i in range(10)], 0.005), "Hello", streaming=True, chunk_size=50, metrics=usage
+    )
+    assert prom.TIME_TO_FIRST_TOKEN.snapshot()["count"] == before + 1 and 0 < usage["time_to_first_token_ms"] < usage["generation_ms"], f"Completion not recorded once with its time-to-first-token: {usage}"
+    tps = prom.TOKENS_PER_SECOND.snapshot()
+    assert tps["count"] >= 1 and tps["buckets"][-1][1] == tps["count"], f"Tokens/sec histogram is inconsistent: {tps}"
+    print(f"✓ Streamed completion recorded (ttft {usage['time_to_first_token_ms']:.1f}ms of {usage['generation_ms']:.1f}ms)")
+
+    asyncio.run(server.call_tool("end_session", {}))
+    asyncio.run(server.call_tool("no_such_tool", {}))
+    assert prom.TOOL_CALLS.value(tool="end_session", status="error") >= 1 and prom.TOOL_CALLS.value(tool="unknown", status="error") >= 1, "MCP tool calls were not counted by tool and status"
+
+    # An answer that happens to start with "Error" is still a successful call
+    async def answer_error(*args, **kwargs):
+        return [server.TextContent(type="text", text="Error handling in Python uses try/except.")], ""
+
+    original_run_generation = server.run_generation
+    server.run_generation = answer_error
+    try:
+        ok_before = prom.TOOL_CALLS.value(tool="generate_text", status="ok")
+        asyncio.run(server.call_tool("generate_text", {"prompt": "How do I handle errors?"}))
+    finally:
+        server.run_generation = original_run_generation
+    assert prom.TOOL_CALLS.value(tool="generate_text", status="ok") == ok_before + 1, "A model answer starting with 'Error' was counted as a failed call"
+    print("✓ MCP tool calls counted by tool and status")
+
+    import server_fastmcp
+
+    before_ttft = prom.TIME_TO_FIRST_TOKEN.snapshot()["count"]
+    before_wait = prom.QUEUE_WAIT.snapshot(queue="model_lock")["count"]
+    class TimedStubModel(_SlowStubModel):
+        def __call__(self, prompt, stream=False, **kwargs):
+            # Phase timings as a batch scheduler reports them
+            return {**super().__call__(prompt, **kwargs), "timings": {"prompt_eval_ms": 1.0, "decode_ms": 1.0}}
+
+    server_fastmcp.generate(TimedStubModel(["a ", "b "], 0.001), "Hello", max_tokens=4)
+    assert (
+        prom.TIME_TO_FIRST_TOKEN.snapshot()["count"] == before_ttft + 1
+        and prom.QUEUE_WAIT.snapshot(queue="model_lock")["count"] == before_wait + 1
+    ), "Streamable HTTP completions should record time-to-first-token and queue wait"
+    print("✓ Streamable HTTP completions record the latency histograms")
+
+    try:
+        from fastapi.testclient import TestClient
+    except ImportError:
+        print("  (skipping endpoint check: web chat dependencies not installed)")
+        return
+    from web_chat import app as web_app
+
+    client = TestClient(web_app.app)
+    client.get("/api/sessions/does-not-exist/messages")
+    r = client.get("/metrics")
+    text = r.text
+    expected = [
+        'llm_http_requests_total{method="GET",endpoint="/api/sessions/{session_id}/messages",status="200"}',
+        "# TYPE llm_time_to_first_token_seconds histogram",
+        'llm_time_to_first_token_seconds_bucket{le="+Inf"}',
+        "# TYPE llm_model_loaded gauge",
+    ]
+    missing = [line for line in expected if line not in text]
+    assert r.status_code == 200 and r.headers["content-type"].startswith("text/plain; version=0.0.4") and not missing, f"/metrics output is missing {missing}"
+    print("✓ /metrics serves Prometheus text with route-template endpoint labels")
+
+
+def test_latency_phases():
+    """Tests the per-phase latency breakdown reported by generate_completion()."""
+    print("\n=== Test: Latency Phases ===\n")
+
+    import time
+
+    import server
+
+    def blocker():
+        time.sleep(0.05)
+
+    def generate():
+        usage = {}
+        server.generate_completion(
+            _SlowStubModel([f"tok{i} " for i in range(10)], 0.005), "Hello", streaming=True, metrics=usage
+        )
+        return usage
+
+    server.inference_executor.submit(blocker)
+    usage = server.inference_executor.submit(generate).result(timeout=10)
+    assert usage["queue_wait_ms"] >= 30 and usage["decode_tokens"] == 9 and usage["decode_tokens_per_s"] > 0, f"Queue wait or stream-derived phases are wrong: {usage}"
+    assert usage["prompt_eval_ms"] <= usage["time_to_first_token_ms"] < usage["generation_ms"], f"Phases do not add up: {usage}"
+    print(f"✓ Queue wait ({usage['queue_wait_ms']:.0f}ms) and stream-derived phases reported")
+
+    model_path = os.getenv("MODEL_PATH", "")
+    if not model_path or not os.path.exists(model_path):
+        print("  (skipping llama.cpp timings check: MODEL_PATH not configured)")
+        return
+    model = server.load_model(model_path)
+    prompt = "User: Tell me about the sea.\nAssistant:"
+    scheduler = server.BatchScheduler(model, 2)
+    try:
+        for target in (model, scheduler):
+            usage = {}
+            server.generate_completion(target, prompt, max_tokens=8, temperature=0.0, cache=False, metrics=usage)
+            name = type(target).__name__
+            assert usage["finish_reason"] in ("stop", "length") and usage["prompt_eval_tokens"] >= 1, f"{name}: missing stop reason or prompt eval: {usage}"
+            assert not (usage["completion_tokens"] > 1 and not usage.get("decode_tokens_per_s")), f"{name}: missing decode rate: {usage}"
+            print(
+                f"✓ {name}: prompt eval {usage['prompt_eval_ms']:.1f}ms ({usage['prompt_eval_tokens']} tokens), "
+                f"first token {usage['time_to_first_token_ms']:.1f}ms, {usage.get('decode_tokens_per_s', 0):.0f} tok/s, "
+                f"stop: {usage['finish_reason']}"
+            )
+
+        # Prompt tokens come from llama.cpp's own tokenization, not a second pass
+        tokenize_calls = []
+        original_tokenize = model.tokenize
+
+        def counting_tokenize(*args, **kwargs):
+            tokenize_calls.append(1)
+            return original_tokenize(*args, **kwargs)
+
+        model.tokenize = counting_tokenize
+        try:
+            for streaming in (False, True):
+                usage = {}
+                server.generate_completion(
+                    model, prompt, max_tokens=4, temperature=0.0, cache=False, streaming=streaming, metrics=usage
+                )
+                assert usage["prompt_tokens"] == len(original_tokenize(prompt.encode("utf-8"), special=True)), f"Wrong prompt token count (streaming={streaming}): {usage}"
+        finally:
+            del model.tokenize
+        assert len(tokenize_calls) == 2, f"Prompt tokenized {len(tokenize_calls)} times for 2 completions"
+        print("✓ Prompt tokens counted without tokenizing twice")
+
+        # Streamed counts are tokens, not deltas, and progress follows them
+        for target in (model, scheduler):
+            counts, progress = [], []
+            for streaming in (False, True):
+                usage = {}
+                server.generate_completion(
+                    target, "Write a long story about dragons:", max_tokens=12, temperature=0.0, cache=False,
+                    streaming=streaming, chunk_size=1, metrics=usage, on_progress=progress.append,
+                )
+                counts.append((usage["prompt_tokens"], usage["completion_tokens"], usage["finish_reason"]))
+            name = type(target).__name__
+            assert counts[0] == counts[1], f"{name}: streamed usage differs from the model's: {counts}"
+            assert progress == sorted(progress) and 0 < progress[-1] <= counts[1][1], f"{name}: progress does not count tokens: {progress}"
+        print("✓ Streamed token counts and progress match the model's usage")
+    finally:
+        scheduler.close()
+
+
+def test_percentile_sketches():
+    """Tests the dashboard quantile sketches: accuracy, merging, rolling windows and persistence (no model required)."""
+    print("\n=== Test: Dashboard Percentile Sketches ===\n")
+
+    import random
+    import tempfile
+    import time
+    from pathlib import Path
+    from web_chat.llm_client import MetricsStore, QuantileSketch, RollingSketch
+
+    rng = random.Random(7)
+    values = [rng.lognormvariate(6, 1.2) for _ in range(20000)]
+    halves = QuantileSketch(), QuantileSketch()
+    for i, v in enumerate(values):
+        halves[i % 2].add(v)
+    merged = halves[0]
+    merged.merge(halves[1])
+    ordered = sorted(values)
+    for q in (0.5, 0.9, 0.95, 0.99):
+        exact = ordered[int(q * (len(ordered) - 1))]
+        assert abs(merged.quantile(q) - exact) / exact <= 0.03, f"p{round(q * 100)} off: {merged.quantile(q):.1f} vs {exact:.1f}"
+    print(f"✓ Merged sketches within 3% of exact p50/p90/p95/p99 using {len(merged.buckets)} buckets")
+
+    window = RollingSketch(60, 6)
+    window.add(1000.0, now=0)
+    for t in range(30, 90):
+        window.add(10.0, now=t)
+    assert window.merged(now=89).quantile(0.99) <= 11 and len(window.slots) == 6, "Rolling window kept expired values"
+    print("✓ Rolling window drops slots older than the window")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        snapshot, log = Path(tmp) / "metrics.json", Path(tmp) / "metrics.log"
+        store = MetricsStore(snapshot, log, snapshot_every=25)
+        stamp = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+        for i in range(40):
+            store.record({
+                "session_id": "s", "timestamp": stamp, "prompt_tokens": 1, "completion_tokens": 1,
+                "total_tokens": 2, "response_time_ms": float(i + 1), "model": "m.gguf",
+                "endpoint": "chat" if i % 2 else "analyze_file", "time_to_first_token_ms": 5.0,
+            })
+        report = store.percentile_report()
+        latency = report["15m"]["all"]["all"]["latency_ms"]
+        assert latency["count"] == 40 and 38 <= latency["p99"] <= 41 and set(report["1h"]["endpoint"]) == {"chat", "analyze_file"}, f"Unexpected percentiles: {report['15m']}"
+        reopened = MetricsStore(snapshot, log)
+        assert reopened.percentile_report() == report, "Percentiles differ after snapshot + log replay"
+        print(f"✓ Per-model/endpoint percentiles survive restarts (p50 {latency['p50']}ms, p99 {latency['p99']}ms)")
+
+
+def test_dashboard_push():
+    """Tests that the dashboard stream pushes a snapshot, then coalesced deltas (no model required)."""
+    print("\n=== Test: Dashboard Push Updates ===\n")
+
+    try:
+        import fastapi  # noqa: F401
+    except ImportError:
+        print("  (skipping: web chat dependencies not installed, see web_chat/requirements.txt)")
+        return
+
+    import asyncio
+    import json
+    import tempfile
+    import threading
+    import time
+    from pathlib import Path
+    from web_chat import app as web_app
+    from web_chat import llm_client
+
+    def entry(i):
+        return {
+            "session_id": f"s{i}", "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "prompt_tokens": 2, "completion_tokens": 3, "total_tokens": 5, "response_time_ms": 10.0,
+            "model": "m", "endpoint": "chat",
+        }
+
+    def parse(text):
+        name, data = text.strip().split("\n", 1)
+        return name[len("event: "):], json.loads(data[len("data: "):])
+
+    async def scenario():
+        hub = web_app.DashboardHub(push_interval_s=0.2)
+        stream = hub.stream()
+        name, snapshot = parse(await stream.__anext__())
+        assert name == "snapshot" and snapshot["seq"] == 1 and len(snapshot["recent_sessions"]) == 1, f"Expected a snapshot first: {name} {snapshot}"
+        print("✓ Stream starts with a full snapshot")
+
+        # A burst of requests recorded from worker threads
+        burst = [threading.Thread(target=llm_client.metrics_store.record, args=(entry(i),)) for i in range(1, 21)]
+        for t in burst:
+            t.start()
+        for t in burst:
+            t.join()
+        deltas, seen = 0, set()
+        while len(seen) < 20:
+            name, delta = parse(await asyncio.wait_for(stream.__anext__(), 5))
+            deltas += 1
+            seen.update(e["seq"] for e in delta["new_sessions"])
+        await stream.aclose()
+        await hub.stop()
+        assert seen == set(range(2, 22)) and delta["summary"]["total_requests"] == 21 and deltas <= 2, f"Deltas incomplete or not coalesced: {deltas} deltas, seqs {sorted(seen)}"
+        assert hub.client_count() == 0 and hub.notify not in llm_client.metrics_store._listeners, "Client or listener left behind"
+        print(f"✓ 20 concurrent requests pushed in {deltas} coalesced delta(s)")
+        return
+
+    original_store = llm_client.metrics_store
+    with tempfile.TemporaryDirectory() as tmp:
+        llm_client.metrics_store = llm_client.MetricsStore(Path(tmp) / "metrics.json", Path(tmp) / "metrics.log")
+        llm_client.metrics_store.record(entry(0))
+        try:
+            return asyncio.run(scenario())
+        finally:
+            llm_client.metrics_store = original_store
+
+
+def test_request_tracing():
+    """Tests span nesting, tail sampling of slow requests and the rotating OTLP/JSON trace file (no model required)."""
+    print("\n=== Test: Request Tracing ===\n")
+
+    import json
+    import tempfile
+    import threading
+    import time
+    from pathlib import Path
+    import tracing
+
+    original_tracer = tracing.tracer
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / "traces.jsonl"
+        tracing.tracer = tracing.Tracer(tracing.JsonlSpanExporter(path, 4096, 2), sample_rate=1.0, slow_ms=0)
+        try:
+            step = tracing.traced("step")(lambda: tracing.set_attributes(tokens=3))
+            with tracing.start_trace("POST /api/chat") as root:
+                with tracing.span("llm_client.continue_session", session_id="s1"):
+                    step()
+                    worker = threading.Thread(target=tracing.bind(step))
+                    worker.start()
+                    worker.join()
+            trace = tracing.get_trace(root.trace_id)
+            names = [(s["depth"], s["name"]) for s in trace["spans"]] if trace else []
+            assert names == [(0, "POST /api/chat"), (1, "llm_client.continue_session"), (2, "step"), (2, "step")], f"Unexpected span tree: {names}"
+            assert trace["spans"][2]["attributes"] == {"tokens": 3}, f"Span attributes not kept: {trace['spans'][2]}"
+            otlp = json.loads(path.read_text().splitlines()[0])
+            span = otlp["resourceSpans"][0]["scopeSpans"][0]["spans"][0]
+            assert len(span["traceId"]) == 32 and len(span["spanId"]) == 16 and "startTimeUnixNano" in span, f"Not OTLP/JSON: {span}"
+            print(f"✓ Spans nested across threads and read back from OTLP/JSON ({len(names)} spans)")
+
+            # Unsampled: only requests slower than slow_ms are kept
+            tracing.tracer.sample_rate, tracing.tracer.slow_ms = 0.0, 20
+            with tracing.start_trace("fast") as fast:
+                pass
+            with tracing.start_trace("slow") as slow:
+                time.sleep(0.03)
+            assert tracing.get_trace(fast.trace_id) is None and tracing.get_trace(slow.trace_id) is not None, "Slow request not kept, or fast one kept despite sampling"
+            assert [t["name"] for t in tracing.recent_traces(min_ms=20)] == ["slow"], f"Unexpected recent traces: {tracing.recent_traces()}"
+            print("✓ Unsampled fast request dropped, slow request always kept")
+
+            for _ in range(20):
+                with tracing.start_trace("slow"):
+                    time.sleep(0.021)
+            tracing.tracer.exporter.flush()
+            files = sorted(p.name for p in path.parent.iterdir())
+            assert files == ["traces.jsonl", "traces.jsonl.1", "traces.jsonl.2"], f"Trace file not rotated: {files}"
+            print("✓ Trace file rotated by size")
+
+            # Ending a request only queues its spans; the writer thread appends them
+            writers = []
+            exporter = tracing.tracer.exporter
+            original_line = exporter._line
+            exporter._line = lambda spans: writers.append(threading.current_thread().name) or original_line(spans)
+            try:
+                with tracing.start_trace("slow"):
+                    time.sleep(0.021)
+                assert not writers, "Trace written on the request's own thread"
+                deadline = time.time() + 5
+                while not writers and time.time() < deadline:
+                    time.sleep(0.01)
+            finally:
+                exporter._line = original_line
+            assert writers == ["trace-writer"], f"Trace not written by the writer thread: {writers}"
+            print("✓ Traces are written off the request path")
+
+            with tracing.span("outside"):
+                pass
+            assert tracing.current_span() is tracing.NOOP_SPAN, "Span leaked outside a trace"
+            print("✓ Spans outside a traced request are no-ops")
+            return
+        finally:
+            tracing.tracer = original_tracer
+
+
+def test_request_profiling():
+    """Tests that an opted-in request is profiled across threads and saved, and others are not (no model required)."""
+    print("\n=== Test: Request Profiling ===\n")
+
+    import pstats
+    import tempfile
+    import threading
+    from pathlib import Path
+    import profiling
+
+    def busy_work():
+        return sum(i * i for i in range(20000))
+
+    original_dir, original_keep = profiling.PROFILE_DIR, profiling.PROFILE_KEEP
+    with tempfile.TemporaryDirectory() as tmp:
+        profiling.PROFILE_DIR = Path(tmp)
+        try:
+            hot = profiling.profiled(busy_work)
+            with profiling.profile_request("fast call", "test", enabled=profiling.requested(False)) as skipped:
+                hot()
+            assert skipped is None and not list(Path(tmp).iterdir()), "Request profiled without being asked to"
+            print("✓ Requests not asking for it are not profiled")
+
+            with profiling.profile_request("slow call", "test", profile_thread=False) as profile:
+                hot()
+                worker = threading.Thread(target=profiling.bind(busy_work))
+                worker.start()
+                worker.join()
+            summary = profiling.get_profile(profile.request_id)
+            assert summary is not None and summary["threads"] == 2, f"Expected a profile of 2 threads: {summary}"
+            functions = [f["function"] for f in summary["top_functions"]]
+            assert any("<genexpr>" in f for f in functions), f"Hot function missing from the summary: {functions}"
+            stats = pstats.Stats(str(profiling.profile_path(profile.request_id)))
+            assert stats.total_calls >= 40000, f".prof file incomplete: {stats.total_calls} calls"
+            print(f"✓ Profile merged from {summary['threads']} threads and saved ({stats.total_calls} calls)")
+
+            # Python 3.12+ refuses a second active cProfile: the request must still succeed
+            class BusyProfile(profiling.cProfile.Profile):
+                def enable(self, *args, **kwargs):
+                    raise ValueError("Another profiling tool is already active")
+
+            original_profile = profiling.cProfile.Profile
+            profiling.cProfile.Profile = BusyProfile
+            try:
+                with profiling.profile_request("contended call", "test") as contended:
+                    assert hot() == busy_work()
+            finally:
+                profiling.cProfile.Profile = original_profile
+            assert contended.skipped_threads >= 1 and contended.path is None, "A busy profiler should only skip the thread"
+            print("✓ A thread that cannot be profiled is skipped without failing the request")
+
+            profiling.PROFILE_KEEP = 2
+            for i in range(3):
+                with profiling.profile_request(f"call {i}", "test"):
+                    busy_work()
+            listed = [p["name"] for p in profiling.list_profiles()]
+            assert len(listed) == 2 and len(list(Path(tmp).glob("*.prof"))) == 2, f"Old profiles not pruned: {listed}"
+            print(f"✓ Listing shows the newest profiles, older ones pruned: {listed}")
+            return
+        finally:
+            profiling.PROFILE_DIR, profiling.PROFILE_KEEP = original_dir, original_keep
+
+
+def _passed(test) -> bool:
+    """Run a test for the script summary, printing why it failed."""
+    try:
+        test()
     except ImportError as e:
-        print(f"❌ Error importing server module: {e}")
+        print(f"❌ Missing dependency: {e}")
         return False
     except Exception as e:
-        print(f"❌ Error while testing session helpers: {e}")
+        print(f"❌ Error: {e}")
         return False
+    return True
 
 
 def main():
@@ -121,17 +1583,74 @@ def main():
     print("Testing Local LLM MCP server configuration\n")
     print("=" * 50)
 
-    mcp_ok = test_mcp_imports()
-    model_ok = test_model_loading()
-    sessions_ok = test_session_helpers()
+    mcp_ok = _passed(test_mcp_imports)
+    # Without a configured model the test is skipped, but the server cannot run
+    model_ok = _passed(test_model_loading) and os.path.exists(os.getenv("MODEL_PATH", ""))
+    sessions_ok = _passed(test_session_helpers)
+    executor_ok = _passed(test_inference_executor)
+    streaming_ok = _passed(test_streaming_time_to_first_token)
+    kv_cache_ok = _passed(test_session_state_cache)
+    response_cache_ok = _passed(test_response_cache)
+    model_pool_ok = _passed(test_model_pool)
+    batching_ok = _passed(test_batch_scheduler)
+    packing_ok = _passed(test_context_packing)
+    speculative_ok = _passed(test_speculative_draft)
+    sse_ok = _passed(test_chat_stream_endpoint)
+    sqlite_ok = _passed(test_sqlite_session_store)
+    tail_reader_ok = _passed(test_session_tail_reader)
+    segmented_log_ok = _passed(test_session_segmented_log)
+    write_behind_ok = _passed(test_write_behind_session_store)
+    listing_ok = _passed(test_session_listing)
+    archival_ok = _passed(test_session_archival)
+    summary_ok = _passed(test_session_summary)
+    search_ok = _passed(test_session_search)
+    gc_ok = _passed(test_session_gc)
+    metrics_ok = _passed(test_metrics_store)
+    prometheus_ok = _passed(test_prometheus_metrics)
+    phases_ok = _passed(test_latency_phases)
+    percentiles_ok = _passed(test_percentile_sketches)
+    dashboard_push_ok = _passed(test_dashboard_push)
+    tracing_ok = _passed(test_request_tracing)
+    profiling_ok = _passed(test_request_profiling)
 
     print("\n" + "=" * 50)
     print("\nSummary:")
     print(f"  MCP: {'✓ OK' if mcp_ok else '❌ FAILED'}")
     print(f"  Model: {'✓ OK' if model_ok else '❌ FAILED'}")
     print(f"  Sessions: {'✓ OK' if sessions_ok else '❌ FAILED'}")
+    print(f"  Inference queue: {'✓ OK' if executor_ok else '❌ FAILED'}")
+    print(f"  Streaming: {'✓ OK' if streaming_ok else '❌ FAILED'}")
+    print(f"  Session KV-cache: {'✓ OK' if kv_cache_ok else '❌ FAILED'}")
+    print(f"  Response cache: {'✓ OK' if response_cache_ok else '❌ FAILED'}")
+    print(f"  Model pool: {'✓ OK' if model_pool_ok else '❌ FAILED'}")
+    print(f"  Batch scheduler: {'✓ OK' if batching_ok else '❌ FAILED'}")
+    print(f"  Context packing: {'✓ OK' if packing_ok else '❌ FAILED'}")
+    print(f"  Speculative decoding: {'✓ OK' if speculative_ok else '❌ FAILED'}")
+    print(f"  Web chat streaming: {'✓ OK' if sse_ok else '❌ FAILED'}")
+    print(f"  SQLite session store: {'✓ OK' if sqlite_ok else '❌ FAILED'}")
+    print(f"  Session tail reader: {'✓ OK' if tail_reader_ok else '❌ FAILED'}")
+    print(f"  Segmented session log: {'✓ OK' if segmented_log_ok else '❌ FAILED'}")
+    print(f"  Write-behind sessions: {'✓ OK' if write_behind_ok else '❌ FAILED'}")
+    print(f"  Session listing: {'✓ OK' if listing_ok else '❌ FAILED'}")
+    print(f"  Session archival: {'✓ OK' if archival_ok else '❌ FAILED'}")
+    print(f"  Rolling session summary: {'✓ OK' if summary_ok else '❌ FAILED'}")
+    print(f"  Session search: {'✓ OK' if search_ok else '❌ FAILED'}")
+    print(f"  Session garbage collection: {'✓ OK' if gc_ok else '❌ FAILED'}")
+    print(f"  Web chat metrics: {'✓ OK' if metrics_ok else '❌ FAILED'}")
+    print(f"  Prometheus metrics: {'✓ OK' if prometheus_ok else '❌ FAILED'}")
+    print(f"  Latency phases: {'✓ OK' if phases_ok else '❌ FAILED'}")
+    print(f"  Dashboard percentiles: {'✓ OK' if percentiles_ok else '❌ FAILED'}")
+    print(f"  Dashboard push updates: {'✓ OK' if dashboard_push_ok else '❌ FAILED'}")
+    print(f"  Request tracing: {'✓ OK' if tracing_ok else '❌ FAILED'}")
+    print(f"  Request profiling: {'✓ OK' if profiling_ok else '❌ FAILED'}")
 
-    if mcp_ok and model_ok and sessions_ok:
+    if all([
+        mcp_ok, model_ok, sessions_ok, executor_ok, streaming_ok, kv_cache_ok, response_cache_ok,
+        model_pool_ok, batching_ok, packing_ok, speculative_ok, sse_ok, sqlite_ok,
+        tail_reader_ok, segmented_log_ok, write_behind_ok, listing_ok, archival_ok, summary_ok,
+        search_ok, gc_ok, metrics_ok, prometheus_ok, phases_ok, percentiles_ok, dashboard_push_ok,
+        tracing_ok, profiling_ok,
+    ]):
         print("\n✅ All ready! You can run the server with:")
         print("   python server.py")
     else:
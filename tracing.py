@@ -0,0 +1,497 @@
+#!/usr/bin/env python3
+"""
+Lightweight request tracing for the web chat and the MCP server.
+
+A request starts a trace with start_trace(); code running under it opens spans
+(timed, named blocks with attributes) with span() or @traced. Outside a traced
+request these cost a single context-variable lookup.
+
+Every request is recorded in memory while it runs. When it ends, its trace is
+kept if it was sampled (TRACE_SAMPLE_RATE) or took at least TRACE_SLOW_MS, so
+slow requests are never lost to sampling. Kept traces are appended to a
+rotating JSONL file by a background writer thread, one OTLP/JSON
+ExportTraceServiceRequest per line (the format of the OpenTelemetry
+collector's file exporter), and read back with get_trace().
+"""
+import atexit
+import contextvars
+import functools
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+BASE_DIR = Path(__file__).resolve().parent
+
+# Share of requests whose trace is kept (0-1), and the duration (ms) from which a
+# request is always kept. Tracing is off when both are 0
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0.1"))
+TRACE_SLOW_MS = float(os.getenv("TRACE_SLOW_MS", "60000"))
+# Trace files: TRACE_DIR/traces.jsonl, rotated to traces.jsonl.1 ... .N at TRACE_FILE_MAX_MB
+TRACE_DIR = BASE_DIR / os.getenv("TRACE_DIR", str(Path(os.getenv("SESSION_HISTORY_DIR", "history")) / "traces"))
+TRACE_FILE_MAX_MB = int(os.getenv("TRACE_FILE_MAX_MB", "10"))
+TRACE_FILE_BACKUPS = int(os.getenv("TRACE_FILE_BACKUPS", "3"))
+
+SERVICE_NAME = "local-llm-mcp-tool"
+
+# OTLP span kinds
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_SERVER = 2
+# OTLP status codes
+STATUS_OK = 1
+STATUS_ERROR = 2
+
+
+class _Trace:
+    """Spans of one request, collected until its root span ends."""
+
+    __slots__ = ("trace_id", "sampled", "spans", "ended", "kept")
+
+    def __init__(self, trace_id: str, sampled: bool):
+        self.trace_id = trace_id
+        self.sampled = sampled
+        self.spans: List["Span"] = []
+        self.ended = False
+        self.kept = False
+
+
+class Span:
+    """A timed operation within a trace."""
+
+    __slots__ = ("trace", "span_id", "parent_id", "name", "kind", "start_ns", "end_ns", "attributes", "error")
+
+    def __init__(self, trace: _Trace, parent_id: Optional[str], name: str, kind: int, attributes: Dict[str, Any]):
+        self.trace = trace
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.start_ns = time.time_ns()
+        self.end_ns = 0
+        self.attributes = attributes
+        self.error: Optional[str] = None
+
+    @property
+    def trace_id(self) -> str:
+        return self.trace.trace_id
+
+    def set(self, **attributes: Any) -> None:
+        """Add attributes (None values are skipped)."""
+        self.attributes.update((k, v) for k, v in attributes.items() if v is not None)
+
+    def to_otlp(self) -> Dict[str, Any]:
+        return {
+            "traceId": self.trace.trace_id,
+            "spanId": self.span_id,
+            "parentSpanId": self.parent_id or "",
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": [{"key": k, "value": _otlp_value(v)} for k, v in self.attributes.items()],
+            "status": {"code": STATUS_ERROR, "message": self.error} if self.error else {"code": STATUS_OK},
+        }
+
+
+class _NoopSpan:
+    """Stands in for a span outside traced requests."""
+
+    trace_id = None
+
+    def set(self, **attributes: Any) -> None:
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+def _otlp_value(value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _plain_value(value: Dict[str, Any]) -> Any:
+    if "intValue" in value:
+        return int(value["intValue"])
+    return next(iter(value.values()), None)
+
+
+class JsonlSpanExporter:
+    """Appends spans to path as OTLP/JSON lines, rotating to path.1 ... path.N past max_bytes.
+
+    export() only queues the spans: it is called when a request ends, often on
+    the event loop. A writer thread (started on first export) serializes and
+    appends them at most flush_delay_ms later. read() writes whatever is still
+    queued first. Past max_pending queued spans new ones are dropped and counted.
+    """
+
+    def __init__(self, path: Path, max_bytes: int, backups: int, flush_delay_ms: int = 200, max_pending: int = 10000):
+        self.path = path
+        self.max_bytes = max(1, max_bytes)
+        self.backups = max(0, backups)
+        self.flush_delay = max(0, flush_delay_ms) / 1000
+        self.max_pending = max(1, max_pending)
+        self._lock = threading.Lock()  # the trace files
+        self._cond = threading.Condition()
+        self._pending: List[List[Span]] = []
+        self._pending_spans = 0
+        self._dropped = 0
+        self._closed = False
+        self._thread: Optional[threading.Thread] = None
+
+    def export(self, spans: List[Span]) -> None:
+        with self._cond:
+            if self._closed or self._pending_spans + len(spans) > self.max_pending:
+                self._dropped += len(spans)
+                return
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="trace-writer", daemon=True)
+                self._thread.start()
+                atexit.register(self.close)
+            if not self._pending:
+                self._cond.notify_all()
+            self._pending.append(list(spans))
+            self._pending_spans += len(spans)
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+                # Traces ending within flush_delay are written together
+                self._cond.wait(self.flush_delay)
+            self.flush()
+
+    def _line(self, spans: List[Span]) -> str:
+        request = {
+            "resourceSpans": [{
+                "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": SERVICE_NAME}}]},
+                "scopeSpans": [{"scope": {"name": "tracing"}, "spans": [s.to_otlp() for s in spans]}],
+            }]
+        }
+        return json.dumps(request, ensure_ascii=False, separators=(",", ":")) + "\n"
+
+    def flush(self) -> None:
+        """Write every queued export now."""
+        with self._lock:
+            with self._cond:
+                batches, self._pending, self._pending_spans = self._pending, [], 0
+            if not batches:
+                return
+            try:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                for spans in batches:
+                    line = self._line(spans)
+                    try:
+                        if self.path.stat().st_size + len(line) > self.max_bytes:
+                            self._rotate()
+                    except FileNotFoundError:
+                        pass
+                    with open(self.path, "a", encoding="utf-8") as f:
+                        f.write(line)
+            except OSError as e:
+                print(f"Warning: could not write trace: {e}", file=sys.stderr)
+
+    def close(self) -> None:
+        """Stop the writer thread and write what is still queued."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+            thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(timeout=5)
+        self.flush()
+
+    def stats(self) -> Dict[str, int]:
+        with self._cond:
+            return {"pending_spans": self._pending_spans, "dropped_spans": self._dropped}
+
+    def _rotate(self) -> None:
+        for i in range(self.backups, 0, -1):
+            source = self.path if i == 1 else self.path.with_name(f"{self.path.name}.{i - 1}")
+            if source.exists():
+                os.replace(source, self.path.with_name(f"{self.path.name}.{i}"))
+        if self.backups == 0:
+            self.path.unlink(missing_ok=True)
+
+    def files(self) -> List[Path]:
+        """Trace files, newest first."""
+        candidates = [self.path] + [self.path.with_name(f"{self.path.name}.{i}") for i in range(1, self.backups + 1)]
+        return [p for p in candidates if p.exists()]
+
+    def read(self, trace_id: str) -> List[Dict[str, Any]]:
+        """Return the OTLP spans of trace_id found in the trace files."""
+        self.flush()
+        spans = []
+        for path in self.files():
+            try:
+                with open(path, encoding="utf-8") as f:
+                    for line in f:
+                        if trace_id not in line:
+                            continue
+                        try:
+                            request = json.loads(line)
+                        except ValueError:
+                            continue
+                        for resource in request.get("resourceSpans", []):
+                            for scope in resource.get("scopeSpans", []):
+                                spans.extend(s for s in scope.get("spans", []) if s.get("traceId") == trace_id)
+            except OSError:
+                continue
+        return spans
+
+
+_current_span: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar("current_span", default=None)
+
+
+class Tracer:
+    """Creates spans, decides which traces to keep and hands them to the exporter."""
+
+    def __init__(
+        self,
+        exporter: JsonlSpanExporter,
+        sample_rate: float = TRACE_SAMPLE_RATE,
+        slow_ms: float = TRACE_SLOW_MS,
+        max_recent: int = 200,
+    ):
+        self.exporter = exporter
+        self.sample_rate = sample_rate
+        self.slow_ms = slow_ms
+        self._recent: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._max_recent = max_recent
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.sample_rate > 0 or self.slow_ms > 0
+
+    @contextmanager
+    def start_trace(self, name: str, kind: int = SPAN_KIND_SERVER, **attributes: Any) -> Iterator[Any]:
+        """Run the block as the root span of a new trace (a no-op span when tracing is off)."""
+        if not self.enabled:
+            yield NOOP_SPAN
+            return
+        trace = _Trace(f"{random.getrandbits(128):032x}", random.random() < self.sample_rate)
+        with self._span(trace, None, name, kind, attributes) as root:
+            yield root
+
+    @contextmanager
+    def span(self, name: str, **attributes: Any) -> Iterator[Any]:
+        """Run the block as a child of the current span (a no-op outside traced requests)."""
+        parent = _current_span.get()
+        if parent is None:
+            yield NOOP_SPAN
+            return
+        with self._span(parent.trace, parent.span_id, name, SPAN_KIND_INTERNAL, attributes) as span:
+            yield span
+
+    @contextmanager
+    def _span(self, trace: _Trace, parent_id: Optional[str], name: str, kind: int, attributes: Dict[str, Any]):
+        span = Span(trace, parent_id, name, kind, attributes)
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            span.end_ns = time.time_ns()
+            _current_span.reset(token)
+            self._finish(span)
+
+    def _finish(self, span: Span) -> None:
+        trace = span.trace
+        if span.parent_id is not None:
+            if not trace.ended:
+                trace.spans.append(span)
+            elif trace.kept:
+                self.exporter.export([span])  # outlived its request (e.g. a streaming worker)
+            return
+
+        trace.spans.append(span)
+        trace.ended = True
+        duration_ms = (span.end_ns - span.start_ns) / 1e6
+        trace.kept = trace.sampled or (self.slow_ms > 0 and duration_ms >= self.slow_ms)
+        if not trace.kept:
+            return
+        self.exporter.export(trace.spans)
+        with self._lock:
+            self._recent[trace.trace_id] = {
+                "trace_id": trace.trace_id,
+                "name": span.name,
+                "start_time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(span.start_ns / 1e9)),
+                "duration_ms": round(duration_ms, 2),
+                "spans": len(trace.spans),
+                "error": next((s.error for s in trace.spans if s.error), None),
+                "sampled": trace.sampled,
+            }
+            while len(self._recent) > self._max_recent:
+                self._recent.popitem(last=False)
+
+    def recent(self, limit: int = 50, min_ms: float = 0) -> List[Dict[str, Any]]:
+        """Kept traces of this process, newest first."""
+        with self._lock:
+            items = list(reversed(self._recent.values()))
+        return [t for t in items if t["duration_ms"] >= min_ms][:limit]
+
+
+tracer = Tracer(JsonlSpanExporter(TRACE_DIR / "traces.jsonl", TRACE_FILE_MAX_MB * 1024 * 1024, TRACE_FILE_BACKUPS))
+
+
+def start_trace(name: str, **attributes: Any):
+    return tracer.start_trace(name, **attributes)
+
+
+def span(name: str, **attributes: Any):
+    return tracer.span(name, **attributes)
+
+
+def current_span() -> Any:
+    """Return the active span (NOOP_SPAN outside traced requests)."""
+    return _current_span.get() or NOOP_SPAN
+
+
+def set_attributes(**attributes: Any) -> None:
+    """Add attributes to the active span, if any."""
+    current = _current_span.get()
+    if current is not None:
+        current.set(**attributes)
+
+
+def traced(name: Optional[str] = None) -> Callable:
+    """Decorator: run the function in a span (named after it by default)."""
+
+    def decorate(func: Callable) -> Callable:
+        span_name = name or f"{func.__module__}.{func.__qualname__}"
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _current_span.get() is None:
+                return func(*args, **kwargs)
+            with tracer.span(span_name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorate
+
+
+def bind(func: Callable) -> Callable:
+    """Return func running under the current span, for handing work to another thread."""
+    parent = _current_span.get()
+    if parent is None:
+        return func
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        token = _current_span.set(parent)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _current_span.reset(token)
+
+    return wrapper
+
+
+def get_trace(trace_id: str) -> Optional[Dict[str, Any]]:
+    """Read a kept trace back: spans ordered by start, with depth, offset and duration in ms."""
+    if not re.fullmatch(r"[0-9a-f]{32}", trace_id):
+        return None
+    raw = tracer.exporter.read(trace_id)
+    if not raw:
+        return None
+    unique = {s["spanId"]: s for s in raw}
+    spans = sorted(unique.values(), key=lambda s: int(s["startTimeUnixNano"]))
+    trace_start = int(spans[0]["startTimeUnixNano"])
+    trace_end = max(int(s["endTimeUnixNano"]) for s in spans)
+    depth: Dict[str, int] = {}
+    result = []
+    for s in spans:
+        parent = s.get("parentSpanId") or None
+        depth[s["spanId"]] = depth.get(parent, -1) + 1 if parent else 0
+        start, end = int(s["startTimeUnixNano"]), int(s["endTimeUnixNano"])
+        result.append({
+            "span_id": s["spanId"],
+            "parent_span_id": parent,
+            "name": s["name"],
+            "depth": depth[s["spanId"]],
+            "start_offset_ms": round((start - trace_start) / 1e6, 3),
+            "duration_ms": round((end - start) / 1e6, 3),
+            "attributes": {a["key"]: _plain_value(a["value"]) for a in s.get("attributes", [])},
+            "error": s.get("status", {}).get("message"),
+        })
+    return {
+        "trace_id": trace_id,
+        "name": result[0]["name"],
+        "duration_ms": round((trace_end - trace_start) / 1e6, 3),
+        "spans": result,
+    }
+
+
+def recent_traces(limit: int = 50, min_ms: float = 0) -> List[Dict[str, Any]]:
+    return tracer.recent(limit, min_ms)
+
+
+# --- ASGI middleware ---
+
+
+class TracingMiddleware:
+    """Pure ASGI middleware running each matching HTTP request as a trace.
+
+    Sampled requests get an X-Trace-Id response header. The root span is named
+    after the matched route template once routing has run.
+    """
+
+    def __init__(self, app, prefixes=("/api/",), skip=()):
+        self.app = app
+        self.prefixes = tuple(prefixes)
+        self.skip = tuple(skip)
+
+    async def __call__(self, scope, receive, send):
+        path = scope.get("path", "")
+        if (
+            scope["type"] != "http"
+            or not tracer.enabled
+            or not path.startswith(self.prefixes)
+            or path.startswith(self.skip)
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        method = scope.get("method", "")
+        with tracer.start_trace(f"{method} {path}", **{"http.method": method, "http.target": path}) as root:
+
+            async def send_wrapper(message):
+                if message["type"] == "http.response.start":
+                    root.set(**{"http.status_code": message["status"]})
+                    if root.trace.sampled:
+                        headers = list(message.get("headers", []))
+                        headers.append((b"x-trace-id", root.trace_id.encode()))
+                        message = {**message, "headers": headers}
+                await send(message)
+
+            try:
+                await self.app(scope, receive, send_wrapper)
+            finally:
+                route = getattr(scope.get("route"), "path", None)
+                if route:
+                    root.name = f"{method} {route}"
+                    root.set(**{"http.route": route})
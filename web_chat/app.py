@@ -1,12 +1,18 @@
 """
 Local LLM Web Chat - FastAPI application
 """
+import asyncio
+import html
+import json
 import os
+import threading
 import uuid
+from contextlib import asynccontextmanager
 from pathlib import Path
+from typing import Callable, Optional
 
-from fastapi import FastAPI, Form, UploadFile, File, Request, HTTPException
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi import FastAPI, Form, UploadFile, File, Request, HTTPException, Query
+from fastapi.responses import FileResponse, HTMLResponse, JSONResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from pydantic import BaseModel
@@ -21,7 +27,26 @@ from dotenv import load_dotenv
 
 load_dotenv(ROOT / ".env")
 
-app = FastAPI(title="Local LLM Web Chat")
+import metrics as prom
+import profiling
+import tracing
+
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    # Start the session background jobs (write-behind, archival, garbage
+    # collection) without loading a model; the model still loads lazily
+    import server
+
+    server.init_session_services()
+
+    yield
+    await dashboard_hub.stop()
+
+
+app = FastAPI(title="Local LLM Web Chat", lifespan=lifespan)
+app.add_middleware(profiling.ProfilingMiddleware, skip=("/api/profiles", "/api/traces", "/api/dashboard"))
+app.add_middleware(tracing.TracingMiddleware, skip=("/api/traces", "/api/dashboard"))
+app.add_middleware(prom.PrometheusMiddleware)
 
 # Templates and static
 BASE_DIR = Path(__file__).parent
@@ -48,6 +73,7 @@ class ChatRequest(BaseModel):
     save_history: bool = True
     session_id: str | None = None
     model_path: str | None = None
+    cache: bool | None = None
 
 
 class ConfigUpdate(BaseModel):
@@ -133,14 +159,16 @@ class ModelSwitchRequest(BaseModel):
 
 
 @app.post("/api/model/switch")
-async def api_model_switch(req: ModelSwitchRequest):
+def api_model_switch(req: ModelSwitchRequest):
     """Load/switch to the specified model. Blocks until loaded (can take 1-2 min)."""
     path = (req.model_path or "").strip()
     if not path:
         raise HTTPException(status_code=400, detail="model_path is required")
     try:
-        from server import load_model
-        load_model(model_path=path)
+        from server import use_model
+        # Load through use_model so the switch never touches a model another request is generating with
+        with use_model(model_path=path):
+            pass
         return {"status": "ok", "model_path": path}
     except FileNotFoundError as e:
         raise HTTPException(status_code=404, detail=str(e))
@@ -148,55 +176,273 @@ async def api_model_switch(req: ModelSwitchRequest):
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.post("/api/chat")
-async def api_chat(request: ChatRequest):
-    """Send chat messages and get response."""
-    try:
-        llm_chat, _, llm_create_session, llm_continue_session, _, _, _ = get_llm()
-        if request.save_history:
-            if request.session_id:
-                text, metrics = llm_continue_session(
-                    session_id=request.session_id,
-                    message=request.messages[-1].content if request.messages else "",
-                    max_tokens=request.max_tokens,
-                    temperature=request.temperature,
-                    top_p=request.top_p,
-                    model_path=request.model_path,
-                )
-                return {"response": text, "metrics": metrics, "session_id": request.session_id}
-            else:
-                from server import append_session_message
-                session_id = llm_create_session(metadata={"source": "web_chat"})
-                messages = [{"role": m.role, "content": m.content} for m in request.messages]
-                text, metrics = llm_chat(
-                    messages=messages,
-                    max_tokens=request.max_tokens,
-                    temperature=request.temperature,
-                    top_p=request.top_p,
-                    session_id=session_id,
-                    model_path=request.model_path,
-                )
-                user_content = messages[-1].get("content", "") if messages else ""
-                append_session_message(session_id, "user", user_content)
-                append_session_message(session_id, "assistant", text)
-                return {"response": text, "metrics": metrics, "session_id": session_id}
+def _run_chat(request: ChatRequest, on_text: Optional[Callable[[str], None]] = None) -> dict:
+    """Run one chat turn (new session, existing session or no history) and return the API payload."""
+    llm_chat, _, llm_create_session, llm_continue_session, _, _, _ = get_llm()
+    if request.save_history:
+        if request.session_id:
+            text, metrics = llm_continue_session(
+                session_id=request.session_id,
+                message=request.messages[-1].content if request.messages else "",
+                max_tokens=request.max_tokens,
+                temperature=request.temperature,
+                top_p=request.top_p,
+                model_path=request.model_path,
+                cache=request.cache,
+                on_text=on_text,
+            )
+            return {"response": text, "metrics": metrics, "session_id": request.session_id}
         else:
+            from server import append_session_message
+            session_id = llm_create_session(metadata={"source": "web_chat"})
             messages = [{"role": m.role, "content": m.content} for m in request.messages]
             text, metrics = llm_chat(
                 messages=messages,
                 max_tokens=request.max_tokens,
                 temperature=request.temperature,
                 top_p=request.top_p,
-                session_id="no_history",
+                session_id=session_id,
                 model_path=request.model_path,
+                cache=request.cache,
+                on_text=on_text,
             )
-            return {"response": text, "metrics": metrics, "session_id": None}
+            user_content = messages[-1].get("content", "") if messages else ""
+            append_session_message(session_id, "user", user_content)
+            append_session_message(session_id, "assistant", text)
+            return {"response": text, "metrics": metrics, "session_id": session_id}
+    else:
+        messages = [{"role": m.role, "content": m.content} for m in request.messages]
+        text, metrics = llm_chat(
+            messages=messages,
+            max_tokens=request.max_tokens,
+            temperature=request.temperature,
+            top_p=request.top_p,
+            session_id="no_history",
+            model_path=request.model_path,
+            cache=request.cache,
+            on_text=on_text,
+        )
+        return {"response": text, "metrics": metrics, "session_id": None}
+
+
+@app.post("/api/chat")
+@profiling.profiled
+def api_chat(request: ChatRequest):
+    """Send chat messages and get response.
+
+    A plain def so FastAPI runs it in its threadpool: concurrent chats then reach
+    the model together (and are decoded together when BATCH_SLOTS > 1).
+    """
+    try:
+        return _run_chat(request)
     except FileNotFoundError as e:
         raise HTTPException(status_code=503, detail="Modelo não encontrado. Configure MODEL_PATH no .env")
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+class DashboardHub:
+    """Pushes dashboard updates to every /api/dashboard/stream client.
+
+    MetricsStore calls notify() from the thread that recorded a request. One
+    broadcaster task coalesces bursts (at most one push per push_interval_s),
+    builds each delta once, from memory, and queues it for every client, so
+    another open dashboard costs a queue and no disk reads. Without new
+    requests the rolling percentiles are still re-sent every refresh_s.
+    """
+
+    def __init__(self, push_interval_s: float = 0.5, refresh_s: float = 30.0, keepalive_s: float = 15.0, max_pending: int = 8):
+        self.push_interval_s = push_interval_s
+        self.refresh_s = refresh_s
+        self.keepalive_s = keepalive_s
+        self.max_pending = max_pending
+        self._clients: set = set()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._seq = 0
+
+    def _ensure_started(self) -> None:
+        loop = asyncio.get_running_loop()
+        if self._loop is loop and self._task is not None and not self._task.done():
+            return
+        from web_chat.llm_client import metrics_store
+
+        metrics_store.unsubscribe(self.notify)
+        self._loop = loop
+        self._wakeup = asyncio.Event()
+        self._seq = metrics_store.recent_since(0, 0)[0]
+        metrics_store.subscribe(self.notify)
+        self._task = loop.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        from web_chat.llm_client import metrics_store
+
+        metrics_store.unsubscribe(self.notify)
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    def notify(self) -> None:
+        """Wake the broadcaster (safe to call from any thread)."""
+        loop, wakeup = self._loop, self._wakeup
+        if loop is not None and wakeup is not None and not loop.is_closed():
+            loop.call_soon_threadsafe(wakeup.set)
+
+    async def _run(self) -> None:
+        from web_chat.llm_client import get_dashboard_delta
+
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.refresh_s)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            delta = get_dashboard_delta(self._seq)
+            self._seq = delta["seq"]
+            if self._clients:
+                self._publish(delta)
+            # Requests finishing during the pause go out together in the next delta
+            await asyncio.sleep(self.push_interval_s)
+
+    def _publish(self, delta: dict) -> None:
+        message = (delta, _sse("delta", delta))
+        for pending in list(self._clients):
+            try:
+                pending.put_nowait(message)
+            except asyncio.QueueFull:
+                # Too far behind: end its stream; EventSource reconnects and gets a fresh snapshot
+                self._clients.discard(pending)
+                while not pending.empty():
+                    pending.get_nowait()
+                pending.put_nowait(None)
+
+    async def stream(self):
+        """SSE for one client: a "snapshot" event, then "delta" events."""
+        from web_chat.llm_client import get_dashboard_data
+
+        self._ensure_started()
+        pending: asyncio.Queue = asyncio.Queue(self.max_pending)
+        self._clients.add(pending)
+        try:
+            data = get_dashboard_data()
+            last_seq = data["seq"]
+            yield _sse("snapshot", data)
+            while True:
+                try:
+                    message = await asyncio.wait_for(pending.get(), self.keepalive_s)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                if message is None:
+                    return
+                delta, text = message
+                if delta["new_sessions"] and delta["new_sessions"][-1]["seq"] <= last_seq:
+                    # Overlaps the snapshot this client started from
+                    delta = {**delta, "new_sessions": [e for e in delta["new_sessions"] if e["seq"] > last_seq]}
+                    text = _sse("delta", delta)
+                last_seq = max(last_seq, delta["seq"])
+                yield text
+        finally:
+            self._clients.discard(pending)
+
+    def client_count(self) -> int:
+        return len(self._clients)
+
+
+dashboard_hub = DashboardHub()
+
+
+# Chat streams run on a bounded pool of worker threads (CHAT_STREAM_WORKERS,
+# default BATCH_SLOTS) with at most INFERENCE_QUEUE_SIZE streams waiting
+_chat_stream_executor = None
+_chat_stream_executor_lock = threading.Lock()
+# How often an idle stream checks whether its client is still connected
+STREAM_DISCONNECT_POLL_S = 1.0
+
+
+def get_chat_stream_executor():
+    global _chat_stream_executor
+    with _chat_stream_executor_lock:
+        if _chat_stream_executor is None:
+            from server import DEFAULT_BATCH_SLOTS, InferenceExecutor
+
+            workers = int(os.getenv("CHAT_STREAM_WORKERS", "0")) or DEFAULT_BATCH_SLOTS
+            _chat_stream_executor = InferenceExecutor(workers=workers, name="chat_stream")
+        return _chat_stream_executor
+
+
+@app.post("/api/chat/stream")
+async def api_chat_stream(request: ChatRequest, http_request: Request):
+    """Like /api/chat, but streams the answer as Server-Sent Events.
+
+    Emits "token" events ({"text": ...}) while generating, then one "done" event
+    with the same payload /api/chat returns (response, metrics, session_id), or
+    an "error" event ({"detail": ...}). History and metrics are saved once, at the end.
+    When the client disconnects, generation stops at the next chunk and nothing is saved.
+    """
+    from server import GenerationCancelled, InferenceQueueFullError
+
+    loop = asyncio.get_running_loop()
+    events: asyncio.Queue = asyncio.Queue()
+    disconnected = threading.Event()
+
+    def emit(event: str, data: dict) -> None:
+        loop.call_soon_threadsafe(events.put_nowait, (event, data))
+
+    def on_text(text: str) -> None:
+        if disconnected.is_set():
+            raise GenerationCancelled("client disconnected")
+        emit("token", {"text": text})
+
+    def worker() -> None:
+        try:
+            emit("done", _run_chat(request, on_text=on_text))
+        except GenerationCancelled:
+            pass
+        except FileNotFoundError:
+            emit("error", {"detail": "Modelo não encontrado. Configure MODEL_PATH no .env"})
+        except Exception as e:
+            emit("error", {"detail": str(e)})
+
+    try:
+        future = get_chat_stream_executor().submit(profiling.bind(tracing.bind(worker)))
+    except InferenceQueueFullError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+
+    async def stream():
+        try:
+            while True:
+                try:
+                    event, data = await asyncio.wait_for(events.get(), STREAM_DISCONNECT_POLL_S)
+                except asyncio.TimeoutError:
+                    if await http_request.is_disconnected():
+                        return
+                    continue
+                yield _sse(event, data)
+                if event != "token":
+                    return
+        finally:
+            # Also reached when the client goes away mid-stream: stop decoding for nobody
+            disconnected.set()
+            future.cancel()
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @app.post("/api/upload")
 async def api_upload(file: UploadFile = File(...)):
     """Upload a file for analysis."""
@@ -225,12 +471,14 @@ async def api_upload(file: UploadFile = File(...)):
 
 
 @app.post("/api/analyze")
-async def api_analyze(
+@profiling.profiled
+def api_analyze(
     path: str = Form(...),
     instruction: str = Form(""),
     max_tokens: int = Form(512),
     temperature: float = Form(0.3),
     model_path: str = Form(""),
+    cache: bool | None = Form(None),
 ):
     """Analyze an uploaded file."""
     try:
@@ -241,6 +489,7 @@ async def api_analyze(
             max_tokens=max_tokens,
             temperature=temperature,
             model_path=model_path.strip() or None,
+            cache=cache,
         )
         return {"analysis": text, "metrics": metrics}
     except Exception as e:
@@ -257,6 +506,66 @@ async def api_dashboard():
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.get("/api/dashboard/stream")
+async def api_dashboard_stream():
+    """Dashboard updates as Server-Sent Events.
+
+    Sends a "snapshot" event (the /api/dashboard payload plus its seq), then a
+    "delta" event whenever requests complete: new_sessions holds only the new
+    requests, summary and percentiles replace the previous values.
+    """
+    return StreamingResponse(
+        dashboard_hub.stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    """Prometheus scrape endpoint (request counts, latency and token histograms)."""
+    return Response(prom.render(), media_type=prom.CONTENT_TYPE)
+
+
+@app.get("/api/traces")
+async def api_traces(limit: int = Query(50, ge=1, le=200), min_ms: float = Query(0, ge=0)):
+    """Recently kept request traces (sampled or slow), newest first."""
+    return {"traces": tracing.recent_traces(limit=limit, min_ms=min_ms)}
+
+
+@app.get("/api/traces/{trace_id}")
+def api_trace(trace_id: str):
+    """One request trace: its spans in start order, with depth, offset and duration (ms)."""
+    trace = tracing.get_trace(trace_id)
+    if trace is None:
+        raise HTTPException(status_code=404, detail="Trace não encontrado")
+    return trace
+
+
+@app.get("/api/profiles")
+async def api_profiles(limit: int = Query(50, ge=1, le=200)):
+    """Saved request profiles (X-Profile: 1 header or PROFILE_REQUESTS), newest first."""
+    return {"profiles": profiling.list_profiles(limit=limit)}
+
+
+@app.get("/api/profiles/{profile_id}")
+async def api_profile(profile_id: str):
+    """One profile's summary: duration, threads and the hottest functions."""
+    summary = profiling.get_profile(profile_id)
+    if summary is None:
+        raise HTTPException(status_code=404, detail="Perfil não encontrado")
+    return summary
+
+
+@app.get("/api/profiles/{profile_id}/download")
+async def api_profile_download(profile_id: str):
+    """The profile in pstats format (open with snakeviz or python -m pstats)."""
+    path = profiling.profile_path(profile_id)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Perfil não encontrado")
+    return FileResponse(path, media_type="application/octet-stream", filename=path.name)
+
+
 @app.get("/api/config")
 async def api_config():
     """Get current config (from env)."""
@@ -269,25 +578,84 @@ async def api_config():
 
 
 @app.get("/api/sessions")
-async def api_sessions():
-    """List all conversation sessions (from server history)."""
+@profiling.profiled
+def api_sessions(
+    limit: int = Query(50, ge=1, le=500),
+    cursor: str | None = None,
+    status: str | None = None,
+    metadata: list[str] = Query([]),
+):
+    """List conversation sessions (from server history), most recently used first.
+
+    Paginated: pass the returned next_cursor to get the following page (null on
+    the last one). status filters by session status; each metadata=key:value
+    keeps only sessions whose metadata has that value.
+    """
+    filters = {}
+    for item in metadata:
+        key, sep, value = item.partition(":")
+        if not sep or not key:
+            raise HTTPException(status_code=400, detail=f"Filtro de metadata inválido: {item!r} (use chave:valor)")
+        filters[key] = value
     try:
-        from server import _load_sessions_index
-
-        data = _load_sessions_index()
-        sessions = data.get("sessions", {})
-        items = [
-            {
-                "id": sid,
-                "created_at": meta.get("created_at", ""),
-                "last_used_at": meta.get("last_used_at", ""),
-                "message_count": meta.get("message_count", 0),
-                "status": meta.get("status", "active"),
-            }
-            for sid, meta in sessions.items()
-        ]
-        items.sort(key=lambda x: x["last_used_at"], reverse=True)
-        return {"sessions": items}
+        from server import list_sessions_page
+
+        page, next_cursor = list_sessions_page(limit, cursor, status, filters)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    items = [
+        {
+            "id": meta["id"],
+            "created_at": meta.get("created_at", ""),
+            "last_used_at": meta.get("last_used_at", ""),
+            "message_count": meta.get("message_count", 0),
+            "status": meta.get("status", "active"),
+        }
+        for meta in page
+    ]
+    return {"sessions": items, "next_cursor": next_cursor}
+
+
+@app.get("/api/sessions/search")
+@profiling.profiled
+def api_sessions_search(
+    q: str = Query(..., min_length=1),
+    limit: int = Query(20, ge=1, le=100),
+    session_id: str | None = None,
+):
+    """Full-text search over session messages, best match first.
+
+    Each result's snippet is HTML with the matched words in <mark> tags.
+    """
+    try:
+        from server import search_sessions
+
+        # Control characters cannot occur in the escaped text, so they mark the matches safely
+        hits = search_sessions(q, limit=limit, session_id=session_id, mark=("\x02", "\x03"))
+    except RuntimeError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    results = [
+        {
+            **hit,
+            "snippet": html.escape(hit["snippet"]).replace("\x02", "<mark>").replace("\x03", "</mark>"),
+        }
+        for hit in hits
+    ]
+    return {"query": q, "results": results}
+
+
+@app.post("/api/sessions/gc")
+@profiling.profiled
+def api_sessions_gc():
+    """Run a session garbage collection pass now (TTL, quota, orphaned files) and return what it reclaimed."""
+    try:
+        from server import collect_session_garbage
+
+        return collect_session_garbage()
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
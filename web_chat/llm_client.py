@@ -1,12 +1,19 @@
 """
 LLM client for web chat - wraps server model and tracks metrics.
 """
+import atexit
+import calendar
+import itertools
 import json
+import math
 import os
 import sys
+import threading
 import time
+from collections import deque
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Any, Dict, List, Optional
+from typing import Any, Callable, Dict, Iterator, List, Optional
 
 # Add parent directory to path so we can import from server
 ROOT = Path(__file__).resolve().parent.parent
@@ -17,42 +24,402 @@ from dotenv import load_dotenv
 
 load_dotenv(ROOT / ".env")
 
-# Metrics storage
-METRICS_FILE = Path(__file__).parent / "data" / "metrics.json"
-UPLOADS_DIR = Path(__file__).parent / "uploads"
-
-
-def _ensure_data_dirs():
-    METRICS_FILE.parent.mkdir(parents=True, exist_ok=True)
-    UPLOADS_DIR.mkdir(parents=True, exist_ok=True)
-    if not METRICS_FILE.exists():
-        METRICS_FILE.write_text('{"sessions": [], "summary": {}}', encoding="utf-8")
+import tracing
+
+# Metrics storage: metrics.json is a snapshot (totals + recent requests), metrics.log holds
+# the requests recorded since, one JSON line each. Both live in WEB_CHAT_DATA_DIR
+# (relative to web_chat/)
+METRICS_FILE = Path(__file__).parent / os.getenv("WEB_CHAT_DATA_DIR", "data") / "metrics.json"
+METRICS_LOG_FILE = METRICS_FILE.with_suffix(".log")
+# Requests kept for the dashboard, and how many are logged between snapshots
+METRICS_RECENT_LIMIT = 500
+METRICS_SNAPSHOT_EVERY = 100
+# Recent requests sent to the dashboard
+DASHBOARD_RECENT_LIMIT = 50
+# Latency phases reported by server.generate_completion(), kept per request
+PHASE_KEYS = (
+    "queue_wait_ms",
+    "prompt_eval_ms",
+    "prompt_eval_tokens",
+    "time_to_first_token_ms",
+    "decode_ms",
+    "decode_tokens_per_s",
+    "finish_reason",
+)
+# Rolling percentile windows: name -> (length in seconds, slots). Each slot holds one
+# sketch, so memory per window is fixed and the window advances one slot at a time
+SKETCH_WINDOWS = {"1m": (60, 6), "15m": (900, 15), "1h": (3600, 12), "24h": (86400, 24)}
+SKETCH_ACCURACY = 0.02
+SKETCH_QUANTILES = (0.5, 0.9, 0.95, 0.99)
+# Per-request values summarized by the sketches (entry key -> series name)
+SKETCH_METRICS = {
+    "response_time_ms": "latency_ms",
+    "time_to_first_token_ms": "ttft_ms",
+    "decode_tokens_per_s": "tokens_per_s",
+}
+
+
+class QuantileSketch:
+    """Streaming quantile sketch with relative accuracy (DDSketch-style).
+
+    Positive values are counted in logarithmic buckets whose bounds grow by
+    gamma = (1 + accuracy) / (1 - accuracy), so every quantile is returned within
+    the given relative error. Sketches merge by adding bucket counts, and the
+    lowest buckets are folded together past max_buckets, which bounds memory.
+    """
 
+    def __init__(self, accuracy: float = SKETCH_ACCURACY, max_buckets: int = 1024):
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.max_buckets = max_buckets
+        self.buckets: Dict[int, int] = {}
+        self.zero_count = 0
+        self.count = 0
+
+    def add(self, value: float, count: int = 1) -> None:
+        self.count += count
+        if value <= 0:
+            self.zero_count += count
+            return
+        index = math.ceil(math.log(value) / self._log_gamma)
+        self.buckets[index] = self.buckets.get(index, 0) + count
+        if len(self.buckets) > self.max_buckets:
+            self._collapse()
+
+    def merge(self, other: "QuantileSketch") -> None:
+        self.count += other.count
+        self.zero_count += other.zero_count
+        for index, n in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + n
+        if len(self.buckets) > self.max_buckets:
+            self._collapse()
+
+    def _collapse(self) -> None:
+        indexes = sorted(self.buckets)
+        keep = indexes[-self.max_buckets + 1]
+        folded = sum(self.buckets.pop(i) for i in indexes if i < keep)
+        self.buckets[keep] += folded
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Return the q-quantile (0 <= q <= 1), or None if the sketch is empty."""
+        if self.count == 0:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zero_count
+        if rank < seen:
+            return 0.0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if rank < seen:
+                return 2 * self.gamma ** index / (self.gamma + 1)
+        return 2 * self.gamma ** max(self.buckets) / (self.gamma + 1)
+
+    def to_list(self) -> List[Any]:
+        """Compact form: [zero_count, lowest bucket index, [counts from that index on]]."""
+        if not self.buckets:
+            return [self.zero_count, 0, []]
+        low, high = min(self.buckets), max(self.buckets)
+        return [self.zero_count, low, [self.buckets.get(i, 0) for i in range(low, high + 1)]]
+
+    @classmethod
+    def from_list(cls, data: List[Any]) -> "QuantileSketch":
+        sketch = cls()
+        zero_count, low, counts = data
+        sketch.zero_count = zero_count
+        sketch.buckets = {low + i: n for i, n in enumerate(counts) if n}
+        sketch.count = zero_count + sum(counts)
+        return sketch
+
+
+class RollingSketch:
+    """Quantile sketch over a sliding time window, kept as a ring of per-slot sketches."""
+
+    def __init__(self, window_s: int, slots: int):
+        self.slot_s = window_s / slots
+        self.slots: List[Optional[tuple]] = [None] * slots  # (slot number, sketch)
+
+    def add(self, value: float, now: float) -> None:
+        number = int(now // self.slot_s)
+        position = number % len(self.slots)
+        slot = self.slots[position]
+        if slot is None or slot[0] != number:
+            if slot is not None and slot[0] > number:
+                return  # older than the window (replayed from the log)
+            slot = self.slots[position] = (number, QuantileSketch())
+        slot[1].add(value)
+
+    def merged(self, now: float) -> QuantileSketch:
+        """Merge the slots that are still inside the window."""
+        oldest = int(now // self.slot_s) - len(self.slots) + 1
+        result = QuantileSketch()
+        for slot in self.slots:
+            if slot is not None and slot[0] >= oldest:
+                result.merge(slot[1])
+        return result
+
+    def to_list(self) -> List[Any]:
+        return [[number, sketch.to_list()] for number, sketch in filter(None, self.slots)]
+
+    def load(self, data: List[Any]) -> None:
+        for number, sketch in data:
+            self.slots[number % len(self.slots)] = (number, QuantileSketch.from_list(sketch))
+
+
+class PercentileTracker:
+    """Rolling latency/throughput percentiles per model and per endpoint (plus overall).
+
+    Not thread-safe on its own; MetricsStore calls it under its lock.
+    """
 
-def _load_metrics() -> dict:
-    _ensure_data_dirs()
+    def __init__(self, windows: Dict[str, tuple] = SKETCH_WINDOWS):
+        self.windows = windows
+        # (dimension, name, series) -> {window: RollingSketch}; dimension is all/model/endpoint
+        self._series: Dict[tuple, Dict[str, RollingSketch]] = {}
+
+    def _rolling(self, key: tuple) -> Dict[str, RollingSketch]:
+        rolling = self._series.get(key)
+        if rolling is None:
+            rolling = self._series[key] = {w: RollingSketch(*spec) for w, spec in self.windows.items()}
+        return rolling
+
+    def add(self, entry: Dict[str, Any], now: float) -> None:
+        groups = (("all", "all"), ("model", entry.get("model") or "unknown"), ("endpoint", entry.get("endpoint") or "unknown"))
+        for field, series in SKETCH_METRICS.items():
+            value = entry.get(field)
+            if value is None:
+                continue
+            for dimension, name in groups:
+                for sketch in self._rolling((dimension, name, series)).values():
+                    sketch.add(value, now)
+
+    def report(self, now: float) -> Dict[str, Any]:
+        """Return {window: {dimension: {name: {series: {count, p50, p90, p95, p99}}}}}."""
+        report: Dict[str, Any] = {w: {} for w in self.windows}
+        for (dimension, name, series), rolling in self._series.items():
+            for window, sketch in rolling.items():
+                merged = sketch.merged(now)
+                if merged.count == 0:
+                    continue
+                stats = {"count": merged.count}
+                for q in SKETCH_QUANTILES:
+                    stats[f"p{round(q * 100)}"] = round(merged.quantile(q), 2)
+                report[window].setdefault(dimension, {}).setdefault(name, {})[series] = stats
+        return report
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "|".join(key): {w: sketch.to_list() for w, sketch in rolling.items()}
+            for key, rolling in self._series.items()
+        }
+
+    def load(self, data: Dict[str, Any]) -> None:
+        for key, windows in data.items():
+            dimension, rest = key.split("|", 1)
+            rolling = self._rolling((dimension, *rest.rsplit("|", 1)))
+            for window, slots in windows.items():
+                if window in rolling:
+                    rolling[window].load(slots)
+
+
+def _entry_time(entry: Dict[str, Any]) -> float:
+    """Return the epoch time of a recorded request (from its UTC timestamp)."""
     try:
-        return json.loads(METRICS_FILE.read_text(encoding="utf-8"))
-    except Exception:
-        return {"sessions": [], "summary": {}}
-
-
-def _save_metrics(data: dict):
-    _ensure_data_dirs()
-    METRICS_FILE.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
+        return calendar.timegm(time.strptime(entry["timestamp"], "%Y-%m-%dT%H:%M:%SZ"))
+    except (KeyError, ValueError):
+        return 0.0
+
+
+class MetricsStore:
+    """Dashboard metrics kept in memory: recent requests in a ring buffer plus running totals.
+
+    Each request is also appended to log_path as one JSON line, under a lock,
+    so concurrent requests never lose or interleave updates. Every
+    snapshot_every requests (and on close) the totals and the ring buffer are
+    written to snapshot_path, atomically replaced, and the log is emptied. On
+    startup the snapshot is read and at most snapshot_every log lines are
+    replayed. Log lines carry a sequence number, so lines already in the
+    snapshot (a crash between the two steps) are not counted twice. Rolling
+    percentile sketches (see PercentileTracker) are snapshotted the same way.
+    """
 
+    SUMMARY_KEYS = (
+        "total_prompt_tokens",
+        "total_completion_tokens",
+        "total_tokens",
+        "total_requests",
+        "total_response_time_ms",
+        "total_queue_wait_ms",
+        "total_prompt_eval_ms",
+        "total_time_to_first_token_ms",
+    )
 
+    def __init__(
+        self,
+        snapshot_path: Path,
+        log_path: Path,
+        max_recent: int = METRICS_RECENT_LIMIT,
+        snapshot_every: int = METRICS_SNAPSHOT_EVERY,
+    ):
+        self.snapshot_path = snapshot_path
+        self.log_path = log_path
+        self.snapshot_every = max(1, snapshot_every)
+        self._lock = threading.Lock()
+        self._recent: deque = deque(maxlen=max_recent)
+        self._summary: Dict[str, float] = dict.fromkeys(self.SUMMARY_KEYS, 0)
+        self.percentiles = PercentileTracker()
+        self._listeners: List[Callable[[], None]] = []
+        self._seq = 0
+        self._since_snapshot = 0
+        self._log = None
+        self._load()
+
+    def _load(self) -> None:
+        try:
+            data = json.loads(self.snapshot_path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            data = {}
+        # metrics.json files written by older versions have the same shape, without "seq"
+        summary = data.get("summary", {})
+        for key in self.SUMMARY_KEYS:
+            self._summary[key] = summary.get(key, 0)
+        self._recent.extend(data.get("sessions", []))
+        if "sketches" in data:
+            self.percentiles.load(data["sketches"])
+        else:
+            for entry in self._recent:  # snapshot from before sketches were kept
+                self.percentiles.add(entry, _entry_time(entry))
+        self._seq = data.get("seq", 0)
+        try:
+            with open(self.log_path, "rb") as f:
+                for line in f:
+                    try:
+                        event = json.loads(line)
+                    except ValueError:
+                        continue  # a line cut short by a crash
+                    if event.get("seq", 0) > self._seq:
+                        self._seq = event.pop("seq")
+                        self._apply(event, _entry_time(event))
+                        self._since_snapshot += 1
+        except OSError:
+            pass
+
+    def _apply(self, entry: Dict[str, Any], now: float) -> None:
+        self._recent.append(entry)
+        self.percentiles.add(entry, now)
+        summary = self._summary
+        summary["total_prompt_tokens"] += entry["prompt_tokens"]
+        summary["total_completion_tokens"] += entry["completion_tokens"]
+        summary["total_tokens"] += entry["total_tokens"]
+        summary["total_requests"] += 1
+        summary["total_response_time_ms"] += entry["response_time_ms"]
+        # Requests recorded before phases were tracked (or served from the cache) lack some
+        summary["total_queue_wait_ms"] += entry.get("queue_wait_ms", 0)
+        summary["total_prompt_eval_ms"] += entry.get("prompt_eval_ms", 0)
+        summary["total_time_to_first_token_ms"] += entry.get("time_to_first_token_ms", 0)
+
+    def _snapshot(self) -> None:
+        data = {
+            "seq": self._seq,
+            "summary": dict(self._summary),
+            "sessions": list(self._recent),
+            "sketches": self.percentiles.to_dict(),
+        }
+        self.snapshot_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.snapshot_path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(data, ensure_ascii=False), encoding="utf-8")
+        tmp_path.replace(self.snapshot_path)
+        # Everything logged so far is in the snapshot now
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+        self.log_path.write_bytes(b"")
+        self._since_snapshot = 0
+
+    def record(self, entry: Dict[str, Any]) -> None:
+        """Add one request to the totals and the ring buffer, and log it."""
+        with self._lock:
+            self._seq += 1
+            self._apply(entry, time.time())
+            line = json.dumps({"seq": self._seq, **entry}, ensure_ascii=False) + "\n"
+            try:
+                if self._log is None:
+                    self.log_path.parent.mkdir(parents=True, exist_ok=True)
+                    self._log = open(self.log_path, "a", encoding="utf-8")
+                self._log.write(line)
+                self._log.flush()
+                self._since_snapshot += 1
+                if self._since_snapshot >= self.snapshot_every:
+                    self._snapshot()
+            except OSError as e:
+                print(f"Warning: could not persist metrics: {e}", file=sys.stderr)
+        for listener in list(self._listeners):
+            listener()
+
+    def subscribe(self, listener: Callable[[], None]) -> None:
+        """Call listener() (from the recording thread) after each recorded request."""
+        self._listeners.append(listener)
+
+    def unsubscribe(self, listener: Callable[[], None]) -> None:
+        if listener in self._listeners:
+            self._listeners.remove(listener)
+
+    def summary(self) -> Dict[str, float]:
+        with self._lock:
+            return dict(self._summary)
+
+    def percentile_report(self) -> Dict[str, Any]:
+        """Return rolling p50/p90/p95/p99 per window, model and endpoint."""
+        with self._lock:
+            return self.percentiles.report(time.time())
+
+    def recent(self, limit: int) -> List[Dict[str, Any]]:
+        """Return the newest limit requests, newest first."""
+        with self._lock:
+            return list(itertools.islice(reversed(self._recent), limit))
+
+    def recent_since(self, since_seq: Optional[int], limit: int) -> tuple[int, List[Dict[str, Any]]]:
+        """Return (current seq, up to limit requests recorded after since_seq, newest first, with their seq).
+
+        since_seq=None returns the newest requests whatever their seq (snapshots
+        from older versions have none).
+        """
+        with self._lock:
+            seq = self._seq
+            count = limit if since_seq is None else min(max(0, seq - since_seq), limit)
+            entries = itertools.islice(reversed(self._recent), count)
+            return seq, [{"seq": seq - i, **entry} for i, entry in enumerate(entries)]
+
+    def close(self) -> None:
+        """Write a final snapshot (nothing to replay on the next start)."""
+        with self._lock:
+            if self._since_snapshot == 0:
+                return
+            try:
+                self._snapshot()
+            except OSError as e:
+                print(f"Warning: could not snapshot metrics: {e}", file=sys.stderr)
+
+
+metrics_store = MetricsStore(METRICS_FILE, METRICS_LOG_FILE)
+atexit.register(metrics_store.close)
+
+
+@tracing.traced("llm_client.record_metrics")
 def record_metrics(
     session_id: str,
     prompt_tokens: int,
     completion_tokens: int,
     response_time_ms: float,
     model_name: str,
+    phases: Optional[Dict[str, Any]] = None,
+    endpoint: str = "chat",
 ):
-    """Record a chat completion for dashboard metrics."""
-    data = _load_metrics()
-    sessions = data.setdefault("sessions", [])
-    sessions.append({
+    """Record a chat completion for dashboard metrics (phases: see phase_metrics).
+
+    endpoint names the web chat operation (chat, continue_session, analyze_file)
+    the rolling percentiles are grouped by.
+    """
+    metrics_store.record({
         "session_id": session_id,
         "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
         "prompt_tokens": prompt_tokens,
@@ -60,48 +427,69 @@ def record_metrics(
         "total_tokens": prompt_tokens + completion_tokens,
         "response_time_ms": round(response_time_ms, 2),
         "model": model_name,
+        "endpoint": endpoint,
+        **(phases or {}),
     })
-    # Keep last 500 entries
-    if len(sessions) > 500:
-        sessions[:] = sessions[-500:]
 
-    summary = data.setdefault("summary", {})
-    summary["total_prompt_tokens"] = summary.get("total_prompt_tokens", 0) + prompt_tokens
-    summary["total_completion_tokens"] = summary.get("total_completion_tokens", 0) + completion_tokens
-    summary["total_tokens"] = summary.get("total_tokens", 0) + prompt_tokens + completion_tokens
-    summary["total_requests"] = summary.get("total_requests", 0) + 1
-    summary["total_response_time_ms"] = summary.get("total_response_time_ms", 0) + response_time_ms
 
-    _save_metrics(data)
+def phase_metrics(usage: Dict[str, Any]) -> Dict[str, Any]:
+    """Pick the latency phases out of generate_completion() metrics, rounded."""
+    phases = {}
+    for key in PHASE_KEYS:
+        value = usage.get(key)
+        if value is not None:
+            phases[key] = round(value, 2) if isinstance(value, float) else value
+    return phases
+
 
+@contextmanager
+def get_model(model_path: Optional[str] = None) -> Iterator[Any]:
+    """Load the Llama model from server and hold its lock while the block runs."""
+    from server import use_model
+    with use_model(model_path=model_path) as model:
+        yield model
 
-def get_model(model_path: Optional[str] = None) -> Any:
-    """Load and return the Llama model from server."""
-    from server import load_model
-    return load_model(model_path=model_path)
 
+def get_available_models() -> List[Dict[str, Any]]:
+    """List available GGUF models, flagging the ones resident in memory."""
+    from server import get_available_models as _get, get_loaded_models
 
-def get_available_models() -> List[Dict[str, str]]:
-    """List available GGUF models."""
-    from server import get_available_models as _get
-    return _get()
+    loaded = {m["path"] for m in get_loaded_models()}
+    return [{**m, "loaded": m["path"] in loaded} for m in _get()]
 
 
 def get_model_info(model_path: Optional[str] = None) -> Dict[str, Any]:
-    """Return current model path and config. model_path overrides for display."""
-    from server import get_current_model_path
+    """Return the model used by this request, config and resident models. model_path overrides for display."""
+    from server import (
+        DEFAULT_BATCH_SLOTS,
+        get_batch_stats,
+        get_current_model_path,
+        get_loaded_models,
+        get_session_store_stats,
+        get_speculative_stats,
+        model_pool,
+    )
 
     current = get_current_model_path()
     path = model_path or current or os.getenv("MODEL_PATH", "")
+    loaded_models = get_loaded_models()
     return {
         "model_path": path,
         "model_name": Path(path).name if path else "Nenhum modelo carregado",
         "context_size": int(os.getenv("CONTEXT_SIZE", "2048")),
         "n_threads": int(os.getenv("N_THREADS", "4")),
         "n_gpu_layers": int(os.getenv("N_GPU_LAYERS", "0")),
+        "loaded_models": loaded_models,
+        "pool_used_mb": round(sum(m["size_bytes"] for m in loaded_models) / (1024 * 1024), 1),
+        "pool_budget_mb": round(model_pool.max_bytes / (1024 * 1024), 1),
+        "batch_slots": DEFAULT_BATCH_SLOTS,
+        "batch": get_batch_stats(),
+        "speculative": get_speculative_stats(),
+        "sessions": get_session_store_stats(),
     }
 
 
+@tracing.traced("llm_client.chat")
 def chat(
     messages: List[Dict[str, str]],
     max_tokens: int = 256,
@@ -109,14 +497,14 @@ def chat(
     top_p: float = 0.9,
     session_id: str = "",
     model_path: Optional[str] = None,
+    cache: Optional[bool] = None,
+    on_text: Optional[Callable[[str], None]] = None,
 ) -> tuple[str, Dict[str, Any]]:
     """
     Send chat messages to the model. Returns (response_text, metrics).
+    If on_text is given, it receives the generated text piece by piece as it is produced.
     """
-    from server import load_model
-
-    model = load_model(model_path=model_path)
-    model_info = get_model_info()
+    from server import generate_completion, use_model
 
     prompt_parts = []
     for msg in messages:
@@ -131,19 +519,25 @@ def chat(
 
     prompt = "\n".join(prompt_parts) + "\nAssistant:"
 
-    start = time.perf_counter()
-    output = model(
-        prompt,
-        max_tokens=max_tokens,
-        temperature=temperature,
-        top_p=top_p,
-        echo=False,
-        stop=["User:", "System:"],
-    )
-    elapsed_ms = (time.perf_counter() - start) * 1000
+    usage: Dict[str, Any] = {}
+    with use_model(model_path, batched=True) as model:
+        _, text = generate_completion(
+            model,
+            prompt,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            top_p=top_p,
+            stop=["User:", "System:"],
+            streaming=on_text is not None,
+            chunk_size=1,
+            on_chunk=on_text,
+            cache=cache,
+            metrics=usage,
+        )
+    elapsed_ms = usage["generation_ms"]
+    model_info = get_model_info()
 
-    text = output["choices"][0]["text"].strip()
-    usage = output.get("usage", {})
+    text = text.strip()
     prompt_tokens = usage.get("prompt_tokens", 0)
     completion_tokens = usage.get("completion_tokens", 0)
     if prompt_tokens == 0 and completion_tokens == 0:
@@ -151,12 +545,15 @@ def chat(
         prompt_tokens = max(1, len(prompt) // 4)
         completion_tokens = max(1, len(text) // 4)
 
+    phases = phase_metrics(usage)
     record_metrics(
         session_id=session_id or "web",
         prompt_tokens=prompt_tokens,
         completion_tokens=completion_tokens,
         response_time_ms=elapsed_ms,
         model_name=model_info["model_name"],
+        phases=phases,
+        endpoint="chat",
     )
 
     metrics = {
@@ -164,6 +561,8 @@ def chat(
         "completion_tokens": completion_tokens,
         "total_tokens": prompt_tokens + completion_tokens,
         "response_time_ms": round(elapsed_ms, 2),
+        "cached": usage.get("cached", False),
+        **phases,
     }
     return text, metrics
 
@@ -175,6 +574,7 @@ def create_session(metadata: Optional[Dict[str, Any]] = None) -> str:
     return _create_session(metadata=metadata)
 
 
+@tracing.traced("llm_client.continue_session")
 def continue_session(
     session_id: str,
     message: str,
@@ -182,63 +582,72 @@ def continue_session(
     temperature: float = 0.7,
     top_p: float = 0.9,
     model_path: Optional[str] = None,
+    cache: Optional[bool] = None,
+    on_text: Optional[Callable[[str], None]] = None,
 ) -> tuple[str, Dict[str, Any]]:
-    """Continue a session with history persisted on server. Returns (response_text, metrics)."""
+    """Continue a session with history persisted on server. Returns (response_text, metrics).
+
+    If on_text is given, it receives the generated text piece by piece as it is produced.
+    """
     from server import (
-        load_model,
-        load_recent_session_messages,
+        BatchScheduler,
         append_session_message,
-        DEFAULT_SESSION_MAX_MESSAGES,
+        build_session_prompt,
+        generate_completion,
+        restore_session_state,
+        save_session_state,
+        use_model,
     )
 
-    model = load_model(model_path=model_path)
+    tracing.set_attributes(session_id=session_id)
+    usage: Dict[str, Any] = {}
+    with use_model(model_path, batched=True) as model:
+        start = time.perf_counter()
+        # History is packed by token budget with the model's tokenizer
+        prompt, prefix_key = build_session_prompt(model, session_id, message, max_tokens)
+        # A batch scheduler decodes in its own context, so the session's KV state only
+        # applies when generating on the model directly
+        batched = isinstance(model, BatchScheduler)
+        if not batched:
+            restore_session_state(model, session_id, prefix_key)
+        _, text = generate_completion(
+            model,
+            prompt,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            top_p=top_p,
+            stop=["User:", "System:"],
+            streaming=on_text is not None,
+            chunk_size=1,
+            on_chunk=on_text,
+            cache=cache,
+            metrics=usage,
+        )
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        # A cached answer decoded nothing: the model's state is not this session's
+        if not batched and not usage.get("cached"):
+            save_session_state(model, session_id, prefix_key)
+
+        text = text.strip()
+        append_session_message(session_id, "user", message, model=model)
+        append_session_message(session_id, "assistant", text, model=model)
     model_info = get_model_info()
 
-    history_events = load_recent_session_messages(
-        session_id, max_messages=DEFAULT_SESSION_MAX_MESSAGES
-    )
-
-    prompt_parts = []
-    for event in history_events:
-        role = event.get("role", "user")
-        content = event.get("content", "")
-        if not content:
-            continue
-        prefix = "System" if role == "system" else ("Assistant" if role == "assistant" else "User")
-        prompt_parts.append(f"{prefix}: {content}")
-
-    prompt_parts.append(f"User: {message}")
-    prompt_parts.append("Assistant:")
-    prompt = "\n".join(prompt_parts)
-
-    start = time.perf_counter()
-    output = model(
-        prompt,
-        max_tokens=max_tokens,
-        temperature=temperature,
-        top_p=top_p,
-        echo=False,
-        stop=["User:", "System:"],
-    )
-    elapsed_ms = (time.perf_counter() - start) * 1000
-
-    text = output["choices"][0]["text"].strip()
-    usage = output.get("usage", {})
     prompt_tokens = usage.get("prompt_tokens", 0)
     completion_tokens = usage.get("completion_tokens", 0)
     if prompt_tokens == 0 and completion_tokens == 0:
         prompt_tokens = max(1, len(prompt) // 4)
         completion_tokens = max(1, len(text) // 4)
 
-    append_session_message(session_id, "user", message)
-    append_session_message(session_id, "assistant", text)
-
+    phases = phase_metrics(usage)
     record_metrics(
         session_id=session_id,
         prompt_tokens=prompt_tokens,
         completion_tokens=completion_tokens,
         response_time_ms=elapsed_ms,
         model_name=model_info["model_name"],
+        phases=phases,
+        endpoint="continue_session",
     )
 
     metrics = {
@@ -246,10 +655,13 @@ def continue_session(
         "completion_tokens": completion_tokens,
         "total_tokens": prompt_tokens + completion_tokens,
         "response_time_ms": round(elapsed_ms, 2),
+        "cached": usage.get("cached", False),
+        **phases,
     }
     return text, metrics
 
 
+@tracing.traced("llm_client.analyze_file")
 def analyze_file(
     file_path: str,
     instruction: Optional[str] = None,
@@ -257,47 +669,51 @@ def analyze_file(
     temperature: float = 0.3,
     session_id: str = "",
     model_path: Optional[str] = None,
+    cache: Optional[bool] = None,
 ) -> tuple[str, Dict[str, Any]]:
     """Read and analyze a file with the model. Returns (analysis_text, metrics)."""
-    from server import _read_file_safe, load_model
+    from server import _read_file_safe, generate_completion, use_model
 
     content, full_path, err = _read_file_safe(file_path, max_bytes=200000)
     if err:
         return err, {}
 
-    model = load_model(model_path=model_path)
-    model_info = get_model_info()
-
     inst = instruction or (
         "Analyze this file. Describe its purpose, structure, "
         "and any notable issues or improvements. Be concise but informative."
     )
     prompt = f"{inst}\n\n--- File: {full_path} ---\n\n{content}"
 
-    start = time.perf_counter()
-    output = model(
-        prompt,
-        max_tokens=max_tokens,
-        temperature=temperature,
-        top_p=0.9,
-        echo=False,
-    )
-    elapsed_ms = (time.perf_counter() - start) * 1000
+    usage: Dict[str, Any] = {}
+    with use_model(model_path, batched=True) as model:
+        _, text = generate_completion(
+            model,
+            prompt,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            top_p=0.9,
+            cache=cache,
+            metrics=usage,
+        )
+    elapsed_ms = usage["generation_ms"]
+    model_info = get_model_info()
 
-    text = output["choices"][0]["text"].strip()
-    usage = output.get("usage", {})
+    text = text.strip()
     prompt_tokens = usage.get("prompt_tokens", 0)
     completion_tokens = usage.get("completion_tokens", 0)
     if prompt_tokens == 0 and completion_tokens == 0:
         prompt_tokens = max(1, len(prompt) // 4)
         completion_tokens = max(1, len(text) // 4)
 
+    phases = phase_metrics(usage)
     record_metrics(
         session_id=session_id or "file_analysis",
         prompt_tokens=prompt_tokens,
         completion_tokens=completion_tokens,
         response_time_ms=elapsed_ms,
         model_name=model_info["model_name"],
+        phases=phases,
+        endpoint="analyze_file",
     )
 
     metrics = {
@@ -305,15 +721,14 @@ def analyze_file(
         "completion_tokens": completion_tokens,
         "total_tokens": prompt_tokens + completion_tokens,
         "response_time_ms": round(elapsed_ms, 2),
+        "cached": usage.get("cached", False),
+        **phases,
     }
     return text, metrics
 
 
-def get_dashboard_data() -> Dict[str, Any]:
-    """Return aggregated metrics for the dashboard."""
-    data = _load_metrics()
-    sessions = data.get("sessions", [])
-    summary = data.get("summary", {})
+def _dashboard_summary() -> Dict[str, Any]:
+    summary = metrics_store.summary()
 
     total_requests = summary.get("total_requests", 0)
     avg_response_ms = (
@@ -323,13 +738,41 @@ def get_dashboard_data() -> Dict[str, Any]:
     )
 
     return {
-        "summary": {
-            "total_prompt_tokens": summary.get("total_prompt_tokens", 0),
-            "total_completion_tokens": summary.get("total_completion_tokens", 0),
-            "total_tokens": summary.get("total_tokens", 0),
-            "total_requests": total_requests,
-            "avg_response_time_ms": round(avg_response_ms, 2),
-            "total_response_time_ms": summary.get("total_response_time_ms", 0),
-        },
-        "recent_sessions": sessions[-50:][::-1],
+        "total_prompt_tokens": summary.get("total_prompt_tokens", 0),
+        "total_completion_tokens": summary.get("total_completion_tokens", 0),
+        "total_tokens": summary.get("total_tokens", 0),
+        "total_requests": total_requests,
+        "avg_response_time_ms": round(avg_response_ms, 2),
+        "total_response_time_ms": summary.get("total_response_time_ms", 0),
+        "avg_queue_wait_ms": round(summary["total_queue_wait_ms"] / total_requests, 2) if total_requests else 0,
+        "avg_prompt_eval_ms": round(summary["total_prompt_eval_ms"] / total_requests, 2) if total_requests else 0,
+        "avg_time_to_first_token_ms": (
+            round(summary["total_time_to_first_token_ms"] / total_requests, 2) if total_requests else 0
+        ),
+    }
+
+
+def get_dashboard_data() -> Dict[str, Any]:
+    """Return aggregated metrics for the dashboard."""
+    seq, recent = metrics_store.recent_since(None, DASHBOARD_RECENT_LIMIT)
+    return {
+        "seq": seq,
+        "summary": _dashboard_summary(),
+        "recent_sessions": recent,
+        "percentiles": metrics_store.percentile_report(),
+    }
+
+
+def get_dashboard_delta(since_seq: int) -> Dict[str, Any]:
+    """Return what changed on the dashboard since since_seq.
+
+    new_sessions holds the requests recorded after since_seq (newest first);
+    summary and percentiles are current values, which replace the old ones.
+    """
+    seq, new_sessions = metrics_store.recent_since(since_seq, DASHBOARD_RECENT_LIMIT)
+    return {
+        "seq": seq,
+        "summary": _dashboard_summary(),
+        "new_sessions": new_sessions,
+        "percentiles": metrics_store.percentile_report(),
     }